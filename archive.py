@@ -0,0 +1,752 @@
+#!/usr/bin/env python3
+"""
+Архив старой истории в колоночных файлах (Parquet)
+Месяцы старше ARCHIVE_AFTER_MONTHS полных месяцев выгружаются из metadata_change_events
+и field_changes в ARCHIVE_DIR и удаляются из PostgreSQL (DROP партиции месяца, строки из
+партиций по умолчанию - DELETE). Раскладка по месяцу и entity_type:
+
+    ARCHIVE_DIR/<таблица>/month=YYYY-MM/entity_type=<тип>/part-<пачка>.parquet
+    ARCHIVE_DIR/manifest.json
+
+Строки в файле отсортированы по entity_id (field_changes - по field_name), поэтому
+статистика row group'ов отсекает ненужные при поиске истории одной сущности.
+full_payload хранится с entity (из payload_blobs он восстанавливается) - архив
+не зависит от БД. Не переносятся txid, search_vector и fqn_path: /events/stream и /search
+видят только историю в БД, поддерево fqn_prefix в архиве ищется по самому entity_fqn.
+
+Выгрузка месяца - одна транзакция REPEATABLE READ: партиции месяца блокируются
+(SHARE) до снимка, поэтому выгружаются и удаляются ровно одни и те же строки.
+Пачка записывается в manifest.json как pending до удаления из БД и становится done
+после commit; pending-пачка при следующем запуске либо удаляется (строки остались
+в БД), либо подтверждается.
+
+/events, /events/export, /stats/fqn и восстановление сущностей (reconstruct.py) читают архив
+вместе с БД, если задан ARCHIVE_DIR.
+
+Примеры:
+    python archive.py list
+    python archive.py run --after-months 12
+    python archive.py run --month 2023-01
+"""
+
+import os
+import sys
+import json
+import uuid
+import heapq
+import logging
+import argparse
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from events_query import (EQUALITY_FILTERS, InvalidQuery, decode_cursor, parse_columns, parse_fqn_prefix,
+                          _parse_time)
+from fqn import subtree_regex
+from log_config import configure_logging
+from partitions import (PARTITION_LOCK_TIMEOUT, PARTITIONED_TABLES, _lock, add_months, list_partitions,
+                        month_start, partition_name)
+from payload_store import collect_garbage, load_entities, release_references
+
+logger = logging.getLogger(__name__)
+
+# Каталог архива ('' - архив выключен)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '')
+# Архивировать месяцы старше N полных месяцев помимо текущего (0 - только вручную)
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', 0))
+# Строк в row group Parquet
+ARCHIVE_ROW_GROUP_ROWS = int(os.getenv('ARCHIVE_ROW_GROUP_ROWS', 20000))
+# Сжатие файлов: zstd, snappy, gzip, none
+ARCHIVE_COMPRESSION = os.getenv('ARCHIVE_COMPRESSION', 'zstd')
+# Порция чтения строк из БД при выгрузке
+ARCHIVE_FETCH_SIZE = int(os.getenv('ARCHIVE_FETCH_SIZE', 5000))
+
+EVENTS_TABLE, FIELDS_TABLE = PARTITIONED_TABLES
+MANIFEST = 'manifest.json'
+NULL_PARTITION = '__null__'
+
+# Ключ advisory lock: архивом в каждый момент занимается один процесс
+_LOCK_KEY = 'om_history_archive'
+
+# Колонки архива: (имя, тип Arrow); версии - десятичная строка без потери точности
+EVENT_FIELDS = (
+    ('id', 'int64'), ('event_id', 'string'), ('event_type', 'string'), ('event_time', 'timestamp'),
+    ('entity_type', 'string'), ('entity_id', 'string'), ('entity_fqn', 'string'), ('entity_name', 'string'),
+    ('change_description', 'string'), ('updated_by', 'string'), ('previous_version', 'string'),
+    ('current_version', 'string'), ('full_payload', 'string'), ('created_at', 'timestamp'),
+)
+FIELD_CHANGE_FIELDS = (
+    ('id', 'int64'), ('event_id', 'string'), ('event_time', 'timestamp'), ('field_name', 'string'),
+    ('old_value', 'string'), ('new_value', 'string'), ('change_type', 'string'),
+    ('created_at', 'timestamp'), ('entity_type', 'string'),
+)
+
+_EXPORT_SQL = {
+    EVENTS_TABLE: f"""
+        SELECT id, event_id, event_type, event_time, entity_type, entity_id, entity_fqn, entity_name,
+               change_description, updated_by, previous_version::text, current_version::text,
+               full_payload::text, created_at, entity_hash
+        FROM {EVENTS_TABLE}
+        WHERE event_time >= %s AND event_time < %s
+        ORDER BY entity_type, entity_id, event_time, id
+    """,
+    # entity_type события - для раскладки по каталогам вместе с событиями
+    FIELDS_TABLE: f"""
+        SELECT f.id, f.event_id, f.event_time, f.field_name, f.old_value, f.new_value, f.change_type,
+               f.created_at, e.entity_type
+        FROM {FIELDS_TABLE} f
+        LEFT JOIN {EVENTS_TABLE} e ON e.event_id = f.event_id AND e.event_time = f.event_time
+        WHERE f.event_time >= %s AND f.event_time < %s
+        ORDER BY e.entity_type, f.field_name, f.event_time, f.id
+    """,
+}
+
+
+def _schema(fields):
+    import pyarrow as pa
+    types = {'int64': pa.int64(), 'string': pa.string(), 'timestamp': pa.timestamp('us')}
+    return pa.schema([(name, types[kind]) for name, kind in fields])
+
+
+def _fsync(path: str, directory: bool = False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _month_label(month: date) -> str:
+    return f"{month:%Y-%m}"
+
+
+def _parse_month(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+def _overlaps(month: date, first: Optional[datetime], last: Optional[datetime]) -> bool:
+    """Пересекается ли месяц с [first, last] (None - без границы)"""
+    return ((first is None or datetime.combine(add_months(month, 1), datetime.min.time()) > first)
+            and (last is None or datetime.combine(month, datetime.min.time()) <= last))
+
+
+class Manifest:
+    """manifest.json: пачки архива со статусом pending/done, файлами и диапазонами id"""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.path = os.path.join(archive_dir, MANIFEST)
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'version': 1, 'batches': []}
+
+    def save(self, manifest: Dict[str, Any]):
+        # Атомарная замена: читатели видят либо прежний, либо новый манифест
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        _fsync(self.archive_dir, directory=True)
+
+    def put(self, batch: Dict[str, Any]):
+        manifest = self.load()
+        manifest['batches'] = [b for b in manifest['batches'] if b['id'] != batch['id']] + [batch]
+        self.save(manifest)
+
+    def remove(self, batch_id: str):
+        manifest = self.load()
+        manifest['batches'] = [b for b in manifest['batches'] if b['id'] != batch_id]
+        self.save(manifest)
+
+
+class _TableExport:
+    """Выгрузка строк одной таблицы за месяц: файл на entity_type, row group по ARCHIVE_ROW_GROUP_ROWS"""
+
+    def __init__(self, archive_dir: str, table: str, month: date, batch_id: str, fields):
+        self.archive_dir = archive_dir
+        self.table = table
+        self.month = month
+        self.batch_id = batch_id
+        self.schema = _schema(fields)
+        self.type_index = [name for name, _ in fields].index('entity_type')
+        self.time_index = [name for name, _ in fields].index('event_time')
+        self.files = []
+        self.rows = 0
+        self.min_id = self.max_id = None
+        self.min_time = self.max_time = None
+        self._writer = None
+        self._entity_type = None
+        self._buffer = []
+        self._file_rows = 0
+
+    def _path(self, entity_type: Optional[str]) -> str:
+        return os.path.join(self.table, f"month={_month_label(self.month)}",
+                            f"entity_type={quote(entity_type or NULL_PARTITION, safe='')}",
+                            f"part-{self.batch_id}.parquet")
+
+    def add(self, rows: List[tuple]):
+        for row in rows:
+            entity_type = row[self.type_index]
+            if self._writer is None or entity_type != self._entity_type:
+                self._close_file()
+                self._open_file(entity_type)
+            self._buffer.append(row)
+            if len(self._buffer) >= ARCHIVE_ROW_GROUP_ROWS:
+                self._flush()
+            row_id, event_time = row[0], row[self.time_index]
+            self.min_id = row_id if self.min_id is None else min(self.min_id, row_id)
+            self.max_id = row_id if self.max_id is None else max(self.max_id, row_id)
+            self.min_time = event_time if self.min_time is None else min(self.min_time, event_time)
+            self.max_time = event_time if self.max_time is None else max(self.max_time, event_time)
+        self.rows += len(rows)
+
+    def _open_file(self, entity_type: Optional[str]):
+        import pyarrow.parquet as pq
+        relative = self._path(entity_type)
+        path = os.path.join(self.archive_dir, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._writer = pq.ParquetWriter(path, self.schema, compression=ARCHIVE_COMPRESSION)
+        self._entity_type = entity_type
+        self._file_rows = 0
+        self.files.append({'table': self.table, 'entity_type': entity_type, 'path': relative})
+
+    def _flush(self):
+        import pyarrow as pa
+        if not self._buffer:
+            return
+        columns = list(zip(*self._buffer))
+        table = pa.Table.from_arrays([pa.array(column, type=field.type)
+                                      for column, field in zip(columns, self.schema)], schema=self.schema)
+        self._writer.write_table(table, row_group_size=len(self._buffer))
+        self._file_rows += len(self._buffer)
+        self._buffer = []
+
+    def _close_file(self):
+        if self._writer is None:
+            return
+        self._flush()
+        self._writer.close()
+        path = os.path.join(self.archive_dir, self.files[-1]['path'])
+        _fsync(path)
+        self.files[-1].update(rows=self._file_rows, bytes=os.path.getsize(path))
+        self._writer = None
+
+    def close(self):
+        self._close_file()
+
+    def discard(self):
+        """Удаляет записанные файлы (выгрузка не удалась)"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for file in self.files:
+            try:
+                os.remove(os.path.join(self.archive_dir, file['path']))
+            except FileNotFoundError:
+                pass
+
+
+def _restore_entities(cursor, rows: List[tuple]) -> List[tuple]:
+    """Строки событий для архива: entity из payload_blobs возвращается в full_payload"""
+    stored = load_entities(cursor, [row[-1] for row in rows if row[-1] is not None])
+    restored = []
+    for row in rows:
+        entity_hash = row[-1]
+        row = row[:-1]
+        if entity_hash is not None and row[12] is not None:
+            payload = json.loads(row[12])
+            payload['entity'] = stored.get(bytes(entity_hash))
+            row = row[:12] + (json.dumps(payload, ensure_ascii=False, default=str),) + row[13:]
+        restored.append(row)
+    return restored
+
+
+def _export_table(conn, export: _TableExport, bounds: tuple):
+    cursor = conn.cursor(name=f'archive_{export.table}')
+    cursor.itersize = ARCHIVE_FETCH_SIZE
+    blobs_cursor = conn.cursor()
+    try:
+        cursor.execute(_EXPORT_SQL[export.table], bounds)
+        while True:
+            rows = cursor.fetchmany(ARCHIVE_FETCH_SIZE)
+            if not rows:
+                break
+            if export.table == EVENTS_TABLE:
+                rows = _restore_entities(blobs_cursor, rows)
+            export.add(rows)
+        export.close()
+    finally:
+        blobs_cursor.close()
+        cursor.close()
+
+
+def _delete_month(cursor, month: date, names: List[str]) -> Tuple[int, int]:
+    """
+    Удаляет строки месяца из БД: партиции месяца - DROP (если за PARTITION_LOCK_TIMEOUT
+    не удалось взять блокировку - DELETE), партиции по умолчанию - DELETE.
+    Возвращает число строк месяца в БД до удаления: (событий, изменений полей)
+    """
+    bounds = (month, add_months(month, 1))
+    cursor.execute(f"SELECT (SELECT count(*) FROM {EVENTS_TABLE} WHERE event_time >= %s AND event_time < %s), "
+                   f"(SELECT count(*) FROM {FIELDS_TABLE} WHERE event_time >= %s AND event_time < %s)",
+                   bounds + bounds)
+    counts = cursor.fetchone()
+
+    if names:
+        cursor.execute("SAVEPOINT archive_drop")
+        try:
+            cursor.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+            for name in names[::-1]:
+                if name == partition_name(EVENTS_TABLE, month):
+                    release_references(cursor, f"SELECT entity_hash FROM {name}")
+                cursor.execute(f"DROP TABLE {name}")
+            cursor.execute("RELEASE SAVEPOINT archive_drop")
+        except Exception as e:
+            # Партицию держит долгий запрос: строки удаляются DELETE, пустая партиция - при следующем запуске
+            cursor.execute("ROLLBACK TO SAVEPOINT archive_drop")
+            logger.warning("Партиции за %s не удалены (%s), строки удаляются DELETE", _month_label(month), e)
+        cursor.execute("RESET lock_timeout")
+
+    # После DROP остаются только строки партиций по умолчанию
+    cursor.execute(f"DELETE FROM {FIELDS_TABLE} WHERE event_time >= %s AND event_time < %s", bounds)
+    release_references(cursor, f"DELETE FROM {EVENTS_TABLE} WHERE event_time >= %s AND event_time < %s "
+                               f"RETURNING entity_hash", bounds)
+    return counts
+
+
+def _new_batch_id() -> str:
+    return f"{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+
+
+def archive_month(conn, month: date, archive_dir: str = ARCHIVE_DIR) -> Optional[Dict[str, Any]]:
+    """
+    Выгружает месяц в архив и удаляет его из БД. Возвращает пачку манифеста
+    или None, если за месяц в БД ничего нет
+    """
+    month = month_start(month)
+    bounds = (month, add_months(month, 1))
+    manifest = Manifest(archive_dir)
+    batch_id = _new_batch_id()
+    exports = [_TableExport(archive_dir, EVENTS_TABLE, month, batch_id, EVENT_FIELDS),
+               _TableExport(archive_dir, FIELDS_TABLE, month, batch_id, FIELD_CHANGE_FIELDS)]
+    batch = None
+
+    cursor = conn.cursor()
+    try:
+        names = [name for table in PARTITIONED_TABLES
+                 for partition_month, name in list_partitions(cursor, table).items() if partition_month == month]
+        conn.commit()
+
+        # Блокировки - до первого запроса транзакции, то есть до снимка: после него
+        # в партиции месяца никто не пишет, и DROP удаляет ровно выгруженные строки
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        if names:
+            cursor.execute(f"LOCK TABLE {', '.join(names)} IN SHARE MODE")
+        _lock(cursor)
+
+        for export in exports:
+            _export_table(conn, export, bounds)
+        events, fields = exports
+        if not events.rows and not fields.rows and not names:
+            conn.rollback()
+            return None
+
+        batch = {
+            'id': batch_id, 'month': _month_label(month), 'status': 'pending',
+            'created_at': datetime.utcnow().isoformat(),
+            'events': events.rows, 'field_changes': fields.rows,
+            'id_ranges': {export.table: [export.min_id, export.max_id] for export in exports if export.rows},
+            'min_time': events.min_time.isoformat() if events.min_time else None,
+            'max_time': events.max_time.isoformat() if events.max_time else None,
+            'files': events.files + fields.files,
+        }
+        manifest.put(batch)
+
+        in_db = _delete_month(cursor, month, names)
+        if tuple(in_db) != (events.rows, fields.rows):
+            raise RuntimeError(f"В БД строк месяца {tuple(in_db)}, выгружено {(events.rows, fields.rows)}")
+        collect_garbage(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for export in exports:
+            export.discard()
+        if batch is not None:
+            manifest.remove(batch_id)
+        raise
+    finally:
+        cursor.close()
+
+    batch['status'] = 'done'
+    manifest.put(batch)
+    logger.info("Месяц %s в архиве: событий %s, изменений полей %s, файлов %s", batch['month'],
+                batch['events'], batch['field_changes'], len(batch['files']))
+    return batch
+
+
+def recover_pending(conn, archive_dir: str = ARCHIVE_DIR) -> int:
+    """
+    Пачки, прерванные между записью файлов и commit: если строки остались в БД,
+    файлы удаляются, иначе пачка подтверждается. Возвращает число разобранных пачек
+    """
+    manifest = Manifest(archive_dir)
+    pending = [batch for batch in manifest.load()['batches'] if batch['status'] == 'pending']
+    cursor = conn.cursor()
+    try:
+        for batch in pending:
+            month = _parse_month(batch['month'])
+            in_db = False
+            for table, (min_id, max_id) in batch['id_ranges'].items():
+                cursor.execute(f"""
+                    SELECT EXISTS (SELECT 1 FROM {table}
+                                   WHERE event_time >= %s AND event_time < %s AND id BETWEEN %s AND %s)
+                """, (month, add_months(month, 1), min_id, max_id))
+                in_db = in_db or cursor.fetchone()[0]
+            conn.rollback()
+            if in_db:
+                for file in batch['files']:
+                    try:
+                        os.remove(os.path.join(archive_dir, file['path']))
+                    except FileNotFoundError:
+                        pass
+                manifest.remove(batch['id'])
+                logger.warning("Пачка архива %s (%s) отменена: строки остались в БД", batch['id'], batch['month'])
+            else:
+                batch['status'] = 'done'
+                manifest.put(batch)
+                logger.info("Пачка архива %s (%s) подтверждена", batch['id'], batch['month'])
+    finally:
+        cursor.close()
+    return len(pending)
+
+
+def pending_months(conn, after_months: int) -> List[date]:
+    """Месяцы старше after_months полных месяцев, за которые в БД есть строки или партиции"""
+    cutoff = add_months(month_start(date.today()), -after_months)
+    cursor = conn.cursor()
+    try:
+        months = {month for month in list_partitions(cursor, EVENTS_TABLE) if month < cutoff}
+        for table in PARTITIONED_TABLES:
+            cursor.execute(f"SELECT DISTINCT date_trunc('month', event_time)::date FROM {table}_default "
+                           f"WHERE event_time < %s", (cutoff,))
+            months.update(month for (month,) in cursor.fetchall())
+        conn.rollback()
+    finally:
+        cursor.close()
+    return sorted(months)
+
+
+def archive_months(conn, months: List[date], archive_dir: str = ARCHIVE_DIR) -> Optional[List[Dict[str, Any]]]:
+    """
+    Архивирует месяцы по порядку, предварительно разобрав незавершённые пачки.
+    Если архивом уже занят другой процесс, ничего не делает и возвращает None
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (_LOCK_KEY,))
+    locked = cursor.fetchone()[0]
+    conn.commit()
+    if not locked:
+        cursor.close()
+        return None
+    try:
+        recover_pending(conn, archive_dir)
+        return [batch for month in months if (batch := archive_month(conn, month, archive_dir)) is not None]
+    finally:
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+
+
+def archive_expired(conn, after_months: int = ARCHIVE_AFTER_MONTHS,
+                    archive_dir: str = ARCHIVE_DIR) -> List[Dict[str, Any]]:
+    """Архивирует все месяцы старше after_months полных месяцев"""
+    if after_months <= 0 or not archive_dir:
+        return []
+    return archive_months(conn, pending_months(conn, after_months), archive_dir) or []
+
+
+def _decode_event(row: Dict[str, Any]) -> Dict[str, Any]:
+    for column in ('previous_version', 'current_version'):
+        if row.get(column) is not None:
+            row[column] = Decimal(row[column])
+    if row.get('full_payload') is not None:
+        row['full_payload'] = json.loads(row['full_payload'])
+    return row
+
+
+class ArchiveReader:
+    """Чтение архива; манифест перечитывается при изменении файла"""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.manifest = Manifest(archive_dir)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._months = {}  # месяц -> {'files': [...], 'min_time', 'max_time', 'events', 'field_changes'}
+
+    def months(self) -> Dict[date, Dict[str, Any]]:
+        """Месяцы готовых (done) пачек"""
+        try:
+            mtime = os.stat(self.manifest.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                months = {}
+                for batch in self.manifest.load()['batches'] if mtime is not None else ():
+                    if batch['status'] != 'done':
+                        continue
+                    month = months.setdefault(_parse_month(batch['month']), {
+                        'files': [], 'min_time': None, 'max_time': None, 'events': 0, 'field_changes': 0})
+                    month['files'].extend(batch['files'])
+                    month['events'] += batch['events']
+                    month['field_changes'] += batch['field_changes']
+                    for key, pick in (('min_time', min), ('max_time', max)):
+                        if batch[key]:
+                            value = datetime.fromisoformat(batch[key])
+                            month[key] = value if month[key] is None else pick(month[key], value)
+                self._months, self._mtime = months, mtime
+            return self._months
+
+    def newest_time(self) -> Optional[datetime]:
+        """Время последнего события в архиве"""
+        times = [month['max_time'] for month in self.months().values() if month['max_time']]
+        return max(times) if times else None
+
+    def _paths(self, month: date, table: str, entity_type: Optional[str] = None) -> List[str]:
+        return [os.path.join(self.archive_dir, file['path']) for file in self.months()[month]['files']
+                if file['table'] == table and (entity_type is None or file['entity_type'] == entity_type)]
+
+    def scan(self, table: str, columns: Optional[List[str]] = None, filter=None,
+             months: Optional[List[date]] = None, entity_type: Optional[str] = None):
+        """Строки таблицы из архива как pyarrow.Table (фильтр - выражение pyarrow.dataset)"""
+        import pyarrow.dataset as ds
+        fields = EVENT_FIELDS if table == EVENTS_TABLE else FIELD_CHANGE_FIELDS
+        paths = [path for month in (months if months is not None else sorted(self.months()))
+                 if month in self.months() for path in self._paths(month, table, entity_type)]
+        return ds.dataset(paths, format='parquet', schema=_schema(fields)).to_table(columns=columns, filter=filter)
+
+    def iter_events(self, args, limit: Optional[int] = None,
+                    boundary: Optional[Tuple[datetime, int]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        События из архива по параметрам /events в порядке (event_time, id) запроса.
+        limit - сколько строк понадобится (из месяца читается не больше), boundary -
+        позиция, дальше которой строки не нужны (последняя строка выборки из БД)
+        """
+        import pyarrow.dataset as ds
+        columns = [c for c in parse_columns(args.get('fields'), args.get('include_payload') in ('1', 'true', 'yes'))
+                   if c != 'entity_hash']
+        order = (args.get('order') or 'desc').lower()
+        if order not in ('asc', 'desc'):
+            raise InvalidQuery("order: ожидается asc или desc")
+        descending = order == 'desc'
+
+        conditions = [ds.field(column) == args.get(name) for name, column in EQUALITY_FILTERS.items()
+                      if args.get(name)]
+        fqn_path = parse_fqn_prefix(args.get('fqn_prefix'))
+        if fqn_path:
+            # Колонки fqn_path в архиве нет: поддерево - по регулярному выражению от FQN
+            import pyarrow.compute as pc
+            conditions.append(pc.match_substring_regex(ds.field('entity_fqn'), pattern=subtree_regex(fqn_path)))
+        first = last = None
+        if args.get('since'):
+            since = _parse_time('since', args['since'])
+            conditions.append(ds.field('event_time') >= since)
+            first = since
+        if args.get('until'):
+            until = _parse_time('until', args['until'])
+            conditions.append(ds.field('event_time') < until)
+            last = until
+        positions = []
+        if args.get('cursor'):
+            positions.append((decode_cursor(args['cursor']), descending))
+        if boundary is not None:
+            positions.append((boundary, not descending))
+        for (event_time, row_id), before in positions:
+            compare = '__lt__' if before else '__gt__'
+            conditions.append(getattr(ds.field('event_time'), compare)(event_time)
+                              | ((ds.field('event_time') == event_time) & getattr(ds.field('id'), compare)(row_id)))
+            if before:
+                last = event_time if last is None else min(last, event_time)
+            else:
+                first = event_time if first is None else max(first, event_time)
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        months = sorted((month for month in self.months() if _overlaps(month, first, last)), reverse=descending)
+        sort_keys = [('event_time', 'descending' if descending else 'ascending'),
+                     ('id', 'descending' if descending else 'ascending')]
+        for month in months:
+            paths = self._paths(month, EVENTS_TABLE, args.get('entity_type') or None)
+            if not paths:
+                continue
+            dataset = ds.dataset(paths, format='parquet', schema=_schema(EVENT_FIELDS))
+            if limit is not None:
+                # Сначала ключи: остальные колонки читаются только для нужных limit строк
+                keys = dataset.to_table(columns=['event_time', 'id'], filter=expression)
+                if keys.num_rows == 0:
+                    continue
+                if keys.num_rows > limit:
+                    import pyarrow.compute as pc
+                    top = keys.take(pc.select_k_unstable(keys, k=limit, sort_keys=sort_keys))
+                    selected = ds.field('id').isin(top['id'])
+                    table = dataset.to_table(columns=columns, filter=selected if expression is None
+                                             else expression & selected)
+                else:
+                    table = dataset.to_table(columns=columns, filter=expression)
+            else:
+                table = dataset.to_table(columns=columns, filter=expression)
+            for row in table.sort_by(sort_keys).to_pylist():
+                yield _decode_event(row)
+
+    def merge_events(self, rows: List[Dict[str, Any]], args, limit: int) -> List[Dict[str, Any]]:
+        """
+        Первые limit событий из выборки /events в БД (rows, уже в порядке запроса)
+        вместе с архивом
+        """
+        if not self.months():
+            return rows
+        descending = (args.get('order') or 'desc').lower() == 'desc'
+        boundary = (rows[-1]['event_time'], rows[-1]['id']) if len(rows) >= limit else None
+        archived = self.iter_events(args, limit, boundary)
+        merged = heapq.merge(rows, archived, key=lambda row: (row['event_time'], row['id']), reverse=descending)
+        result = []
+        for row in merged:
+            result.append(row)
+            if len(result) >= limit:
+                break
+        return result
+
+    def entity_events(self, entity_id: str, after: Optional[datetime] = None,
+                      upto: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """События сущности в архиве за (after, upto] по (event_time, event_id)"""
+        import pyarrow.dataset as ds
+        expression = ds.field('entity_id') == entity_id
+        if after is not None:
+            expression = expression & (ds.field('event_time') >= after)
+        if upto is not None:
+            expression = expression & (ds.field('event_time') <= upto)
+        months = [month for month in sorted(self.months()) if _overlaps(month, after, upto)]
+        if not months:
+            return []
+        table = self.scan(EVENTS_TABLE, ['event_time', 'event_id', 'event_type', 'current_version', 'full_payload'],
+                          expression, months)
+        rows = [_decode_event(row) for row in table.to_pylist()]
+        rows.sort(key=lambda row: (row['event_time'], row['event_id']))
+        return rows
+
+    def find_target(self, entity_id: str, at: Optional[datetime] = None,
+                    version: Optional[Decimal] = None) -> Optional[tuple]:
+        """Последнее событие сущности в архиве не позже at / с версией version: (event_id, event_time, version)"""
+        import pyarrow.dataset as ds
+        expression = ds.field('entity_id') == entity_id
+        if at is not None:
+            expression = expression & (ds.field('event_time') <= at)
+        months = [month for month in sorted(self.months()) if _overlaps(month, None, at)]
+        if not months:
+            return None
+        table = self.scan(EVENTS_TABLE, ['event_id', 'event_time', 'current_version'], expression, months)
+        best = None
+        for row in table.to_pylist():
+            row_version = Decimal(row['current_version']) if row['current_version'] is not None else None
+            if version is not None and row_version != version:
+                continue
+            if best is None or (row['event_time'], row['event_id']) > (best[1], best[0]):
+                best = (row['event_id'], row['event_time'], row_version)
+        return best
+
+    def fqn_counts(self, fqn_path: Optional[List[str]], since: Optional[datetime] = None,
+                   until: Optional[datetime] = None,
+                   filters: Optional[Dict[str, str]] = None) -> Dict[Optional[str], int]:
+        """
+        Число событий архива по entity_fqn в поддереве fqn_path (None - все) за [since, until);
+        filters - равенства по колонкам событий
+        """
+        import pyarrow.dataset as ds
+        import pyarrow.compute as pc
+        conditions = [ds.field(column) == value for column, value in (filters or {}).items()]
+        if fqn_path:
+            conditions.append(pc.match_substring_regex(ds.field('entity_fqn'), pattern=subtree_regex(fqn_path)))
+        if since is not None:
+            conditions.append(ds.field('event_time') >= since)
+        if until is not None:
+            conditions.append(ds.field('event_time') < until)
+        months = [month for month in sorted(self.months()) if _overlaps(month, since, until)]
+        if not months:
+            return {}
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        table = self.scan(EVENTS_TABLE, ['entity_fqn'], expression, months,
+                          (filters or {}).get('entity_type'))
+        counts = pc.value_counts(table['entity_fqn']).to_pylist()
+        return {item['values']: item['counts'] for item in counts}
+
+    def stats(self) -> Dict[str, Any]:
+        months = self.months()
+        return {
+            'archive_dir': self.archive_dir,
+            'months': len(months),
+            'first_month': _month_label(min(months)) if months else None,
+            'last_month': _month_label(max(months)) if months else None,
+            'events': sum(month['events'] for month in months.values()),
+            'field_changes': sum(month['field_changes'] for month in months.values()),
+            'bytes': sum(file.get('bytes', 0) for month in months.values() for file in month['files']),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help='Каталог архива (ARCHIVE_DIR)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='Показать месяцы в архиве')
+    run = sub.add_parser('run', help='Архивировать старые месяцы')
+    run.add_argument('--after-months', type=int, default=ARCHIVE_AFTER_MONTHS,
+                     help='Архивировать месяцы старше N полных месяцев помимо текущего')
+    run.add_argument('--month', type=_parse_month, default=None, help='Только этот месяц (YYYY-MM)')
+    args = parser.parse_args()
+    if not args.archive_dir:
+        parser.error("не задан каталог архива: ARCHIVE_DIR или --archive-dir")
+
+    configure_logging()
+    if args.command == 'list':
+        reader = ArchiveReader(args.archive_dir)
+        for month, info in sorted(reader.months().items()):
+            size = sum(file.get('bytes', 0) for file in info['files'])
+            print(f"{_month_label(month)}  событий {info['events']:>10}  изменений полей {info['field_changes']:>10}"
+                  f"  файлов {len(info['files']):>4}  {size / 1024 / 1024:>9.1f} МБ")
+        pending = [batch['id'] for batch in reader.manifest.load()['batches'] if batch['status'] != 'done']
+        if pending:
+            print(f"Незавершённые пачки: {', '.join(pending)}")
+        return 0
+
+    from db_pool import db_connection
+    with db_connection() as conn:
+        if args.month:
+            batches = archive_months(conn, [args.month], args.archive_dir)
+        else:
+            if args.after_months <= 0:
+                parser.error("укажите --after-months или ARCHIVE_AFTER_MONTHS")
+            batches = archive_months(conn, pending_months(conn, args.after_months), args.archive_dir)
+    if batches is None:
+        print("Архивом занят другой процесс")
+        return 1
+    for batch in batches:
+        print(f"{batch['month']}: событий {batch['events']}, изменений полей {batch['field_changes']}")
+    print(f"Архивировано месяцев: {len(batches)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+"""
+Асинхронный (ASGI) вариант webhook listener'а: те же маршруты, что у Flask-приложения
+(/webhook, /webhook/batch, /events, /events/export, /events/stream, /events/poll, /search,
+/stats, /stats/fqn, /gaps, /entities, /health, /metrics)
+Запросы обслуживает event loop, поэтому один процесс держит сотни одновременных /webhook.
+События одновременных запросов собираются в общие транзакции (group commit):
+пока пишется одна пачка, следующие события копятся и уходят следующей пачкой.
+Ответ 200 отдаётся после commit пачки, как и в синхронном режиме.
+
+Запись идёт через тот же write_events, что и во Flask-приложении (состояние сущностей,
+снимки, payload_blobs, агрегаты), в ASYNC_WRITERS потоках с подключениями из пула
+db_pool; чтение (/events, /search, /stats, /entities, /health...) - в отдельных потоках тем же кодом,
+что и во Flask-приложении, event loop не блокируется.
+Подписчики /events/stream и /events/poll ждут новых событий в event loop'е, не занимая потоков,
+поэтому держать много подписчиков удобнее здесь, чем в синхронных воркерах gunicorn.
+
+Запуск:
+    python asgi_app.py
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 2 --timeout-graceful-shutdown 10
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Iterator, List, Optional
+
+from quart import Quart, Response, request, jsonify
+
+import metrics
+import webhook_listener as listener
+from db_pool import TRANSIENT_ERRORS
+from events_query import InvalidQuery
+from change_stream import (
+    STREAM_POLL_INTERVAL, STREAM_MAX_SECONDS, STREAM_HEARTBEAT_SEC, STREAM_FETCH_SIZE,
+    parse_stream_args, sse_message, sse_position, poll_timeout
+)
+from ingest_queue import QueueFull, QueueClosed
+from entity_order import INGEST_ENTITY_ORDER, entity_id_of
+from spool import SPOOL_DIR
+from reconstruct import EntityNotFound
+
+logger = logging.getLogger(__name__)
+
+# Событий в одной транзакции
+ASYNC_BATCH_SIZE = int(os.getenv('ASYNC_BATCH_SIZE', 500))
+# Одновременных пишущих транзакций (потоков записи)
+ASYNC_WRITERS = max(int(os.getenv('ASYNC_WRITERS', 4)), 1)
+# Потоков для чтения (/events, /health)
+ASYNC_READERS = max(int(os.getenv('ASYNC_READERS', 4)), 1)
+# Событий, ждущих записи; сверх этого /webhook отвечает 429
+ASYNC_MAX_PENDING = int(os.getenv('ASYNC_MAX_PENDING', 10000))
+# Сколько ждать открытых подключений при остановке, сек: подписчики /events/stream
+# сами не отключаются, и без ограничения остановка ждала бы STREAM_MAX_SECONDS
+ASYNC_SHUTDOWN_TIMEOUT = int(os.getenv('ASYNC_SHUTDOWN_TIMEOUT', 10))
+
+app = Quart(__name__)
+
+
+class GroupCommitter:
+    """
+    Собирает события одновременных запросов в общие транзакции.
+    Свободный поток записи сразу забирает всё, что накопилось (не больше batch_size):
+    при малой нагрузке пачка из одного события уходит без задержки, при большой
+    пачки растут сами, пока предыдущие пишутся.
+
+    С entity_order событие сущности, которая есть в пишущейся пачке, ждёт её commit
+    (вместе со следующими событиями той же сущности), а события других сущностей уходят
+    в пачки без задержки: события сущности записываются в порядке поступления
+    """
+
+    def __init__(self, write_batch: Callable[[List[Dict[str, Any]]], None],
+                 write_one: Callable[[Dict[str, Any]], bool],
+                 batch_size: int = 500, writers: int = 4, max_pending: int = 10000,
+                 entity_order: bool = False):
+        self.write_batch = write_batch
+        self.write_one = write_one
+        self.batch_size = batch_size
+        self.writers = writers
+        self.max_pending = max_pending
+        self.entity_order = entity_order
+
+        self._executor = ThreadPoolExecutor(writers, thread_name_prefix='group-commit')
+        self._pending = []  # (event_data, future, entity_id)
+        # Сущности пишущихся пачек (entity_order): {entity_id: число пачек}
+        self._busy = {}
+        self._wakeup = None
+        self._slots = None
+        self._task = None
+        self._in_flight = set()
+        self._closed = False
+
+        # Метрики
+        self._batches = 0
+        self._written = 0
+        self._failed = 0
+        self._rejected = 0
+        self._max_batch = 0
+        self._last_batch_size = 0
+        self._last_batch_ms = 0.0
+
+    def start(self):
+        """Запускает диспетчер пачек в текущем event loop'е"""
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.writers)
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, event_data: Dict[str, Any]) -> bool:
+        """Ставит событие в ближайшую пачку и ждёт её commit; False - событие не сохранено"""
+        if self._closed:
+            raise QueueClosed("Приём событий остановлен")
+        if len(self._pending) >= self.max_pending:
+            self._rejected += 1
+            raise QueueFull(f"Ждут записи {len(self._pending)} событий")
+        future = asyncio.get_running_loop().create_future()
+        entity_id = entity_id_of(event_data) if self.entity_order else None
+        self._pending.append((event_data, future, entity_id))
+        self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        while not (self._closed and not self._pending):
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                await self._slots.acquire()
+                batch = self._take_batch()
+                if not batch:
+                    # Все ждущие события - сущностей пишущихся пачек: _commit разбудит после commit
+                    self._slots.release()
+                    break
+                task = asyncio.create_task(self._commit(batch))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+
+    def _take_batch(self) -> list:
+        """Следующая пачка из ждущих событий (не больше batch_size)"""
+        if not self.entity_order:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            return batch
+
+        batch, rest = [], []
+        for item in self._pending:
+            if len(batch) < self.batch_size and item[2] not in self._busy:
+                batch.append(item)
+            else:
+                # Следующие события той же сущности тоже остаются: порядок не нарушается
+                rest.append(item)
+        self._pending = rest
+        for entity_id in {item[2] for item in batch if item[2] is not None}:
+            self._busy[entity_id] = self._busy.get(entity_id, 0) + 1
+        return batch
+
+    def _release(self, batch: list):
+        for entity_id in {item[2] for item in batch if item[2] is not None}:
+            if self._busy[entity_id] > 1:
+                self._busy[entity_id] -= 1
+            else:
+                del self._busy[entity_id]
+        if self._pending:
+            self._wakeup.set()
+
+    async def _commit(self, batch: list):
+        started = time.monotonic()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write, [event_data for event_data, _, _ in batch])
+        except Exception as e:
+            logger.exception("Ошибка записи пачки из %s событий: %s", len(batch), e)
+            results = [False] * len(batch)
+        finally:
+            self._slots.release()
+            if self.entity_order:
+                self._release(batch)
+
+        written = sum(results)
+        self._batches += 1
+        self._written += written
+        self._failed += len(batch) - written
+        self._max_batch = max(self._max_batch, len(batch))
+        self._last_batch_size = len(batch)
+        self._last_batch_ms = round((time.monotonic() - started) * 1000, 3)
+        for (_, future, _), ok in zip(batch, results):
+            if not future.done():
+                future.set_result(ok)
+
+    def _write(self, events: List[Dict[str, Any]]) -> List[bool]:
+        """Пишет пачку (в потоке записи); при ошибке - по одному, как синхронный /webhook"""
+        if len(events) == 1:
+            return [self.write_one(events[0])]
+        try:
+            self.write_batch(events)
+            listener.events_logger.info("✓ Пачка из %s событий сохранена", len(events))
+            return [True] * len(events)
+        except TRANSIENT_ERRORS as e:
+            if SPOOL_DIR:
+                try:
+                    listener._spill_to_spool(events)
+                    logger.warning("БД недоступна (%s), пачка из %s событий записана в spool", e, len(events))
+                    return [True] * len(events)
+                except Exception as spool_error:
+                    logger.error("Не удалось записать пачку в spool: %s", spool_error)
+            logger.error("✗ Ошибка сохранения пачки из %s событий: %s", len(events), e)
+            return [False] * len(events)
+        except Exception as e:
+            # Пачку испортило конкретное событие - остальные не должны получить 500
+            logger.error("Ошибка записи пачки из %s событий: %s; пишем по одному", len(events), e)
+            return [self.write_one(event_data) for event_data in events]
+
+    async def run(self, func: Callable, *args):
+        """Выполняет func в потоке записи: своя транзакция наравне с пачками (/webhook/batch)"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def stop(self):
+        """Перестаёт принимать события и дописывает накопленные"""
+        self._closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight)
+        self._executor.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self._pending),
+            'in_flight': len(self._in_flight),
+            'writers': self.writers,
+            'batches': self._batches,
+            'written': self._written,
+            'failed': self._failed,
+            'rejected': self._rejected,
+            'max_batch_size': self._max_batch,
+            'entity_order': self.entity_order,
+            # Ждут commit пачки со своей сущностью
+            'held_back': sum(1 for item in self._pending if item[2] in self._busy),
+            'last_batch_size': self._last_batch_size,
+            'last_batch_ms': self._last_batch_ms,
+        }
+
+
+committer = GroupCommitter(
+    listener.save_change_events, listener.save_change_event,
+    batch_size=ASYNC_BATCH_SIZE, writers=ASYNC_WRITERS, max_pending=ASYNC_MAX_PENDING,
+    entity_order=INGEST_ENTITY_ORDER
+)
+_readers = ThreadPoolExecutor(ASYNC_READERS, thread_name_prefix='reader')
+
+
+async def _in_reader(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_readers, func, *args)
+
+
+def _next_lines(lines: Iterator[str]) -> List[str]:
+    return list(itertools.islice(lines, listener.EXPORT_FETCH_SIZE))
+
+
+@app.before_serving
+async def _startup():
+    # Единственное место инициализации БД: под uvicorn --workers main() не выполняется,
+    # схема проверяется в каждом воркере (актуальная - один запрос, миграции выполняет один воркер).
+    # БД недоступна: со SPOOL_DIR воркер стартует и пишет в spool, без него - не стартует
+    try:
+        await _in_reader(listener.init_database)
+    except TRANSIENT_ERRORS as e:
+        if not SPOOL_DIR:
+            raise
+        logger.warning("БД недоступна при запуске (%s): события пишутся в spool", e)
+    listener.get_schema_migrator()
+    committer.start()
+    if SPOOL_DIR:
+        # Перенос spool, оставшегося с прошлого запуска
+        listener.get_spool()
+    if listener.PARTITION_MAINTENANCE_INTERVAL > 0:
+        listener.get_partition_maintainer()
+    if listener.VERSION_GAP_SCAN_INTERVAL > 0:
+        listener.get_gap_detector()
+
+
+@app.after_serving
+async def _shutdown():
+    await committer.stop()
+    _readers.shutdown()
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Проверка работоспособности сервиса"""
+    body, status = await _in_reader(listener.health_status)
+    body['group_commit'] = committer.stats()
+    return jsonify(body), status
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.route('/webhook', methods=['POST'])
+async def webhook_receiver():
+    """Приём webhook'а OpenMetadata: ответ после commit пачки, в которую попало событие"""
+    started = time.perf_counter()
+    event_type = None
+    try:
+        response, event_type = await _receive_webhook()
+    except Exception as e:
+        logger.error(f"Ошибка обработки webhook: {e}")
+        response = jsonify({'error': str(e)}), 500
+    response = await app.make_response(response)
+    metrics.count_request(response.status_code, event_type)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
+    return response
+
+
+async def _receive_webhook():
+    with metrics.stage('auth'):
+        auth_header = request.headers.get('Authorization')
+        authorized = not listener.WEBHOOK_SECRET or auth_header == f"Bearer {listener.WEBHOOK_SECRET}"
+    if not authorized:
+        logger.warning("Неверный секретный ключ webhook")
+        return (jsonify({'error': 'Unauthorized'}), 401), None
+
+    if request.content_length is not None:
+        metrics.PAYLOAD_BYTES.observe(request.content_length)
+    with metrics.stage('json_parse'):
+        event_data = await request.get_json()
+    if not event_data:
+        return (jsonify({'error': 'Empty payload'}), 400), None
+
+    with metrics.stage('validate'):
+        error = listener.validate_event(event_data)
+    if error:
+        return (jsonify({'error': error}), 400), None
+    event_type = event_data.get('eventType')
+
+    listener.events_logger.info("Получено событие: %s для %s", event_type, event_data.get('entityType'))
+
+    if listener.known_duplicate(event_data):
+        # Повторная доставка уже записанного события - без очереди group commit и БД
+        return (jsonify({
+            'status': 'success',
+            'message': 'Duplicate event, already saved'
+        }), 200), event_type
+
+    try:
+        success = await committer.submit(event_data)
+    except QueueFull:
+        return (jsonify({
+            'status': 'error',
+            'message': 'Too many events in flight, retry later'
+        }), 429, {'Retry-After': '1'}), event_type
+    except QueueClosed:
+        return (jsonify({
+            'status': 'error',
+            'message': 'Service is shutting down'
+        }), 503, {'Retry-After': '5'}), event_type
+
+    if success:
+        return (jsonify({
+            'status': 'success',
+            'message': 'Event processed and saved'
+        }), 200), event_type
+    return (jsonify({
+        'status': 'error',
+        'message': 'Failed to save event'
+    }), 500), event_type
+
+
+@app.route('/webhook/batch', methods=['POST'])
+async def webhook_batch_receiver():
+    """Пачка событий в одном запросе - как /webhook/batch Flask-приложения, запись в потоке записи"""
+    started = time.perf_counter()
+    try:
+        with metrics.stage('auth'):
+            auth_header = request.headers.get('Authorization')
+            authorized = not listener.WEBHOOK_SECRET or auth_header == f"Bearer {listener.WEBHOOK_SECRET}"
+        if not authorized:
+            logger.warning("Неверный секретный ключ webhook")
+            response = jsonify({'error': 'Unauthorized'}), 401
+        else:
+            body, status = await committer.run(listener.receive_batch, await request.get_data())
+            response = jsonify(body), status
+    except Exception as e:
+        logger.error(f"Ошибка обработки пачки событий: {e}")
+        response = jsonify({'error': str(e)}), 500
+    response = await app.make_response(response)
+    metrics.BATCH_REQUESTS.labels(str(response.status_code)).inc()
+    metrics.BATCH_REQUEST_SECONDS.observe(time.perf_counter() - started)
+    return response
+
+
+@app.route('/events', methods=['GET'])
+async def get_events():
+    """Сохранённые события постранично - как /events Flask-приложения"""
+    try:
+        return jsonify(await _in_reader(listener.fetch_events_page, request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения событий: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/events/export', methods=['GET'])
+async def export_events():
+    """Выгрузка событий в NDJSON - как /events/export Flask-приложения, порциями в потоке чтения"""
+    try:
+        lines = listener.export_lines(request.args)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+
+    async def generate():
+        try:
+            while True:
+                chunk = await _in_reader(_next_lines, lines)
+                if not chunk:
+                    break
+                yield ''.join(chunk)
+        finally:
+            # Прерванная выгрузка возвращает подключение в пул
+            await _in_reader(lines.close)
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.timeout = None
+    return response
+
+
+@app.route('/events/stream', methods=['GET'])
+async def stream_events():
+    """Новые события в формате Server-Sent Events - как /events/stream Flask-приложения"""
+    try:
+        subscription = parse_stream_args(request.args, request.headers.get('Last-Event-ID'))
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    feed = listener.get_change_feed()
+
+    async def generate():
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        last_output = 0.0
+        delivered = 0
+        feed.attach()
+        try:
+            while True:
+                version = feed.version
+                events, position = await _in_reader(listener.fetch_stream_changes, subscription)
+                for event in events:
+                    yield sse_message(event, app.json.dumps)
+                delivered += len(events)
+                now = time.monotonic()
+                if events:
+                    last_output = now
+                if len(events) == STREAM_FETCH_SIZE:
+                    continue
+                if now - last_output >= STREAM_HEARTBEAT_SEC:
+                    yield sse_position(position)
+                    last_output = now
+                if now >= deadline:
+                    break
+                await feed.wait_async(
+                    version, min(STREAM_POLL_INTERVAL, STREAM_HEARTBEAT_SEC - (now - last_output)))
+        except asyncio.CancelledError:
+            logger.info("Подписчик /events/stream отключился после %s событий", delivered)
+            raise
+        except Exception as e:
+            logger.error("Ошибка потока событий после %s событий: %s", delivered, e)
+        finally:
+            feed.detach()
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Поток ограничен STREAM_MAX_SECONDS, а не RESPONSE_TIMEOUT Quart
+    response.timeout = None
+    return response
+
+
+@app.route('/events/poll', methods=['GET'])
+async def poll_events():
+    """Long-poll новых событий - как /events/poll Flask-приложения"""
+    try:
+        subscription = parse_stream_args(request.args)
+        timeout = poll_timeout(request.args.get('timeout'))
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    feed = listener.get_change_feed()
+    feed.attach()
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            version = feed.version
+            events, position = await _in_reader(listener.fetch_stream_changes, subscription)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                break
+            await feed.wait_async(version, min(remaining, STREAM_POLL_INTERVAL))
+        return jsonify({'count': len(events), 'events': events, 'cursor': position}), 200
+    except Exception as e:
+        logger.error("Ошибка ожидания событий: %s", e)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        feed.detach()
+
+
+@app.route('/search', methods=['GET'])
+async def search_history():
+    """Поиск по истории изменений - как /search Flask-приложения"""
+    try:
+        return jsonify(await _in_reader(listener.fetch_search_page, request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка поиска: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/stats', methods=['GET'])
+async def get_stats():
+    """Статистика из агрегатов - как /stats Flask-приложения"""
+    try:
+        return jsonify(await _in_reader(listener.fetch_stats, request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения статистики: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/stats/fqn', methods=['GET'])
+async def get_fqn_stats():
+    """Число событий по поддеревьям FQN - как /stats/fqn Flask-приложения"""
+    try:
+        return jsonify(await _in_reader(listener.fetch_fqn_stats, request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения статистики по FQN: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/gaps', methods=['GET'])
+async def get_gaps():
+    """Пропуски в цепочках версий - как /gaps Flask-приложения"""
+    try:
+        return jsonify(await _in_reader(listener.fetch_gaps, request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения пропусков версий: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/entities/<path:entity_id>', methods=['GET'])
+@app.route('/entities', methods=['GET'])
+async def get_entity(entity_id: Optional[str] = None):
+    """Состояние сущности (или восстановленное на момент/версию) - как /entities Flask-приложения"""
+    try:
+        state = await _in_reader(listener.fetch_entity, entity_id, request.args)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except EntityNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        logger.error("Ошибка получения состояния сущности: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+    if state is None:
+        return jsonify({'error': 'Entity not found'}), 404
+    return jsonify(state), 200
+
+
+def main():
+    import uvicorn
+
+    # БД инициализируется в _startup - так же, как под uvicorn asgi_app:app
+    port = int(os.getenv('PORT', 5000))
+    uvicorn.run(app, host='0.0.0.0', port=port, log_config=None,
+                timeout_graceful_shutdown=ASYNC_SHUTDOWN_TIMEOUT)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
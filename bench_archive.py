@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк архива (archive.py): загружает синтетическую историю в отдельные старые месяцы
+(по умолчанию 2010-01 ... 2010-03, чтобы не задеть настоящие данные), замеряет запросы
+по строкам в PostgreSQL, переносит месяцы в архив Parquet и повторяет те же запросы
+по архиву. Выводит скорость архивирования, размер в БД и в архиве, задержку запросов
+и сверяет результаты (число строк, восстановление сущности) до и после переноса.
+
+Пример:
+    python bench_archive.py --events 300000 --entities 5000
+    python bench_archive.py --archive-dir /tmp/om_archive --keep   # архив остаётся для archive.py list
+"""
+
+import sys
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import pyarrow.dataset as ds
+
+import archive
+from bulk_import import ChunkLoader
+from db_pool import db_connection
+from event_parser import parse_event
+from events_query import build_events_query
+from partitions import PARTITIONED_TABLES, _lock, add_months, ensure_partition, partition_name
+from reconstruct import Reconstructor
+
+ENTITY_TYPES = (('table', 0.6), ('dashboard', 0.2), ('pipeline', 0.1), ('topic', 0.1))
+COLUMNS = tuple(f"col_{i}" for i in range(12))
+
+
+def _entity_type(entity_number: int) -> str:
+    point = (entity_number * 7919 % 1000) / 1000
+    for entity_type, share in ENTITY_TYPES:
+        if point < share:
+            return entity_type
+        point -= share
+    return ENTITY_TYPES[0][0]
+
+
+def make_event(run_id: str, number: int, entities: int, start: datetime, step: float) -> dict:
+    """Событие number: сущность number % entities, её версия number // entities"""
+    entity_number, version = number % entities, number // entities
+    entity_id = f"archivebench-{run_id}-{entity_number}"
+    entity_type = _entity_type(entity_number)
+    description = f"Описание {entity_number} версии {version}"
+    tags = [{"tagFQN": f"Bench.tag_{i}"} for i in range(version // 10)]
+    entity = {
+        "id": entity_id, "name": f"{entity_type}_{entity_number}",
+        "fullyQualifiedName": f"svc_{entity_number % 7}.db_{entity_number % 31}.{entity_type}_{entity_number}",
+        "version": round(0.1 * (version + 1), 1), "description": description, "tags": tags,
+        "columns": [{"name": column, "dataType": "VARCHAR", "description": f"Колонка {column}"}
+                    for column in COLUMNS],
+    }
+    changes = {'fieldsAdded': [], 'fieldsUpdated': [], 'fieldsDeleted': []}
+    if version:
+        changes['fieldsUpdated'].append({'name': 'description', 'oldValue': f"Описание {entity_number} версии "
+                                                                           f"{version - 1}", 'newValue': description})
+        if version % 10 == 0:
+            changes['fieldsAdded'].append({'name': 'tags', 'newValue': [{"tagFQN": f"Bench.tag_{version // 10 - 1}"}]})
+    event_time = start + timedelta(seconds=version * step + entity_number % 3600)
+    return {
+        "id": f"archivebench-{run_id}-{number}",
+        "eventType": "entityUpdated" if version else "entityCreated",
+        "timestamp": int(event_time.timestamp() * 1000),
+        "entityType": entity_type,
+        "entityId": entity_id,
+        "entity": entity,
+        "userName": f"user{number % 50}@example.com",
+        "previousVersion": round(0.1 * version, 1) if version else None,
+        "currentVersion": round(0.1 * (version + 1), 1),
+        "changeDescription": changes if version else None,
+    }
+
+
+def load_part(args) -> int:
+    run_id, first, count, entities, start, step, chunk_size = args
+    with db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+        for number in range(first, first + count):
+            loader.add(parse_event(make_event(run_id, number, entities, start, step)))
+            if loader.full():
+                loader.flush()
+        loader.flush()
+        loader.cursor.close()
+    return loader.totals['inserted']
+
+
+def load(run_id: str, events: int, entities: int, months: list, workers: int, chunk_size: int):
+    start = datetime.combine(months[0], datetime.min.time())
+    span = (datetime.combine(add_months(months[-1], 1), datetime.min.time()) - start).total_seconds() - 3600
+    step = span / max(-(-events // entities), 1)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        _lock(cursor)
+        for month in months:
+            for table in PARTITIONED_TABLES:
+                ensure_partition(cursor, table, month)
+        conn.commit()
+        cursor.close()
+    per_worker = -(-events // workers)
+    parts = [(run_id, first, min(per_worker, events - first), entities, start, step, chunk_size)
+             for first in range(0, events, per_worker)]
+    started = time.monotonic()
+    with Pool(workers) as pool:
+        inserted = sum(pool.map(load_part, parts))
+    elapsed = time.monotonic() - started
+    print(f"Загружено событий: {inserted} за {elapsed:.0f} с ({inserted / elapsed:.0f}/сек)")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for month in months:
+            for table in PARTITIONED_TABLES:
+                cursor.execute(f"ANALYZE {partition_name(table, month)}")
+        conn.commit()
+        cursor.close()
+
+
+def _timed(function, repeat: int) -> tuple:
+    timings, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings)
+
+
+def database_queries(run_id: str, months: list, entity_id: str, repeat: int, limit: int) -> dict:
+    """Запросы по строкам в БД: {название: (результат, p50 мс)}"""
+    since, until = months[0].isoformat(), add_months(months[-1], 1).isoformat()
+    page_query, page_params, _ = build_events_query(
+        {'entity_type': 'dashboard', 'since': since, 'until': until}, limit)
+    queries = {
+        'события по entity_type': ("SELECT entity_type, count(*) FROM metadata_change_events "
+                                   "WHERE event_time >= %s AND event_time < %s GROUP BY 1 ORDER BY 1", (since, until)),
+        'история сущности': ("SELECT id FROM metadata_change_events WHERE entity_id = %s "
+                             "AND event_time >= %s AND event_time < %s ORDER BY event_time, id",
+                             (entity_id, since, until)),
+        f'/events entity_type=dashboard, {limit}': (page_query, page_params),
+        'изменения поля tags': ("SELECT count(*) FROM field_changes WHERE field_name = 'tags' "
+                                "AND event_time >= %s AND event_time < %s", (since, until)),
+    }
+    results = {}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for name, (query, params) in queries.items():
+            def run():
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            rows, p50 = _timed(run, repeat)
+            results[name] = (_summary(name, rows), p50)
+        conn.rollback()
+        cursor.close()
+    return results
+
+
+def archive_queries(reader: archive.ArchiveReader, months: list, entity_id: str, repeat: int, limit: int) -> dict:
+    """Те же запросы по архиву"""
+    since, until = months[0].isoformat(), add_months(months[-1], 1).isoformat()
+    events, fields = PARTITIONED_TABLES
+
+    def by_type():
+        table = reader.scan(events, ['entity_type'], months=months)
+        counts = table.group_by('entity_type').aggregate([('entity_type', 'count')]).sort_by('entity_type')
+        return list(zip(counts['entity_type'].to_pylist(), counts['entity_type_count'].to_pylist()))
+
+    def history():
+        table = reader.scan(events, ['id', 'event_time'], ds.field('entity_id') == entity_id, months)
+        return [(row_id,) for row_id in table.sort_by([('event_time', 'ascending'), ('id', 'ascending')])['id']
+                .to_pylist()]
+
+    def page():
+        return reader.merge_events([], {'entity_type': 'dashboard', 'since': since, 'until': until}, limit)
+
+    def tags():
+        table = reader.scan(fields, ['id'], ds.field('field_name') == 'tags', months)
+        return [(table.num_rows,)]
+
+    results = {}
+    for name, function in (('события по entity_type', by_type), ('история сущности', history),
+                           (f'/events entity_type=dashboard, {limit}', page), ('изменения поля tags', tags)):
+        rows, p50 = _timed(function, repeat)
+        if name.startswith('/events'):
+            rows = [tuple(row.values()) for row in rows]
+        results[name] = (_summary(name, rows), p50)
+    return results
+
+
+def _summary(name: str, rows: list):
+    """Что сверяется до и после переноса: строки целиком или их число и id"""
+    if name.startswith('/events'):
+        return [row[0] for row in rows]
+    if name == 'история сущности':
+        return [row[0] for row in rows]
+    return [tuple(row) for row in rows]
+
+
+def database_size(months: list) -> int:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(sum(pg_total_relation_size(c.oid)), 0) FROM pg_class c WHERE c.relname = ANY(%s)",
+                       ([partition_name(table, month) for table in PARTITIONED_TABLES for month in months],))
+        size = cursor.fetchone()[0]
+        conn.rollback()
+        cursor.close()
+    return size
+
+
+def cleanup(run_id: str, months: list):
+    """Удаляет то, что осталось в БД: непереносённые месяцы, снимки и состояние сущностей"""
+    pattern = f"archivebench-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        _lock(cursor)
+        for month in months:
+            for table in reversed(PARTITIONED_TABLES):
+                cursor.execute(f"DROP TABLE IF EXISTS {partition_name(table, month)}")
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (pattern,))
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=300000, help='Событий для загрузки')
+    parser.add_argument('--entities', type=int, default=5000, help='Разных сущностей')
+    parser.add_argument('--from', dest='start', type=archive._parse_month, default=archive._parse_month('2010-01'),
+                        help='Первый месяц загрузки (YYYY-MM), в нём и следующих не должно быть настоящих данных')
+    parser.add_argument('--months', type=int, default=3, help='Сколько месяцев')
+    parser.add_argument('--workers', type=int, default=4, help='Процессов загрузки')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Событий в транзакции загрузки')
+    parser.add_argument('--repeat', type=int, default=5, help='Повторов каждого запроса')
+    parser.add_argument('--limit', type=int, default=100, help='Размер страницы /events')
+    parser.add_argument('--archive-dir', default=None, help='Каталог архива (по умолчанию временный)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять каталог архива')
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    months = [add_months(args.start, offset) for offset in range(args.months)]
+    archive_dir = args.archive_dir or tempfile.mkdtemp(prefix='om_archive_bench_')
+    entity_id = f"archivebench-{run_id}-{args.entities // 2}"
+    print(f"run_id: {run_id}, месяцы {months[0]:%Y-%m} ... {months[-1]:%Y-%m}, архив: {archive_dir}")
+    try:
+        load(run_id, args.events, args.entities, months, args.workers, args.chunk_size)
+        before = database_queries(run_id, months, entity_id, args.repeat, args.limit)
+        reconstructor = Reconstructor(db_connection, cache_size=0)
+        middle = datetime.combine(months[len(months) // 2], datetime.min.time()) + timedelta(days=10)
+        entity_before = reconstructor.reconstruct(entity_id, at=middle)
+        size_before = database_size(months)
+
+        started = time.monotonic()
+        with db_connection() as conn:
+            batches = archive.archive_months(conn, months, archive_dir)
+        elapsed = time.monotonic() - started
+        if batches is None:
+            print("Архивом занят другой процесс")
+            return 1
+        archived = sum(batch['events'] for batch in batches)
+        archived_fields = sum(batch['field_changes'] for batch in batches)
+        archive_bytes = sum(file['bytes'] for batch in batches for file in batch['files'])
+        print(f"В архив: событий {archived}, изменений полей {archived_fields} за {elapsed:.1f} с "
+              f"({archived / elapsed:.0f} событий/сек)")
+        print(f"Размер: в БД {size_before / 1024 / 1024:.1f} МБ (с индексами), в архиве {archive_bytes / 1024 / 1024:.1f} МБ "
+              f"({size_before / max(archive_bytes, 1):.1f}x)")
+
+        reader = archive.ArchiveReader(archive_dir)
+        after = archive_queries(reader, months, entity_id, args.repeat, args.limit)
+        entity_after = Reconstructor(db_connection, cache_size=0, archive=reader).reconstruct(entity_id, at=middle)
+
+        print(f"{'запрос':<40} | {'БД, мс':>9} | {'архив, мс':>9} | совпадает")
+        print("-" * 76)
+        failed = False
+        for name, (expected, p50) in before.items():
+            actual, archive_p50 = after[name]
+            failed = failed or actual != expected
+            print(f"{name:<40} | {p50:>9.1f} | {archive_p50:>9.1f} | {'да' if actual == expected else 'НЕТ'}")
+        same_entity = (entity_after['entity'] == entity_before['entity']
+                       and entity_after['event_id'] == entity_before['event_id'])
+        failed = failed or not same_entity
+        print(f"{'восстановление на ' + middle.date().isoformat():<40} | {'':>9} | {'':>9} | "
+              f"{'да' if same_entity else 'НЕТ'}")
+    finally:
+        cleanup(run_id, months)
+        if not args.keep:
+            shutil.rmtree(archive_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
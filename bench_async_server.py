@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк приёма /webhook: Flask-приложение под gunicorn против ASGI-приложения (asgi_app.py)
+при разной конкурентности клиентов. Оба сервера запускаются как отдельные процессы
+на свободных портах с настройками БД из окружения; каждый клиент шлёт события подряд
+и ждёт ответа. Выводит события/сек и задержку ответа (p50/p99).
+
+Пример:
+    python bench_async_server.py --events 2000 --concurrency 1 8 32 128
+    python bench_async_server.py --gunicorn-workers 4 --uvicorn-workers 1
+"""
+
+import os
+import sys
+import time
+import uuid
+import socket
+import argparse
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from db_pool import db_connection
+
+SECRET = 'bench-secret'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind: str, port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, WEBHOOK_SECRET=SECRET, INGEST_MODE='sync', LOG_LEVEL='WARNING')
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    if kind == 'flask':
+        command = ['gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(workers), '--log-level', 'warning', 'webhook_listener:app']
+        # Общий каталог метрик - свой для прогона
+        env['PROMETHEUS_MULTIPROC_DIR'] = f'/tmp/bench_async_metrics_{port}'
+    else:
+        command = ['uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(workers), '--log-level', 'warning', '--no-access-log',
+                   '--timeout-graceful-shutdown', '5']
+    process = subprocess.Popen(command, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Сервер {kind} не поднялся на порту {port}")
+
+
+def make_event(run_id: str, number: int) -> dict:
+    entity_id = f"asyncbench-{run_id}-{number % 50}"
+    return {
+        "id": f"asyncbench-{run_id}-{number}",
+        "eventType": "entityUpdated",
+        "timestamp": 1700000000000 + number,
+        "entityType": "table",
+        "entityId": entity_id,
+        "entity": {"id": entity_id, "name": entity_id, "version": round(1 + number / 1000, 3),
+                   "fullyQualifiedName": f"bench_db.bench_schema.{entity_id}",
+                   "description": f"Описание {number}"},
+        "userName": "bench@example.com",
+        "previousVersion": 1.0,
+        "currentVersion": round(1 + number / 1000, 3),
+        "changeDescription": {"fieldsUpdated": [{
+            "name": "description", "oldValue": "старое", "newValue": f"Описание {number}"}]},
+    }
+
+
+def run_load(port: int, run_id: str, events: int, concurrency: int) -> tuple:
+    """Шлёт events событий из concurrency потоков; (событий/сек, p50 мс, p99 мс, ошибок)"""
+    url = f'http://127.0.0.1:{port}/webhook'
+    headers = {'Authorization': f'Bearer {SECRET}'}
+    per_client = events // concurrency
+
+    def client(index: int):
+        session = requests.Session()
+        latencies, errors = [], 0
+        for number in range(index * per_client, (index + 1) * per_client):
+            started = time.perf_counter()
+            response = session.post(url, json=make_event(run_id, number), headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += 1
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors in results)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return len(latencies) / elapsed, statistics.median(latencies), p99, errors
+
+
+def cleanup(run_id: str):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"asyncbench-{run_id}-%"
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (pattern,))
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000, help='Событий на каждую точку')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128],
+                        help='Одновременных клиентов')
+    parser.add_argument('--gunicorn-workers', type=int, default=2, help='Воркеров gunicorn (как в Dockerfile)')
+    parser.add_argument('--uvicorn-workers', type=int, default=1, help='Процессов uvicorn')
+    parser.add_argument('--servers', nargs='+', default=['flask', 'asgi'], choices=['flask', 'asgi'])
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    print(f"{'сервер':>24} | {'клиентов':>8} | {'событий/сек':>11} | {'p50, мс':>8} | {'p99, мс':>8} | {'ошибок':>6}")
+    print("-" * 80)
+    for kind in args.servers:
+        workers = args.gunicorn_workers if kind == 'flask' else args.uvicorn_workers
+        label = f"flask/gunicorn x{workers}" if kind == 'flask' else f"asgi/uvicorn x{workers}"
+        port = free_port()
+        process = start_server(kind, port, workers)
+        run_id = uuid.uuid4().hex[:8]
+        try:
+            for concurrency in args.concurrency:
+                rate, p50, p99, errors = run_load(port, f"{run_id}-{concurrency}", args.events, concurrency)
+                print(f"{label:>24} | {concurrency:>8} | {rate:>11.0f} | {p50:>8.1f} | {p99:>8.1f} | {errors:>6}")
+        finally:
+            process.terminate()
+            process.wait(30)
+            if not args.keep:
+                cleanup(run_id)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
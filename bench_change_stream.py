@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Проверка и бенчмарк потока событий: подписчики /events/stream (SSE) или /events/poll
+(long-poll) с фильтром entity_type + fqn_prefix, параллельные клиенты шлют /webhook.
+Каждый подписчик должен получить каждое событие ровно один раз; часть подписчиков
+обрывает подключение посередине и продолжает с Last-Event-ID / cursor.
+Выводит задержку доставки (от отправки /webhook до получения подписчиком, p50/p99)
+и число потерянных и повторных событий.
+
+Пример:
+    python bench_change_stream.py --events 2000 --subscribers 4
+    python bench_change_stream.py --server flask --workers 8 --mode poll
+"""
+
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_async_server import SECRET, free_port, start_server, make_event, cleanup
+
+FILTER = {'entity_type': 'table', 'fqn_prefix': 'bench_db.bench_schema'}
+
+
+class Subscriber(threading.Thread):
+    """Читает поток, пока не получит expected событий прогона; reconnect_after - обрыв после N событий"""
+
+    def __init__(self, port: int, mode: str, run_id: str, expected: int, reconnect_after: int = 0):
+        super().__init__(daemon=True)
+        self.port = port
+        self.mode = mode
+        self.prefix = f"asyncbench-{run_id}-"
+        self.expected = expected
+        self.reconnect_after = reconnect_after
+        self.received = {}
+        self.duplicates = 0
+        self.reconnects = 0
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.position = None
+
+    def _record(self, event: dict) -> bool:
+        event_id = event.get('event_id') or ''
+        if not event_id.startswith(self.prefix):
+            return False
+        if event_id in self.received:
+            self.duplicates += 1
+        else:
+            self.received[event_id] = time.perf_counter()
+        return True
+
+    def run(self):
+        try:
+            while not self.done.is_set() and len(self.received) < self.expected:
+                if self.mode == 'sse':
+                    self._read_stream()
+                else:
+                    self._poll()
+        finally:
+            self.done.set()
+
+    def _read_stream(self):
+        headers = {'Last-Event-ID': self.position} if self.position else {}
+        url = f'http://127.0.0.1:{self.port}/events/stream'
+        with requests.get(url, params=FILTER, headers=headers, stream=True, timeout=60) as response:
+            counted = 0
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if line.startswith('id: '):
+                    self.position = line[4:]
+                    self.ready.set()
+                elif line.startswith('data: ') and self._record(json.loads(line[6:])):
+                    counted += 1
+                    if len(self.received) >= self.expected:
+                        return
+                    if self.reconnect_after and counted == self.reconnect_after:
+                        # Обрыв посередине: продолжение - с последнего id
+                        self.reconnect_after = 0
+                        self.reconnects += 1
+                        return
+
+    def _poll(self):
+        url = f'http://127.0.0.1:{self.port}/events/poll'
+        params = dict(FILTER, timeout='10')
+        if self.position:
+            params['cursor'] = self.position
+        else:
+            params['timeout'] = '0'
+        body = requests.get(url, params=params, timeout=60).json()
+        self.position = body['cursor']
+        self.ready.set()
+        for event in body['events']:
+            self._record(event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000, help='Событий в прогоне')
+    parser.add_argument('--subscribers', type=int, default=4, help='Подписчиков')
+    parser.add_argument('--concurrency', type=int, default=4, help='Одновременных отправителей /webhook')
+    parser.add_argument('--mode', choices=['sse', 'poll'], default='sse')
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='asgi')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Воркеров (синхронный gunicorn: подписчик SSE занимает воркер)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    port = free_port()
+    process = start_server(args.server, port, args.workers)
+    run_id = uuid.uuid4().hex[:8]
+    subscribers = [Subscriber(port, args.mode, run_id, args.events,
+                              reconnect_after=args.events // 3 if index % 2 else 0)
+                   for index in range(args.subscribers)]
+    sent = {}
+    try:
+        for subscriber in subscribers:
+            subscriber.start()
+        for subscriber in subscribers:
+            if not subscriber.ready.wait(30):
+                raise RuntimeError("Подписчик не получил начальную позицию потока")
+
+        headers = {'Authorization': f'Bearer {SECRET}', 'Content-Type': 'application/json'}
+
+        def send(number: int):
+            event_data = make_event(run_id, number)
+            sent[event_data['id']] = time.perf_counter()
+            requests.post(f'http://127.0.0.1:{port}/webhook', data=json.dumps(event_data),
+                          headers=headers, timeout=30).raise_for_status()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(send, range(args.events)))
+        send_elapsed = time.perf_counter() - started
+
+        deadline = time.monotonic() + 60
+        for subscriber in subscribers:
+            subscriber.done.wait(max(deadline - time.monotonic(), 0))
+        for subscriber in subscribers:
+            subscriber.done.set()
+
+        print(f"{args.server} x{args.workers}, {args.mode}: событий {args.events} "
+              f"({args.events / send_elapsed:.0f}/сек), подписчиков {args.subscribers}")
+        print(f"{'подписчик':>9} | {'получено':>8} | {'потеряно':>8} | {'повторов':>8} | "
+              f"{'обрывов':>7} | {'p50, мс':>8} | {'p99, мс':>8}")
+        print("-" * 78)
+        failed = False
+        for index, subscriber in enumerate(subscribers):
+            latencies = sorted((subscriber.received[event_id] - sent[event_id]) * 1000
+                               for event_id in subscriber.received if event_id in sent)
+            missing = args.events - len(subscriber.received)
+            failed = failed or missing > 0 or subscriber.duplicates > 0
+            p50 = statistics.median(latencies) if latencies else float('nan')
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float('nan')
+            print(f"{index:>9} | {len(subscriber.received):>8} | {missing:>8} | {subscriber.duplicates:>8} | "
+                  f"{subscriber.reconnects:>7} | {p50:>8.1f} | {p99:>8.1f}")
+    finally:
+        process.terminate()
+        # Синхронный воркер gunicorn замечает отключение подписчика SSE только при записи
+        # в поток, поэтому остановка может занять до graceful_timeout (30 сек)
+        process.wait(60)
+        if not args.keep:
+            cleanup(run_id)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
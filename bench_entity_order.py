@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест порядка записи событий одной сущности при нескольких воркерах и экземплярах
+Поднимает --replicas серверов (gunicorn или uvicorn) по --workers воркеров на каждое
+значение и шлёт в них версии сущностей так, как их доставляет OpenMetadata: версии одной
+сущности - по порядку, следующая после ответа на предыдущую, но каждая в следующий сервер
+по кругу (то есть в другой воркер или экземпляр). Часть доставок - /webhook/batch с несколькими
+версиями подряд, часть сущностей удаляется дважды, старое удаление доставляется повторно
+(ретрай). Параллельно --hot-clients потоков без всякого порядка меняют --hot-entities
+«горячих» сущностей - конкуренция за одни и те же строки.
+
+После каждого прогона проверяется:
+- история каждой упорядоченной сущности в порядке потока (/events/stream: txid, id) идёт
+  по возрастанию версий (инверсии - нарушения порядка);
+- entity_current_state: последняя версия, последнее событие и число изменений каждой сущности,
+  у горячих - наибольшая отправленная версия;
+- deleted_entities.deleted_at - время последнего удаления, а не доставленного последним.
+Выводит события/сек для каждого числа воркеров с INGEST_ENTITY_ORDER=1 и без.
+Кэш повторов у серверов выключен: повторная доставка доходит до БД.
+
+Пример:
+    python bench_entity_order.py --workers 1 2 4 --replicas 2
+    python bench_entity_order.py --server asgi --workers 1 2 --order on --entities 500
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_async_server import SECRET, free_port, start_server
+from db_pool import db_connection
+from payload_store import release_references, collect_garbage
+
+BASE_TIME_MS = 1700000000000
+
+
+def version_of(number: int) -> float:
+    return round(1 + number / 10, 1)
+
+
+def make_event(run_id: str, entity: str, number: int, event_type: str = 'entityUpdated') -> dict:
+    entity_id = f"orderbench-{run_id}-{entity}"
+    version = version_of(number)
+    return {
+        # Номер версии в конце id: порядок id по строке не совпадает с порядком версий (v10 < v2)
+        "id": f"orderbench-{run_id}-{entity}-{number}",
+        "eventType": event_type,
+        "timestamp": BASE_TIME_MS + number * 1000,
+        "entityType": "table",
+        "entityId": entity_id,
+        "entity": {"id": entity_id, "name": entity, "version": version,
+                   "fullyQualifiedName": f"orderbench.{run_id}.{entity}",
+                   "description": f"Версия {number}"},
+        "userName": f"user{number % 7}@example.com",
+        "previousVersion": version_of(number - 1),
+        "currentVersion": version,
+        "changeDescription": {"fieldsUpdated": [{
+            "name": "description", "oldValue": f"Версия {number - 1}", "newValue": f"Версия {number}"}]},
+    }
+
+
+def entity_script(run_id: str, entity: str, versions: int, deleting: bool) -> list:
+    """
+    Доставки одной сущности по порядку: [события одной доставки]; у удаляемой -
+    удаление в середине и в конце, затем повтор первого удаления
+    """
+    events = []
+    for number in range(1, versions + 1):
+        event_type = 'entityCreated' if number == 1 else 'entityUpdated'
+        if deleting and number in (versions // 2, versions):
+            event_type = 'entityDeleted'
+        elif deleting and number == versions // 2 + 1:
+            event_type = 'entityRestored'
+        events.append(make_event(run_id, entity, number, event_type))
+    return events
+
+
+class Sender:
+    """Доставка в серверы по кругу; считает события и ошибки"""
+
+    def __init__(self, ports: list):
+        self.urls = itertools.cycle([f'http://127.0.0.1:{port}' for port in ports])
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.errors = 0
+
+    def post(self, session: requests.Session, events: list):
+        with self._lock:
+            url = next(self.urls)
+        headers = {'Authorization': f'Bearer {SECRET}'}
+        if len(events) == 1:
+            response = session.post(f'{url}/webhook', json=events[0], headers=headers)
+        else:
+            response = session.post(f'{url}/webhook/batch', json=events, headers=headers)
+            if response.status_code < 300 and any(
+                    item['status'] == 'rejected' for item in response.json().get('results', [])):
+                response.status_code = 500
+        with self._lock:
+            self.sent += len(events)
+            if response.status_code >= 300:
+                self.errors += 1
+
+
+def ordered_client(sender: Sender, scripts: dict, batch_share: float, seed: int):
+    """Сущности клиента вперемешку, версии каждой - по порядку, следующая после ответа"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    positions = {entity: 0 for entity in scripts}
+    while positions:
+        entity = rng.choice(list(positions))
+        script, position = scripts[entity], positions[entity]
+        size = rng.randint(2, 5) if rng.random() < batch_share else 1
+        sender.post(session, script[position:position + size])
+        positions[entity] = position + size
+        if positions[entity] >= len(script):
+            del positions[entity]
+
+
+def hot_client(sender: Sender, run_id: str, hot_entities: int, counters: dict, events: int, seed: int):
+    """Меняет горячие сущности без порядка: номер версии - общий счётчик сущности"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    for _ in range(events):
+        entity = f"hot{rng.randrange(hot_entities)}"
+        number = next(counters[entity])
+        sender.post(session, [make_event(run_id, entity, number)])
+
+
+def run_load(ports: list, run_id: str, args) -> dict:
+    rng = random.Random(run_id)
+    scripts, expected = {}, {}
+    for index in range(args.entities):
+        entity = f"e{index}"
+        deleting = index % 5 == 0
+        script = entity_script(run_id, entity, args.versions, deleting)
+        expected[entity] = script[-1]
+        if deleting:
+            # Повтор старого удаления после последнего (ретрай OpenMetadata)
+            script.append(script[args.versions // 2 - 1])
+        scripts[entity] = script
+
+    per_client = defaultdict(dict)
+    for entity in scripts:
+        per_client[rng.randrange(args.clients)][entity] = scripts[entity]
+    # Первая версия горячей сущности - до нагрузки, дальше счётчик с 2
+    counters = {f"hot{index}": itertools.count(2) for index in range(args.hot_entities)}
+
+    sender = Sender(ports)
+    session = requests.Session()
+    for entity in counters:
+        sender.post(session, [make_event(run_id, entity, 1, 'entityCreated')])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.clients + args.hot_clients) as executor:
+        futures = [executor.submit(ordered_client, sender, client_scripts,
+                                   args.batch_share, index)
+                   for index, client_scripts in per_client.items()]
+        futures += [executor.submit(hot_client, sender, run_id, args.hot_entities, counters,
+                                    args.hot_events, 1000 + index)
+                    for index in range(args.hot_clients if args.hot_entities else 0)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - started
+    hot_max = {entity: next(counter) - 1 for entity, counter in counters.items()}
+    return {'rate': sender.sent / elapsed, 'sent': sender.sent, 'errors': sender.errors,
+            'expected': expected, 'hot_max': hot_max}
+
+
+def verify(run_id: str, args, load: dict) -> dict:
+    pattern = f"orderbench-{run_id}-%"
+    prefix = f"orderbench-{run_id}-"
+    problems = defaultdict(int)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT entity_id, current_version FROM metadata_change_events
+            WHERE event_id LIKE %s ORDER BY entity_id, txid, id
+        """, (pattern,))
+        previous = {}
+        for entity_id, version in cursor.fetchall():
+            entity = entity_id[len(prefix):]
+            if entity.startswith('hot'):
+                continue
+            if entity in previous and version <= previous[entity]:
+                problems['инверсии'] += 1
+            previous[entity] = version
+
+        cursor.execute("""
+            SELECT entity_id, current_version, last_event_id, change_count, is_deleted
+            FROM entity_current_state WHERE entity_id LIKE %s
+        """, (pattern,))
+        states = {entity_id[len(prefix):]: row for entity_id, *row in cursor.fetchall()}
+        for entity, event in load['expected'].items():
+            state = states.get(entity)
+            if (state is None or float(state[0]) != event['currentVersion'] or state[1] != event['id']
+                    or state[2] != args.versions or state[3] != (event['eventType'] == 'entityDeleted')):
+                problems['состояние'] += 1
+        for entity, number in load['hot_max'].items():
+            state = states.get(entity)
+            if state is None or float(state[0]) != version_of(number) or state[2] != number:
+                problems['горячие'] += 1
+
+        cursor.execute("SELECT entity_id, deleted_at FROM deleted_entities WHERE entity_id LIKE %s", (pattern,))
+        deleted = {entity_id[len(prefix):]: deleted_at for entity_id, deleted_at in cursor.fetchall()}
+        for entity, event in load['expected'].items():
+            if event['eventType'] != 'entityDeleted':
+                continue
+            deleted_at = deleted.get(entity)
+            if deleted_at is None or int(deleted_at.timestamp() * 1000) != event['timestamp']:
+                problems['deleted_at'] += 1
+        conn.rollback()
+        cursor.close()
+    return problems
+
+
+def cleanup(run_id: str):
+    pattern = f"orderbench-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        release_references(cursor, "SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s",
+                           (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        for table in ('entity_snapshots', 'entity_current_state', 'deleted_entities'):
+            cursor.execute(f"DELETE FROM {table} WHERE entity_id LIKE %s", (pattern,))
+        collect_garbage(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Воркеров на сервер')
+    parser.add_argument('--replicas', type=int, default=2, help='Экземпляров сервера с одной БД')
+    parser.add_argument('--order', nargs='+', choices=['on', 'off'], default=['off', 'on'],
+                        help='INGEST_ENTITY_ORDER серверов')
+    parser.add_argument('--entities', type=int, default=200, help='Сущностей с упорядоченными версиями')
+    parser.add_argument('--versions', type=int, default=20, help='Версий каждой сущности')
+    parser.add_argument('--clients', type=int, default=16, help='Потоков упорядоченной доставки')
+    parser.add_argument('--batch-share', type=float, default=0.2,
+                        help='Доля доставок пачкой из нескольких версий (/webhook/batch)')
+    parser.add_argument('--hot-entities', type=int, default=5, help='Горячих сущностей (0 - без них)')
+    parser.add_argument('--hot-clients', type=int, default=8, help='Потоков для горячих сущностей')
+    parser.add_argument('--hot-events', type=int, default=200, help='Событий на поток горячих сущностей')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    # Повтор должен доходить до БД, а не отсекаться кэшем воркера
+    os.environ['DEDUPE_CACHE_SIZE'] = '0'
+    failed = False
+    print(f"{'сервер':>22} | {'порядок':>7} | {'событий/сек':>11} | {'ошибок':>6} | проверка")
+    print("-" * 80)
+    for order in args.order:
+        os.environ['INGEST_ENTITY_ORDER'] = '1' if order == 'on' else '0'
+        for workers in args.workers:
+            ports = [free_port() for _ in range(args.replicas)]
+            processes = []
+            run_id = uuid.uuid4().hex[:8]
+            try:
+                for port in ports:
+                    processes.append(start_server(args.server, port, workers))
+                load = run_load(ports, run_id, args)
+                problems = verify(run_id, args, load)
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait(30)
+                if not args.keep:
+                    cleanup(run_id)
+            failed = failed or bool(problems) or bool(load['errors'])
+            label = f"{args.server} {args.replicas}x{workers}"
+            result = ', '.join(f"{name}: {count}" for name, count in problems.items()) or 'ok'
+            print(f"{label:>22} | {order:>7} | {load['rate']:>11.0f} | {load['errors']:>6} | {result}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
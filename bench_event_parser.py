@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк разбора событий (event_parser.parse_event) без БД
+Прогоняет типичные формы payload'ов и печатает время разбора одного события в мкс
+
+Пример:
+    python bench_event_parser.py --number 20000
+"""
+
+import argparse
+import json
+import timeit
+
+from event_parser import parse_event
+
+
+def _entity(columns: int = 0) -> dict:
+    entity = {
+        "id": "bench-entity-1",
+        "type": "table",
+        "name": "orders",
+        "fullyQualifiedName": "bench_db.bench_schema.orders",
+        "description": "Таблица заказов",
+        "version": 0.2,
+    }
+    if columns:
+        entity["columns"] = [
+            {"name": f"col_{i}", "dataType": "VARCHAR", "dataLength": 255,
+             "description": f"Колонка {i}", "tags": [{"tagFQN": "PII.None"}]}
+            for i in range(columns)
+        ]
+    return entity
+
+
+def _event(event_type: str = "entityUpdated", entity=None, change_desc=None, timestamp=1700000000000) -> dict:
+    return {
+        "id": "bench-event-1",
+        "eventType": event_type,
+        "timestamp": timestamp,
+        "entityType": "table",
+        "entityId": "bench-entity-1",
+        "entity": _entity() if entity is None else entity,
+        "userName": "bench@example.com",
+        "previousVersion": 0.1,
+        "currentVersion": 0.2,
+        "changeDescription": change_desc if change_desc is not None else {
+            "fieldsAdded": [], "fieldsUpdated": [], "fieldsDeleted": []
+        },
+    }
+
+
+def _fields_updated(n: int) -> dict:
+    return {
+        "fieldsAdded": [],
+        "fieldsUpdated": [{"name": f"columns.col_{i}.description", "oldValue": f"Старое {i}",
+                           "newValue": f"Новое {i}"} for i in range(n)],
+        "fieldsDeleted": [],
+    }
+
+
+PAYLOADS = {
+    'entityCreated, маленький': _event("entityCreated"),
+    'entityUpdated, 50 полей': _event(change_desc=_fields_updated(50)),
+    'entity с 500 колонками': _event(entity=_entity(500), change_desc=_fields_updated(1)),
+    'entity JSON-строкой': _event(entity=json.dumps(_entity(50))),
+    'changeDescription JSON-строкой': _event(change_desc=json.dumps(_fields_updated(50))),
+    'без entity': _event(entity={}),
+    'timestamp epoch ms': _event(timestamp=1700000000000),
+    'timestamp epoch s': _event(timestamp=1700000000),
+    'timestamp ISO': _event(timestamp="2023-11-14T22:13:20"),
+}
+
+
+def bench(name: str, func, number: int):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    print(f"  {name:<34} {best / number * 1e6:9.2f} мкс/событие")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='Разборов на один замер')
+    parser.add_argument('--with-json', action='store_true',
+                        help='Учитывать json.loads тела запроса, как в /webhook')
+    args = parser.parse_args()
+
+    print("parse_event:")
+    for name, payload in PAYLOADS.items():
+        if args.with_json:
+            body = json.dumps(payload)
+            bench(name, lambda body=body: parse_event(json.loads(body)), args.number)
+        else:
+            bench(name, lambda payload=payload: parse_event(payload), args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк записи событий с разным количеством изменений полей
+Пишет события через save_change_event в БД из настроек .env и считает events/sec
+
+Пример:
+    python bench_field_changes.py --events 200 --fields 1 50 500
+"""
+
+import argparse
+import logging
+import time
+import uuid
+
+import webhook_listener
+from db_pool import db_connection
+
+
+def make_event(run_id: str, n: int, fields_count: int) -> dict:
+    """Событие entityUpdated с fields_count изменёнными колонками"""
+    return {
+        "id": f"bench-{run_id}-{fields_count}-{n}",
+        "eventType": "entityUpdated",
+        "timestamp": int(time.time() * 1000),
+        "entityType": "table",
+        "entityId": f"bench-entity-{n % 100}",
+        "entityFQN": f"bench_db.bench_schema.table_{n % 100}",
+        "entity": {
+            "id": f"bench-entity-{n % 100}",
+            "type": "table",
+            "name": f"table_{n % 100}",
+            "fullyQualifiedName": f"bench_db.bench_schema.table_{n % 100}"
+        },
+        "userName": "bench@example.com",
+        "previousVersion": 0.1,
+        "currentVersion": 0.2,
+        "changeDescription": {
+            "fieldsAdded": [],
+            "fieldsUpdated": [
+                {
+                    "name": f"columns.col_{i}.description",
+                    "oldValue": f"Старое описание колонки {i}",
+                    "newValue": f"Новое описание колонки {i}"
+                }
+                for i in range(fields_count)
+            ],
+            "fieldsDeleted": []
+        }
+    }
+
+
+def cleanup(run_id: str):
+    """Удаляет события, записанные бенчмарком"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"bench-{run_id}-%"
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", ("bench-entity-%",))
+        conn.commit()
+        cursor.close()
+
+
+def run(events: int, fields_count: int, run_id: str) -> float:
+    """Записывает events событий и возвращает events/sec"""
+    payloads = [make_event(run_id, n, fields_count) for n in range(events)]
+
+    started = time.perf_counter()
+    for payload in payloads:
+        if not webhook_listener.save_change_event(payload):
+            raise RuntimeError(f"Не удалось сохранить событие {payload['id']}")
+    elapsed = time.perf_counter() - started
+
+    return events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200, help='Событий на каждый размер')
+    parser.add_argument('--fields', type=int, nargs='+', default=[1, 50, 500],
+                        help='Количество изменений полей в событии')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    # Логи на каждое событие искажают замер
+    logging.getLogger('webhook_listener').setLevel(logging.WARNING)
+    webhook_listener.init_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    print(f"{'fields/event':>12} | {'events/sec':>10} | {'field rows/sec':>14}")
+    print("-" * 44)
+    try:
+        for fields_count in args.fields:
+            rate = run(args.events, fields_count, run_id)
+            print(f"{fields_count:>12} | {rate:>10.1f} | {rate * fields_count:>14.0f}")
+    finally:
+        if not args.keep:
+            cleanup(run_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк запросов по поддеревьям FQN: загружает синтетические события иерархии
+сервис -> база -> схема -> таблица через ChunkLoader из bulk_import в БД из настроек .env
+и сравнивает для поддеревьев каждого уровня:
+- страницу /events?fqn_prefix=... (диапазон по индексу fqn_path) с прежним способом,
+  entity_fqn = P OR entity_fqn LIKE 'P.%' - по индексу entity_fqn (так его может
+  использовать только БД с collation "C") и без индекса (как при любой другой collation);
+- число событий поддерева теми же способами;
+- число событий по ветвям следующего уровня: из агрегатов (/stats/fqn), GROUP BY по
+  fqn_path и прежним способом - GROUP BY entity_fqn по LIKE с разбором FQN в Python.
+
+Пример:
+    python bench_fqn.py --events 1000000 --workers 4
+    python bench_fqn.py --run-id 1a2b3c4d --skip-load --repeat 20   # повторно по загруженным
+    python bench_fqn.py --run-id 1a2b3c4d --cleanup-only
+"""
+
+import sys
+import time
+import uuid
+import random
+import argparse
+import statistics
+from collections import Counter
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from bulk_import import ChunkLoader
+from db_pool import db_connection
+from event_parser import parse_event
+from events_query import build_events_query
+from fqn import FQN_ROLLUP_DEPTH, join_fqn, split_fqn, subtree_condition, subtree_counts
+from partitions import ensure_partitions
+from payload_store import release_references, collect_garbage
+from rollups import fqn_children
+
+SERVICES, DATABASES, SCHEMAS = 4, 10, 25
+
+
+def entity_path(run_id: str, entity_number: int, entities: int) -> list:
+    """Путь сущности: таблицы равномерно по схемам, каждая пятая база - с точкой в имени"""
+    per_schema = max(entities // (SERVICES * DATABASES * SCHEMAS), 1)
+    schema_number = entity_number // per_schema
+    database = schema_number // SCHEMAS
+    service = database // DATABASES
+    database_name = f"db_{database % DATABASES}" + ('.v2' if database % 5 == 0 else '')
+    return [f"fqnbench_{run_id}_svc{service % SERVICES}", database_name,
+            f"schema_{schema_number % SCHEMAS}", f"table_{entity_number}"]
+
+
+def make_event(rng: random.Random, run_id: str, number: int, entities: int, start: datetime,
+               span_seconds: int) -> dict:
+    # Часть сущностей меняется чаще (распределение близко к Ципфу)
+    entity_number = min(int((rng.paretovariate(1.2) - 1) * entities / 50), entities - 1) if rng.random() < 0.5 \
+        else rng.randrange(entities)
+    entity_id = f"fqnbench-{run_id}-{entity_number}"
+    fqn = join_fqn(entity_path(run_id, entity_number, entities))
+    event_time = start + timedelta(seconds=rng.randrange(span_seconds))
+    return {
+        "id": f"fqnbench-{run_id}-{number}",
+        "eventType": "entityUpdated",
+        "entityType": "table",
+        "entityId": entity_id,
+        "entityFQN": fqn,
+        "timestamp": int(event_time.timestamp() * 1000),
+        "userName": f"user{rng.randrange(50)}@example.com",
+        "previousVersion": 0.1,
+        "currentVersion": 0.2,
+        "changeDescription": {"fieldsUpdated": [
+            {"name": "description", "oldValue": f"old {number}", "newValue": f"new {number}"}]},
+        "entity": {"id": entity_id, "name": f"table_{entity_number}", "fullyQualifiedName": fqn},
+    }
+
+
+def load_part(args) -> int:
+    run_id, first, count, entities, start, span_seconds, chunk_size = args
+    rng = random.Random(first)
+    with db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+        for number in range(first, first + count):
+            loader.add(parse_event(make_event(rng, run_id, number, entities, start, span_seconds)))
+            if loader.full():
+                loader.flush()
+        loader.flush()
+        loader.cursor.close()
+    return loader.totals['inserted']
+
+
+def load(run_id: str, events: int, entities: int, days: int, workers: int, chunk_size: int):
+    start = datetime.now() - timedelta(days=days)
+    with db_connection() as conn:
+        ensure_partitions(conn, start=start.date())
+    per_worker = -(-events // workers)
+    parts = [(run_id, first, min(per_worker, events - first), entities, start, days * 86400, chunk_size)
+             for first in range(0, events, per_worker)]
+    started = time.monotonic()
+    with Pool(workers) as pool:
+        inserted = sum(pool.map(load_part, parts))
+    elapsed = time.monotonic() - started
+    print(f"Загружено событий: {inserted} за {elapsed:.0f} с ({inserted / elapsed:.0f}/сек)")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("ANALYZE metadata_change_events")
+        conn.commit()
+        cursor.close()
+
+
+def _like_condition(prefix: str, indexed: bool) -> tuple:
+    """Прежний способ: сама сущность или FQN с префиксом 'prefix.'"""
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    # || '' скрывает колонку от индекса - так LIKE выполняется при collation не "C"
+    column = "entity_fqn" if indexed else "(entity_fqn || '')"
+    return f"({column} = %s OR {column} LIKE %s)", [prefix, escaped + '.%']
+
+
+def _timed(repeat: int, run):
+    timings, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings), max(timings)
+
+
+def _query(cursor, query: str, params: list):
+    def run():
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    return run
+
+
+def _like_children(cursor, prefix: str, depth: int):
+    condition, params = _like_condition(prefix, True)
+
+    def run():
+        cursor.execute(f"SELECT entity_fqn, count(*) FROM metadata_change_events WHERE {condition} "
+                       f"GROUP BY entity_fqn", params)
+        counts = Counter()
+        for entity_fqn, count in cursor.fetchall():
+            counts[join_fqn(split_fqn(entity_fqn)[:depth])] += count
+        return counts
+    return run
+
+
+def run_queries(run_id: str, entities: int, repeat: int, limit: int):
+    # Поддеревья каждого уровня: самая часто меняемая сущность и её предки
+    path = entity_path(run_id, 0, entities)
+    prefixes = [path[:depth] for depth in range(1, len(path) + 1)]
+
+    print(f"{'запрос':<58} | {'строк':>8} | {'p50, мс':>9} | {'max, мс':>9}")
+    print("-" * 94)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for prefix_path in prefixes:
+            prefix = join_fqn(prefix_path)
+            depth = len(prefix_path)
+            print(f"поддерево уровня {depth}: {prefix}")
+            cases = []
+            query, params, _ = build_events_query({'fqn_prefix': prefix, 'fields': 'id'}, limit)
+            cases.append(("  страница: fqn_path", _query(cursor, query, params)))
+            for indexed, title in ((True, "LIKE по индексу entity_fqn"), (False, "LIKE без индекса")):
+                condition, params = _like_condition(prefix, indexed)
+                cases.append((f"  страница: {title}", _query(
+                    cursor, f"SELECT id, event_time FROM metadata_change_events WHERE {condition} "
+                            f"ORDER BY event_time DESC, id DESC LIMIT %s", params + [limit])))
+            condition, params = subtree_condition('fqn_path', prefix_path)
+            cases.append(("  число событий: fqn_path", _query(
+                cursor, f"SELECT count(*) FROM metadata_change_events WHERE {condition}", params)))
+            for indexed, title in ((True, "LIKE по индексу entity_fqn"), (False, "LIKE без индекса")):
+                condition, params = _like_condition(prefix, indexed)
+                cases.append((f"  число событий: {title}", _query(
+                    cursor, f"SELECT count(*) FROM metadata_change_events WHERE {condition}", params)))
+            if depth < len(path):
+                if depth < FQN_ROLLUP_DEPTH:
+                    cases.append(("  по ветвям: агрегаты (/stats/fqn)",
+                                  lambda: fqn_children(cursor, 'day', None, None, prefix, depth + 1)['children']))
+                cases.append(("  по ветвям: GROUP BY fqn_path",
+                              lambda: subtree_counts(cursor, prefix_path)))
+                cases.append(("  по ветвям: LIKE + разбор FQN", _like_children(cursor, prefix, depth + 1)))
+            for name, run in cases:
+                rows, median, worst = _timed(repeat, run)
+                if name.startswith("  число событий"):
+                    rows = rows[0][0]
+                else:
+                    rows = len(rows)
+                print(f"{name:<58} | {rows:>8} | {median:>9.1f} | {worst:>9.1f}")
+
+        cursor.execute("""
+            SELECT relname, pg_size_pretty(sum(pg_relation_size(c.oid))) FROM (
+                SELECT i.inhrelid AS oid, regexp_replace(p.relname, '^idx_events_', '') AS relname
+                FROM pg_class p JOIN pg_inherits i ON i.inhparent = p.oid
+                WHERE p.relname IN ('idx_events_fqn_time', 'idx_events_fqn_path_time')
+            ) c GROUP BY relname ORDER BY relname
+        """)
+        print("Размер индексов:", ', '.join(f"{name} {size}" for name, size in cursor.fetchall()))
+        conn.rollback()
+        cursor.close()
+
+
+def cleanup(run_id: str):
+    pattern = f"fqnbench-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        release_references(cursor, "SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s",
+                           (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM event_rollups WHERE dimension LIKE 'fqn\\_%%' AND value LIKE %s",
+                       (f"fqnbench\\_{run_id}\\_%",))
+        collect_garbage(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=1000000, help='Событий для загрузки')
+    parser.add_argument('--entities', type=int, default=50000, help='Разных сущностей (таблиц)')
+    parser.add_argument('--days', type=int, default=180, help='За сколько дней распределить события')
+    parser.add_argument('--workers', type=int, default=4, help='Процессов загрузки')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Событий в транзакции загрузки')
+    parser.add_argument('--repeat', type=int, default=10, help='Повторов каждого запроса')
+    parser.add_argument('--limit', type=int, default=100, help='Размер страницы')
+    parser.add_argument('--run-id', default=None, help='Метка загрузки (для повторного прогона)')
+    parser.add_argument('--skip-load', action='store_true', help='Не загружать, запрашивать уже загруженные')
+    parser.add_argument('--keep', action='store_true', help='Не удалять загруженные события')
+    parser.add_argument('--cleanup-only', action='store_true', help='Только удалить события --run-id')
+    args = parser.parse_args()
+
+    run_id = args.run_id or uuid.uuid4().hex[:8]
+    if args.cleanup_only:
+        cleanup(run_id)
+        return 0
+    print(f"run_id: {run_id}")
+    try:
+        if not args.skip_load:
+            load(run_id, args.events, args.entities, args.days, args.workers, args.chunk_size)
+        run_queries(run_id, args.entities, args.repeat, args.limit)
+    finally:
+        if not args.keep:
+            cleanup(run_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Проверка и бенчмарк миграций схемы (migrations.py) на отдельной БД <DB_NAME>_migrations_bench
+1. --workers процессов одновременно запускают init_database на пустой БД: схема создаётся
+   одним процессом, каждая миграция записана один раз, ошибок нет;
+2. время init_database при актуальной схеме против прежнего запуска всего DDL при старте;
+3. загружается --events событий, online-индексы удаляются и строятся заново, пока поток
+   пишет события по одному через write_events: задержка записи во время CREATE INDEX CONCURRENTLY
+   по партициям и во время обычного CREATE INDEX (как раньше в init_database);
+4. запуск воркера, пока долгий запрос (--hold секунд) читает metadata_change_events: прежний DDL
+   (ALTER TABLE ... ADD COLUMN IF NOT EXISTS ждёт ACCESS EXCLUSIVE) останавливает запись
+   до конца запроса, проверка версии схемы - нет;
+5. обновление установки с данными: колонки search_vector и fqn_path удаляются вместе с записями
+   их миграций, init_database добавляет их обычными колонками с триггером, пока поток пишет
+   события, online-миграции заполняют старые строки; все значения совпадают с выражениями.
+
+Пример:
+    python bench_migrations.py --events 300000 --workers 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from statistics import median
+
+import psycopg2
+
+from db_pool import DB_CONFIG
+
+BENCH_DB = f"{DB_CONFIG['database']}_migrations_bench"
+# Подпроцессы и импорт webhook_listener ниже работают с отдельной БД
+os.environ['DB_NAME'] = BENCH_DB
+DB_CONFIG['database'] = BENCH_DB
+
+from bench_version_gaps import make_event  # noqa: E402
+from bulk_import import ChunkLoader  # noqa: E402
+from db_pool import db_connection  # noqa: E402
+from event_parser import parse_event  # noqa: E402
+from events_query import EVENT_INDEXES  # noqa: E402
+from fqn import FQN_COLUMNS  # noqa: E402
+import migrations  # noqa: E402
+from search import SEARCH_COLUMNS  # noqa: E402
+from webhook_listener import init_database, write_events  # noqa: E402
+
+START_WORKER = """
+import time, webhook_listener
+started = time.perf_counter()
+webhook_listener.init_database()
+print(f"{time.perf_counter() - started:.3f}")
+"""
+
+ONLINE_INDEXES = ('idx_entity_type_fqn', 'idx_field_changes_name_type')
+
+# Как init_database до миграций: весь DDL при каждом старте. ADD COLUMN IF NOT EXISTS
+# и CREATE INDEX IF NOT EXISTS ждут блокировки таблицы и для готовых колонок и индексов
+OLD_STARTUP_DDL = [
+    "ALTER TABLE metadata_change_events ADD COLUMN IF NOT EXISTS entity_hash BYTEA",
+    "ALTER TABLE field_changes ADD COLUMN IF NOT EXISTS event_time TIMESTAMP",
+    "ALTER TABLE metadata_change_events ADD COLUMN IF NOT EXISTS txid xid8",
+] + [f"CREATE INDEX IF NOT EXISTS {name} ON metadata_change_events{columns}" for name, columns in EVENT_INDEXES.items()]
+
+DERIVED_COLUMNS = SEARCH_COLUMNS + FQN_COLUMNS
+# Миграции колонок search_vector и fqn_path, их заполнения и индексов
+DERIVED_MIGRATIONS = [8, 9, 15, 16, 17, 18]
+
+
+def admin(sql: str):
+    conn = psycopg2.connect(**{**DB_CONFIG, 'database': 'postgres'})
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    conn.close()
+
+
+def start_workers(count: int) -> list:
+    """count процессов одновременно выполняют init_database; время каждого, сек"""
+    processes = [subprocess.Popen([sys.executable, '-c', START_WORKER], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, text=True, env={**os.environ, 'PYTHONPATH': '.'})
+                 for _ in range(count)]
+    times = []
+    for process in processes:
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"init_database завершился с ошибкой:\n{err}")
+        times.append(float(out.strip().splitlines()[-1]))
+    return times
+
+
+def check_applied() -> list:
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version, count(*) FROM schema_migrations GROUP BY version ORDER BY version")
+        rows = cursor.fetchall()
+        conn.rollback()
+        cursor.close()
+    return rows
+
+
+def load(events: int, chunk_size: int = 5000):
+    with db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+        for number in range(events):
+            loader.add(parse_event(make_event('bench', number // 10, number % 10 + 1)))
+            if loader.full():
+                loader.flush()
+        loader.flush()
+        loader.cursor.close()
+        cursor = conn.cursor()
+        cursor.execute("ANALYZE metadata_change_events")
+        cursor.execute("ANALYZE field_changes")
+        conn.commit()
+        cursor.close()
+
+
+class Writer(threading.Thread):
+    """Пишет события по одному и записывает задержку каждой записи"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stop = threading.Event()
+        self.latencies = []
+        self.number = 0
+
+    def run(self):
+        while not self.stop.is_set():
+            self.number += 1
+            event = parse_event(make_event('writer', self.number, 1))
+            started = time.perf_counter()
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                write_events(cursor, [event])
+                conn.commit()
+                cursor.close()
+            self.latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+
+def with_writer(action) -> tuple:
+    writer = Writer()
+    writer.start()
+    time.sleep(1)
+    started = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - started
+    time.sleep(1)
+    writer.stop.set()
+    writer.join()
+    return elapsed, writer.latencies
+
+
+def drop_online_indexes():
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    for name in ONLINE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    cursor.execute("DELETE FROM schema_migrations WHERE version = 2")
+    conn.close()
+
+
+def online_migration():
+    online_migrations([2])
+
+
+def blocking_create():
+    conn = psycopg2.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX idx_entity_type_fqn ON metadata_change_events (entity_type, entity_fqn)")
+    cursor.execute("CREATE INDEX idx_field_changes_name_type ON field_changes (field_name, change_type)")
+    conn.commit()
+    conn.close()
+
+
+def with_long_reader(hold: float, action) -> tuple:
+    """action во время транзакции, которая hold секунд держит чтение metadata_change_events"""
+    reader = psycopg2.connect(**DB_CONFIG)
+    cursor = reader.cursor()
+    cursor.execute("SELECT count(*) FROM metadata_change_events")
+    timer = threading.Timer(hold, reader.rollback)
+    timer.start()
+    try:
+        return with_writer(action)
+    finally:
+        timer.join()
+        reader.close()
+
+
+def old_startup_ddl(cursor):
+    migrations.create_base_schema(cursor)
+    for sql in OLD_STARTUP_DDL:
+        cursor.execute(sql)
+
+
+def old_startup():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        old_startup_ddl(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def drop_derived_columns():
+    """Схема установки до колонок search_vector и fqn_path (вместе с их индексами)"""
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    for table, column, _, _, _ in DERIVED_COLUMNS:
+        cursor.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {column}")
+    cursor.execute("DELETE FROM schema_migrations WHERE version = ANY(%s)", (DERIVED_MIGRATIONS,))
+    conn.close()
+
+
+def check_derived_columns() -> list:
+    """Ошибки колонок после обновления: генерируемые вместо обычных, незаполненные или неверные строки"""
+    errors = []
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for table, column, _, _, expression in DERIVED_COLUMNS:
+            if migrations._is_generated(cursor, table, column):
+                errors.append(f"{table}.{column} - генерируемая колонка")
+            cursor.execute(f"SELECT count(*) FROM {table} WHERE {column} IS DISTINCT FROM ({expression.format(row='')})")
+            stale = cursor.fetchone()[0]
+            if stale:
+                errors.append(f"{table}.{column}: строк с неверным значением {stale}")
+        conn.rollback()
+        cursor.close()
+    return errors
+
+
+def online_migrations(expected: list):
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        applied = migrations.migrate(conn, online=True)
+    finally:
+        conn.close()
+    if applied != expected:
+        raise RuntimeError(f"Применены миграции {applied} вместо {expected}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=300000, help='Событий для замера построения индексов')
+    parser.add_argument('--workers', type=int, default=4, help='Процессов, одновременно запускающих init_database')
+    parser.add_argument('--repeats', type=int, default=20, help='Повторов замера запуска при актуальной схеме')
+    parser.add_argument('--hold', type=float, default=3, help='Длительность долгого запроса в шаге 4, сек')
+    parser.add_argument('--keep', action='store_true', help='Не удалять БД бенчмарка')
+    args = parser.parse_args()
+
+    failures = []
+    admin(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+    admin(f"CREATE DATABASE {BENCH_DB}")
+    try:
+        times = start_workers(args.workers)
+        applied = check_applied()
+        print(f"1. {args.workers} процессов на пустой БД: {max(times):.2f} с (быстрейший {min(times):.2f} с), "
+              f"миграции {[version for version, _ in applied]}")
+        if applied != [(migration.version, 1) for migration in migrations.MIGRATIONS if not migration.online]:
+            failures.append(f"миграции записаны не по одному разу: {applied}")
+        # Online-миграции на пустых таблицах - сразу, как их выполнит поток воркера
+        conn = psycopg2.connect(**DB_CONFIG)
+        online_migration_applied = migrations.migrate(conn, online=True)
+        conn.close()
+
+        fast, full = [], []
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            init_database()
+            fast.append(time.perf_counter() - started)
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                started = time.perf_counter()
+                old_startup_ddl(cursor)
+                conn.commit()
+                full.append(time.perf_counter() - started)
+                cursor.close()
+        print(f"2. init_database при актуальной схеме: {median(fast) * 1000:.1f} мс "
+              f"(весь DDL, как раньше: {median(full) * 1000:.1f} мс); online-миграции {online_migration_applied}")
+        processes = start_workers(args.workers)
+        print(f"   запуск {args.workers} новых процессов: init_database {median(processes) * 1000:.0f} мс")
+
+        started = time.perf_counter()
+        load(args.events)
+        print(f"3. загружено {args.events} событий за {time.perf_counter() - started:.0f} с")
+        _, idle = with_writer(lambda: time.sleep(5))
+        drop_online_indexes()
+        concurrent, during = with_writer(online_migration)
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                       "WHERE c.relname = ANY(%s) AND i.indisvalid", (list(ONLINE_INDEXES),))
+        valid = cursor.fetchone()[0]
+        conn.close()
+        drop_online_indexes()
+        blocking, blocked = with_writer(blocking_create)
+        for title, elapsed, latencies in (('без построения', None, idle),
+                                          ('CREATE INDEX CONCURRENTLY по партициям', concurrent, during),
+                                          ('CREATE INDEX (блокирующий)', blocking, blocked)):
+            print(f"   {title}: " + (f"{elapsed:.1f} с, " if elapsed else "") +
+                  f"записей {len(latencies)}, задержка p50 {percentile(latencies, 0.5) * 1000:.0f} мс, "
+                  f"p99 {percentile(latencies, 0.99) * 1000:.0f} мс, max {max(latencies) * 1000:.0f} мс")
+
+        for title, action in (('4. запуск при долгом запросе, прежний DDL', old_startup),
+                              ('   запуск при долгом запросе, init_database', init_database)):
+            elapsed, latencies = with_long_reader(args.hold, action)
+            print(f"{title}: {elapsed:.2f} с, задержка записи max {max(latencies) * 1000:.0f} мс")
+
+        drop_derived_columns()
+        required, during_required = with_writer(init_database)
+        # Кроме заполнения и индексов колонок - миграция 2, индексы которой шаг 3 построил вручную
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            pending = [migration.version for migration in migrations.pending_migrations(cursor) if migration.online]
+            conn.rollback()
+            cursor.close()
+        backfill, during_backfill = with_writer(lambda: online_migrations(pending))
+        for title, elapsed, latencies in (('5. колонки search_vector и fqn_path на таблицах с данными', required,
+                                           during_required),
+                                          ('   заполнение старых строк и индексы (online)', backfill, during_backfill)):
+            print(f"{title}: {elapsed:.2f} с, записей {len(latencies)}, "
+                  f"задержка записи max {max(latencies) * 1000:.0f} мс")
+        failures.extend(check_derived_columns())
+        if valid != len(ONLINE_INDEXES):
+            failures.append(f"действительных online-индексов {valid} из {len(ONLINE_INDEXES)}")
+    finally:
+        from db_pool import get_pool
+        get_pool().closeall()
+        if not args.keep:
+            admin(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+
+    print("ok" if not failures else "Ошибки: " + "; ".join(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк хранения full_payload: inline / blob / patch (PAYLOAD_STORAGE)
+Синтетическая нагрузка - таблицы с сотнями колонок, каждая версия меняет описание
+одной колонки (типичная правка в OpenMetadata). Для каждого режима пишет одинаковый
+поток событий через write_events, замеряет скорость приёма, место под payload'ы
+(full_payload + entity_hash + payload_blobs) и проверяет, что entity читается обратно.
+
+Пример:
+    python bench_payload_store.py --tables 20 --versions 50 --columns 300
+"""
+
+import argparse
+import logging
+import random
+import time
+import uuid
+
+import payload_store
+import webhook_listener
+from db_pool import db_connection
+
+# Описания колонок, изменённые к текущей версии: {entity_id: {номер колонки: описание}}
+events_state = {}
+
+
+def make_entity(entity_id: str, columns: int, version: int, described: dict) -> dict:
+    return {
+        "id": entity_id,
+        "type": "table",
+        "name": entity_id,
+        "fullyQualifiedName": f"bench_db.bench_schema.{entity_id}",
+        "version": round(0.1 * (version + 1), 1),
+        "updatedAt": 1700000000000 + version * 1000,
+        "updatedBy": "bench@example.com",
+        "description": "Таблица для бенчмарка хранения payload'ов",
+        "tableType": "Regular",
+        "owners": [{"id": "owner-1", "type": "user", "name": "bench"}],
+        "tags": [{"tagFQN": "Tier.Tier2", "source": "Classification", "labelType": "Manual"}],
+        "columns": [{
+            "name": f"column_{i}",
+            "dataType": "VARCHAR",
+            "dataLength": 255,
+            "dataTypeDisplay": "varchar(255)",
+            "fullyQualifiedName": f"bench_db.bench_schema.{entity_id}.column_{i}",
+            "description": described.get(i, f"Колонка {i}: исходное описание"),
+            "constraint": "NULL",
+            "ordinalPosition": i + 1,
+            "tags": [],
+        } for i in range(columns)],
+    }
+
+
+def make_events(run_id: str, tables: int, versions: int, columns: int) -> list:
+    """События в порядке поступления: версии разных таблиц вперемешку"""
+    rng = random.Random(42)
+    events = []
+    for version in range(versions):
+        for table in range(tables):
+            entity_id = f"payload-{run_id}-{table}"
+            described = events_state.setdefault(entity_id, {})
+            change_desc = {"fieldsAdded": [], "fieldsUpdated": [], "fieldsDeleted": []}
+            if version:
+                column = rng.randrange(columns)
+                old = described.get(column, f"Колонка {column}: исходное описание")
+                described[column] = f"Колонка {column}: описание версии {version}"
+                change_desc["fieldsUpdated"].append({
+                    "name": f"columns.column_{column}.description",
+                    "oldValue": old,
+                    "newValue": described[column],
+                })
+            entity = make_entity(entity_id, columns, version, described)
+            events.append({
+                "id": f"payloadbench-{run_id}-{table}-{version}",
+                "eventType": "entityUpdated" if version else "entityCreated",
+                "timestamp": 1700000000000 + version * 1000 + table,
+                "entityType": "table",
+                "entityId": entity_id,
+                "entity": entity,
+                "userName": "bench@example.com",
+                "previousVersion": round(0.1 * version, 1),
+                "currentVersion": entity["version"],
+                "changeDescription": change_desc,
+            })
+    return events
+
+
+def cleanup(run_id: str):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"payloadbench-{run_id}-%"
+        entity_pattern = f"payload-{run_id}-%"
+        cursor.execute("""
+            DELETE FROM payload_blobs WHERE hash IN (
+                SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s)
+        """, (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (entity_pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (entity_pattern,))
+        conn.commit()
+        cursor.close()
+
+
+def measure_size(run_id: str) -> tuple:
+    """Байт на диске (после TOAST-сжатия): full_payload + entity_hash событий и их blob'ы"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"payloadbench-{run_id}-%"
+        cursor.execute("""
+            SELECT COALESCE(sum(pg_column_size(full_payload)), 0)
+                   + COALESCE(sum(pg_column_size(entity_hash)), 0)
+            FROM metadata_change_events WHERE event_id LIKE %s
+        """, (pattern,))
+        events_size = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT COALESCE(sum(pg_column_size(b.*)), 0), count(*), count(base_hash)
+            FROM payload_blobs b
+            WHERE hash IN (SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s)
+        """, (pattern,))
+        blobs_size, blobs, patches = cursor.fetchone()
+        cursor.close()
+    return int(events_size), int(blobs_size), blobs, patches
+
+
+def verify(run_id: str, events: list) -> bool:
+    """Каждый entity, прочитанный через /events-путь (restore_payloads), совпадает с исходным"""
+    expected = {event["id"]: payload_store.canonical_json(event["entity"]) for event in events}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT event_id, full_payload, entity_hash FROM metadata_change_events
+            WHERE event_id LIKE %s
+        """, (f"payloadbench-{run_id}-%",))
+        rows = [dict(zip(('event_id', 'full_payload', 'entity_hash'), row)) for row in cursor.fetchall()]
+        payload_store.restore_payloads(cursor, rows)
+        cursor.close()
+    return len(rows) == len(expected) and all(
+        payload_store.canonical_json(row['full_payload'].get('entity')) == expected[row['event_id']]
+        for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tables', type=int, default=20, help='Число таблиц')
+    parser.add_argument('--versions', type=int, default=50, help='Версий каждой таблицы')
+    parser.add_argument('--columns', type=int, default=300, help='Колонок в таблице')
+    parser.add_argument('--batch-size', type=int, default=50, help='Событий в одной транзакции')
+    parser.add_argument('--modes', nargs='+', default=list(payload_store.STORAGE_MODES),
+                        choices=payload_store.STORAGE_MODES)
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    logging.getLogger('webhook_listener').setLevel(logging.WARNING)
+    webhook_listener.init_database()
+
+    print(f"{'режим':>7} | {'событий/сек':>11} | {'payload, КБ':>11} | {'blob, КБ':>9} | "
+          f"{'всего, КБ':>10} | {'на событие, Б':>13} | {'blob/patch':>11} | {'читается':>8}")
+    print("-" * 100)
+    raw_size = None
+    for mode in args.modes:
+        run_id = uuid.uuid4().hex[:8]
+        events_state.clear()
+        events = make_events(run_id, args.tables, args.versions, args.columns)
+        if raw_size is None:
+            raw_size = sum(len(payload_store.canonical_json(event["entity"])) for event in events)
+        payload_store.PAYLOAD_STORAGE = mode
+        try:
+            started = time.perf_counter()
+            for start in range(0, len(events), args.batch_size):
+                webhook_listener.save_change_events(events[start:start + args.batch_size])
+            elapsed = time.perf_counter() - started
+
+            events_size, blobs_size, blobs, patches = measure_size(run_id)
+            total = events_size + blobs_size
+            ok = verify(run_id, events)
+            print(f"{mode:>7} | {len(events) / elapsed:>11.0f} | {events_size / 1024:>11.0f} | "
+                  f"{blobs_size / 1024:>9.0f} | {total / 1024:>10.0f} | {total / len(events):>13.0f} | "
+                  f"{f'{blobs - patches}/{patches}':>11} | {'да' if ok else 'НЕТ':>8}")
+        finally:
+            if not args.keep:
+                cleanup(run_id)
+    print(f"\nСырой JSON entity: {raw_size / 1024:.0f} КБ на {args.tables * args.versions} событий")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк восстановления сущности на дату в зависимости от глубины истории
+Для каждой глубины пишет сущность с N версиями (снимки раз в --interval версий и без снимков),
+затем замеряет время восстановления последней и средней версии без кэша и из кэша
+и сверяет результат с entity из payload'а события
+
+Пример:
+    python bench_reconstruct.py --depths 10 100 1000 --interval 50
+"""
+
+import argparse
+import logging
+import statistics
+import time
+import uuid
+
+import reconstruct
+import webhook_listener
+from db_pool import db_connection
+
+
+def make_entity(entity_id: str, version: int) -> dict:
+    """Таблица на версии version: описание меняется каждую версию, тег добавляется каждую десятую"""
+    return {
+        "id": entity_id,
+        "type": "table",
+        "name": entity_id,
+        "fullyQualifiedName": f"bench_db.bench_schema.{entity_id}",
+        "version": round(0.1 * (version + 1), 1),
+        "description": f"Описание версии {version}",
+        "tags": [{"tagFQN": f"Bench.tag_{i}"} for i in range(version // 10)],
+        "columns": [{"name": f"col_{i}", "dataType": "VARCHAR", "description": f"Колонка {i}"}
+                    for i in range(20)],
+    }
+
+
+def make_events(run_id: str, entity_id: str, depth: int) -> list:
+    events = []
+    for version in range(depth):
+        entity = make_entity(entity_id, version)
+        change_desc = {"fieldsAdded": [], "fieldsUpdated": [], "fieldsDeleted": []}
+        if version:
+            change_desc["fieldsUpdated"].append({
+                "name": "description",
+                "oldValue": f"Описание версии {version - 1}",
+                "newValue": f"Описание версии {version}",
+            })
+            if version % 10 == 0:
+                change_desc["fieldsAdded"].append({
+                    "name": "tags",
+                    "newValue": f'[{{"tagFQN": "Bench.tag_{version // 10 - 1}"}}]',
+                })
+        events.append({
+            "id": f"reconbench-{run_id}-{entity_id}-{version}",
+            "eventType": "entityUpdated" if version else "entityCreated",
+            "timestamp": 1700000000000 + version * 1000,
+            "entityType": "table",
+            "entityId": entity_id,
+            "entity": entity,
+            "userName": "bench@example.com",
+            "previousVersion": round(0.1 * version, 1),
+            "currentVersion": entity["version"],
+            "changeDescription": change_desc,
+        })
+    return events
+
+
+def cleanup(run_id: str):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"reconbench-{run_id}-%"
+        entity_pattern = f"recon-{run_id}-%"
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (entity_pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (entity_pattern,))
+        conn.commit()
+        cursor.close()
+
+
+def measure(reconstructor, entity_id: str, version: float, repeat: int, cached: bool):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if not cached:
+            reconstructor.clear()
+        started = time.perf_counter()
+        result = reconstructor.reconstruct(entity_id, version=version)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Число версий сущности')
+    parser.add_argument('--interval', type=int, default=reconstruct.ENTITY_SNAPSHOT_INTERVAL,
+                        help='Снимок раз в N версий')
+    parser.add_argument('--repeat', type=int, default=20, help='Замеров на точку')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    logging.getLogger('webhook_listener').setLevel(logging.WARNING)
+    webhook_listener.init_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    reconstructor = reconstruct.Reconstructor(db_connection, cache_size=256)
+    print(f"{'версий':>7} | {'снимки':>8} | {'версия':>8} | {'дельт':>6} | {'без кэша, мс':>12} | "
+          f"{'из кэша, мс':>11} | {'совпадает':>9}")
+    print("-" * 80)
+    try:
+        for depth in args.depths:
+            for interval in (args.interval, 0):
+                entity_id = f"recon-{run_id}-{depth}-{interval}"
+                reconstruct.ENTITY_SNAPSHOT_INTERVAL = interval
+                events = make_events(run_id, entity_id, depth)
+                for start in range(0, depth, 500):
+                    # Пачками по одной версии: снимки создаются так же, как при обычном приёме
+                    for event in events[start:start + 500]:
+                        webhook_listener.save_change_events([event])
+
+                for target in (depth - 1, depth // 2):
+                    expected = make_entity(entity_id, target)
+                    cold, result = measure(reconstructor, entity_id, expected["version"], args.repeat, False)
+                    warm, _ = measure(reconstructor, entity_id, expected["version"], args.repeat, True)
+                    entity = result['entity']
+                    ok = (entity.get('description') == expected['description']
+                          and entity.get('tags') == expected['tags'])
+                    label = f"{interval}" if interval else "нет"
+                    print(f"{depth:>7} | {label:>8} | {expected['version']:>8} | {result['deltas_applied']:>6} | "
+                          f"{cold:>12.2f} | {warm:>11.3f} | {'да' if ok else 'НЕТ':>9}")
+    finally:
+        if not args.keep:
+            cleanup(run_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк /search на большой истории: загружает синтетические события (изменения описаний,
+тегов колонок и владельцев) через ChunkLoader из bulk_import в БД из настроек .env
+и измеряет задержку запросов поиска - через GIN-индексы (search.build_search_query)
+и для сравнения прежним способом, LIKE по тексту new_value.
+
+Редкая «иголка»: колонка ssn получает тег PII.Sensitive примерно в одном событии из NEEDLE_EVERY.
+
+Пример:
+    python bench_search.py --events 2000000 --workers 4
+    python bench_search.py --run-id 1a2b3c4d --skip-load --repeat 20   # повторно по загруженным
+    python bench_search.py --run-id 1a2b3c4d --skip-load --cleanup-only
+"""
+
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from bulk_import import ChunkLoader
+from db_pool import db_connection
+from event_parser import parse_event
+from partitions import ensure_partitions
+from payload_store import release_references, collect_garbage
+from search import build_search_query
+
+NEEDLE_EVERY = 5000
+COLUMNS = ('id', 'ssn', 'email', 'phone', 'address', 'created_at', 'amount', 'status')
+TAGS = ('Tier.Tier1', 'Tier.Tier2', 'PII.NonSensitive', 'Quality.Verified', 'Domain.Sales', 'Domain.Finance')
+USERS = tuple(f"user{i}@example.com" for i in range(200))
+# Словарь описаний: частые и редкие слова (распределение близко к Ципфу)
+WORDS = tuple(f"term{i}" for i in range(20000)) + (
+    'клиенты', 'заказы', 'платежи', 'витрина', 'выгрузка', 'ежедневная', 'customer', 'orders', 'revenue')
+
+
+def _word(rng: random.Random) -> str:
+    return WORDS[min(int(rng.paretovariate(1.1)) - 1, len(WORDS) - 1)] if rng.random() < 0.7 \
+        else rng.choice(WORDS)
+
+
+def make_event(rng: random.Random, run_id: str, number: int, entities: int, start: datetime,
+               span_seconds: int) -> dict:
+    entity_number = rng.randrange(entities)
+    entity_id = f"searchbench-{run_id}-{entity_number}"
+    fqn = f"svc_{entity_number % 7}.db_{entity_number % 31}.schema_{entity_number % 97}.table_{entity_number}"
+    description = ' '.join(_word(rng) for _ in range(rng.randint(5, 25)))
+    owner = {"name": rng.choice(USERS), "type": "user"}
+
+    changes = {'fieldsAdded': [], 'fieldsUpdated': [], 'fieldsDeleted': []}
+    column_tags = []
+    for _ in range(rng.randint(1, 3)):
+        kind = rng.random()
+        if kind < 0.4:
+            changes['fieldsUpdated'].append({
+                'name': 'description', 'oldValue': ' '.join(_word(rng) for _ in range(8)), 'newValue': description})
+        elif kind < 0.8:
+            column = rng.choice(COLUMNS)
+            tag = rng.choice(TAGS)
+            if number % NEEDLE_EVERY == 0:
+                column, tag = 'ssn', 'PII.Sensitive'
+            column_tags.append((column, tag))
+            changes['fieldsAdded'].append({
+                'name': f"columns.{column}.tags",
+                'newValue': json.dumps([{"tagFQN": tag, "source": "Classification", "labelType": "Manual"}])})
+        else:
+            changes['fieldsUpdated'].append({
+                'name': 'owner', 'oldValue': json.dumps({"name": rng.choice(USERS), "type": "user"}),
+                'newValue': json.dumps(owner)})
+
+    tags_by_column = dict(column_tags)
+    event_time = start + timedelta(seconds=rng.randrange(span_seconds))
+    return {
+        "id": f"searchbench-{run_id}-{number}",
+        "eventType": "entityUpdated",
+        "timestamp": int(event_time.timestamp() * 1000),
+        "entityType": "table",
+        "entityId": entity_id,
+        "entity": {
+            "id": entity_id, "name": f"table_{entity_number}", "fullyQualifiedName": fqn,
+            "description": description, "owner": owner,
+            "columns": [{"name": column, "dataType": "VARCHAR",
+                         "tags": [{"tagFQN": tags_by_column[column]}] if column in tags_by_column else []}
+                        for column in COLUMNS],
+        },
+        "userName": rng.choice(USERS),
+        "previousVersion": 0.1,
+        "currentVersion": round(0.1 + number / 1e6, 6),
+        "changeDescription": changes,
+    }
+
+
+def load_part(args) -> int:
+    run_id, first, count, entities, start, span_seconds, chunk_size = args
+    rng = random.Random(first)
+    with db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+        for number in range(first, first + count):
+            loader.add(parse_event(make_event(rng, run_id, number, entities, start, span_seconds)))
+            if loader.full():
+                loader.flush()
+        loader.flush()
+        loader.cursor.close()
+    return loader.totals['inserted']
+
+
+def load(run_id: str, events: int, entities: int, days: int, workers: int, chunk_size: int):
+    start = datetime.now() - timedelta(days=days)
+    with db_connection() as conn:
+        ensure_partitions(conn, start=start.date())
+    per_worker = -(-events // workers)
+    parts = [(run_id, first, min(per_worker, events - first), entities, start, days * 86400, chunk_size)
+             for first in range(0, events, per_worker)]
+    started = time.monotonic()
+    with Pool(workers) as pool:
+        inserted = sum(pool.map(load_part, parts))
+    elapsed = time.monotonic() - started
+    print(f"Загружено событий: {inserted} за {elapsed:.0f} с ({inserted / elapsed:.0f}/сек)")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("ANALYZE metadata_change_events")
+        cursor.execute("ANALYZE field_changes")
+        cursor.execute("ANALYZE entity_current_state")
+        conn.commit()
+        cursor.close()
+
+
+# (название, параметры /search или SQL прежнего способа)
+CASES = (
+    ("ssn получил PII.Sensitive: field+contains",
+     {'field': 'columns.ssn.tags', 'contains': '[{"tagFQN": "PII.Sensitive"}]'}),
+    ("ssn получил PII.Sensitive: q",
+     {'q': 'ssn "PII.Sensitive"'}),
+    ("ssn получил PII.Sensitive: LIKE (прежний способ)",
+     "SELECT f.id FROM field_changes f WHERE f.field_name LIKE '%%ssn%%' "
+     "AND f.new_value LIKE '%%PII.Sensitive%%' ORDER BY f.event_time DESC, f.id DESC LIMIT %s"),
+    ("редкое слово в описании: q", {'q': 'term15000'}),
+    ("редкое слово: LIKE (прежний способ)",
+     "SELECT f.id FROM field_changes f WHERE f.new_value LIKE '%%term15000 %%' "
+     "ORDER BY f.event_time DESC, f.id DESC LIMIT %s"),
+    ("частое слово в описании: q", {'q': 'term0'}),
+    ("слова + исключение: q", {'q': 'клиенты заказы -revenue'}),
+    ("смена владельца на user7: contains",
+     {'field': 'owner', 'contains': '{"name": "user7@example.com"}'}),
+    ("тег Domain.Finance, последние 7 дней",
+     {'contains': '[{"tagFQN": "Domain.Finance"}]', 'since': None}),
+    ("сущности: колонка ssn с PII.Sensitive",
+     {'scope': 'entities', 'contains': '{"columns": [{"name": "ssn", "tags": [{"tagFQN": "PII.Sensitive"}]}]}'}),
+    ("сущности: владелец user7",
+     {'scope': 'entities', 'contains': '{"owner": {"name": "user7@example.com"}}'}),
+    ("сущности: текст", {'scope': 'entities', 'q': 'витрина'}),
+)
+
+
+def run_queries(repeat: int, limit: int):
+    week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+    print(f"{'запрос':<52} | {'строк':>6} | {'p50, мс':>9} | {'max, мс':>9}")
+    print("-" * 86)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for name, case in CASES:
+            if isinstance(case, dict):
+                args = {k: (week_ago if k == 'since' else v) for k, v in case.items()}
+                query, params, _ = build_search_query(args, limit)
+            else:
+                query, params = case, [limit]
+            timings, rows = [], 0
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cursor.execute(query, params)
+                rows = len(cursor.fetchall())
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{name:<52} | {rows:>6} | {statistics.median(timings):>9.1f} | {max(timings):>9.1f}")
+        conn.rollback()
+        cursor.close()
+
+
+def cleanup(run_id: str):
+    pattern = f"searchbench-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        release_references(cursor, "SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s",
+                           (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (pattern,))
+        collect_garbage(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000000, help='Событий для загрузки')
+    parser.add_argument('--entities', type=int, default=50000, help='Разных сущностей')
+    parser.add_argument('--days', type=int, default=180, help='За сколько дней распределить события')
+    parser.add_argument('--workers', type=int, default=4, help='Процессов загрузки')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Событий в транзакции загрузки')
+    parser.add_argument('--repeat', type=int, default=10, help='Повторов каждого запроса')
+    parser.add_argument('--limit', type=int, default=100, help='Размер страницы')
+    parser.add_argument('--run-id', default=None, help='Метка загрузки (для повторного прогона)')
+    parser.add_argument('--skip-load', action='store_true', help='Не загружать, искать по уже загруженным')
+    parser.add_argument('--keep', action='store_true', help='Не удалять загруженные события')
+    parser.add_argument('--cleanup-only', action='store_true', help='Только удалить события --run-id')
+    args = parser.parse_args()
+
+    run_id = args.run_id or uuid.uuid4().hex[:8]
+    if args.cleanup_only:
+        cleanup(run_id)
+        return 0
+    print(f"run_id: {run_id}")
+    try:
+        if not args.skip_load:
+            load(run_id, args.events, args.entities, args.days, args.workers, args.chunk_size)
+        run_queries(args.repeat, args.limit)
+    finally:
+        if not args.keep:
+            cleanup(run_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
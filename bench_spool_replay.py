@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк spool: запись накопившихся за время простоя БД событий и их перенос в БД
+Генерирует backlog в отдельном каталоге spool, затем переносит его SpoolReplayer'ом
+в БД из настроек .env и печатает скорость обеих фаз
+
+Пример:
+    python bench_spool_replay.py --events 1000000 --batch-size 1000
+"""
+
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+import uuid
+
+import webhook_listener
+from db_pool import db_connection
+from spool import Spool, SpoolReplayer, pending_stats
+
+
+def make_event(run_id: str, n: int) -> dict:
+    """Типичное небольшое событие entityUpdated с двумя изменёнными полями"""
+    return {
+        "id": f"spoolbench-{run_id}-{n}",
+        "eventType": "entityUpdated",
+        "timestamp": 1700000000000 + n,
+        "entityType": "table",
+        "entityId": f"spoolbench-entity-{n % 1000}",
+        "entityFQN": f"bench_db.bench_schema.table_{n % 1000}",
+        "entity": {
+            "id": f"spoolbench-entity-{n % 1000}",
+            "type": "table",
+            "name": f"table_{n % 1000}",
+            "fullyQualifiedName": f"bench_db.bench_schema.table_{n % 1000}"
+        },
+        "userName": "bench@example.com",
+        "previousVersion": 0.1,
+        "currentVersion": 0.2,
+        "changeDescription": {
+            "fieldsAdded": [],
+            "fieldsUpdated": [
+                {"name": "description", "oldValue": "Старое описание", "newValue": "Новое описание"},
+                {"name": "tags", "oldValue": [], "newValue": ["PII.Sensitive"]}
+            ],
+            "fieldsDeleted": []
+        }
+    }
+
+
+def cleanup(run_id: str):
+    """Удаляет события, записанные бенчмарком"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        pattern = f"spoolbench-{run_id}-%"
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", ("spoolbench-entity-%",))
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=1000000, help='Размер backlog')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Событий в одной транзакции переноса')
+    parser.add_argument('--segment-mb', type=int, default=64, help='Размер сегмента spool, МБ')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    logging.getLogger('webhook_listener').setLevel(logging.WARNING)
+    webhook_listener.init_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    directory = tempfile.mkdtemp(prefix='om_spool_bench_')
+    try:
+        # Фаза 1: БД «лежит», события пишутся в spool
+        spool = Spool(directory, segment_max_bytes=args.segment_mb * 1024 * 1024)
+        started = time.perf_counter()
+        for n in range(args.events):
+            spool.append(make_event(run_id, n), wait_sync=False)
+        spool.close()
+        spool_elapsed = time.perf_counter() - started
+        backlog = pending_stats(directory)
+        print(f"Запись в spool:   {args.events} событий за {spool_elapsed:.1f} сек "
+              f"({args.events / spool_elapsed:.0f} событий/сек), "
+              f"{backlog['pending_segments']} сегментов, {backlog['pending_bytes'] / 1024 / 1024:.0f} МБ")
+
+        # Фаза 2: БД вернулась, переносим backlog
+        replayer = SpoolReplayer(directory, webhook_listener.save_change_events, batch_size=args.batch_size)
+        started = time.perf_counter()
+        replayed = replayer.replay_all()
+        replay_elapsed = time.perf_counter() - started
+        print(f"Перенос в БД:     {replayed} событий за {replay_elapsed:.1f} сек "
+              f"({replayed / replay_elapsed:.0f} событий/сек, пачка {args.batch_size})")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if not args.keep:
+            cleanup(run_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Проверка и бенчмарк поиска пропусков версий (version_gaps.py) с заглушкой API OpenMetadata
+Загружает через ChunkLoader (bulk_import) историю --entities сущностей по --versions версий,
+выбрасывая долю --drop версий (потерянные webhook'и), и поднимает локальный HTTP-сервер,
+который отдаёт полные версии этих сущностей как GET /api/v1/tables/<id>/versions.
+
+Шаги (позиция проверки сначала переносится в конец потока - старая история БД не проверяется):
+1. scan: найденные пропуски сверяются с выброшенными версиями, скорость - событий/сек;
+2. поздняя доставка части пропущенных версий - scan закрывает их пропуски (filled);
+3. backfill из заглушки, повторный scan - новых пропусков нет, цепочки версий непрерывны;
+4. стоимость инкрементального шага: --step событий поверх всей таблицы.
+
+Пример:
+    python bench_version_gaps.py --entities 20000 --versions 20 --drop 0.02
+    python bench_version_gaps.py --run-id 1a2b3c4d --cleanup-only
+"""
+
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+
+from bench_async_server import free_port
+from bulk_import import ChunkLoader
+from db_pool import db_connection
+from event_parser import parse_event
+from partitions import ensure_partitions
+from payload_store import release_references, collect_garbage
+from version_gaps import OpenMetadataClient, backfill, scan, skip_to_head
+from webhook_listener import init_database, write_events
+
+START = datetime.now().replace(microsecond=0) - timedelta(days=20)
+
+
+def entity_id(run_id: str, number: int) -> str:
+    return f"gapbench-{run_id}-{number}"
+
+
+def version(number: int) -> float:
+    # 0.1, 0.2, ... (k / 10 без накопленной ошибки float)
+    return number / 10
+
+
+def entity_at(run_id: str, number: int, k: int) -> dict:
+    """Сущность number в версии k - как её отдаёт OpenMetadata"""
+    eid = entity_id(run_id, number)
+    return {
+        "id": eid, "name": f"table_{number}", "fullyQualifiedName": f"gapbench.{run_id}.table_{number}",
+        "version": version(k), "updatedAt": int((START + timedelta(minutes=number % 1000 + k * 5)).timestamp() * 1000),
+        "updatedBy": f"user{k % 7}@example.com", "description": f"Версия {k}",
+        "changeDescription": {"previousVersion": version(k - 1) if k > 1 else None, "fieldsUpdated": [
+            {"name": "description", "oldValue": f"Версия {k - 1}", "newValue": f"Версия {k}"}]},
+    }
+
+
+def make_event(run_id: str, number: int, k: int) -> dict:
+    entity = entity_at(run_id, number, k)
+    return {
+        "id": f"{entity['id']}-v{k}",
+        "eventType": "entityCreated" if k == 1 else "entityUpdated",
+        "entityType": "table",
+        "entityId": entity['id'],
+        "timestamp": entity['updatedAt'],
+        "userName": entity['updatedBy'],
+        "previousVersion": version(k - 1) if k > 1 else version(k),
+        "currentVersion": version(k),
+        "changeDescription": entity['changeDescription'],
+        "entity": entity,
+    }
+
+
+def dropped_versions(run_id: str, entities: int, versions: int, drop: float) -> dict:
+    """{entity: [k, ...]} - выброшенные версии; первая версия всегда есть"""
+    rng = random.Random(run_id)
+    return {number: ks for number in range(entities)
+            if (ks := [k for k in range(2, versions + 1) if rng.random() < drop])}
+
+
+def expected_gaps(dropped: dict, versions: int) -> set:
+    """
+    Обнаружимые пропуски: (entity, последняя выброшенная версия серии), если после серии
+    есть событие; выброшенный хвост не виден, пока не придёт следующая версия
+    """
+    gaps = set()
+    for number, ks in dropped.items():
+        missing = set(ks)
+        for k in ks:
+            if k + 1 not in missing and k < versions:
+                gaps.add((number, k))
+    return gaps
+
+
+def load_part(args) -> int:
+    run_id, numbers, versions, dropped, chunk_size = args
+    with db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+        for number in numbers:
+            skip = set(dropped.get(number, ()))
+            for k in range(1, versions + 1):
+                if k not in skip:
+                    loader.add(parse_event(make_event(run_id, number, k)))
+                    if loader.full():
+                        loader.flush()
+        loader.flush()
+        loader.cursor.close()
+    return loader.totals['inserted']
+
+
+def load(run_id: str, entities: int, versions: int, dropped: dict, workers: int, chunk_size: int) -> float:
+    numbers = list(range(entities))
+    parts = [(run_id, numbers[i::workers], versions, dropped, chunk_size) for i in range(workers)]
+    started = time.monotonic()
+    with Pool(workers) as pool:
+        inserted = sum(pool.map(load_part, parts))
+    elapsed = time.monotonic() - started
+    print(f"Загружено событий: {inserted} за {elapsed:.0f} с")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("ANALYZE metadata_change_events")
+        conn.commit()
+        cursor.close()
+    return inserted
+
+
+def deliver(run_id: str, pairs: list):
+    """Поздняя доставка: события (entity, k) через write_events одной транзакцией"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        write_events(cursor, [parse_event(make_event(run_id, number, k)) for number, k in pairs])
+        conn.commit()
+        cursor.close()
+
+
+class StubOpenMetadata(ThreadingHTTPServer):
+    """GET /api/v1/tables/<id>/versions - все версии сущности от новой к старой"""
+
+    daemon_threads = True
+
+    def __init__(self, port: int, run_id: str, versions: int):
+        self.run_id = run_id
+        self.versions = versions
+        self.requests = 0
+        super().__init__(('127.0.0.1', port), _StubHandler)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        parts = self.path.strip('/').split('/')
+        prefix = f"gapbench-{server.run_id}-"
+        if len(parts) != 5 or parts[:3] != ['api', 'v1', 'tables'] or parts[4] != 'versions' \
+                or not parts[3].startswith(prefix):
+            self.send_error(404)
+            return
+        number = int(parts[3][len(prefix):])
+        body = json.dumps({"entityType": "table", "versions": [
+            json.dumps(entity_at(server.run_id, number, k)) for k in range(server.versions, 0, -1)]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def found_gaps(run_id: str, status: str = None) -> set:
+    prefix = f"gapbench-{run_id}-"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT entity_id, missing_version FROM version_gaps WHERE entity_id LIKE %s"
+                       + (" AND status = %s" if status else ""), (prefix + '%',) + ((status,) if status else ()))
+        gaps = {(int(eid[len(prefix):]), int(missing * 10)) for eid, missing in cursor.fetchall()}
+        conn.rollback()
+        cursor.close()
+    return gaps
+
+
+def broken_chains(run_id: str, versions: int, dropped: dict) -> int:
+    """Сущности, у которых не хватает версий, кроме выброшенного хвоста"""
+    prefix = f"gapbench-{run_id}-"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT entity_id, array_agg(DISTINCT current_version) FROM metadata_change_events "
+                       "WHERE entity_id LIKE %s GROUP BY entity_id", (prefix + '%',))
+        present = {int(eid[len(prefix):]): {int(v * 10) for v in vs} for eid, vs in cursor.fetchall()}
+        conn.rollback()
+        cursor.close()
+    broken = 0
+    for number, ks in present.items():
+        tail = versions
+        while tail in set(dropped.get(number, ())) and tail not in ks:
+            tail -= 1
+        if ks != set(range(1, tail + 1)):
+            broken += 1
+    return broken
+
+
+def timed_scan(limit: int) -> tuple:
+    with db_connection() as conn:
+        started = time.perf_counter()
+        result = scan(conn, limit=limit)
+        return result, time.perf_counter() - started
+
+
+def cleanup(run_id: str):
+    pattern = f"gapbench-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        release_references(cursor, "SELECT entity_hash FROM metadata_change_events WHERE entity_id LIKE %s",
+                           (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s OR event_id LIKE %s",
+                       (pattern, 'backfill-' + pattern))
+        for table in ('metadata_change_events', 'entity_snapshots', 'entity_current_state', 'version_gaps'):
+            cursor.execute(f"DELETE FROM {table} WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM event_rollups WHERE dimension LIKE 'fqn\\_%%' AND value LIKE %s",
+                       (f"gapbench.{run_id}%",))
+        collect_garbage(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', type=int, default=20000, help='Сущностей')
+    parser.add_argument('--versions', type=int, default=20, help='Версий каждой сущности')
+    parser.add_argument('--drop', type=float, default=0.02, help='Доля потерянных версий')
+    parser.add_argument('--late', type=float, default=0.3, help='Доля пропусков, версия которых приходит позже')
+    parser.add_argument('--step', type=int, default=1000, help='Событий в замере инкрементального шага')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Событий за шаг scan')
+    parser.add_argument('--workers', type=int, default=2, help='Процессов загрузки')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Событий в транзакции загрузки')
+    parser.add_argument('--run-id', default=None, help='Метка прогона (для --cleanup-only)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять загруженные события')
+    parser.add_argument('--cleanup-only', action='store_true', help='Только удалить данные --run-id')
+    args = parser.parse_args()
+
+    run_id = args.run_id or uuid.uuid4().hex[:8]
+    if args.cleanup_only:
+        cleanup(run_id)
+        return 0
+    print(f"run_id: {run_id}")
+    init_database()
+    with db_connection() as conn:
+        ensure_partitions(conn, start=START.date())
+        skip_to_head(conn)
+
+    failures = []
+    dropped = dropped_versions(run_id, args.entities, args.versions, args.drop)
+    expected = expected_gaps(dropped, args.versions)
+    port = free_port()
+    stub = StubOpenMetadata(port, run_id, args.versions)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    try:
+        inserted = load(run_id, args.entities, args.versions, dropped, args.workers, args.chunk_size)
+
+        result, elapsed = timed_scan(args.batch_size)
+        found = found_gaps(run_id)
+        print(f"1. scan: {result['scanned']} событий за {elapsed:.1f} с ({result['scanned'] / elapsed:.0f}/сек), "
+              f"пропусков {len(found)}, ожидалось {len(expected)}")
+        if found != expected or result['scanned'] < inserted:
+            failures.append(f"scan: лишних {len(found - expected)}, не найдено {len(expected - found)}")
+
+        # Поздно приходит ровно пропущенная версия из серии длиной 1 - её пропуск закрывается
+        rng = random.Random(run_id + 'late')
+        singles = sorted((number, k) for number, k in expected if k - 1 not in dropped[number])
+        late = [pair for pair in singles if rng.random() < args.late]
+        deliver(run_id, late)
+        for number, k in late:
+            dropped[number].remove(k)
+        result, elapsed = timed_scan(args.batch_size)
+        filled = found_gaps(run_id, 'filled')
+        print(f"2. поздняя доставка {len(late)} версий: закрыто пропусков {result['filled']}")
+        if filled != set(late):
+            failures.append(f"filled: {len(filled)} вместо {len(late)}")
+
+        with db_connection() as conn:
+            started = time.perf_counter()
+            result = backfill(conn, OpenMetadataClient(f'http://127.0.0.1:{port}'), write_events,
+                              limit=len(expected) + 1)
+            elapsed = time.perf_counter() - started
+        rescan, _ = timed_scan(args.batch_size)
+        broken = broken_chains(run_id, args.versions, dropped)
+        print(f"3. backfill: пропусков {result['backfilled']} ({result['events']} событий) за {elapsed:.1f} с, "
+              f"ошибок {result['failed']}, запросов к заглушке {stub.requests}; новых пропусков {rescan['gaps']}, "
+              f"разорванных цепочек {broken}")
+        if result['failed'] or rescan['gaps'] or broken or found_gaps(run_id, 'open'):
+            failures.append("backfill: остались пропуски")
+
+        # Инкрементальный шаг: step новых версий поверх всей таблицы
+        numbers = rng.sample(range(args.entities), min(args.step, args.entities))
+        deliver(run_id, [(number, args.versions + 2) for number in numbers])
+        result, elapsed = timed_scan(args.batch_size)
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT count(*) FROM metadata_change_events")
+            total = cursor.fetchone()[0]
+            conn.rollback()
+            cursor.close()
+        print(f"4. шаг: {result['scanned']} новых событий (таблица - {total}) за {elapsed * 1000:.0f} мс, "
+              f"пропусков {result['gaps']} (ожидалось {len(numbers)})")
+        if result['gaps'] != len(numbers):
+            failures.append("шаг: не найдены пропуски")
+    finally:
+        stub.shutdown()
+        if not args.keep:
+            cleanup(run_id)
+
+    print("ok" if not failures else "Ошибки: " + "; ".join(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
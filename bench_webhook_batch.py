@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк приёма пачками: /webhook (событие на запрос) против /webhook/batch с разным
+размером пачки. Сервер (gunicorn с Flask-приложением или uvicorn с asgi_app) запускается
+на свободном порту с настройками БД из окружения; клиенты шлют запросы подряд.
+Выводит события/сек, запросов/сек и задержку ответа на запрос (p50/p99).
+
+Пример:
+    python bench_webhook_batch.py --events 20000 --batch-sizes 1 10 100 1000
+    python bench_webhook_batch.py --server asgi --concurrency 8 --format ndjson
+"""
+
+import sys
+import json
+import time
+import uuid
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_async_server import SECRET, free_port, start_server, make_event, cleanup
+
+
+def run_load(port: int, run_id: str, events: int, batch_size: int, concurrency: int, ndjson: bool) -> tuple:
+    """events событий пачками по batch_size из concurrency потоков (batch_size=1 - через /webhook)"""
+    headers = {'Authorization': f'Bearer {SECRET}', 'Content-Type': 'application/json'}
+    if batch_size == 1:
+        url = f'http://127.0.0.1:{port}/webhook'
+    else:
+        url = f'http://127.0.0.1:{port}/webhook/batch'
+        if ndjson:
+            headers['Content-Type'] = 'application/x-ndjson'
+    per_client = events // concurrency
+
+    def client(index: int):
+        session = requests.Session()
+        latencies, written, errors = [], 0, 0
+        numbers = range(index * per_client, (index + 1) * per_client)
+        for start in range(0, len(numbers), batch_size):
+            batch = [make_event(run_id, number) for number in numbers[start:start + batch_size]]
+            if batch_size == 1:
+                body = json.dumps(batch[0])
+            elif ndjson:
+                body = '\n'.join(json.dumps(event_data) for event_data in batch)
+            else:
+                body = json.dumps(batch)
+            started = time.perf_counter()
+            response = session.post(url, data=body, headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += len(batch)
+            elif batch_size == 1:
+                written += 1
+            else:
+                result = response.json()
+                written += result['accepted'] + result['duplicate']
+                errors += result['rejected']
+        return latencies, written, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for client_latencies, _, _ in results for latency in client_latencies)
+    written = sum(client_written for _, client_written, _ in results)
+    errors = sum(client_errors for _, _, client_errors in results)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return written / elapsed, len(latencies) / elapsed, statistics.median(latencies), p99, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000, help='Событий на каждый размер пачки')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Событий в запросе (1 - /webhook)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Одновременных клиентов')
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask')
+    parser.add_argument('--workers', type=int, default=2, help='Воркеров gunicorn/uvicorn')
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json', help='Тело /webhook/batch')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записанные события')
+    args = parser.parse_args()
+
+    port = free_port()
+    process = start_server(args.server, port, args.workers)
+    run_id = uuid.uuid4().hex[:8]
+    print(f"{args.server} x{args.workers}, клиентов: {args.concurrency}, тело пачки: {args.format}")
+    print(f"{'пачка':>6} | {'событий/сек':>11} | {'запросов/сек':>12} | {'p50, мс':>8} | {'p99, мс':>8} | {'ошибок':>6}")
+    print("-" * 68)
+    try:
+        for batch_size in args.batch_sizes:
+            rate, request_rate, p50, p99, errors = run_load(
+                port, f"{run_id}-{batch_size}", args.events, batch_size, args.concurrency, args.format == 'ndjson')
+            print(f"{batch_size:>6} | {rate:>11.0f} | {request_rate:>12.1f} | {p50:>8.1f} | {p99:>8.1f} | {errors:>6}")
+    finally:
+        process.terminate()
+        process.wait(30)
+        if not args.keep:
+            cleanup(run_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
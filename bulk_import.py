@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Массовая загрузка исторических событий OpenMetadata из JSONL-файла
+Файл читается построчно (память не зависит от размера файла), события разбираются
+той же функцией, что и в /webhook, и грузятся через COPY во временные таблицы
+с последующим слиянием в metadata_change_events / field_changes / deleted_entities.
+При PAYLOAD_STORAGE=blob|patch entity кладутся в payload_blobs полными сжатыми копиями
+(patch'и к предыдущим версиям строит только приём через /webhook).
+
+Примеры:
+    python bulk_import.py events.jsonl
+    python bulk_import.py events.jsonl --workers 4 --state-file events.state
+    python bulk_import.py events.jsonl --start-offset 1073741824
+
+При повторном запуске с тем же --state-file и --workers загрузка продолжается
+с последнего подтверждённого смещения каждого куска файла.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import fcntl
+import logging
+import argparse
+import multiprocessing
+from typing import Dict, Any, List, Optional, Tuple
+
+from db_pool import db_connection
+from event_parser import ChangeEvent, json_text, parse_event
+from entity_state import STATE_COLUMNS, UPSERT_CONFLICT
+from log_config import configure_logging
+from payload_store import PAYLOAD_COMPRESSION_LEVEL, prepare_blobs, stored_payload
+from rollups import merge_sql, source_sql
+from webhook_listener import init_database, resolve_clock_times
+
+logger = logging.getLogger('bulk_import')
+
+STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS import_events (
+        event_id TEXT,
+        event_type TEXT,
+        event_time TEXT,
+        entity_type TEXT,
+        entity_id TEXT,
+        entity_fqn TEXT,
+        entity_name TEXT,
+        change_description TEXT,
+        updated_by TEXT,
+        previous_version TEXT,
+        current_version TEXT,
+        full_payload TEXT,
+        entity_snapshot TEXT,
+        field_change_count INTEGER,
+        entity_hash TEXT
+    );
+    CREATE TEMP TABLE IF NOT EXISTS import_blobs (
+        hash TEXT,
+        data TEXT,
+        raw_size INTEGER,
+        stored_size INTEGER
+    );
+    CREATE TEMP TABLE IF NOT EXISTS import_field_changes (
+        event_id TEXT,
+        event_time TEXT,
+        field_name TEXT,
+        old_value TEXT,
+        new_value TEXT,
+        change_type TEXT
+    );
+    CREATE TEMP TABLE IF NOT EXISTS import_deleted_entities (
+        event_id TEXT,
+        entity_id TEXT,
+        entity_type TEXT,
+        entity_fqn TEXT,
+        entity_name TEXT,
+        deleted_at TEXT,
+        deleted_by TEXT,
+        last_snapshot TEXT
+    );
+"""
+
+# Слияние кусочка: новые события, их изменения полей и удаления - одним запросом.
+# Изменения полей, удаления, состояние сущностей и агрегаты - только для событий,
+# которых ещё не было в БД: новые определяются по ключу ON CONFLICT (event_id, event_time).
+# События без id с ключом не конфликтуют (NULL в уникальном ключе) и вставляются все, как в /webhook
+MERGE_SQL = """
+    WITH inserted AS (
+        INSERT INTO metadata_change_events
+        (event_id, event_type, event_time, entity_type, entity_id, entity_fqn,
+         entity_name, change_description, updated_by, previous_version,
+         current_version, full_payload, entity_hash)
+        SELECT event_id, event_type, event_time::timestamp, entity_type, entity_id, entity_fqn,
+               entity_name, change_description, updated_by, previous_version::decimal,
+               current_version::decimal, full_payload::jsonb, entity_hash::bytea
+        FROM import_events
+        ON CONFLICT DO NOTHING
+        RETURNING event_id, event_time, entity_hash
+    ),
+    new_events AS (
+        SELECT ev.* FROM import_events ev
+        JOIN inserted i ON i.event_id = ev.event_id AND i.event_time = ev.event_time::timestamp
+        UNION ALL
+        SELECT ev.* FROM import_events ev WHERE ev.event_id IS NULL
+    ),
+    new_fields AS (
+        SELECT f.* FROM import_field_changes f
+        WHERE f.event_id IS NULL
+           OR EXISTS (SELECT 1 FROM inserted i
+                      WHERE i.event_id = f.event_id AND i.event_time = f.event_time::timestamp)
+    ),
+    inserted_blobs AS (
+        INSERT INTO payload_blobs AS b (hash, depth, data, raw_size, stored_size, refcount)
+        SELECT r.hash, 0, bl.data::bytea, bl.raw_size, bl.stored_size, r.n
+        FROM (SELECT entity_hash AS hash, count(*) AS n FROM inserted
+              WHERE entity_hash IS NOT NULL GROUP BY entity_hash) r
+        JOIN import_blobs bl ON bl.hash::bytea = r.hash
+        ON CONFLICT (hash) DO UPDATE SET refcount = b.refcount + EXCLUDED.refcount
+        RETURNING 1
+    ),
+    inserted_fields AS (
+        INSERT INTO field_changes (event_id, event_time, field_name, old_value, new_value, change_type)
+        SELECT f.event_id, f.event_time::timestamp, f.field_name, f.old_value, f.new_value, f.change_type
+        FROM new_fields f
+        RETURNING 1
+    ),
+    inserted_deleted AS (
+        INSERT INTO deleted_entities
+        (entity_id, entity_type, entity_fqn, entity_name, deleted_at, deleted_by, last_snapshot)
+        SELECT DISTINCT ON (d.entity_id)
+               d.entity_id, d.entity_type, d.entity_fqn, d.entity_name,
+               d.deleted_at::timestamp, d.deleted_by, d.last_snapshot::jsonb
+        FROM import_deleted_entities d
+        WHERE d.event_id IS NULL
+           OR EXISTS (SELECT 1 FROM inserted i
+                      WHERE i.event_id = d.event_id AND i.event_time = d.deleted_at::timestamp)
+        ORDER BY d.entity_id, d.deleted_at::timestamp DESC
+        ON CONFLICT (entity_id) DO UPDATE SET
+            deleted_at = EXCLUDED.deleted_at,
+            deleted_by = EXCLUDED.deleted_by
+        WHERE EXCLUDED.deleted_at >= deleted_entities.deleted_at
+        RETURNING 1
+    ),
+    inserted_state AS (
+        INSERT INTO entity_current_state AS s ({state_columns})
+        SELECT DISTINCT ON (ev.entity_id)
+               ev.entity_id, ev.entity_type, ev.entity_fqn, ev.entity_name, ev.current_version::decimal,
+               ev.event_id, ev.event_type, ev.event_time::timestamp, ev.updated_by,
+               ev.entity_snapshot::jsonb, ev.event_type = 'entityDeleted',
+               min(ev.event_time::timestamp) OVER w, count(*) OVER w, sum(ev.field_change_count) OVER w,
+               CASE WHEN ev.entity_snapshot IS NOT NULL THEN ev.entity_hash::bytea END
+        FROM new_events ev
+        WHERE ev.entity_id IS NOT NULL
+        WINDOW w AS (PARTITION BY ev.entity_id)
+        ORDER BY ev.entity_id, COALESCE(ev.current_version::decimal, -1) DESC, ev.event_time::timestamp DESC
+        {state_conflict}
+        RETURNING 1
+    ),
+    inserted_rollups AS (
+        {rollups}
+    )
+    SELECT (SELECT count(*) FROM inserted),
+           (SELECT count(*) FROM inserted_fields),
+           (SELECT count(*) FROM inserted_deleted),
+           (SELECT count(*) FROM inserted_state),
+           (SELECT count(*) FROM inserted_blobs)
+""".format(
+    state_columns=', '.join(STATE_COLUMNS),
+    state_conflict=UPSERT_CONFLICT,
+    rollups=merge_sql(source_sql(
+        "new_events e",
+        "new_fields f",
+    )),
+)
+
+
+def _copy_value(value) -> str:
+    """Значение в текстовом формате COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, bytes):
+        value = '\\x' + value.hex()
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _write_row(buffer: io.StringIO, row: tuple):
+    buffer.write('\t'.join(_copy_value(value) for value in row))
+    buffer.write('\n')
+
+
+class ChunkLoader:
+    """Копит разобранные события и загружает их в БД кусками по chunk_size"""
+
+    def __init__(self, conn, chunk_size: int):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.cursor = conn.cursor()
+        self.cursor.execute(STAGING_DDL)
+        conn.commit()
+        self._reset()
+        self.totals = {'lines': 0, 'events': 0, 'inserted': 0, 'field_changes': 0,
+                       'deleted': 0, 'entities': 0, 'blobs': 0, 'rejected': 0}
+
+    def _reset(self):
+        self.events = io.StringIO()
+        self.fields = io.StringIO()
+        self.deleted = io.StringIO()
+        self.blobs = io.StringIO()
+        self.seen = set()
+        self.seen_blobs = set()
+        # События с id без времени ждут flush: их время - от уже записанной копии
+        self.clocked = []
+        self.count = 0
+
+    def add(self, event: ChangeEvent):
+        if event.event_time_from_clock and event.event_id is not None:
+            self.clocked.append(event)
+            return
+        self._write(event)
+
+    def _write(self, event: ChangeEvent):
+        event_id = event.event_id
+        if event_id is not None:
+            key = (event_id, event.event_time)
+            if key in self.seen:
+                # Дубликат внутри куска: оставляем первое вхождение, как ON CONFLICT DO NOTHING.
+                # События без id не дедуплицируются - ни здесь, ни в БД
+                return
+            self.seen.add(key)
+
+        for entity_hash, raw in prepare_blobs([event]).items():
+            if entity_hash not in self.seen_blobs:
+                self.seen_blobs.add(entity_hash)
+                data = zlib.compress(raw, PAYLOAD_COMPRESSION_LEVEL)
+                _write_row(self.blobs, (entity_hash, data, len(raw), len(data)))
+        _write_row(self.events, (
+            event_id, event.event_type, event.event_time, event.entity_type, event.entity_id,
+            event.entity_fqn, event.entity_name, json_text(event.change_description), event.updated_by,
+            event.previous_version, event.current_version, stored_payload(event),
+            None if event.entity_from_event else event.entity, len(event.field_changes),
+            event.entity_hash
+        ))
+        for row in event.field_changes:
+            _write_row(self.fields, row)
+        if event.is_deletion:
+            _write_row(self.deleted, (
+                event_id, event.entity_id, event.entity_type, event.entity_fqn, event.entity_name,
+                event.event_time, event.updated_by, event.entity
+            ))
+        self.count += 1
+
+    def full(self) -> bool:
+        return self.count + len(self.clocked) >= self.chunk_size
+
+    def flush(self):
+        """COPY куска во временные таблицы и слияние в основные в одной транзакции"""
+        if self.clocked:
+            # Блокировки event_id держатся до commit куска, как в write_events
+            resolve_clock_times(self.cursor, self.clocked)
+            for event in self.clocked:
+                self._write(event)
+        if self.count:
+            cursor = self.cursor
+            for table, buffer in (('import_events', self.events),
+                                  ('import_field_changes', self.fields),
+                                  ('import_deleted_entities', self.deleted),
+                                  ('import_blobs', self.blobs)):
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} FROM STDIN", buffer)
+
+            cursor.execute(MERGE_SQL)
+            inserted, field_changes, deleted, entities, blobs = cursor.fetchone()
+            cursor.execute("TRUNCATE import_events, import_field_changes, import_deleted_entities, import_blobs")
+            self.conn.commit()
+
+            self.totals['events'] += self.count
+            self.totals['inserted'] += inserted
+            self.totals['field_changes'] += field_changes
+            self.totals['deleted'] += deleted
+            self.totals['entities'] += entities
+            self.totals['blobs'] += blobs
+        self._reset()
+
+
+def split_ranges(path: str, start: int, end: Optional[int], parts: int) -> List[Tuple[int, int]]:
+    """Делит [start, end) на parts кусков; границы потом выравниваются по строкам"""
+    size = os.path.getsize(path)
+    end = size if end is None else min(end, size)
+    step = max((end - start) // parts, 1)
+    bounds = [start + step * i for i in range(parts)] + [end]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def _read_state(state_file: Optional[str]) -> Dict[str, int]:
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        content = f.read().strip()
+    return json.loads(content) if content else {}
+
+
+def _save_state(state_file: Optional[str], key: str, offset: int):
+    """Запоминает подтверждённое смещение куска (файл общий для всех процессов)"""
+    if not state_file:
+        return
+    with open(state_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        content = f.read().strip()
+        state = json.loads(content) if content else {}
+        state[key] = offset
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def import_range(path: str, start: int, end: int, chunk_size: int,
+                 state_file: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Загружает строки, начинающиеся в [start, end).
+    Возвращает счётчики и смещение, до которого всё подтверждено
+    """
+    key = f"{start}-{end}"
+    resume_from = _read_state(state_file).get(key)
+    offset = resume_from if resume_from is not None else start
+
+    with open(path, 'rb') as f, db_connection() as conn:
+        loader = ChunkLoader(conn, chunk_size)
+
+        if offset > 0:
+            # Если offset попал в середину строки, эта строка принадлежит предыдущему куску
+            f.seek(offset - 1)
+            if f.read(1) != b'\n':
+                offset += len(f.readline())
+        f.seek(offset)
+
+        committed = offset
+        started = time.monotonic()
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            line_start = offset
+            offset += len(line)
+            loader.totals['lines'] += 1
+
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event_data = json.loads(line)
+                if not isinstance(event_data, dict) or not event_data.get('eventType'):
+                    raise ValueError("нет eventType")
+                loader.add(parse_event(event_data))
+            except Exception as e:
+                loader.totals['rejected'] += 1
+                logger.warning(f"Строка на смещении {line_start} пропущена: {e}")
+                continue
+
+            if loader.full():
+                loader.flush()
+                committed = offset
+                _save_state(state_file, key, committed)
+                elapsed = time.monotonic() - started
+                logger.info(f"[{key}] смещение {committed}, событий {loader.totals['events']} "
+                            f"({loader.totals['events'] / elapsed:.0f}/сек)")
+
+        loader.flush()
+        committed = offset
+        _save_state(state_file, key, committed)
+        loader.cursor.close()
+
+    return {**loader.totals, 'range': key, 'committed_offset': committed}
+
+
+def _import_range_worker(args) -> Dict[str, Any]:
+    return import_range(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='JSONL-файл с событиями OpenMetadata (по одному на строку)')
+    parser.add_argument('--workers', type=int, default=1, help='Число параллельных процессов')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Событий в одной транзакции')
+    parser.add_argument('--start-offset', type=int, default=0, help='С какого байта начать')
+    parser.add_argument('--end-offset', type=int, default=None, help='На каком байте закончить')
+    parser.add_argument('--state-file', default=None,
+                        help='Файл с прогрессом для продолжения после сбоя')
+    args = parser.parse_args()
+
+    configure_logging()
+    init_database()
+
+    ranges = split_ranges(args.path, args.start_offset, args.end_offset, args.workers)
+    tasks = [(args.path, a, b, args.chunk_size, args.state_file) for a, b in ranges]
+
+    started = time.monotonic()
+    if len(tasks) == 1:
+        results = [_import_range_worker(tasks[0])]
+    else:
+        with multiprocessing.Pool(len(tasks)) as pool:
+            results = pool.map(_import_range_worker, tasks)
+    elapsed = time.monotonic() - started
+
+    totals = {k: sum(r[k] for r in results)
+              for k in ('lines', 'events', 'inserted', 'field_changes', 'deleted', 'entities', 'blobs',
+                        'rejected')}
+    print(f"Строк: {totals['lines']}, событий: {totals['events']}, новых: {totals['inserted']}, "
+          f"изменений полей: {totals['field_changes']}, удалений: {totals['deleted']}, "
+          f"обновлено сущностей: {totals['entities']}, entity в payload_blobs: {totals['blobs']}, "
+          f"пропущено: {totals['rejected']}")
+    print(f"Время: {elapsed:.1f} сек ({totals['events'] / elapsed if elapsed else 0:.0f} событий/сек)")
+    for r in results:
+        print(f"  кусок {r['range']}: подтверждено до смещения {r['committed_offset']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
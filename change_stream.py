@@ -0,0 +1,445 @@
+"""
+Поток новых событий для подписчиков (/events/stream - Server-Sent Events, /events/poll - long-poll)
+
+Позиция в потоке - (txid, id): номер записавшей транзакции (колонка txid, заполняется
+по умолчанию pg_current_xact_id()) и id события. Подписчику отдаются только события
+транзакций старше самой старой ещё выполняющейся (pg_snapshot_xmin): набор таких событий
+больше не меняется, поэтому продолжение с сохранённой позиции не пропускает событий
+транзакции, которая получила id раньше, а завершилась позже. События, записанные
+до появления колонки (txid IS NULL), в поток не попадают - их читают через /events.
+
+Транзакция записи событий отправляет NOTIFY; ChangeFeed (один на процесс) по нему
+дочитывает новые события в общий буфер, и подписчики процесса фильтруют их в памяти.
+Без уведомлений (STREAM_NOTIFY=0, bulk_import) буфер обновляется раз в STREAM_POLL_INTERVAL секунд.
+"""
+
+import os
+import time
+import select
+import asyncio
+import logging
+import threading
+from bisect import bisect_right
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from events_query import InvalidQuery, parse_columns, parse_fqn_prefix, DEFAULT_COLUMNS
+from fqn import in_subtree, subtree_condition
+
+logger = logging.getLogger(__name__)
+
+# Канал LISTEN/NOTIFY
+STREAM_CHANNEL = 'history_events'
+# Отправлять NOTIFY из транзакции записи событий
+STREAM_NOTIFY = os.getenv('STREAM_NOTIFY', '1') == '1'
+# Как часто проверять новые события без уведомлений, сек
+STREAM_POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', 5))
+# Не чаще одного чтения новых событий в буфер за столько мс: при частой записи
+# уведомления нескольких транзакций обрабатываются одним запросом
+STREAM_REFRESH_INTERVAL_MS = int(os.getenv('STREAM_REFRESH_INTERVAL_MS', 50))
+# Последних событий в буфере процесса; подписчик, отставший сильнее, читает БД сам
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', 5000))
+# Сколько держать SSE-подключение, сек: потом клиент переподключается с Last-Event-ID
+# (под gunicorn подписчик занимает воркер или поток)
+STREAM_MAX_SECONDS = float(os.getenv('STREAM_MAX_SECONDS', 60))
+# Сообщение в SSE-поток без новых событий не реже, сек: не даёт прокси закрыть
+# подключение и сдвигает позицию клиента за отфильтрованные события
+STREAM_HEARTBEAT_SEC = float(os.getenv('STREAM_HEARTBEAT_SEC', 15))
+# Предельное ожидание одного запроса /events/poll, сек
+STREAM_POLL_MAX_WAIT = float(os.getenv('STREAM_POLL_MAX_WAIT', 30))
+# Событий за одно чтение
+STREAM_FETCH_SIZE = int(os.getenv('STREAM_FETCH_SIZE', 500))
+
+STREAM_DDL = """
+    -- Без значения по умолчанию в ALTER ... ADD COLUMN: таблица не перезаписывается,
+    -- у старых событий txid остаётся NULL
+    ALTER TABLE metadata_change_events ADD COLUMN IF NOT EXISTS txid xid8;
+    ALTER TABLE metadata_change_events ALTER COLUMN txid SET DEFAULT pg_current_xact_id();
+"""
+# Чтение потока по позиции (txid, id), строится online-миграцией
+STREAM_INDEX = ('idx_events_txid_id', 'metadata_change_events', '(txid, id)')
+
+NOTIFY_SQL = "SELECT pg_notify(%s, '')"
+
+# Последнее событие, видимое подписчикам (позиция конца потока)
+_HEAD_SQL = """
+    SELECT txid::text AS position_txid, id FROM metadata_change_events
+    WHERE txid < pg_snapshot_xmin(pg_current_snapshot())
+    ORDER BY txid DESC, id DESC
+    LIMIT 1
+"""
+
+# События после позиции (txid, id). Отдельное txid >= даёт планировщику оценку по гистограмме:
+# по одному сравнению строк он ждёт треть таблицы и выбирает параллельный план
+_AFTER_CONDITION = "txid >= %s::xid8 AND (txid, id) > (%s::xid8, %s)"
+
+
+def encode_position(position: Tuple[int, int]) -> str:
+    return f"{position[0]}-{position[1]}"
+
+
+def decode_position(position: str) -> Tuple[int, int]:
+    try:
+        txid, row_id = position.split('-')
+        return int(txid), int(row_id)
+    except ValueError:
+        raise InvalidQuery(f"Некорректная позиция потока: {position!r}")
+
+
+def parse_stream_args(args: Dict[str, Any], last_event_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Параметры подписки: cursor (или заголовок Last-Event-ID) - позиция, после которой
+    отдавать события (без неё - только новые); фильтры entity_type, event_type
+    (через запятую), fqn_prefix (сама сущность и всё под ней); fields, include_payload - как у /events
+    """
+    position = args.get('cursor') or last_event_id
+    entity_type = args.get('entity_type') or None
+    event_types = [value.strip() for value in (args.get('event_type') or '').split(',') if value.strip()]
+    fqn_path = parse_fqn_prefix(args.get('fqn_prefix'))
+
+    conditions, params = [], []
+    if entity_type:
+        conditions.append("entity_type = %s")
+        params.append(entity_type)
+    if event_types:
+        conditions.append("event_type = ANY(%s)")
+        params.append(event_types)
+    if fqn_path:
+        condition, condition_params = subtree_condition('fqn_path', fqn_path)
+        conditions.append(condition)
+        params.extend(condition_params)
+    return {
+        'position': decode_position(position) if position else None,
+        'columns': parse_columns(args.get('fields'), args.get('include_payload') in ('1', 'true', 'yes')),
+        'entity_type': entity_type,
+        'event_types': frozenset(event_types),
+        'fqn_path': fqn_path,
+        'conditions': conditions,
+        'params': params,
+    }
+
+
+def matches(subscription: Dict[str, Any], event: Dict[str, Any]) -> bool:
+    """Фильтры подписки для события из буфера - те же условия, что и в SQL fetch_changes"""
+    if subscription['entity_type'] and event['entity_type'] != subscription['entity_type']:
+        return False
+    if subscription['event_types'] and event['event_type'] not in subscription['event_types']:
+        return False
+    if subscription['fqn_path'] and not in_subtree(event['entity_fqn'], subscription['fqn_path']):
+        return False
+    return True
+
+
+def fetch_changes(cursor, subscription: Dict[str, Any], limit: int = STREAM_FETCH_SIZE
+                  ) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Следующие события подписки после её позиции - запросом к БД. Возвращает (события, новая позиция);
+    позиция сдвигается и за события, не прошедшие фильтры, чтобы их не просматривать снова.
+    У каждого события - поле position
+    """
+    cursor.execute("""
+        WITH horizon AS (SELECT pg_snapshot_xmin(pg_current_snapshot()) AS xmin)
+        SELECT horizon.xmin, (
+            SELECT ARRAY[txid::text, id::text] FROM metadata_change_events
+            WHERE txid < horizon.xmin
+            ORDER BY txid DESC, id DESC
+            LIMIT 1
+        )
+        FROM horizon
+    """)
+    horizon, last = cursor.fetchone()
+    upper = (int(last[0]), int(last[1])) if last else (0, 0)
+
+    position = subscription['position']
+    if position is None:
+        # Новая подписка без позиции - с текущего конца потока
+        subscription['position'] = upper
+        return [], encode_position(upper)
+    if upper <= position:
+        return [], encode_position(position)
+
+    columns = subscription['columns']
+    where = " AND ".join([_AFTER_CONDITION, "txid < %s::xid8"] + subscription['conditions'])
+    cursor.execute(f"""
+        SELECT {', '.join(columns)}, txid::text AS position_txid
+        FROM metadata_change_events
+        WHERE {where}
+        ORDER BY txid, id
+        LIMIT %s
+    """, [str(position[0]), str(position[0]), position[1], horizon] + subscription['params'] + [limit])
+    rows = cursor.fetchall()
+
+    events = []
+    for row in rows:
+        event = dict(zip(columns, row[:-1]))
+        event['position'] = encode_position((int(row[-1]), event['id']))
+        events.append(event)
+    # Неполная страница - всё до конца потока просмотрено
+    position = decode_position(events[-1]['position']) if len(rows) == limit else upper
+    subscription['position'] = position
+    return events, encode_position(position)
+
+
+def sse_message(event: Dict[str, Any], dumps: Callable[[Any], str]) -> str:
+    """Событие в формате Server-Sent Events: id - позиция для Last-Event-ID"""
+    return f"id: {event['position']}\nevent: change\ndata: {dumps(event)}\n\n"
+
+
+def sse_position(position: str) -> str:
+    """Сообщение только с id: клиент запоминает позицию (в том числе после отфильтрованных событий)"""
+    return f"id: {position}\n\n"
+
+
+def poll_timeout(value: Optional[str]) -> float:
+    """Ожидание /events/poll из параметра timeout (секунды), не больше STREAM_POLL_MAX_WAIT"""
+    if value is None:
+        return STREAM_POLL_MAX_WAIT
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise InvalidQuery(f"timeout: ожидается число секунд, получено {value!r}")
+    return min(max(timeout, 0.0), STREAM_POLL_MAX_WAIT)
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeFeed:
+    """
+    Общая лента новых событий для подписчиков процесса. Поток с отдельным подключением
+    (LISTEN STREAM_CHANNEL) по уведомлению о записи дочитывает новые события одним запросом
+    в буфер последних buffer_size событий и будит подписчиков - потоки (wait) и корутины
+    (wait_async). Подписчики, чья позиция внутри буфера, получают события из памяти (read),
+    поэтому запросов к БД столько же при одном подписчике, сколько и при сотне.
+    Пока подписчиков нет, лента не читает БД и не держит буфер
+    """
+
+    def __init__(self, connect: Callable[[], Any], channel: str = STREAM_CHANNEL,
+                 buffer_size: int = STREAM_BUFFER_SIZE, fetch_size: int = STREAM_FETCH_SIZE,
+                 poll_interval: float = STREAM_POLL_INTERVAL,
+                 refresh_interval: float = STREAM_REFRESH_INTERVAL_MS / 1000,
+                 reconnect_delay: float = 1.0):
+        self.connect = connect
+        self.channel = channel
+        self.buffer_size = buffer_size
+        self.fetch_size = fetch_size
+        self.poll_interval = poll_interval
+        self.refresh_interval = refresh_interval
+        self.reconnect_delay = reconnect_delay
+
+        self._cond = threading.Condition(threading.Lock())
+        self._version = 0
+        self._async_waiters = set()  # (loop, future)
+        # Буфер: позиции и события по возрастанию позиции, (start, head] - покрытый диапазон
+        self._keys = []
+        self._events = []
+        self._start = None
+        self._head = None
+        self._subscribers = 0
+        self._seed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._connected = False
+
+        # Метрики
+        self._notifications = 0
+        self._refreshes = 0
+        self._reconnects = 0
+        self._buffer_reads = 0
+        self._database_reads = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def attach(self):
+        """Подписчик начал ждать события (лента читает БД, пока есть подписчики)"""
+        with self._cond:
+            self._subscribers += 1
+        if self._head is None:
+            self._seed.set()
+
+    def detach(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self.channel}")
+                self._connected = True
+                # Пока подключения не было, уведомления терялись - дочитываем сразу
+                pending, last_refresh = True, 0.0
+                while not self._stop.is_set():
+                    # Уведомления, пришедшие во время запросов _refresh, psycopg2 уже сложил в notifies
+                    if not conn.notifies:
+                        timeout = 0.5
+                        if pending:
+                            timeout = max(last_refresh + self.refresh_interval - time.monotonic(), 0)
+                        if select.select([conn], [], [], timeout)[0]:
+                            conn.poll()
+                    if conn.notifies:
+                        self._notifications += len(conn.notifies)
+                        conn.notifies.clear()
+                        pending = True
+                    now = time.monotonic()
+                    if self._seed.is_set() or now - last_refresh >= self.poll_interval:
+                        pending = True
+                    if pending and now - last_refresh >= self.refresh_interval:
+                        self._seed.clear()
+                        self._refresh(cursor)
+                        pending, last_refresh = False, now
+            except Exception as e:
+                if not self._stop.is_set():
+                    self._reconnects += 1
+                    logger.warning("Лента событий: подключение LISTEN %s потеряно: %s", self.channel, e)
+                    self._stop.wait(self.reconnect_delay)
+            finally:
+                self._connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _refresh(self, cursor):
+        """Дочитывает в буфер события после его конца"""
+        if not self._subscribers:
+            if self._head is not None:
+                with self._cond:
+                    self._keys, self._events = [], []
+                    self._start = self._head = None
+            return
+        self._refreshes += 1
+        if self._head is None:
+            cursor.execute(_HEAD_SQL)
+            row = cursor.fetchone()
+            with self._cond:
+                self._start = self._head = (int(row[0]), row[1]) if row else (0, 0)
+            self._wake()
+            return
+
+        appended = False
+        while True:
+            cursor.execute(f"""
+                SELECT {', '.join(DEFAULT_COLUMNS)}, txid::text AS position_txid
+                FROM metadata_change_events
+                WHERE {_AFTER_CONDITION} AND txid < pg_snapshot_xmin(pg_current_snapshot())
+                ORDER BY txid, id
+                LIMIT %s
+            """, (str(self._head[0]), str(self._head[0]), self._head[1], self.fetch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            with self._cond:
+                for row in rows:
+                    event = dict(zip(DEFAULT_COLUMNS, row[:-1]))
+                    key = (int(row[-1]), event['id'])
+                    event['position'] = encode_position(key)
+                    self._keys.append(key)
+                    self._events.append(event)
+                self._head = self._keys[-1]
+                if len(self._keys) > self.buffer_size * 2:
+                    dropped = len(self._keys) - self.buffer_size
+                    self._start = self._keys[dropped - 1]
+                    del self._keys[:dropped]
+                    del self._events[:dropped]
+            appended = True
+            if len(rows) < self.fetch_size:
+                break
+        if appended:
+            self._wake()
+
+    def read(self, subscription: Dict[str, Any], limit: int = STREAM_FETCH_SIZE
+             ) -> Optional[Tuple[List[Dict[str, Any]], str]]:
+        """
+        События подписки из буфера - как fetch_changes, но без запроса к БД.
+        None - буфер не покрывает позицию подписки или подписке нужен full_payload: читать БД
+        """
+        if 'full_payload' in subscription['columns']:
+            self._database_reads += 1
+            return None
+        columns = subscription['columns']
+        with self._cond:
+            position = subscription['position']
+            if self._head is None or (position is not None and position < self._start):
+                self._database_reads += 1
+                return None
+            self._buffer_reads += 1
+            if position is None:
+                position = self._head
+            events = []
+            for index in range(bisect_right(self._keys, position), len(self._keys)):
+                event = self._events[index]
+                if matches(subscription, event):
+                    events.append({**{column: event[column] for column in columns},
+                                   'position': event['position']})
+                    if len(events) == limit:
+                        position = self._keys[index]
+                        break
+            else:
+                position = max(position, self._head)
+            subscription['position'] = position
+        return events, encode_position(position)
+
+    def _wake(self):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+            self._async_waiters.clear()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_result, future)
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Ждёт версию новее version (не дольше timeout); возвращает текущую версию"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version or self._stop.is_set(), timeout)
+            return self._version
+
+    async def wait_async(self, version: int, timeout: float) -> int:
+        """wait для корутин: event loop не блокируется"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._cond:
+            if self._version != version:
+                return self._version
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        return self._version
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'connected': self._connected,
+            'subscribers': self._subscribers,
+            'buffered_events': len(self._keys),
+            'notifications': self._notifications,
+            'refreshes': self._refreshes,
+            'buffer_reads': self._buffer_reads,
+            'database_reads': self._database_reads,
+            'reconnects': self._reconnects,
+        }
@@ -0,0 +1,301 @@
+"""
+Пул подключений к PostgreSQL для webhook listener'а
+Один пул на процесс (gunicorn-воркер): подключения переиспользуются между запросами,
+простаивавшие подключения проверяются перед выдачей
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# Настройки подключения к БД (можно вынести в .env)
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', '172.24.64.1'),
+    'port': os.getenv('DB_PORT', '5432'),
+    'database': os.getenv('DB_NAME', 'openmetadata_history'),
+    'user': os.getenv('DB_USER', 'postgres'),
+    'password': os.getenv('DB_PASSWORD', 'postgres')
+}
+
+# Настройки пула (на один процесс)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+# Сколько секунд ждать свободное подключение, прежде чем отдать ошибку
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+# Подключения, простаивавшие дольше N секунд, проверяются через SELECT 1 перед выдачей
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv('DB_POOL_HEALTHCHECK_IDLE', 30))
+# Подключения сверх минимума закрываются после N секунд простоя
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+# Ограничение времени записывающей транзакции (мс, 0 - без ограничения):
+# «медленная» БД считается недоступной и события уходят в spool
+DB_WRITE_TIMEOUT_MS = int(os.getenv('DB_WRITE_TIMEOUT_MS', 0))
+
+
+class PoolTimeout(Exception):
+    """Не дождались свободного подключения из пула"""
+
+
+# Ошибки, при которых запись имеет смысл повторить позже (БД недоступна, пул исчерпан,
+# сработал statement_timeout)
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+
+class ConnectionPool:
+    """Потокобезопасный пул psycopg2-подключений с проверкой простаивающих подключений"""
+
+    def __init__(self, min_size: int = 1, max_size: int = 10, timeout: float = 10,
+                 healthcheck_idle: float = 30, max_idle: float = 300, **connect_kwargs):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError(f"Некорректный размер пула: min={min_size}, max={max_size}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.max_idle = max_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (conn, время возврата в пул)
+        self._total = 0       # открытые подключения + зарезервированные под открытие
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        # Метрики
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._healthcheck_failures = 0
+        self._checkout_time_total = 0.0
+        self._checkout_time_max = 0.0
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def _is_alive(self, conn) -> bool:
+        """Проверяет, что подключение ещё живо"""
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Подключение из пула не прошло проверку: {e}")
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        """Выдаёт подключение из пула, ожидая не дольше self.timeout секунд"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+
+        while True:
+            conn = None
+            idle_since = None
+            create = False
+
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Пул подключений закрыт")
+                    if self._idle:
+                        # LIFO: самое «тёплое» подключение с наименьшим простоем
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._total < self.max_size:
+                        self._total += 1
+                        create = True
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"Нет свободных подключений за {self.timeout} сек "
+                            f"(max_size={self.max_size})"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - idle_since > self.healthcheck_idle and not self._is_alive(conn):
+                self._close_quietly(conn)
+                with self._cond:
+                    self._total -= 1
+                    self._discarded += 1
+                    self._healthcheck_failures += 1
+                continue
+            elif conn.closed:
+                with self._cond:
+                    self._total -= 1
+                    self._discarded += 1
+                continue
+
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._in_use += 1
+                self._checkouts += 1
+                self._checkout_time_total += elapsed
+                self._checkout_time_max = max(self._checkout_time_max, elapsed)
+            return conn
+
+    def putconn(self, conn, discard: bool = False):
+        """Возвращает подключение в пул (или закрывает его, если оно сломано)"""
+        if not discard and not conn.closed:
+            try:
+                # Незавершённая транзакция не должна утечь к следующему запросу
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        discard = discard or bool(conn.closed)
+        if discard:
+            self._close_quietly(conn)
+
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._total -= 1
+                if discard:
+                    self._discarded += 1
+            else:
+                self._idle.append((conn, now))
+                # Закрываем лишние подключения, которые давно не использовались
+                while (self._idle and self._total > self.min_size
+                       and now - self._idle[0][1] > self.max_idle):
+                    expired.append(self._idle.popleft()[0])
+                    self._total -= 1
+            self._cond.notify()
+
+        for old_conn in expired:
+            self._close_quietly(old_conn)
+
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер: выдаёт подключение и возвращает его в пул"""
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def prefill(self):
+        """Открывает min_size подключений заранее"""
+        conns = []
+        try:
+            for _ in range(self.min_size):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущие метрики пула"""
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'total': self._total,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'healthcheck_failures': self._healthcheck_failures,
+                'checkout_time_avg_ms': round(
+                    self._checkout_time_total / self._checkouts * 1000, 3
+                ) if self._checkouts else 0.0,
+                'checkout_time_max_ms': round(self._checkout_time_max * 1000, 3),
+            }
+
+    def closeall(self):
+        """Закрывает все простаивающие подключения; выданные закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Пул текущего процесса (после fork'а gunicorn'ом создаётся заново)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                # Подключения, унаследованные от родителя, не трогаем — они принадлежат ему
+                _pool = ConnectionPool(
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    **DB_CONFIG
+                )
+                _pool_pid = pid
+                # min_size подключений открываем сразу, а не на первых запросах воркера;
+                # недоступная БД не мешает созданию пула (события уйдут в spool)
+                try:
+                    _pool.prefill()
+                except TRANSIENT_ERRORS as e:
+                    logger.warning(f"Не удалось заранее открыть подключения пула: {e}")
+    return _pool
+
+
+@contextmanager
+def db_connection():
+    """Подключение к PostgreSQL из пула текущего процесса"""
+    with get_pool().connection() as conn:
+        yield conn
@@ -0,0 +1,170 @@
+"""
+Кэш недавно записанных событий: повторная доставка (ретраи OpenMetadata, повтор spool,
+ретрансляторы) с уже известным event_id отвечается без обращения к БД.
+
+Ключ - (event_id, timestamp) из payload'а, как и уникальность в metadata_change_events
+(event_id, event_time): событие без id или без timestamp не кэшируется - его время
+определяется только при разборе или записи (entity.updatedAt, время записанной копии).
+Ключ попадает в кэш только
+после commit транзакции, в которой событие записано или оказалось повтором, поэтому
+попадание в кэш всегда означает, что событие уже в БД.
+
+Кэш процесса - LRU на DEDUPE_CACHE_SIZE ключей. С DEDUPE_SHARED_FILE воркеры
+(gunicorn, uvicorn --workers) дополнительно делят таблицу отпечатков ключей в mmap-файле
+(лучше в /dev/shm): повтор, пришедший в другой воркер, тоже отсекается.
+Таблица - наборы по SHARED_WAYS слотов с 64-битными отпечатками (blake2b), без блокировок:
+вытесняется слот набора по кругу, а недописанный слот может дать только промах.
+Ложное совпадение отпечатков - вероятность порядка числа ключей / 2^64.
+
+Если БД очищается, а файл остаётся (uvicorn без перезапуска, ручная очистка таблиц),
+файл нужно удалить: иначе повторная отправка тех же событий будет считаться повтором.
+gunicorn.conf.py удаляет его при старте master-процесса.
+"""
+
+import os
+import mmap
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# Ключей в кэше процесса (0 - кэш выключен)
+DEDUPE_CACHE_SIZE = int(os.getenv('DEDUPE_CACHE_SIZE', 50000))
+# Файл общей таблицы воркеров ('' - только кэш процесса)
+DEDUPE_SHARED_FILE = os.getenv('DEDUPE_SHARED_FILE', '')
+# Слотов в общей таблице (по 8 байт; 1048576 - файл 8 МБ)
+DEDUPE_SHARED_SLOTS = int(os.getenv('DEDUPE_SHARED_SLOTS', 1048576))
+
+SHARED_WAYS = 8
+_SLOT = struct.Struct('<Q')
+_SET = struct.Struct(f'<{SHARED_WAYS}Q')
+
+
+def event_key(event_data: Dict[str, Any]) -> Optional[str]:
+    """Ключ события для кэша или None, если событие не кэшируется"""
+    event_id = event_data.get('id', event_data.get('eventId'))
+    timestamp = event_data.get('timestamp')
+    if event_id is None or timestamp is None or isinstance(timestamp, bool):
+        return None
+    if not isinstance(timestamp, (int, float, str)):
+        return None
+    # Разные записи одного времени (1.7e12 и 1700000000000) дают разные ключи - это лишь промах
+    return json.dumps([event_id, timestamp], ensure_ascii=False, default=str)
+
+
+def _fingerprint(key: str) -> int:
+    # 0 - пустой слот
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class SharedKeySet:
+    """Таблица отпечатков ключей в mmap-файле, общая для процессов"""
+
+    def __init__(self, path: str, slots: int = DEDUPE_SHARED_SLOTS):
+        self.path = path
+        self.sets = max(slots // SHARED_WAYS, 1)
+        size = self.sets * _SET.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Воркеры с одинаковыми настройками открывают файл одного размера; после смены
+            # DEDUPE_SHARED_SLOTS отпечатки оказываются не в своих наборах - это только промахи
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._next_way = 0
+
+    def _offset(self, fingerprint: int) -> int:
+        return (fingerprint % self.sets) * _SET.size
+
+    def __contains__(self, key: str) -> bool:
+        fingerprint = _fingerprint(key)
+        return fingerprint in _SET.unpack_from(self._map, self._offset(fingerprint))
+
+    def add(self, key: str):
+        fingerprint = _fingerprint(key)
+        offset = self._offset(fingerprint)
+        ways = _SET.unpack_from(self._map, offset)
+        if fingerprint in ways:
+            return
+        if 0 in ways:
+            way = ways.index(0)
+        else:
+            way = self._next_way
+            self._next_way = (way + 1) % SHARED_WAYS
+        _SLOT.pack_into(self._map, offset + way * _SLOT.size, fingerprint)
+
+    def close(self):
+        self._map.close()
+
+
+class DedupeCache:
+    """LRU ключей недавно записанных событий процесса и, если задана, общая таблица воркеров"""
+
+    def __init__(self, cache_size: int = 50000, shared: Optional[SharedKeySet] = None):
+        self.cache_size = cache_size
+        self.shared = shared
+        self._cache = OrderedDict()  # ключ -> None
+        self._lock = threading.Lock()
+        self._local_hits = 0
+        self._shared_hits = 0
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_size > 0 or self.shared is not None
+
+    def seen(self, key: Optional[str]) -> Optional[str]:
+        """Где найден ключ: 'local', 'shared' или None (нет в кэше или ключа нет)"""
+        if key is None:
+            return None
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._local_hits += 1
+                return 'local'
+            if self.shared is not None and key in self.shared:
+                self._put(key)
+                self._shared_hits += 1
+                return 'shared'
+            self._misses += 1
+            return None
+
+    def remember(self, keys):
+        """Ключи событий после commit транзакции, в которой они записаны (или оказались повторами)"""
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                self._put(key)
+                if self.shared is not None:
+                    self.shared.add(key)
+
+    def _put(self, key: str):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = None
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._local_hits + self._shared_hits + self._misses
+            hits = self._local_hits + self._shared_hits
+            stats = {
+                'cache_size': len(self._cache), 'cache_max_size': self.cache_size,
+                'local_hits': self._local_hits, 'shared_hits': self._shared_hits, 'misses': self._misses,
+                'hit_rate': round(hits / lookups, 4) if lookups else None,
+            }
+        if self.shared is not None:
+            stats['shared_file'] = self.shared.path
+            stats['shared_slots'] = self.shared.sets * SHARED_WAYS
+        return stats
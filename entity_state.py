@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Текущее состояние сущностей (таблица entity_current_state)
+Обновляется в той же транзакции, что и запись события: последняя версия, снимок entity,
+автор последнего изменения и счётчики изменений. /entities читает одну строку по
+entity_id или FQN вместо просмотра всей истории событий.
+
+Пересчёт по уже накопленным событиям (после обновления или для проверки):
+    python entity_state.py rebuild
+"""
+
+import sys
+import logging
+import argparse
+from typing import Dict, Any, List, Optional, Tuple
+
+from psycopg2.extras import Json, execute_values
+
+from event_parser import ChangeEvent
+from log_config import configure_logging
+from payload_store import load_entities
+
+logger = logging.getLogger(__name__)
+
+STATE_COLUMNS = (
+    'entity_id', 'entity_type', 'entity_fqn', 'entity_name', 'current_version',
+    'last_event_id', 'last_event_type', 'last_event_time', 'last_updated_by',
+    'snapshot', 'is_deleted', 'first_seen_at', 'change_count', 'field_change_count', 'payload_hash',
+)
+# Служебные колонки, которые /entities не возвращает
+_INTERNAL_COLUMNS = ('payload_hash',)
+
+# Поля «последнего состояния» меняются, только если пришедшее событие не старше сохранённого:
+# события одной сущности могут прийти не по порядку (повторы, spool, пачки разных воркеров)
+_NEWER = ("(COALESCE(EXCLUDED.current_version, -1), EXCLUDED.last_event_time) >= "
+          "(COALESCE(s.current_version, -1), s.last_event_time)")
+_LATEST_COLUMNS = ('entity_type', 'entity_fqn', 'entity_name', 'current_version', 'last_event_id',
+                   'last_event_type', 'last_event_time', 'last_updated_by', 'is_deleted')
+
+# Слияние с сохранённым состоянием (целевая таблица - под псевдонимом s)
+UPSERT_CONFLICT = f"""
+    ON CONFLICT (entity_id) DO UPDATE SET
+        {', '.join(f"{c} = CASE WHEN {_NEWER} THEN EXCLUDED.{c} ELSE s.{c} END" for c in _LATEST_COLUMNS)},
+        snapshot = CASE WHEN {_NEWER} THEN COALESCE(EXCLUDED.snapshot, s.snapshot) ELSE s.snapshot END,
+        payload_hash = CASE WHEN {_NEWER} AND EXCLUDED.snapshot IS NOT NULL
+                            THEN EXCLUDED.payload_hash ELSE s.payload_hash END,
+        first_seen_at = LEAST(s.first_seen_at, EXCLUDED.first_seen_at),
+        change_count = s.change_count + EXCLUDED.change_count,
+        field_change_count = s.field_change_count + EXCLUDED.field_change_count,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+UPSERT_SQL = f"""
+    INSERT INTO entity_current_state AS s ({', '.join(STATE_COLUMNS)})
+    VALUES %s
+""" + UPSERT_CONFLICT + """
+    RETURNING entity_id, change_count
+"""
+
+# Пересчёт из накопленных событий: последняя версия каждой сущности и счётчики по всей истории
+REBUILD_SQL = f"""
+    INSERT INTO entity_current_state AS s ({', '.join(STATE_COLUMNS)})
+    SELECT DISTINCT ON (e.entity_id)
+           e.entity_id, e.entity_type, e.entity_fqn, e.entity_name, e.current_version,
+           e.event_id, e.event_type, e.event_time, e.updated_by,
+           CASE WHEN jsonb_typeof(e.full_payload->'entity') = 'object' THEN e.full_payload->'entity' END,
+           e.event_type = 'entityDeleted',
+           min(e.event_time) OVER w, count(*) OVER w, COALESCE(fc.field_change_count, 0), e.entity_hash
+    FROM metadata_change_events e
+    LEFT JOIN (
+        SELECT e2.entity_id, count(*) AS field_change_count
+        FROM field_changes f
+        JOIN metadata_change_events e2 ON e2.event_id = f.event_id AND e2.event_time = f.event_time
+        GROUP BY e2.entity_id
+    ) fc ON fc.entity_id = e.entity_id
+    WHERE e.entity_id IS NOT NULL
+    WINDOW w AS (PARTITION BY e.entity_id)
+    ORDER BY e.entity_id, COALESCE(e.current_version, -1) DESC, e.event_time DESC, e.id DESC
+    ON CONFLICT (entity_id) DO UPDATE SET
+        {', '.join(f"{c} = EXCLUDED.{c}" for c in STATE_COLUMNS if c != 'entity_id')},
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
+def state_rows(events: List[ChangeEvent]) -> List[tuple]:
+    """
+    Строки для UPSERT_SQL: одна на сущность (в одном INSERT ... ON CONFLICT сущность
+    может встречаться только раз) - последнее событие пачки плюс счётчики всей пачки
+    """
+    latest: Dict[str, ChangeEvent] = {}
+    counts: Dict[str, List] = {}
+    for event in events:
+        if not event.entity_id:
+            continue
+        current = latest.get(event.entity_id)
+        if current is None or event.version_key() >= current.version_key():
+            latest[event.entity_id] = event
+        count = counts.setdefault(event.entity_id, [0, 0, event.event_time])
+        count[0] += 1
+        count[1] += len(event.field_changes)
+        count[2] = min(count[2], event.event_time)
+
+    rows = []
+    # По порядку ключа - параллельные пачки блокируют строки в одном порядке
+    for entity_id in sorted(latest):
+        event = latest[entity_id]
+        change_count, field_change_count, first_seen = counts[entity_id]
+        rows.append((
+            entity_id, event.entity_type, event.entity_fqn, event.entity_name, event.current_version,
+            event.event_id, event.event_type, event.event_time, event.updated_by,
+            # Псевдо-entity из полей события не заменяет настоящий снимок
+            None if event.entity_from_event else Json(event.entity),
+            event.is_deletion, first_seen, change_count, field_change_count, event.entity_hash,
+        ))
+    return rows
+
+
+def upsert_entity_state(cursor, events: List[ChangeEvent]) -> Dict[str, Tuple[int, int]]:
+    """
+    Обновляет entity_current_state по записанным событиям в текущей транзакции.
+    Возвращает {entity_id: (change_count до пачки, change_count после)}
+    """
+    rows = state_rows(events)
+    if not rows:
+        return {}
+    batch_counts = {row[0]: row[STATE_COLUMNS.index('change_count')] for row in rows}
+    result = execute_values(cursor, UPSERT_SQL, rows, page_size=len(rows), fetch=True)
+    return {entity_id: (count - batch_counts[entity_id], count) for entity_id, count in result}
+
+
+def get_entity_state(cursor, entity_id: Optional[str] = None, entity_fqn: Optional[str] = None,
+                     include_snapshot: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Состояние сущности по id или FQN. FQN может принадлежать нескольким сущностям
+    (удалили и создали заново) - возвращается последняя изменённая
+    """
+    columns = [c for c in STATE_COLUMNS
+               if c not in _INTERNAL_COLUMNS and (include_snapshot or c != 'snapshot')] + ['updated_at']
+    query = f"SELECT {', '.join(columns)} FROM entity_current_state"
+    if entity_id is not None:
+        cursor.execute(query + " WHERE entity_id = %s", (entity_id,))
+    else:
+        cursor.execute(query + " WHERE entity_fqn = %s ORDER BY last_event_time DESC LIMIT 1",
+                       (entity_fqn,))
+    row = cursor.fetchone()
+    return dict(zip(columns, row)) if row else None
+
+
+def _restore_snapshots(cursor, page_size: int = 500):
+    """Снимки сущностей, чьё последнее событие хранит entity в payload_blobs"""
+    cursor.execute("SELECT entity_id, payload_hash FROM entity_current_state "
+                   "WHERE snapshot IS NULL AND payload_hash IS NOT NULL")
+    pending = cursor.fetchall()
+    for start in range(0, len(pending), page_size):
+        page = pending[start:start + page_size]
+        entities = load_entities(cursor, [payload_hash for _, payload_hash in page])
+        rows = [(entity_id, Json(entities[bytes(payload_hash)])) for entity_id, payload_hash in page
+                if bytes(payload_hash) in entities]
+        if rows:
+            execute_values(cursor, """
+                UPDATE entity_current_state s SET snapshot = v.snapshot::jsonb
+                FROM (VALUES %s) AS v(entity_id, snapshot)
+                WHERE s.entity_id = v.entity_id
+            """, rows, page_size=len(rows))
+
+
+def rebuild(conn) -> int:
+    """Пересчитывает entity_current_state по всем событиям; возвращает число сущностей"""
+    cursor = conn.cursor()
+    cursor.execute(REBUILD_SQL)
+    count = cursor.rowcount
+    _restore_snapshots(cursor)
+    conn.commit()
+    cursor.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+
+    configure_logging()
+    from webhook_listener import init_database
+    from db_pool import db_connection
+
+    init_database()
+    with db_connection() as conn:
+        count = rebuild(conn)
+    print(f"Пересчитано сущностей: {count}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Разбор событий OpenMetadata
+Превращает сырой payload webhook'а в компактную запись ChangeEvent и строки field_changes.
+Модуль не зависит от Flask и БД: его используют /webhook, /webhook/batch, bulk_import и перенос spool.
+"""
+
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+
+
+class FieldChange(NamedTuple):
+    """Строка field_changes в порядке колонок таблицы"""
+    event_id: Optional[str]
+    event_time: str
+    field_name: Optional[str]
+    old_value: Optional[str]
+    new_value: Optional[str]
+    change_type: str
+
+
+@dataclass(slots=True)
+class ChangeEvent:
+    """Нормализованное событие изменения"""
+    event_id: Optional[str]
+    event_type: Optional[str]
+    event_time: str
+    entity_type: Optional[str]
+    entity_id: Optional[str]
+    entity_fqn: Optional[str]
+    entity_name: Optional[str]
+    updated_by: Optional[str]
+    previous_version: Any
+    current_version: Any
+    change_description: Dict[str, Any]
+    entity: Dict[str, Any]
+    payload: Dict[str, Any]
+    field_changes: List[FieldChange] = field(default_factory=list)
+    # entity не пришёл и собран из полей верхнего уровня события
+    entity_from_event: bool = False
+    # SHA-256 entity, если он хранится в payload_blobs (см. payload_store)
+    entity_hash: Optional[bytes] = None
+    # Времени в событии нет, его назначили часы сервера; у события с id при записи его
+    # заменяет время уже сохранённой копии (webhook_listener.resolve_clock_times)
+    event_time_from_clock: bool = False
+
+    @property
+    def is_deletion(self) -> bool:
+        return self.event_type == 'entityDeleted'
+
+    def version_key(self):
+        """Порядок версий одной сущности: (версия, время события); без версии - раньше всех"""
+        try:
+            version = float(self.current_version) if self.current_version is not None else -1.0
+        except (TypeError, ValueError):
+            version = -1.0
+        return version, self.event_time
+
+
+def parse_timestamp(raw_ts: Any) -> Optional[str]:
+    """Время события в ISO: epoch в секундах или миллисекундах, ISO-строка; не время - None"""
+    if isinstance(raw_ts, (int, float)) and not isinstance(raw_ts, bool):
+        try:
+            # Если это миллисекунды
+            if raw_ts > 10**12:  # значит это ms, не секунды
+                return datetime.fromtimestamp(raw_ts / 1000).isoformat()
+            return datetime.fromtimestamp(raw_ts).isoformat()
+        except (ValueError, OverflowError, OSError):
+            return None
+
+    if isinstance(raw_ts, str):
+        try:
+            datetime.fromisoformat(raw_ts)
+        except ValueError:
+            return None
+        return raw_ts
+
+    return None
+
+
+def event_time_of(event_data: Dict[str, Any], entity: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    Время события: timestamp, а без него (или нечитаемого) - entity.updatedAt.
+    Оба приходят одинаковыми при повторной доставке, поэтому повтор получает тот же
+    ключ дедупликации (event_id, event_time)
+    """
+    event_time = parse_timestamp(event_data.get('timestamp'))
+    if event_time is None:
+        if entity is None:
+            entity = _parse_json_object(event_data.get('entity'))
+        event_time = parse_timestamp(entity.get('updatedAt'))
+    return event_time
+
+
+def stored_event_time(event_time: str) -> datetime:
+    """
+    Время события, как его хранит колонка TIMESTAMP: смещение часового пояса отбрасывается
+    без пересчёта. Этим значением событие и записывается, и сверяется с RETURNING
+    """
+    return datetime.fromisoformat(event_time).replace(tzinfo=None)
+
+
+def _parse_json_object(value: Any) -> Dict[str, Any]:
+    """dict как есть, JSON-строку - распарсить; всё остальное - пустой dict"""
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return {}
+        return value if isinstance(value, dict) else {}
+    return {}
+
+
+def json_text(value: Any) -> Optional[str]:
+    """Значение для текстовой колонки: строка как есть, остальное - JSON (а не repr Python)"""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def field_change_rows(event_id: Optional[str], event_time: str,
+                      change_desc: Dict[str, Any]) -> List[FieldChange]:
+    """Строки field_changes: (event_id, event_time, field_name, old_value, new_value, change_type)"""
+    rows = []
+
+    for item in change_desc.get('fieldsAdded') or []:
+        if isinstance(item, dict):
+            rows.append(FieldChange(event_id, event_time, item.get('name'), None,
+                                    json_text(item.get('newValue')), 'added'))
+
+    for item in change_desc.get('fieldsUpdated') or []:
+        if isinstance(item, dict):
+            rows.append(FieldChange(event_id, event_time, item.get('name'), json_text(item.get('oldValue')),
+                                    json_text(item.get('newValue')), 'updated'))
+
+    for item in change_desc.get('fieldsDeleted') or []:
+        if isinstance(item, dict):
+            rows.append(FieldChange(event_id, event_time, item.get('name'), json_text(item.get('oldValue')),
+                                    None, 'deleted'))
+
+    return rows
+
+
+def parse_event(event_data: Dict[str, Any]) -> ChangeEvent:
+    """Разбирает событие OpenMetadata в ChangeEvent"""
+    get = event_data.get
+    event_id = get('id', get('eventId'))
+
+    # entity может прийти dict'ом, JSON-строкой или не прийти вовсе
+    raw_entity = get('entity')
+    entity_from_event = False
+    if not raw_entity:
+        # Создаём псевдо-entity из данных event_data
+        entity_from_event = True
+        entity = {
+            'type': get('entityType'),
+            'id': get('entityId'),
+            'fullyQualifiedName': get('entityFQN') or get('entityUrn'),
+            'name': get('entityName')
+        }
+    else:
+        entity = _parse_json_object(raw_entity)
+
+    change_desc = _parse_json_object(get('changeDescription'))
+    event_time = event_time_of(event_data, entity)
+    event_time_from_clock = event_time is None
+    if event_time_from_clock:
+        event_time = datetime.utcnow().isoformat()
+
+    return ChangeEvent(
+        event_id=event_id,
+        event_type=get('eventType'),
+        event_time=event_time,
+        entity_type=entity.get('type') or get('entityType'),
+        entity_id=entity.get('id') or get('entityId'),
+        entity_fqn=entity.get('fullyQualifiedName') or get('entityFQN') or get('entityUrn'),
+        entity_name=entity.get('name') or get('entityName'),
+        updated_by=get('updatedBy') or get('userName'),
+        previous_version=get('previousVersion'),
+        current_version=get('currentVersion'),
+        change_description=change_desc,
+        entity=entity,
+        payload=event_data,
+        field_changes=field_change_rows(event_id, event_time, change_desc),
+        entity_from_event=entity_from_event,
+        event_time_from_clock=event_time_from_clock,
+    )
+
+
+def parse_batch_body(body: bytes) -> List[Tuple[Any, Optional[str]]]:
+    """
+    Тело /webhook/batch: JSON-массив событий или NDJSON (событие на строку).
+    Возвращает (событие, ошибка) по порядку; строка NDJSON, которая не разбирается,
+    даёт (None, ошибка). Нечитаемый JSON-массив целиком - ValueError
+    """
+    body = body.strip()
+    if body.startswith(b'['):
+        events = json.loads(body)
+        if not isinstance(events, list):
+            raise ValueError('Ожидается JSON-массив событий')
+        return [(event_data, None) for event_data in events]
+
+    items = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError as e:
+            items.append((None, f'Invalid JSON: {e}'))
+    return items
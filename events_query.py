@@ -0,0 +1,160 @@
+"""
+Построение запросов к metadata_change_events для /events и /events/export
+Keyset-пагинация по (event_time, id), проекция колонок и фильтры,
+каждый из которых опирается на индекс (..., event_time, id).
+"""
+
+import os
+import json
+import base64
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from fqn import split_fqn, subtree_condition
+
+# Максимальный размер страницы /events
+EVENTS_MAX_LIMIT = int(os.getenv('EVENTS_MAX_LIMIT', 1000))
+EVENTS_DEFAULT_LIMIT = 100
+
+# Колонки, которые можно запросить через fields=...
+EVENT_COLUMNS = (
+    'id', 'event_id', 'event_type', 'event_time', 'entity_type', 'entity_id', 'entity_fqn',
+    'entity_name', 'change_description', 'updated_by', 'previous_version', 'current_version',
+    'full_payload', 'created_at',
+)
+# По умолчанию всё, кроме full_payload (его возвращаем только по include_payload=1)
+DEFAULT_COLUMNS = tuple(c for c in EVENT_COLUMNS if c != 'full_payload')
+
+# Фильтры на равенство: параметр запроса -> колонка
+EQUALITY_FILTERS = {
+    'entity_fqn': 'entity_fqn',
+    'event_type': 'event_type',
+    'entity_type': 'entity_type',
+    'updated_by': 'updated_by',
+    'entity_id': 'entity_id',
+}
+
+# Индексы под фильтры: равенство + сортировка по (event_time, id) без отдельной сортировки
+EVENT_INDEXES = {
+    'idx_events_time_id': '(event_time, id)',
+    'idx_events_fqn_time': '(entity_fqn, event_time, id)',
+    'idx_events_type_time': '(event_type, event_time, id)',
+    'idx_events_entity_type_time': '(entity_type, event_time, id)',
+    'idx_events_updated_by_time': '(updated_by, event_time, id)',
+    'idx_events_entity_id_time': '(entity_id, event_time, id)',
+}
+# fqn_prefix (поддерево) - диапазон по idx_events_fqn_path_time (fqn_path, event_time, id),
+# см. fqn.FQN_INDEXES
+
+
+class InvalidQuery(ValueError):
+    """Некорректные параметры запроса (ответ 400)"""
+
+
+def encode_cursor(event_time: datetime, row_id: int) -> str:
+    """Курсор следующей страницы: позиция последней отданной строки"""
+    raw = json.dumps([event_time.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        event_time, row_id = json.loads(raw)
+        return datetime.fromisoformat(event_time), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidQuery(f"Некорректный cursor: {e}")
+
+
+def _parse_time(name: str, value: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidQuery(f"{name}: ожидается дата/время в ISO 8601, получено {value!r}")
+
+
+def parse_fqn_prefix(value: Optional[str]) -> Optional[List[str]]:
+    """fqn_prefix=svc.db - путь поддерева (сама сущность и всё под ней) или None"""
+    if not value:
+        return None
+    path = split_fqn(value)
+    if not path:
+        raise InvalidQuery(f"fqn_prefix: нет ни одного компонента FQN в {value!r}")
+    return path
+
+
+def parse_columns(fields: Optional[str], include_payload: bool) -> List[str]:
+    """Проекция: fields=a,b,c или колонки по умолчанию; id и event_time нужны для курсора"""
+    if fields:
+        columns = [c.strip() for c in fields.split(',') if c.strip()]
+        unknown = [c for c in columns if c not in EVENT_COLUMNS]
+        if unknown:
+            raise InvalidQuery(f"Неизвестные поля: {', '.join(unknown)}")
+    else:
+        columns = list(DEFAULT_COLUMNS)
+    if include_payload and 'full_payload' not in columns:
+        columns.append('full_payload')
+    for required in ('event_time', 'id'):
+        if required not in columns:
+            columns.insert(0, required)
+    if 'full_payload' in columns:
+        # Ссылка на entity в payload_blobs: по ней entity возвращается в full_payload
+        columns.append('entity_hash')
+    return columns
+
+
+def parse_limit(value: Optional[str]) -> int:
+    if value is None:
+        return EVENTS_DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidQuery(f"limit: ожидается число, получено {value!r}")
+    if limit < 1:
+        raise InvalidQuery("limit должен быть больше 0")
+    return min(limit, EVENTS_MAX_LIMIT)
+
+
+def build_events_query(args: Dict[str, Any], limit: Optional[int]) -> Tuple[str, list, List[str]]:
+    """
+    SQL для выборки событий по параметрам запроса.
+    Возвращает (query, params, columns); limit=None - без ограничения (для выгрузки)
+    """
+    columns = parse_columns(args.get('fields'), args.get('include_payload') in ('1', 'true', 'yes'))
+    order = (args.get('order') or 'desc').lower()
+    if order not in ('asc', 'desc'):
+        raise InvalidQuery("order: ожидается asc или desc")
+
+    conditions = []
+    params = []
+    for name, column in EQUALITY_FILTERS.items():
+        value = args.get(name)
+        if value:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    fqn_path = parse_fqn_prefix(args.get('fqn_prefix'))
+    if fqn_path:
+        condition, condition_params = subtree_condition('fqn_path', fqn_path)
+        conditions.append(condition)
+        params.extend(condition_params)
+
+    if args.get('since'):
+        conditions.append("event_time >= %s")
+        params.append(_parse_time('since', args['since']))
+    if args.get('until'):
+        conditions.append("event_time < %s")
+        params.append(_parse_time('until', args['until']))
+
+    if args.get('cursor'):
+        event_time, row_id = decode_cursor(args['cursor'])
+        conditions.append(f"(event_time, id) {'<' if order == 'desc' else '>'} (%s, %s)")
+        params.extend([event_time, row_id])
+
+    query = f"SELECT {', '.join(columns)} FROM metadata_change_events"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY event_time {order.upper()}, id {order.upper()}"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params, columns
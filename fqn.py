@@ -0,0 +1,146 @@
+"""
+Иерархические FQN: service.database.schema.table как путь из компонентов
+Компонент с точкой OpenMetadata берёт в кавычки (svc."db.v2".sales), поэтому
+разбор - по компонентам, а не по точкам строки. Путь хранится в колонке fqn_path
+(TEXT[] COLLATE "C") у metadata_change_events и entity_current_state и разбирается самим
+PostgreSQL при записи строки, отдельного шага в write_events нет: на новой установке это
+генерируемая колонка, на установке с данными - обычная, с триггером и фоновым заполнением
+старых строк (migrations.add_derived_column).
+
+Поддерево - непрерывный диапазон путей в B-tree индексе (fqn_path, event_time, id):
+    fqn_path >= {svc,db} AND fqn_path < {svc,"db\\x01"}
+В порядке "C" любой путь с префиксом {svc,db} лежит между этими границами, а соседние
+ветки (db2, "db.x") - вне их. LIKE 'svc.db.%' использует индекс только при
+collation "C" и путает компоненты с точками в кавычках.
+
+Число событий по поддеревьям первых FQN_ROLLUP_DEPTH уровней считается в event_rollups
+(разрезы fqn_1 ... fqn_N, значение - канонический FQN префикса).
+"""
+
+import os
+import re
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Сколько уровней FQN считать в агрегатах event_rollups (fqn_1 ... fqn_N; 0 - не считать).
+# После увеличения глубины прошлые периоды - через python rollups.rebuild
+FQN_ROLLUP_DEPTH = max(int(os.getenv('FQN_ROLLUP_DEPTH', 3)), 0)
+
+FQN_DIMENSIONS = tuple(f'fqn_{depth}' for depth in range(1, FQN_ROLLUP_DEPTH + 1))
+
+# Компонент: "в кавычках" (кавычки отбрасываются) или без точек и кавычек.
+# Альтернативы начинаются с разных символов - PostgreSQL и re разбирают одинаково
+_COMPONENT_RE = re.compile(r'"([^"]*)"|([^."]+)')
+_COMPONENT_SQL = '"([^"]*)"|([^."]+)'
+
+FQN_FUNCTIONS_DDL = f"""
+    CREATE OR REPLACE FUNCTION history_fqn_path(fqn TEXT) RETURNS TEXT[]
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT ARRAY(
+            SELECT coalesce(m[1], m[2])
+            FROM regexp_matches(fqn, '{_COMPONENT_SQL}', 'g') WITH ORDINALITY AS r (m, n)
+            ORDER BY n
+        )
+    $$;
+
+    -- Префиксы FQN первых max_depth уровней в каноническом виде (как join_fqn)
+    CREATE OR REPLACE FUNCTION history_fqn_prefixes(fqn TEXT, max_depth INT)
+    RETURNS TABLE (fqn_depth INT, prefix TEXT)
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT k, array_to_string(ARRAY(
+            SELECT CASE WHEN c LIKE '%.%' THEN '"' || c || '"' ELSE c END
+            FROM unnest(path[1:k]) WITH ORDINALITY AS u (c, n)
+            ORDER BY n
+        ), '.')
+        FROM history_fqn_path(fqn) AS path,
+             generate_series(1, least(max_depth, cardinality(path))) AS k
+    $$;
+"""
+
+# Колонки fqn_path: (таблица, колонка, тип, исходные колонки, выражение от строки {row})
+FQN_COLUMNS = tuple(
+    (table, 'fqn_path', 'TEXT[] COLLATE "C"', ('entity_fqn',), 'history_fqn_path({row}entity_fqn)')
+    for table in ('metadata_change_events', 'entity_current_state')
+)
+
+# Индексы поддеревьев: (имя, таблица, определение), строятся online-миграцией
+FQN_INDEXES = (
+    ('idx_events_fqn_path_time', 'metadata_change_events', '(fqn_path, event_time, id)'),
+    ('idx_entity_state_fqn_path', 'entity_current_state', '(fqn_path, last_event_time)'),
+)
+
+
+def split_fqn(fqn: Optional[str]) -> List[str]:
+    """Компоненты FQN (как history_fqn_path): svc."db.v2".sales -> ['svc', 'db.v2', 'sales']"""
+    if not fqn:
+        return []
+    return [m.group(1) if m.group(1) is not None else m.group(2) for m in _COMPONENT_RE.finditer(fqn)]
+
+
+def join_fqn(path: List[str]) -> str:
+    """Канонический FQN пути: компоненты с точкой - в кавычках"""
+    return '.'.join(f'"{component}"' if '.' in component else component for component in path)
+
+
+def fqn_prefixes(fqn: Optional[str], depth: int = FQN_ROLLUP_DEPTH) -> List[Tuple[str, str]]:
+    """Разрезы агрегатов события: [('fqn_1', 'svc'), ('fqn_2', 'svc.db'), ...] (как history_fqn_prefixes)"""
+    path = split_fqn(fqn)
+    return [(f'fqn_{k}', join_fqn(path[:k])) for k in range(1, min(depth, len(path)) + 1)]
+
+
+def subtree_bounds(path: List[str]) -> Tuple[List[str], List[str]]:
+    """Границы поддерева [path, upper) в порядке "C": символ \\x01 - наименьший возможный в TEXT"""
+    return list(path), list(path[:-1]) + [path[-1] + '\x01']
+
+
+def subtree_condition(column: str, path: List[str]) -> Tuple[str, list]:
+    """SQL-условие «путь в поддереве path» по колонке fqn_path: (условие, параметры)"""
+    lower, upper = subtree_bounds(path)
+    return f"({column} >= %s::text[] AND {column} < %s::text[])", [lower, upper]
+
+
+def in_subtree(fqn: Optional[str], path: List[str]) -> bool:
+    """Та же проверка для события в памяти"""
+    return split_fqn(fqn)[:len(path)] == path
+
+
+def subtree_regex(path: List[str]) -> str:
+    """
+    Регулярное выражение (RE2/re) для FQN из поддерева path - фильтр архива,
+    где колонки fqn_path нет. Компонент без точки может быть и в кавычках
+    """
+    components = []
+    for component in path:
+        quoted = re.escape(f'"{component}"')
+        components.append(quoted if '.' in component else f'(?:{re.escape(component)}|{quoted})')
+    return '^' + r'\.'.join(components) + r'(?:\.|$)'
+
+
+def subtree_counts(cursor, path: List[str], since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   filters: Optional[Dict[str, str]] = None) -> Counter:
+    """
+    Число событий поддерева path (пустой - все) в metadata_change_events по ветвям
+    следующего уровня: {путь ветви: n}; события самого path - под ключом tuple(path).
+    filters - равенства по колонкам событий
+    """
+    depth = len(path) + 1
+    conditions, params = ["fqn_path IS NOT NULL"], []
+    if path:
+        condition, params = subtree_condition('fqn_path', path)
+        conditions = [condition]
+    for column, value in (filters or {}).items():
+        conditions.append(f"{column} = %s")
+        params.append(value)
+    if since is not None:
+        conditions.append("event_time >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("event_time < %s")
+        params.append(until)
+    cursor.execute(f"""
+        SELECT fqn_path[1:{depth}], count(*) FROM metadata_change_events
+        WHERE {' AND '.join(conditions)}
+        GROUP BY 1
+    """, params)
+    return Counter({tuple(branch): count for branch, count in cursor.fetchall()})
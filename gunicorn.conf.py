@@ -0,0 +1,44 @@
+"""
+Настройки gunicorn для webhook listener'а
+Воркеры пишут метрики Prometheus в общий каталог PROMETHEUS_MULTIPROC_DIR, и /metrics
+любого воркера отдаёт сумму по всем. Каталог очищается при старте master-процесса,
+файлы завершившихся воркеров помечаются в child_exit. Общая таблица кэша повторов
+(DEDUPE_SHARED_FILE) при старте тоже удаляется: БД могла быть очищена, пока сервис стоял.
+Каждый воркер при запуске проверяет схему БД (migrations.py): актуальная - один запрос,
+обязательные миграции выполняет один воркер, остальные его ждут.
+
+    gunicorn --config gunicorn.conf.py --bind 0.0.0.0:5000 --workers 2 webhook_listener:app
+"""
+
+import os
+import shutil
+
+# Задаётся до импорта приложения воркерами: prometheus_client читает переменную при импорте
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/om_history_metrics')
+
+
+def on_starting(server):
+    # Файлы от прошлого запуска исказили бы счётчики
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    if os.getenv('DEDUPE_SHARED_FILE'):
+        try:
+            os.remove(os.environ['DEDUPE_SHARED_FILE'])
+        except FileNotFoundError:
+            pass
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # __main__ под gunicorn не выполняется. БД недоступна: со SPOOL_DIR воркер стартует и пишет
+    # в spool, без него - не стартует, как python webhook_listener.py
+    from webhook_listener import init_database, SPOOL_DIR
+    try:
+        init_database()
+    except Exception:
+        if not SPOOL_DIR:
+            raise
@@ -0,0 +1,454 @@
+"""
+Асинхронный приём событий
+/webhook кладёт событие в ограниченную очередь и сразу отвечает 202,
+фоновый поток пишет события в БД пачками (N событий или раз в T мс) в одной транзакции.
+Опционально очередь дублируется в журнал на диске, чтобы пережить рестарт воркера.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from db_pool import TRANSIENT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Настройки очереди (на один процесс)
+INGEST_QUEUE_MAX_SIZE = int(os.getenv('INGEST_QUEUE_MAX_SIZE', 10000))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))
+INGEST_FLUSH_INTERVAL_MS = float(os.getenv('INGEST_FLUSH_INTERVAL_MS', 50))
+# Каталог для журнала очереди; пусто - очередь только в памяти
+INGEST_QUEUE_DIR = os.getenv('INGEST_QUEUE_DIR', '')
+INGEST_QUEUE_FSYNC = os.getenv('INGEST_QUEUE_FSYNC', '0') == '1'
+# Размер сегмента журнала, после которого начинается новый файл
+INGEST_QUEUE_SEGMENT_MAX_BYTES = int(os.getenv('INGEST_QUEUE_SEGMENT_MAX_BYTES', 16 * 1024 * 1024))
+# Сколько секунд дописывать очередь при остановке (SIGTERM)
+INGEST_DRAIN_TIMEOUT = float(os.getenv('INGEST_DRAIN_TIMEOUT', 25))
+
+
+class QueueFull(Exception):
+    """Очередь заполнена - клиенту нужно повторить позже"""
+
+
+class QueueClosed(Exception):
+    """Очередь остановлена и больше не принимает события"""
+
+
+class QueueJournal:
+    """
+    Журнал очереди на диске: каждое событие дописывается JSON-строкой в сегмент
+    queue-<pid>-<id>-<номер>.journal, после записи пачки в БД запоминается позиция,
+    до которой всё сохранено. Сегмент больше segment_max_bytes закрывается для записи и
+    начинается следующий (как в spool); полностью сохранённые сегменты удаляются, поэтому
+    под постоянной нагрузкой, когда очередь не опустошается, журнал не растёт
+    """
+
+    def __init__(self, directory: str, fsync: bool = False,
+                 segment_max_bytes: int = 16 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_max_bytes = segment_max_bytes
+        self.prefix = os.path.join(directory, f"queue-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self._lock = threading.Lock()
+        # fsync - вне блокировки записи: пока один поток ждёт диск, другие дописывают строки,
+        # и следующий fsync подтверждает их разом (group commit). Счётчики - строки журнала
+        self._sync_lock = threading.Lock()
+        self._appended = 0
+        self._synced = 0
+        # Несохранённые сегменты: {номер: [путь, файл, размер]}. Пока процесс жив, все они
+        # заблокированы - другие воркеры их не подхватят
+        self._segments = {}
+        self._number = 0
+        self._open_segment()
+
+    def _open_segment(self):
+        self._number += 1
+        self.path = f"{self.prefix}-{self._number:06d}.journal"
+        self._file = open(self.path, 'ab')
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segments[self._number] = [self.path, self._file, 0]
+
+    def append(self, event: Dict[str, Any],
+               enqueue: Optional[Callable[[Tuple[int, int]], None]] = None) -> Tuple[int, int]:
+        """
+        Дописывает событие и возвращает позицию конца записи: (номер сегмента, смещение).
+        enqueue(позиция) вызывается под блокировкой журнала, поэтому события попадают
+        в очередь в порядке записи. С fsync возвращается, когда запись уже на диске
+        """
+        line = json.dumps(event, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+        with self._lock:
+            segment = self._segments[self._number]
+            if segment[2] >= self.segment_max_bytes:
+                if self.fsync:
+                    # Сегмент закрывается для записи - sync() дальше касается только нового
+                    os.fsync(self._file.fileno())
+                self._open_segment()
+                segment = self._segments[self._number]
+            self._file.write(line)
+            self._file.flush()
+            segment[2] += len(line)
+            self._appended += 1
+            sequence = self._appended
+            position = (self._number, segment[2])
+            if enqueue is not None:
+                enqueue(position)
+        if self.fsync:
+            self.sync(sequence)
+        return position
+
+    def sync(self, sequence: int):
+        """Ждёт, пока на диске окажутся первые sequence строк журнала"""
+        with self._sync_lock:
+            if self._synced >= sequence:
+                # Уже покрыто fsync'ом другого потока
+                return
+            with self._lock:
+                target = self._appended
+                # Копия дескриптора: commit может закрыть сегмент, пока идёт fsync
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = target
+
+    def commit(self, position: Tuple[int, int]):
+        """Отмечает, что всё до позиции position записано в БД"""
+        number, offset = position
+        with self._lock:
+            # Сегменты до number сохранены целиком, как и сегмент number, если он уже не пишется
+            done = [n for n in self._segments if n < number or (n == number != self._number
+                                                                and offset >= self._segments[n][2])]
+            for n in done:
+                path, segment_file, _ = self._segments.pop(n)
+                segment_file.close()
+                _remove_segment(path)
+            if number not in self._segments:
+                return
+
+            path, segment_file, size = self._segments[number]
+            if number == self._number and offset >= size:
+                # Всё записано - активный сегмент можно обнулить
+                segment_file.truncate(0)
+                segment_file.seek(0)
+                self._segments[number][2] = 0
+                offset = 0
+            _write_offset(path, offset, self.fsync)
+
+    def close(self, remove: bool = False):
+        with self._lock:
+            for path, segment_file, _ in self._segments.values():
+                segment_file.close()
+                if remove:
+                    _remove_segment(path)
+            self._segments.clear()
+
+    def recover_orphans(self):
+        """
+        Находит сегменты журналов завершившихся процессов и возвращает несохранённые события.
+        Каждый сегмент отдаётся как (события, функция удаления сегмента), по порядку записи
+        """
+        own = os.path.basename(self.prefix) + '-'
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.journal') or name.startswith(own):
+                continue
+            try:
+                orphan = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Журнал живого воркера
+                orphan.close()
+                continue
+
+            orphan.seek(_read_offset(path))
+            events = []
+            for line in orphan:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # Недописанная строка при аварийном завершении
+                    logger.warning(f"Пропущена повреждённая строка в журнале {path}")
+
+            def remove(orphan=orphan, path=path):
+                _remove_segment(path)
+                orphan.close()
+
+            yield events, remove
+
+
+def _remove_segment(journal_path: str):
+    for path in (journal_path, journal_path + '.committed'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _read_offset(journal_path: str) -> int:
+    try:
+        with open(journal_path + '.committed') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_offset(journal_path: str, offset: int, fsync: bool):
+    tmp_path = journal_path + '.committed.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(offset))
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path + '.committed')
+
+
+class IngestQueue:
+    """Ограниченная очередь событий с фоновым потоком пакетной записи в БД"""
+
+    def __init__(self, write_batch: Callable[[List[Dict[str, Any]]], None],
+                 maxsize: int = 10000, batch_size: int = 500, flush_interval: float = 0.05,
+                 journal_dir: Optional[str] = None, journal_fsync: bool = False,
+                 journal_segment_max_bytes: int = 16 * 1024 * 1024,
+                 retry_delay: float = 0.5, retry_delay_max: float = 30,
+                 spill: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self.write_batch = write_batch
+        # Куда отдать пачку, если БД недоступна (spool), вместо повторов с задержкой
+        self.spill = spill
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.retry_delay_max = retry_delay_max
+
+        self._journal = QueueJournal(journal_dir, journal_fsync,
+                                     journal_segment_max_bytes) if journal_dir else None
+        self._cond = threading.Condition(threading.Lock())
+        self._items = deque()  # (событие, позиция в журнале, время постановки)
+        self._in_flight = 0
+        # Места, занятые событиями, которые ещё дописываются в журнал
+        self._reserved = 0
+        self._closed = False
+        self._abort = threading.Event()
+        self._thread = None
+
+        # Метрики
+        self._enqueued = 0
+        self._rejected = 0
+        self._written = 0
+        self._dropped = 0
+        self._spilled = 0
+        self._batches = 0
+        self._failed_batches = 0
+        self._last_batch_size = 0
+        self._last_batch_ms = 0.0
+        self._max_depth = 0
+
+    def start(self):
+        """Поднимает события из журналов упавших воркеров и запускает поток записи"""
+        if self._journal is not None:
+            for events, remove in self._journal.recover_orphans():
+                for event_data in events:
+                    self.put(event_data, force=True)
+                remove()
+                if events:
+                    logger.info(f"Из журнала восстановлено событий: {len(events)}")
+
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, event_data: Dict[str, Any], force: bool = False):
+        """Ставит событие в очередь; при переполнении бросает QueueFull"""
+        with self._cond:
+            if self._closed:
+                raise QueueClosed("Очередь остановлена")
+            depth = len(self._items) + self._in_flight + self._reserved
+            if depth >= self.maxsize and not force:
+                self._rejected += 1
+                raise QueueFull(f"Очередь заполнена ({self.maxsize} событий)")
+            if self._journal is None:
+                self._enqueue(event_data, None)
+                return
+            # Место занято сразу, а запись в журнал (и fsync) идёт без блокировки очереди:
+            # её не ждут ни поток записи, ни другие запросы
+            self._reserved += 1
+
+        enqueued = False
+
+        def enqueue(position: Tuple[int, int]):
+            nonlocal enqueued
+            with self._cond:
+                self._reserved -= 1
+                self._enqueue(event_data, position)
+            enqueued = True
+
+        try:
+            self._journal.append(event_data, enqueue)
+        except Exception:
+            if not enqueued:
+                with self._cond:
+                    self._reserved -= 1
+                    self._cond.notify_all()
+            raise
+
+    def _enqueue(self, event_data: Dict[str, Any], position: Optional[Tuple[int, int]]):
+        # Вызывается под self._cond
+        self._items.append((event_data, position, time.monotonic()))
+        self._enqueued += 1
+        self._max_depth = max(self._max_depth, len(self._items) + self._in_flight + self._reserved)
+        self._cond.notify()
+
+    def _next_batch(self) -> list:
+        """Ждёт первое событие, затем добирает пачку до batch_size или flush_interval"""
+        with self._cond:
+            # После остановки - ещё и события, которые дописываются в журнал
+            while not self._items and (not self._closed or self._reserved):
+                self._cond.wait()
+            if not self._items:
+                return []
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._items) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            count = min(self.batch_size, len(self._items))
+            batch = [self._items.popleft() for _ in range(count)]
+            self._in_flight = count
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+            self._write(batch)
+            with self._cond:
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def _write(self, batch: list):
+        """Пишет пачку, повторяя при временных ошибках БД"""
+        events = [event_data for event_data, _, _ in batch]
+        delay = self.retry_delay
+
+        while True:
+            started = time.monotonic()
+            try:
+                try:
+                    self.write_batch(events)
+                    written = len(events)
+                except TRANSIENT_ERRORS:
+                    raise
+                except Exception as e:
+                    # Пачку испортило конкретное событие - пишем по одному, плохие отбрасываем
+                    logger.error(f"Ошибка записи пачки из {len(events)} событий: {e}; пишем по одному")
+                    written = self._write_one_by_one(events)
+            except TRANSIENT_ERRORS as e:
+                with self._cond:
+                    self._failed_batches += 1
+                if self.spill is not None and self._spill(batch, e):
+                    return
+                logger.error(f"БД недоступна, пачка из {len(events)} событий будет повторена "
+                             f"через {delay:.1f} сек: {e}")
+                if self._abort.wait(delay):
+                    return
+                delay = min(delay * 2, self.retry_delay_max)
+                continue
+
+            elapsed_ms = (time.monotonic() - started) * 1000
+            if self._journal is not None:
+                self._journal.commit(batch[-1][1])
+            with self._cond:
+                self._written += written
+                self._dropped += len(events) - written
+                self._batches += 1
+                self._last_batch_size = len(events)
+                self._last_batch_ms = round(elapsed_ms, 3)
+            return
+
+    def _spill(self, batch: list, error: Exception) -> bool:
+        events = [event_data for event_data, _, _ in batch]
+        try:
+            self.spill(events)
+        except Exception as e:
+            logger.error(f"Не удалось записать пачку в spool: {e}")
+            return False
+
+        logger.warning(f"БД недоступна ({error}), пачка из {len(events)} событий записана в spool")
+        if self._journal is not None:
+            self._journal.commit(batch[-1][1])
+        with self._cond:
+            self._spilled += len(events)
+            self._batches += 1
+        return True
+
+    def _write_one_by_one(self, events: List[Dict[str, Any]]) -> int:
+        written = 0
+        for event_data in events:
+            try:
+                self.write_batch([event_data])
+                written += 1
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.error("✗ Событие %s отброшено: %s", event_data.get('id', event_data.get('eventId')), e)
+        return written
+
+    def stop(self, timeout: float = 25):
+        """Перестаёт принимать события и дописывает очередь в БД (не дольше timeout секунд)"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                # БД так и не ответила - прерываем повторы
+                self._abort.set()
+                self._thread.join(1)
+
+        with self._cond:
+            left = len(self._items) + self._in_flight + self._reserved
+        if left:
+            where = f"остаются в журнале {self._journal.prefix}-*" if self._journal else "потеряны"
+            logger.error(f"При остановке не записано событий: {left}, они {where}")
+        else:
+            logger.info("Очередь событий дописана в БД")
+
+        if self._journal is not None:
+            self._journal.close(remove=not left)
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущие метрики очереди"""
+        with self._cond:
+            oldest_age = time.monotonic() - self._items[0][2] if self._items else 0.0
+            return {
+                'depth': len(self._items) + self._in_flight + self._reserved,
+                'max_size': self.maxsize,
+                'max_depth': self._max_depth,
+                'in_flight': self._in_flight,
+                'oldest_age_ms': round(oldest_age * 1000, 3),
+                'enqueued': self._enqueued,
+                'rejected': self._rejected,
+                'written': self._written,
+                'dropped': self._dropped,
+                'spilled': self._spilled,
+                'batches': self._batches,
+                'failed_batches': self._failed_batches,
+                'last_batch_size': self._last_batch_size,
+                'last_batch_ms': self._last_batch_ms,
+                'journal': self._journal.path if self._journal else None,
+            }
@@ -371,6 +371,10 @@ psycopg2-binary==2.9.9
 python-dotenv==1.0.0
 requests==2.31.0
 gunicorn==21.2.0
+prometheus-client==0.19.0
+quart==0.19.4
+uvicorn==0.30.6
+pyarrow==17.0.0
 EOF
         print_success "requirements.txt создан"
     else
@@ -393,11 +397,11 @@ RUN apt-get update && apt-get install -y \
 COPY requirements.txt .
 RUN pip install --no-cache-dir -r requirements.txt
 
-COPY webhook_listener.py .
+COPY *.py ./
 
 EXPOSE 5000
 
-CMD ["gunicorn", "--bind", "0.0.0.0:5000", "--workers", "2", "--timeout", "120", "webhook_listener:app"]
+CMD ["gunicorn", "--config", "gunicorn.conf.py", "--bind", "0.0.0.0:5000", "--workers", "2", "--timeout", "120", "webhook_listener:app"]
 EOF
         print_success "Dockerfile создан"
     fi
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест webhook listener'а
+Генерирует поток событий, похожий на OpenMetadata (как в test_webhook.py, но с жизненным
+циклом сущностей): создания, изменения и удаления в заданной пропорции, таблицы разного
+размера, разное число изменённых полей в событии, повторная доставка событий с тем же id.
+Нагрузка - с фиксированной конкурентностью (клиент ждёт ответа перед следующим запросом)
+или с целевой частотой событий в секунду. В конце - пропускная способность, задержки
+p50/p95/p99, коды ответов и доля ошибок; пороги --max-p99-ms / --max-error-rate
+превращают прогон в проверку перед выкладкой (код выхода 1 при превышении).
+
+Примеры:
+    python loadgen.py --concurrency 16 --duration 30
+    python loadgen.py --rate 200 --duration 60 --mix created=1,updated=8,deleted=1
+    python loadgen.py --events 5000 --columns 10-300 --fields 1-20 --duplicates 0.05 \\
+        --max-p99-ms 250 --max-error-rate 0.001 --json report.json --cleanup
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+import requests
+
+EVENT_TYPES = ('created', 'updated', 'deleted')
+DATA_TYPES = ('INT', 'BIGINT', 'VARCHAR', 'TEXT', 'TIMESTAMP', 'BOOLEAN', 'DECIMAL')
+TAGS = ('PII.Sensitive', 'PII.NonSensitive', 'Tier.Tier1', 'Tier.Tier2', 'Tier.Gold')
+USERS = tuple(f"user{i}@example.com" for i in range(20))
+
+
+def parse_range(value: str) -> Tuple[int, int]:
+    """'20' -> (20, 20), '10-300' -> (10, 300)"""
+    low, _, high = value.partition('-')
+    low, high = int(low), int(high or low)
+    if low < 0 or high < low:
+        raise argparse.ArgumentTypeError(f"Некорректный диапазон: {value}")
+    return low, high
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """'created=1,updated=8,deleted=1' -> веса типов событий"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in EVENT_TYPES:
+            raise argparse.ArgumentTypeError(f"Неизвестный тип события: {name}")
+        mix[name.strip()] = float(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("Все веса нулевые")
+    return mix
+
+
+class EventStream:
+    """
+    Поток событий OpenMetadata: живые сущности создаются, меняются и удаляются,
+    версии и changeDescription согласованы с предыдущим состоянием сущности.
+    Потокобезопасен: next_event() можно вызывать из нескольких потоков
+    """
+
+    def __init__(self, run_id: str, mix: Dict[str, float], columns: Tuple[int, int],
+                 fields: Tuple[int, int], duplicates: float = 0.0, entities: int = 1000, seed: int = 42):
+        self.run_id = run_id
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.columns = columns
+        self.fields = fields
+        self.duplicates = duplicates
+        self.max_entities = entities
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._live = {}      # entity_id -> entity (последняя версия)
+        self._live_ids = []  # для случайного выбора
+        self._sent = []      # недавние события - для повторной доставки
+        self._counter = 0
+
+    def _entity_id(self) -> str:
+        return f"loadgen-{self.run_id}-entity-{uuid.UUID(int=self.rng.getrandbits(128))}"
+
+    def _new_entity(self, entity_id: str) -> Dict[str, Any]:
+        name = f"table_{len(self._live_ids)}_{self._counter}"
+        fqn = f"loadgen_db.{self.run_id}.{name}"
+        return {
+            "id": entity_id,
+            "type": "table",
+            "name": name,
+            "fullyQualifiedName": fqn,
+            "description": f"Таблица {name} из нагрузочного теста",
+            "version": 0.1,
+            "updatedBy": self.rng.choice(USERS),
+            "tableType": "Regular",
+            "owners": [{"id": "owner-1", "type": "user", "name": "loadgen"}],
+            "tags": [],
+            "columns": [{
+                "name": f"column_{i}",
+                "dataType": self.rng.choice(DATA_TYPES),
+                "fullyQualifiedName": f"{fqn}.column_{i}",
+                "description": f"Колонка {i}",
+                "ordinalPosition": i + 1,
+                "tags": [],
+            } for i in range(self.rng.randint(*self.columns))],
+        }
+
+    def _change(self, entity: Dict[str, Any]) -> Dict[str, Any]:
+        """Меняет сущность на месте и возвращает changeDescription"""
+        updated, added = [], []
+        for _ in range(self.rng.randint(*self.fields)):
+            roll = self.rng.random()
+            if roll < 0.15:
+                old_tags = list(entity["tags"])
+                entity["tags"] = old_tags + [{"tagFQN": self.rng.choice(TAGS), "labelType": "Manual"}]
+                added.append({"name": "tags", "newValue": json.dumps(entity["tags"][-1:])})
+            elif roll < 0.3 or not entity["columns"]:
+                old = entity["description"]
+                entity["description"] = f"Описание версии {self._counter}"
+                updated.append({"name": "description", "oldValue": old, "newValue": entity["description"]})
+            else:
+                column = self.rng.choice(entity["columns"])
+                old = column["description"]
+                column["description"] = f"Колонка {column['name']}, правка {self._counter}"
+                updated.append({"name": f"columns.{column['name']}.description",
+                                "oldValue": old, "newValue": column["description"]})
+        return {"fieldsAdded": added, "fieldsUpdated": updated, "fieldsDeleted": [],
+                "previousVersion": entity["version"]}
+
+    def _event(self, kind: str, entity: Dict[str, Any], previous: Optional[float],
+               change: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        self._counter += 1
+        event = {
+            "id": f"loadgen-{self.run_id}-{self._counter}",
+            "eventType": f"entity{kind.capitalize()}",
+            "timestamp": int(time.time() * 1000),
+            "entityType": "table",
+            "entityId": entity["id"],
+            "entityFQN": entity["fullyQualifiedName"],
+            "userName": entity["updatedBy"],
+            "currentVersion": entity["version"],
+            # Сериализуем сразу: сущность дальше меняется на месте
+            "entity": json.loads(json.dumps(entity)),
+        }
+        if previous is not None:
+            event["previousVersion"] = previous
+        if change is not None:
+            event["changeDescription"] = change
+        return event
+
+    def next_event(self) -> Tuple[str, Dict[str, Any]]:
+        """(тип для отчёта, событие); тип 'duplicate' - повтор уже отправленного события"""
+        with self._lock:
+            if self._sent and self.rng.random() < self.duplicates:
+                return 'duplicate', self.rng.choice(self._sent)
+
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            if not self._live_ids or (kind == 'created' and len(self._live_ids) < self.max_entities):
+                kind = 'created'
+            elif kind == 'created':
+                # Пул сущностей заполнен - вместо создания меняем существующую
+                kind = 'updated'
+
+            if kind == 'created':
+                entity_id = self._entity_id()
+                entity = self._new_entity(entity_id)
+                self._live[entity_id] = entity
+                self._live_ids.append(entity_id)
+                event = self._event('created', entity, None, None)
+            else:
+                index = self.rng.randrange(len(self._live_ids))
+                entity = self._live[self._live_ids[index]]
+                previous = entity["version"]
+                entity["version"] = round(previous + 0.1, 1)
+                entity["updatedBy"] = self.rng.choice(USERS)
+                if kind == 'updated':
+                    event = self._event('updated', entity, previous, self._change(entity))
+                else:
+                    entity["deleted"] = True
+                    event = self._event('deleted', entity, previous, None)
+                    # O(1): на место удалённой ставим последнюю
+                    self._live_ids[index] = self._live_ids[-1]
+                    self._live_ids.pop()
+                    del self._live[entity["id"]]
+
+            self._sent.append(event)
+            if len(self._sent) > 1000:
+                del self._sent[:500]
+            return kind, event
+
+
+class Recorder:
+    """Собирает результаты запросов из всех потоков"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []  # мс, от запланированного момента отправки до ответа
+        self.statuses = Counter()
+        self.kinds = Counter()
+        self.errors = Counter()  # исключения клиента (нет соединения, таймаут)
+
+    def add(self, kind: str, latency_ms: float, status: Optional[int], error: Optional[str] = None):
+        with self._lock:
+            self.latencies.append(latency_ms)
+            self.kinds[kind] += 1
+            if status is not None:
+                self.statuses[status] += 1
+            if error is not None:
+                self.errors[error] += 1
+
+    def snapshot(self) -> Tuple[int, int]:
+        """(всего запросов, из них неуспешных)"""
+        with self._lock:
+            total = len(self.latencies)
+            ok = sum(count for status, count in self.statuses.items() if 200 <= status < 300)
+            return total, total - ok
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run(url: str, secret: str, stream: EventStream, concurrency: int, rate: Optional[float],
+        events: Optional[int], duration: Optional[float], timeout: float,
+        report_interval: float) -> Tuple[Recorder, float]:
+    """
+    Гонит нагрузку и возвращает результаты и длительность прогона.
+    С rate - открытая модель: i-е событие отправляется в момент start + i / rate, задержка
+    считается от этого момента (если клиенты не успевают, очередь видна в p99)
+    """
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['Authorization'] = f'Bearer {secret}'
+    recorder = Recorder()
+    next_index = iter(range(sys.maxsize))
+    index_lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+    stop = threading.Event()
+
+    def claim() -> Optional[int]:
+        with index_lock:
+            index = next(next_index)
+        if events is not None and index >= events:
+            return None
+        return index
+
+    def worker():
+        session = requests.Session()
+        while not stop.is_set():
+            index = claim()
+            if index is None:
+                return
+            if rate:
+                scheduled = started + index / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            kind, event = stream.next_event()
+            body = json.dumps(event)
+            if not rate:
+                scheduled = time.perf_counter()
+            status, error = None, None
+            try:
+                status = session.post(url, data=body, headers=headers, timeout=timeout).status_code
+            except requests.RequestException as e:
+                error = type(e).__name__
+            recorder.add(kind, (time.perf_counter() - scheduled) * 1000, status, error)
+
+    def reporter():
+        last_total, last_time = 0, started
+        while not stop.wait(report_interval):
+            total, failed = recorder.snapshot()
+            now = time.perf_counter()
+            print(f"  {now - started:6.1f} с: {total} запросов, {(total - last_total) / (now - last_time):.0f}/с, "
+                  f"ошибок {failed}", file=sys.stderr)
+            last_total, last_time = total, now
+
+    progress = threading.Thread(target=reporter, daemon=True) if report_interval > 0 else None
+    if progress:
+        progress.start()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return recorder, elapsed
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(recorder.latencies)
+    total = len(latencies)
+    ok = sum(count for status, count in recorder.statuses.items() if 200 <= status < 300)
+    return {
+        'requests': total,
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2),
+            'max': round(latencies[-1], 2) if latencies else 0.0,
+        },
+        'error_rate': round((total - ok) / total, 5) if total else 0.0,
+        'statuses': {str(status): count for status, count in sorted(recorder.statuses.items())},
+        'client_errors': dict(recorder.errors),
+        'events': dict(recorder.kinds),
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    latency = report['latency_ms']
+    print(f"Запросов: {report['requests']} за {report['duration_s']} с, {report['throughput_rps']}/с")
+    print(f"Задержка, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}, max {latency['max']}")
+    print(f"Ошибок: {report['error_rate'] * 100:.3f}%, коды ответов: {report['statuses']}"
+          + (f", клиент: {report['client_errors']}" if report['client_errors'] else ''))
+    print(f"События: {report['events']}")
+
+
+def cleanup(run_id: str):
+    """Удаляет из БД всё, что записал прогон (события, изменения полей, состояние, blob'ы)"""
+    from db_pool import db_connection
+    from payload_store import collect_garbage, release_references
+
+    pattern = f"loadgen-{run_id}-%"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        release_references(cursor, "SELECT entity_hash FROM metadata_change_events WHERE event_id LIKE %s",
+                           (pattern,))
+        cursor.execute("DELETE FROM field_changes WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM metadata_change_events WHERE event_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM deleted_entities WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_snapshots WHERE entity_id LIKE %s", (pattern,))
+        cursor.execute("DELETE FROM entity_current_state WHERE entity_id LIKE %s", (pattern,))
+        collect_garbage(cursor)
+        conn.commit()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.getenv('LOADGEN_URL', 'http://localhost:5000/webhook'))
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''),
+                        help='Bearer-ключ (по умолчанию WEBHOOK_SECRET)')
+    load = parser.add_argument_group('нагрузка')
+    load.add_argument('--concurrency', type=int, default=8,
+                      help='Одновременных клиентов (с --rate - максимум запросов в полёте)')
+    load.add_argument('--rate', type=float, default=None, help='Целевая частота, событий/сек')
+    load.add_argument('--events', type=int, default=None, help='Сколько событий отправить')
+    load.add_argument('--duration', type=float, default=None, help='Длительность прогона, сек')
+    load.add_argument('--timeout', type=float, default=30, help='Таймаут запроса, сек')
+    stream = parser.add_argument_group('поток событий')
+    stream.add_argument('--mix', type=parse_mix, default=parse_mix('created=1,updated=8,deleted=1'),
+                        help='Веса типов событий (по умолчанию created=1,updated=8,deleted=1)')
+    stream.add_argument('--columns', type=parse_range, default=(10, 50),
+                        help='Колонок в таблице: N или MIN-MAX (по умолчанию 10-50)')
+    stream.add_argument('--fields', type=parse_range, default=(1, 3),
+                        help='Изменённых полей в entityUpdated: N или MIN-MAX (по умолчанию 1-3)')
+    stream.add_argument('--duplicates', type=float, default=0.0,
+                        help='Доля повторных доставок уже отправленных событий (0-1)')
+    stream.add_argument('--entities', type=int, default=1000, help='Максимум живых сущностей')
+    stream.add_argument('--seed', type=int, default=42)
+    report = parser.add_argument_group('отчёт')
+    report.add_argument('--report-interval', type=float, default=5, help='Прогресс раз в N сек (0 - нет)')
+    report.add_argument('--json', default=None, help='Записать отчёт в JSON-файл')
+    report.add_argument('--max-p99-ms', type=float, default=None, help='Порог p99, мс')
+    report.add_argument('--max-error-rate', type=float, default=None, help='Порог доли ошибок (0-1)')
+    report.add_argument('--cleanup', action='store_true',
+                        help='После прогона удалить записанное из БД (настройки DB_* из окружения)')
+    args = parser.parse_args()
+
+    if args.events is None and args.duration is None:
+        args.events = 1000
+    run_id = uuid.uuid4().hex[:8]
+    events = EventStream(run_id, args.mix, args.columns, args.fields, args.duplicates,
+                         args.entities, args.seed)
+
+    mode = f"{args.rate:g} событий/с" if args.rate else "без ограничения частоты"
+    print(f"Прогон {run_id}: {args.url}, {args.concurrency} клиентов, {mode}", file=sys.stderr)
+    recorder, elapsed = run(args.url, args.secret, events, args.concurrency, args.rate,
+                            args.events, args.duration, args.timeout, args.report_interval)
+    result = summarize(recorder, elapsed)
+    result['run_id'] = run_id
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.cleanup:
+        cleanup(run_id)
+
+    failed = []
+    if args.max_p99_ms is not None and result['latency_ms']['p99'] > args.max_p99_ms:
+        failed.append(f"p99 {result['latency_ms']['p99']} мс > {args.max_p99_ms} мс")
+    if args.max_error_rate is not None and result['error_rate'] > args.max_error_rate:
+        failed.append(f"ошибок {result['error_rate']} > {args.max_error_rate}")
+    if failed:
+        print("ПОРОГИ ПРЕВЫШЕНЫ: " + "; ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
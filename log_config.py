@@ -0,0 +1,110 @@
+"""
+Настройка логирования
+Текстовый или JSON-формат (одна запись - одна строка), уровни по модулям
+и выборочное логирование payload'ов событий (1 из N или по префиксу FQN).
+"""
+
+import os
+import sys
+import json
+import random
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# text - привычный формат, json - одна JSON-запись на строку (для Loki/ELK)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Уровни по отдельным логгерам: "ingest_queue=DEBUG,spool=WARNING,webhook_listener.payload=DEBUG"
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+# Payload событий: 0 - не логировать, 1 - каждое событие, N - одно из N
+LOG_PAYLOAD_SAMPLE_RATE = int(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0))
+# Payload событий с FQN из этих префиксов логируется всегда (через запятую)
+LOG_PAYLOAD_FQN_PREFIXES = tuple(p.strip() for p in os.getenv('LOG_PAYLOAD_FQN_PREFIXES', '').split(',')
+                                 if p.strip())
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями (extra=...)
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, object]:
+    return {key: value for key, value in record.__dict__.items()
+            if key not in _RECORD_ATTRS and not key.startswith('_')}
+
+
+class TextFormatter(logging.Formatter):
+    """Привычный текстовый формат; поля из extra=... дописываются в конец как key=value"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += ' | ' + ' '.join(
+                f"{key}={json.dumps(value, ensure_ascii=False, default=str)}" for key, value in fields.items()
+            )
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной JSON-строкой; поля из extra=... попадают в запись как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(fmt: Optional[str] = None, level: Optional[str] = None):
+    """Настраивает корневой логгер; повторный вызов не добавляет обработчиков"""
+    fmt = fmt or LOG_FORMAT
+    root = logging.getLogger()
+    if getattr(root, '_om_history_configured', False):
+        return
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    root.handlers[:] = [handler]
+    root.setLevel((level or LOG_LEVEL).upper())
+
+    for name, logger_level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(logger_level)
+    root._om_history_configured = True
+
+
+class PayloadSampler:
+    """Решает, логировать ли payload события: 1 из N или по префиксу FQN"""
+
+    def __init__(self, rate: int = 0, fqn_prefixes: tuple = ()):
+        self.rate = rate
+        self.fqn_prefixes = fqn_prefixes
+
+    def __call__(self, entity_fqn: Optional[str]) -> bool:
+        if self.fqn_prefixes and entity_fqn and entity_fqn.startswith(self.fqn_prefixes):
+            return True
+        if self.rate <= 0:
+            return False
+        return self.rate == 1 or random.randrange(self.rate) == 0
+
+
+sample_payload = PayloadSampler(LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_FQN_PREFIXES)
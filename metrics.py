@@ -0,0 +1,157 @@
+"""
+Метрики Prometheus для webhook listener'а (GET /metrics)
+Запросы по статусу и типу события, время каждого этапа приёма (проверка ключа, разбор JSON,
+нормализация, подключение к БД, каждый INSERT, commit), ошибки БД, размер payload'ов
+и число изменений полей в событии, попадания в кэш повторов; для /webhook/batch - размер пачек
+и результаты событий.
+
+Под gunicorn с несколькими воркерами метрики пишутся в общий каталог
+PROMETHEUS_MULTIPROC_DIR (его задаёт gunicorn.conf.py) и при чтении суммируются
+по всем воркерам. Без каталога - метрики только текущего процесса.
+"""
+
+import os
+import time
+from typing import Dict, Optional
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+# Каталог общих файлов метрик воркеров; prometheus_client читает его сам при импорте
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+
+# Типы событий OpenMetadata; остальные значения попадают в метки как 'other',
+# чтобы произвольный eventType из запроса не плодил временные ряды
+EVENT_TYPES = frozenset((
+    'entityCreated', 'entityUpdated', 'entitySoftDeleted', 'entityDeleted',
+    'entityRestored', 'entityNoChange', 'entityFieldsChanged',
+))
+
+# Этапы приёма: webhook_receiver и запись (save_change_event/write_events).
+# При пачечной записи (async, spool) этапы write_events измеряются на всю пачку
+STAGES = (
+    'auth', 'json_parse', 'validate', 'dedupe', 'normalize', 'db_connect', 'entity_locks',
+    'payload_prepare', 'insert_events', 'insert_field_changes', 'deleted_entities', 'payload_blobs',
+    'entity_state', 'snapshots', 'rollups', 'notify', 'commit',
+)
+
+REQUESTS = Counter(
+    'webhook_requests_total', 'Запросы /webhook по HTTP-статусу и типу события',
+    ['status', 'event_type'])
+REQUEST_SECONDS = Histogram(
+    'webhook_request_duration_seconds', 'Полное время обработки /webhook',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+STAGE_SECONDS = Histogram(
+    'ingest_stage_duration_seconds', 'Время этапа приёма события',
+    ['stage'], buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1))
+DB_ERRORS = Counter(
+    'ingest_db_errors_total', 'Ошибки записи в БД по классу исключения',
+    ['error', 'transient'])
+EVENTS_WRITTEN = Counter(
+    'ingest_events_written_total', 'События, переданные на запись: новые и повторы',
+    ['result'])
+PAYLOAD_BYTES = Histogram(
+    'webhook_payload_bytes', 'Размер тела /webhook, байт',
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+BATCH_REQUESTS = Counter(
+    'webhook_batch_requests_total', 'Запросы /webhook/batch по HTTP-статусу',
+    ['status'])
+BATCH_REQUEST_SECONDS = Histogram(
+    'webhook_batch_request_duration_seconds', 'Полное время обработки /webhook/batch',
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+BATCH_SIZE = Histogram(
+    'webhook_batch_size', 'Событий в одном запросе /webhook/batch',
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+BATCH_EVENTS = Counter(
+    'webhook_batch_events_total', 'События /webhook/batch по результату: accepted, duplicate, rejected',
+    ['result'])
+DEDUPE_LOOKUPS = Counter(
+    'ingest_dedupe_lookups_total',
+    'Проверки кэша повторов: local_hit, shared_hit (общая таблица воркеров) или miss',
+    ['result'])
+LATE_EVENTS = Counter(
+    'ingest_late_events_total',
+    'События, пришедшие после более новой версии своей сущности (считаются при INGEST_ENTITY_ORDER=1)')
+FIELD_CHANGES = Histogram(
+    'event_field_changes', 'Изменений полей в одном событии',
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# Дочерние метрики с метками создаются один раз: labels() на каждом событии заметно дороже
+_stage_histograms = {name: STAGE_SECONDS.labels(name) for name in STAGES}
+_written = {result: EVENTS_WRITTEN.labels(result) for result in ('inserted', 'duplicate')}
+_batch_events = {result: BATCH_EVENTS.labels(result) for result in ('accepted', 'duplicate', 'rejected')}
+_dedupe = {found: DEDUPE_LOOKUPS.labels(result) for found, result in
+           (('local', 'local_hit'), ('shared', 'shared_hit'), (None, 'miss'))}
+
+
+class _StageTimer:
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._started)
+        return False
+
+
+def stage(name: str) -> _StageTimer:
+    """Контекстный менеджер: время блока попадает в ingest_stage_duration_seconds{stage=name}"""
+    return _StageTimer(_stage_histograms[name])
+
+
+def observe_stage(name: str, seconds: float):
+    _stage_histograms[name].observe(seconds)
+
+
+def event_type_label(event_type: Optional[str]) -> str:
+    return event_type if event_type in EVENT_TYPES else 'other'
+
+
+def count_request(status: int, event_type: Optional[str] = None):
+    REQUESTS.labels(str(status), event_type_label(event_type) if event_type else 'none').inc()
+
+
+def count_db_error(error: BaseException, transient: bool):
+    DB_ERRORS.labels(type(error).__name__, 'true' if transient else 'false').inc()
+
+
+def count_written(total: int, inserted: int):
+    """Учитывает пачку записанных событий: сколько оказались новыми, сколько повторами"""
+    if inserted:
+        _written['inserted'].inc(inserted)
+    if total > inserted:
+        _written['duplicate'].inc(total - inserted)
+
+
+def count_late(count: int):
+    """Учитывает события, пришедшие не по порядку версий своей сущности"""
+    if count:
+        LATE_EVENTS.inc(count)
+
+
+def count_dedupe(found: Optional[str]):
+    """Учитывает проверку кэша повторов: found - 'local', 'shared' или None (промах)"""
+    _dedupe[found].inc()
+
+
+def count_batch_events(results: Dict[str, int]):
+    """Учитывает события пачки /webhook/batch по результату: {'accepted': n, ...}"""
+    for result, count in results.items():
+        if count:
+            _batch_events[result].inc(count)
+
+
+def render():
+    """Текст метрик в формате Prometheus и его Content-Type"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+"""
+Версионированные миграции схемы БД
+Применённые миграции записываются в schema_migrations. Если схема актуальна, запуск
+процесса (воркер gunicorn/uvicorn, скрипт) выполняет один запрос к этой таблице и ни одного DDL:
+CREATE ... IF NOT EXISTS и ALTER TABLE ... ADD COLUMN IF NOT EXISTS тоже ждут блокировок
+таблиц и на нагруженной БД останавливают приём.
+
+Миграции двух видов:
+- обязательные - без них код не работает (таблицы, колонки, функции). Выполняются при старте,
+  каждая в своей транзакции вместе с записью в schema_migrations;
+- online - новые индексы, CREATE INDEX CONCURRENTLY без блокировки записи, и заполнение новых
+  колонок у существующих строк. Сервис работает и до их окончания, поэтому они выполняются
+  фоновым потоком (SchemaMigrator) после старта. У секционированных таблиц индекс строится
+  по партициям: индекс родителя создаётся ON ONLY, индексы партиций - CONCURRENTLY по одной
+  и подключаются ATTACH PARTITION.
+
+Миграция 1 - схема, с которой установки пришли к миграциям; всё, что появилось позже, - в своих
+миграциях. Обязательная миграция не перезаписывает таблицу и не строит на ней индекс: таблица,
+колонка или функция создаются, только если их ещё нет. Производные колонки (search_vector,
+fqn_path) на пустой таблице - генерируемые (STORED), а на таблице с данными - обычные:
+новые строки заполняет триггер, старые - online-миграция пачками (add_derived_column).
+
+Миграции выполняет один процесс (сессионный advisory lock). Остальные ждут обязательные
+миграции и затем видят актуальную схему, а online-миграции пропускают, если их уже выполняет
+другой процесс. Прерванное построение оставляет недействительный индекс - следующая попытка
+удаляет его и строит заново.
+
+    python migrations.py status
+    python migrations.py migrate              # обязательные и online, в текущем процессе
+    python migrations.py migrate --required   # только обязательные
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from change_stream import STREAM_DDL, STREAM_INDEX
+from events_query import EVENT_INDEXES
+from fqn import FQN_COLUMNS, FQN_FUNCTIONS_DDL, FQN_INDEXES
+from log_config import configure_logging
+from partitions import is_partitioned
+from payload_store import BLOBS_DDL
+from rollups import ROLLUPS_DDL
+from search import SEARCH_COLUMNS, SEARCH_FUNCTIONS_DDL, SEARCH_INDEXES
+from version_gaps import GAPS_DDL, GAPS_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Ожидание короткой блокировки таблицы (индекс родителя, ATTACH, DROP) в online-миграции
+MIGRATION_LOCK_TIMEOUT = os.getenv('MIGRATION_LOCK_TIMEOUT', '5s')
+# Повтор online-миграций, если не удались или их держит другой процесс, сек
+MIGRATION_RETRY_INTERVAL = float(os.getenv('MIGRATION_RETRY_INTERVAL', 300))
+# Строк за одну транзакцию при заполнении новой колонки у существующих строк
+MIGRATION_BACKFILL_BATCH = int(os.getenv('MIGRATION_BACKFILL_BATCH', 5000))
+
+MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name TEXT NOT NULL,
+        online BOOLEAN NOT NULL DEFAULT FALSE,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        duration_sec DOUBLE PRECISION
+    );
+"""
+
+# Ключ advisory lock: миграции в каждый момент выполняет один процесс
+_LOCK_KEY = 'om_history_migrations'
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Any], None]  # получает курсор (online - в autocommit)
+    online: bool = False
+
+
+def create_base_schema(cursor):
+    """
+    Схема, с которой установки пришли к миграциям (её создавал init_database при каждом старте).
+    Не меняется: всё, что появилось позже, - в следующих миграциях
+    """
+    # Таблица для хранения событий изменений
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS metadata_change_events (
+            id BIGSERIAL,
+            event_id VARCHAR(255),
+            event_type VARCHAR(100) NOT NULL,
+            event_time TIMESTAMP NOT NULL,
+            entity_type VARCHAR(100),
+            entity_id VARCHAR(255),
+            entity_fqn TEXT,
+            entity_name VARCHAR(500),
+            change_description TEXT,
+            updated_by VARCHAR(255),
+            previous_version DECIMAL,
+            current_version DECIMAL,
+            full_payload JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            -- Ключ секционирования входит во все уникальные ограничения:
+            -- повтор события приходит с тем же timestamp и отсекается по (event_id, event_time)
+            PRIMARY KEY (id, event_time),
+            UNIQUE (event_id, event_time)
+        ) PARTITION BY RANGE (event_time);
+    """)
+    # Одноколоночные индексы (entity_fqn), (event_type), (event_time) - только у установок
+    # до миграций: их перекрывают индексы /events (миграция 12), удаляет миграция 13
+
+    # Таблица для хранения конкретных изменений полей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS field_changes (
+            id BIGSERIAL,
+            event_id VARCHAR(255),
+            event_time TIMESTAMP NOT NULL,
+            field_name VARCHAR(255),
+            old_value TEXT,
+            new_value TEXT,
+            change_type VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, event_time)
+        ) PARTITION BY RANGE (event_time);
+    """)
+
+    # Индексы для field_changes
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_field_changes_event_id
+        ON field_changes(event_id);
+    """)
+    # (field_name) - индекс установок до миграций: его перекрывает idx_field_changes_name_type
+    # (миграция 2), на новой установке он не создаётся, на старой удаляется миграцией 3
+
+    # Таблица для софт-удалённых сущностей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS deleted_entities (
+            id SERIAL PRIMARY KEY,
+            entity_id VARCHAR(255) UNIQUE,
+            entity_type VARCHAR(100),
+            entity_fqn TEXT,
+            entity_name VARCHAR(500),
+            deleted_at TIMESTAMP,
+            deleted_by VARCHAR(255),
+            last_snapshot JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # Индексы для deleted_entities
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_deleted_entity_type
+        ON deleted_entities(entity_type);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_deleted_at
+        ON deleted_entities(deleted_at);
+    """)
+
+
+def _relation_exists(cursor, name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cursor.fetchone()[0]
+
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    cursor.execute("""
+        SELECT EXISTS (SELECT 1 FROM pg_attribute
+                       WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped)
+    """, (table, column))
+    return cursor.fetchone()[0]
+
+
+def _is_generated(cursor, table: str, column: str) -> bool:
+    cursor.execute("SELECT attgenerated = 's' FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s",
+                   (table, column))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def add_column(cursor, table: str, column: str, definition: str) -> bool:
+    """
+    Добавляет колонку без значения по умолчанию (таблица не перезаписывается), если её ещё нет:
+    ALTER TABLE ... ADD COLUMN IF NOT EXISTS ждал бы ACCESS EXCLUSIVE и для готовой колонки.
+    Возвращает, добавлена ли колонка
+    """
+    if _column_exists(cursor, table, column):
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+def _trigger_name(table: str, column: str) -> str:
+    return f"history_fill_{table}_{column}"
+
+
+def add_derived_column(cursor, table: str, column: str, column_type: str,
+                       sources: Tuple[str, ...], expression: str):
+    """
+    Колонка, вычисляемая из других колонок строки; expression - выражение с {row} перед колонками.
+    На пустой таблице (новая установка) - GENERATED ALWAYS ... STORED. На таблице с данными такая
+    колонка перезаписала бы всю таблицу под ACCESS EXCLUSIVE, поэтому колонка - обычная nullable:
+    новые и изменённые строки заполняет триггер, существующие - backfill_column (online-миграция)
+    """
+    if _column_exists(cursor, table, column):
+        return
+    cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+    if cursor.fetchone()[0]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type} "
+                       f"GENERATED ALWAYS AS ({expression.format(row='')}) STORED")
+        return
+
+    trigger = _trigger_name(table, column)
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {trigger}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.{column} := {expression.format(row='NEW.')};
+            RETURN NEW;
+        END
+        $$;
+    """)
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    # Только при изменении исходных колонок: UPDATE из backfill_column триггер не вызывает
+    cursor.execute(f"""
+        CREATE TRIGGER {trigger} BEFORE INSERT OR UPDATE OF {', '.join(sources)} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {trigger}()
+    """)
+
+
+def backfill_column(cursor, table: str, column: str, expression: str, key: str):
+    """
+    Заполняет колонку add_derived_column у строк, записанных до её появления (курсор в autocommit):
+    пачками по MIGRATION_BACKFILL_BATCH в порядке ключа key, каждая пачка - своей транзакцией,
+    поэтому строки блокируются ненадолго. У генерируемой колонки заполнять нечего
+    """
+    if _is_generated(cursor, table, column):
+        return
+    last, filled, started = None, 0, time.monotonic()
+    while True:
+        after = '' if last is None else f"WHERE {key} > %(last)s"
+        cursor.execute(f"""
+            WITH batch AS (
+                SELECT {key} FROM {table} {after}
+                ORDER BY {key} LIMIT %(limit)s
+            ), filled AS (
+                UPDATE {table} t SET {column} = {expression.format(row='t.')}
+                FROM batch WHERE t.{key} = batch.{key} AND t.{column} IS NULL
+                RETURNING 1
+            )
+            SELECT (SELECT max({key}) FROM batch), (SELECT count(*) FROM filled)
+        """, {'last': last, 'limit': MIGRATION_BACKFILL_BATCH})
+        last, count = cursor.fetchone()
+        if last is None:
+            break
+        filled += count
+    logger.info("Колонка %s.%s заполнена: строк %s за %.1f с", table, column, filled, time.monotonic() - started)
+
+
+def _execute_with_lock_timeout(cursor, sql: str):
+    """Оператор с короткой блокировкой таблицы: не ждать её дольше MIGRATION_LOCK_TIMEOUT"""
+    cursor.execute("SET lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+    try:
+        cursor.execute(sql)
+    finally:
+        cursor.execute("RESET lock_timeout")
+
+
+def _index_kind(cursor, name: str) -> Optional[str]:
+    """'i' - индекс таблицы, 'I' - индекс секционированной таблицы, None - индекса нет"""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _drop_invalid_index(cursor, name: str):
+    """Остаток прерванного CREATE INDEX CONCURRENTLY: удаляется перед повторным построением"""
+    cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        logger.warning("Индекс %s недействителен (построение прервано), строится заново", name)
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def _partition_index_name(partition: str, name: str) -> str:
+    child = f"{partition}_{name[4:] if name.startswith('idx_') else name}"
+    if len(child) > 63:
+        child = f"{child[:54]}_{hashlib.md5(child.encode()).hexdigest()[:8]}"
+    return child
+
+
+def create_index_concurrently(cursor, name: str, table: str, definition: str):
+    """
+    Индекс без блокировки записи в таблицу (курсор в autocommit).
+    definition - всё после имени таблицы: '(entity_type, entity_fqn)', 'USING GIN (...)'
+    """
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        # Уже построен (на установке, где его создала прежняя миграция) - без блокировок
+        return
+    if not is_partitioned(cursor, table):
+        _drop_invalid_index(cursor, name)
+        cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+        return
+
+    # Секционированная таблица: CONCURRENTLY для неё не поддерживается. Индекс родителя ON ONLY
+    # пуст и недействителен, пока к нему не подключены индексы всех партиций. Новые партиции
+    # (PartitionMaintainer) получают его сразу при создании
+    _execute_with_lock_timeout(cursor, f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    cursor.execute("""
+        SELECT c.relname,
+               EXISTS (SELECT 1 FROM pg_inherits ii JOIN pg_index x ON x.indexrelid = ii.inhrelid
+                       WHERE ii.inhparent = to_regclass(%s) AND x.indrelid = c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (name, table))
+    for partition, attached in cursor.fetchall():
+        if attached:
+            continue
+        child = _partition_index_name(partition, name)
+        _drop_invalid_index(cursor, child)
+        started = time.monotonic()
+        cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} {definition}")
+        _execute_with_lock_timeout(cursor, f"ALTER INDEX {name} ATTACH PARTITION {child}")
+        elapsed = time.monotonic() - started
+        logger.log(logging.INFO if elapsed >= 1 else logging.DEBUG, "Индекс %s построен за %.1f с", child, elapsed)
+
+
+def drop_index(cursor, name: str):
+    """Удаляет индекс: обычный - CONCURRENTLY, секционированный - под коротким lock_timeout"""
+    kind = _index_kind(cursor, name)
+    if kind == 'i':
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    elif kind == 'I':
+        _execute_with_lock_timeout(cursor, f"DROP INDEX IF EXISTS {name}")
+
+
+def _add_query_indexes(cursor):
+    # Индексы из useful_queries.sql, которые не перекрыты индексами /events:
+    # выборки по типу и FQN и отчёты по полю и виду изменения
+    create_index_concurrently(cursor, 'idx_entity_type_fqn', 'metadata_change_events', '(entity_type, entity_fqn)')
+    create_index_concurrently(cursor, 'idx_field_changes_name_type', 'field_changes', '(field_name, change_type)')
+
+
+def _drop_redundant_indexes(cursor):
+    # (field_name) перекрыт (field_name, change_type); индексы из прежней useful_queries.sql -
+    # индексами /events: idx_events_time_id читается и в обратном порядке
+    for name in ('idx_field_changes_name', 'idx_event_time_desc', 'idx_updated_by_time'):
+        drop_index(cursor, name)
+
+
+def _add_field_change_time(cursor):
+    # Установки до секционирования: колонка нужна для записи, пока не выполнен partitions.py migrate
+    add_column(cursor, 'field_changes', 'event_time', 'TIMESTAMP')
+
+
+def _add_payload_blobs(cursor):
+    # Тела сущностей по хэшу содержимого (сжатые, со счётчиком ссылок) и ссылка на них из события
+    if not _relation_exists(cursor, 'payload_blobs'):
+        cursor.execute(BLOBS_DDL)
+    add_column(cursor, 'metadata_change_events', 'entity_hash', 'BYTEA')
+
+
+def _add_entity_state(cursor):
+    # Текущее состояние сущностей, обновляется вместе с записью события
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS entity_current_state (
+            entity_id VARCHAR(255) PRIMARY KEY,
+            entity_type VARCHAR(100),
+            entity_fqn TEXT,
+            entity_name VARCHAR(500),
+            current_version DECIMAL,
+            last_event_id VARCHAR(255),
+            last_event_type VARCHAR(100),
+            last_event_time TIMESTAMP,
+            last_updated_by VARCHAR(255),
+            snapshot JSONB,
+            is_deleted BOOLEAN DEFAULT FALSE,
+            first_seen_at TIMESTAMP,
+            change_count BIGINT DEFAULT 0,
+            field_change_count BIGINT DEFAULT 0,
+            payload_hash BYTEA,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Таблица установок до payload_blobs
+    add_column(cursor, 'entity_current_state', 'payload_hash', 'BYTEA')
+
+    # Полные снимки сущностей раз в ENTITY_SNAPSHOT_INTERVAL версий (для восстановления на дату)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS entity_snapshots (
+            entity_id VARCHAR(255) NOT NULL,
+            event_time TIMESTAMP NOT NULL,
+            event_id VARCHAR(255) NOT NULL,
+            version DECIMAL,
+            snapshot JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (entity_id, event_time, event_id)
+        );
+    """)
+
+
+def _add_rollups(cursor):
+    # Почасовые и посуточные агрегаты для /stats
+    cursor.execute(ROLLUPS_DDL)
+
+
+def _add_search_vectors(cursor):
+    cursor.execute(SEARCH_FUNCTIONS_DDL)
+    for table, column, column_type, sources, expression in SEARCH_COLUMNS:
+        add_derived_column(cursor, table, column, column_type, sources, expression)
+
+
+def _add_fqn_paths(cursor):
+    cursor.execute(FQN_FUNCTIONS_DDL)
+    for table, column, column_type, sources, expression in FQN_COLUMNS:
+        add_derived_column(cursor, table, column, column_type, sources, expression)
+
+
+def _add_stream_position(cursor):
+    # Позиция события в потоке /events/stream
+    if not _column_exists(cursor, 'metadata_change_events', 'txid'):
+        cursor.execute(STREAM_DDL)
+
+
+def _add_version_gaps(cursor):
+    # Пропуски в цепочках версий сущностей
+    if not _relation_exists(cursor, 'version_gaps'):
+        cursor.execute(GAPS_DDL)
+
+
+def _add_event_indexes(cursor):
+    # Под каждый фильтр /events - (колонка, event_time, id): keyset-пагинация по индексу без сортировки
+    for name, columns in EVENT_INDEXES.items():
+        create_index_concurrently(cursor, name, 'metadata_change_events', columns)
+
+
+def _drop_single_column_indexes(cursor):
+    # Индексы установок до миграций, перекрытые индексами /events
+    for name in ('idx_entity_fqn', 'idx_event_type', 'idx_event_time'):
+        drop_index(cursor, name)
+
+
+def _add_entity_state_indexes(cursor):
+    # Самые изменяемые сущности для /stats и поиск состояния по FQN
+    create_index_concurrently(cursor, 'idx_entity_state_change_count', 'entity_current_state', '(change_count DESC)')
+    create_index_concurrently(cursor, 'idx_entity_state_fqn', 'entity_current_state', '(entity_fqn, last_event_time)')
+
+
+# Ключ пачек заполнения: id строк событий уникален и во всех партициях
+_BACKFILL_KEYS = {'metadata_change_events': 'id', 'field_changes': 'id', 'entity_current_state': 'entity_id'}
+
+
+def _backfill_search_vectors(cursor):
+    for table, column, _, _, expression in SEARCH_COLUMNS:
+        backfill_column(cursor, table, column, expression, _BACKFILL_KEYS[table])
+
+
+def _add_search_indexes(cursor):
+    for name, table, definition in SEARCH_INDEXES:
+        create_index_concurrently(cursor, name, table, definition)
+
+
+def _backfill_fqn_paths(cursor):
+    for table, column, _, _, expression in FQN_COLUMNS:
+        backfill_column(cursor, table, column, expression, _BACKFILL_KEYS[table])
+
+
+def _add_fqn_indexes(cursor):
+    for name, table, definition in FQN_INDEXES:
+        create_index_concurrently(cursor, name, table, definition)
+
+
+def _add_stream_index(cursor):
+    create_index_concurrently(cursor, *STREAM_INDEX)
+
+
+def _add_gaps_index(cursor):
+    create_index_concurrently(cursor, *GAPS_INDEX)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'Базовая схема', create_base_schema),
+    Migration(2, 'Индексы (entity_type, entity_fqn) и (field_name, change_type)', _add_query_indexes, online=True),
+    Migration(3, 'Удаление перекрытых индексов', _drop_redundant_indexes, online=True),
+    Migration(4, 'Колонка field_changes.event_time', _add_field_change_time),
+    Migration(5, 'Таблица payload_blobs и колонка entity_hash', _add_payload_blobs),
+    Migration(6, 'Таблицы entity_current_state и entity_snapshots', _add_entity_state),
+    Migration(7, 'Таблица event_rollups', _add_rollups),
+    Migration(8, 'Колонки search_vector', _add_search_vectors),
+    Migration(9, 'Колонки fqn_path', _add_fqn_paths),
+    Migration(10, 'Колонка txid (позиция в потоке событий)', _add_stream_position),
+    Migration(11, 'Таблицы version_gaps и version_gap_scan', _add_version_gaps),
+    Migration(12, 'Индексы /events', _add_event_indexes, online=True),
+    Migration(13, 'Удаление одноколоночных индексов событий', _drop_single_column_indexes, online=True),
+    Migration(14, 'Индексы entity_current_state', _add_entity_state_indexes, online=True),
+    Migration(15, 'Заполнение search_vector', _backfill_search_vectors, online=True),
+    Migration(16, 'Индексы /search', _add_search_indexes, online=True),
+    Migration(17, 'Заполнение fqn_path', _backfill_fqn_paths, online=True),
+    Migration(18, 'Индексы fqn_path', _add_fqn_indexes, online=True),
+    Migration(19, 'Индекс потока событий (txid, id)', _add_stream_index, online=True),
+    Migration(20, 'Индекс версий сущностей (entity_id, current_version)', _add_gaps_index, online=True),
+]
+
+
+def applied_migrations(cursor) -> Dict[int, Dict[str, Any]]:
+    """Применённые миграции по версиям (пусто, если таблицы schema_migrations ещё нет)"""
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return {}
+    cursor.execute("SELECT version, name, online, applied_at, duration_sec FROM schema_migrations")
+    return {row[0]: {'name': row[1], 'online': row[2], 'applied_at': row[3], 'duration_sec': row[4]}
+            for row in cursor.fetchall()}
+
+
+def pending_migrations(cursor, online: bool = True) -> List[Migration]:
+    """Неприменённые миграции по порядку версий (online=False - только обязательные)"""
+    applied = applied_migrations(cursor)
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied and (online or not migration.online)]
+
+
+def migrate(conn, online: bool = False, wait: bool = True, rerun: bool = False) -> Optional[List[int]]:
+    """
+    Применяет неприменённые миграции: обязательные, а с online=True - и online.
+    Ждёт другой процесс, который уже выполняет миграции (wait=False - возвращает None).
+    rerun - выполнить заново и применённые (все миграции идемпотентны): схема для новых
+    таблиц после переименования старых (partitions.py migrate).
+    Возвращает версии применённых миграций
+    """
+    def selected():
+        if rerun:
+            return [migration for migration in MIGRATIONS if online or not migration.online]
+        return pending_migrations(cursor, online)
+
+    cursor = conn.cursor()
+    try:
+        # Схема актуальна - ни одного DDL и ни одной блокировки
+        todo = selected()
+        conn.rollback()
+        if not todo:
+            return []
+
+        # Сессионная блокировка и CONCURRENTLY - вне транзакции
+        conn.autocommit = True
+        if wait:
+            cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (_LOCK_KEY,))
+        else:
+            cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                return None
+        try:
+            cursor.execute(MIGRATIONS_DDL)
+            done = []
+            # Пока ждали блокировку, часть миграций мог выполнить другой процесс
+            for migration in selected():
+                logger.info("Миграция %s: %s", migration.version, migration.name)
+                started = time.monotonic()
+                if not migration.online:
+                    cursor.execute("BEGIN")
+                try:
+                    migration.apply(cursor)
+                    cursor.execute("""
+                        INSERT INTO schema_migrations (version, name, online, duration_sec) VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (version) DO UPDATE SET applied_at = CURRENT_TIMESTAMP,
+                            duration_sec = EXCLUDED.duration_sec
+                    """, (migration.version, migration.name, migration.online, time.monotonic() - started))
+                    if not migration.online:
+                        cursor.execute("COMMIT")
+                except Exception:
+                    if not migration.online:
+                        cursor.execute("ROLLBACK")
+                    raise
+                logger.info("Миграция %s выполнена за %.1f с", migration.version, time.monotonic() - started)
+                done.append(migration.version)
+            return done
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (_LOCK_KEY,))
+    finally:
+        cursor.close()
+        if conn.autocommit:
+            conn.autocommit = False
+
+
+class SchemaMigrator:
+    """Фоновый поток: выполняет online-миграции; неудача или занятая блокировка - повтор через interval"""
+
+    def __init__(self, connect: Callable[[], Any], interval: float = MIGRATION_RETRY_INTERVAL):
+        self.connect = connect
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+        self.last_error = None
+        self.applied = []
+        self.done = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='schema-migrator', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        try:
+            # Отдельное подключение не из пула: построение индекса может идти часами
+            conn = self.connect()
+            try:
+                result = migrate(conn, online=True, wait=False)
+            finally:
+                conn.close()
+            if result is not None:
+                self.applied.extend(result)
+                self.done = True
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            logger.warning("Online-миграция не удалась: %s", e)
+        self.last_run = datetime.utcnow().isoformat()
+
+    def _run(self):
+        while True:
+            self.run_once()
+            if self.done or self.interval <= 0 or self._stop.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'last_run': self.last_run, 'last_error': self.last_error, 'applied': self.applied,
+                'done': self.done}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['status', 'migrate'])
+    parser.add_argument('--required', action='store_true', help='migrate: только обязательные миграции')
+    args = parser.parse_args()
+
+    configure_logging()
+    import psycopg2
+    from db_pool import DB_CONFIG
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if args.command == 'migrate':
+            applied = migrate(conn, online=not args.required)
+            print(f"Применено миграций: {len(applied)}" + (f" ({', '.join(map(str, applied))})" if applied else ""))
+        else:
+            cursor = conn.cursor()
+            applied = applied_migrations(cursor)
+            for migration in MIGRATIONS:
+                state = applied.get(migration.version)
+                status = (f"{state['applied_at']:%Y-%m-%d %H:%M:%S} ({state['duration_sec']:.1f} с)"
+                          if state else 'не применена')
+                print(f"{migration.version:>3} {'online' if migration.online else '':<6} {migration.name}: {status}")
+            cursor.execute("""
+                SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE NOT i.indisvalid AND c.relnamespace = current_schema()::regnamespace
+                ORDER BY c.relname
+            """)
+            invalid = [name for (name,) in cursor.fetchall()]
+            if invalid:
+                print(f"Недействительные индексы (строятся или построение прервано): {', '.join(invalid)}")
+            conn.rollback()
+            cursor.close()
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
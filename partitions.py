@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Помесячные партиции metadata_change_events и field_changes
+Обе таблицы секционированы по event_time (field_changes - по времени своего события),
+партиции называются <таблица>_pYYYY_MM, строки вне существующих партиций попадают
+в <таблица>_default и переносятся в месячную партицию при её создании.
+
+Хранение ограничивается удалением целых партиций (DROP TABLE) вместо DELETE по строкам.
+
+Примеры:
+    python partitions.py list
+    python partitions.py ensure --from 2023-01 --ahead 3
+    python partitions.py drop --retention-months 12
+    python partitions.py migrate            # перевод существующей установки на партиции
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from log_config import configure_logging
+from payload_store import collect_garbage, release_references
+
+logger = logging.getLogger(__name__)
+
+# Сколько месяцев вперёд держать готовые партиции
+PARTITION_PREMAKE_MONTHS = int(os.getenv('PARTITION_PREMAKE_MONTHS', 3))
+# Сколько полных месяцев хранить помимо текущего (0 - хранить всё)
+PARTITION_RETENTION_MONTHS = int(os.getenv('PARTITION_RETENTION_MONTHS', 0))
+# Как часто воркер проверяет партиции, сек (0 - только при старте)
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv('PARTITION_MAINTENANCE_INTERVAL', 3600))
+# Сколько ждать блокировку таблицы при удалении партиции, чтобы не задерживать запись
+PARTITION_LOCK_TIMEOUT = os.getenv('PARTITION_LOCK_TIMEOUT', '5s')
+
+PARTITIONED_TABLES = ('metadata_change_events', 'field_changes')
+
+# Ключ advisory lock: партициями в каждый момент занимается один процесс
+_LOCK_KEY = 'om_history_partitions'
+
+_PARTITION_RE = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace
+        )
+    """, (table,))
+    return cursor.fetchone()[0]
+
+
+def list_partitions(cursor, table: str) -> Dict[date, str]:
+    """Месячные партиции таблицы: {первое число месяца: имя}"""
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s AND p.relnamespace = current_schema()::regnamespace
+    """, (table,))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = _PARTITION_RE.search(name)
+        if match and name == partition_name(table, date(int(match[1]), int(match[2]), 1)):
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def _lock(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (_LOCK_KEY,))
+
+
+def stored_columns(cursor, table: str) -> List[str]:
+    """Колонки таблицы, кроме генерируемых (search_vector, fqn_path): только их можно вставлять"""
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum
+    """, (table,))
+    return [name for (name,) in cursor.fetchall()]
+
+
+def ensure_partition(cursor, table: str, month: date) -> bool:
+    """
+    Создаёт партицию месяца, если её нет. Строки этого месяца, уже попавшие
+    в партицию по умолчанию, переносятся в новую. Возвращает True, если партиция создана
+    """
+    name = partition_name(table, month)
+    if name in list_partitions(cursor, table).values():
+        return False
+
+    default = f"{table}_default"
+    bounds = (month, add_months(month, 1))
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE event_time >= %s AND event_time < %s)",
+                   bounds)
+    if not cursor.fetchone()[0]:
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return True
+
+    # Пока партиции не было, строки месяца лежат в default: переносим их и подключаем партицию
+    # Генерируемые колонки должны быть генерируемыми и в партиции, и вставлять их нельзя
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)")
+    columns = ', '.join(stored_columns(cursor, table))
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {default} WHERE event_time >= %s AND event_time < %s RETURNING *
+        )
+        INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+    """, bounds)
+    moved = cursor.rowcount
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+    logger.info("Партиция %s создана, из %s перенесено строк: %s", name, default, moved)
+    return True
+
+
+def ensure_partitions(conn, start: Optional[date] = None,
+                      months_ahead: int = PARTITION_PREMAKE_MONTHS) -> List[str]:
+    """Партиции по умолчанию и помесячные от start (по умолчанию - текущий месяц) до +months_ahead"""
+    current = month_start(date.today())
+    start = month_start(start) if start else current
+    created = []
+
+    cursor = conn.cursor()
+    try:
+        # Все партиции уже есть (обычный запуск воркера) - без DDL и блокировок
+        months, month = [], start
+        while month <= add_months(current, months_ahead):
+            months.append(month)
+            month = add_months(month, 1)
+        names = [f"{table}_default" for table in PARTITIONED_TABLES] + \
+                [partition_name(table, month) for month in months for table in PARTITIONED_TABLES]
+        cursor.execute("""
+            SELECT count(*) FROM pg_class
+            WHERE relname = ANY(%s) AND relispartition AND relnamespace = current_schema()::regnamespace
+        """, (names,))
+        if cursor.fetchone()[0] == len(names):
+            conn.rollback()
+            return created
+
+        # IF NOT EXISTS не защищает от одновременного создания в нескольких воркерах
+        _lock(cursor)
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(cursor, table):
+                raise RuntimeError(f"Таблица {table} не секционирована, выполните: python partitions.py migrate")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+        conn.commit()
+
+        for month in months:
+            # Партиции месяца в обеих таблицах создаются в одной транзакции
+            _lock(cursor)
+            for table in PARTITIONED_TABLES:
+                if ensure_partition(cursor, table, month):
+                    created.append(partition_name(table, month))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if created:
+        logger.info("Создано партиций: %s (%s ... %s)", len(created), created[0], created[-1])
+    return created
+
+
+def drop_expired_partitions(conn, retention_months: int = PARTITION_RETENTION_MONTHS) -> List[str]:
+    """
+    Удаляет партиции месяцев старше retention_months полных месяцев и такие же
+    старые строки из партиций по умолчанию. Партиция, которую не удалось
+    заблокировать за PARTITION_LOCK_TIMEOUT, останется до следующего запуска
+    """
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(date.today()), -retention_months)
+    dropped = []
+
+    cursor = conn.cursor()
+    try:
+        months = sorted(month for month in list_partitions(cursor, PARTITIONED_TABLES[0]) if month < cutoff)
+        for month in months:
+            # Сначала изменения полей, затем сами события - месяц удаляется целиком
+            names = [partition_name(table, month) for table in reversed(PARTITIONED_TABLES)]
+            try:
+                _lock(cursor)
+                cursor.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+                for name in names:
+                    if name == partition_name(PARTITIONED_TABLES[0], month):
+                        # entity событий месяца в payload_blobs теряют ссылки
+                        release_references(cursor, f"SELECT entity_hash FROM {name}")
+                    cursor.execute(f"DROP TABLE IF EXISTS {name}")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.warning("Партиции за %s не удалены: %s", f"{month:%Y-%m}", e)
+                continue
+            dropped.extend(names)
+
+        _lock(cursor)
+        cursor.execute(f"DELETE FROM {PARTITIONED_TABLES[1]}_default WHERE event_time < %s", (cutoff,))
+        release_references(cursor, f"DELETE FROM {PARTITIONED_TABLES[0]}_default "
+                                   f"WHERE event_time < %s RETURNING entity_hash", (cutoff,))
+        collect_garbage(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if dropped:
+        logger.info("Удалено партиций старше %s: %s (%s ... %s)", f"{cutoff:%Y-%m}", len(dropped),
+                    dropped[0], dropped[-1])
+    return dropped
+
+
+def maintain(conn) -> Dict[str, List[str]]:
+    """
+    Создание будущих партиций, перенос старых месяцев в архив (ARCHIVE_DIR,
+    ARCHIVE_AFTER_MONTHS) и удаление устаревших. Если архивирование не удалось,
+    партиции не удаляются
+    """
+    from archive import archive_expired
+    return {
+        'created': ensure_partitions(conn),
+        'archived': [batch['month'] for batch in archive_expired(conn)],
+        'dropped': drop_expired_partitions(conn),
+    }
+
+
+class PartitionMaintainer:
+    """Фоновый поток: раз в interval секунд создаёт будущие партиции и удаляет устаревшие"""
+
+    def __init__(self, get_connection, interval: float = 3600):
+        self.get_connection = get_connection
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+        self.last_error = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='partition-maintainer', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        try:
+            with self.get_connection() as conn:
+                maintain(conn)
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            logger.warning("Обслуживание партиций не удалось: %s", e)
+        self.last_run = datetime.utcnow().isoformat()
+
+    def _run(self):
+        while True:
+            self.run_once()
+            if self.interval <= 0 or self._stop.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Optional[str]]:
+        return {'last_run': self.last_run, 'last_error': self.last_error}
+
+
+def _rename_legacy(cursor, table: str):
+    """Переименовывает несекционированную таблицу вместе с индексами и последовательностью"""
+    legacy = f"{table}_legacy"
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND schemaname = current_schema()",
+                   (table,))
+    for (index,) in cursor.fetchall():
+        cursor.execute(f"ALTER INDEX {index} RENAME TO {index}_legacy")
+    if sequence:
+        cursor.execute(f"ALTER SEQUENCE {sequence} RENAME TO {table}_legacy_id_seq")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+
+
+def migrate_legacy(conn, drop_legacy: bool = False):
+    """
+    Переводит существующую установку на партиции:
+    1. старые таблицы переименовываются в *_legacy, создаются секционированные (короткая блокировка,
+       после неё сервис сразу пишет в новые таблицы);
+    2. история переносится помесячно, каждый месяц - отдельной транзакцией с удалением
+       из *_legacy, поэтому прерванную миграцию можно просто запустить ещё раз.
+    """
+    import migrations
+    from webhook_listener import init_database
+
+    cursor = conn.cursor()
+    _lock(cursor)
+    if not is_partitioned(cursor, 'metadata_change_events'):
+        cursor.execute("SELECT to_regclass('metadata_change_events_legacy')")
+        if cursor.fetchone()[0]:
+            raise RuntimeError("metadata_change_events_legacy уже существует - разберитесь с ней вручную")
+        cursor.execute("LOCK TABLE metadata_change_events, field_changes IN ACCESS EXCLUSIVE MODE")
+        for table in PARTITIONED_TABLES:
+            _rename_legacy(cursor, table)
+        conn.commit()
+        logger.info("Старые таблицы переименованы в *_legacy")
+    else:
+        conn.commit()
+
+    cursor.execute("SELECT to_regclass('metadata_change_events_legacy')")
+    if not cursor.fetchone()[0]:
+        logger.info("Таблицы уже секционированы, переносить нечего")
+        cursor.close()
+        return
+
+    # Создаёт секционированные таблицы и индексы: миграции уже отмечены применёнными и выполняются
+    # заново (таблицы пусты - online-индексы строятся сразу), затем партиции
+    conn.commit()
+    migrations.migrate(conn, online=True, rerun=True)
+    init_database()
+    # Установки старше payload_blobs: колонки ссылки на entity ещё нет
+    cursor.execute("ALTER TABLE metadata_change_events_legacy ADD COLUMN IF NOT EXISTS entity_hash BYTEA")
+
+    cursor.execute("SELECT min(event_time), max(event_time) FROM metadata_change_events_legacy")
+    first, last = cursor.fetchone()
+    if first is not None:
+        ensure_partitions(conn, start=first.date(), months_ahead=PARTITION_PREMAKE_MONTHS)
+        month = month_start(first.date())
+        while month <= last.date():
+            started = time.monotonic()
+            bounds = (month, add_months(month, 1))
+            cursor.execute("""
+                WITH moved AS (
+                    DELETE FROM field_changes_legacy f
+                    USING metadata_change_events_legacy e
+                    WHERE f.event_id = e.event_id AND e.event_time >= %s AND e.event_time < %s
+                    RETURNING f.event_id, e.event_time, f.field_name, f.old_value, f.new_value,
+                              f.change_type, f.created_at
+                )
+                INSERT INTO field_changes
+                (event_id, event_time, field_name, old_value, new_value, change_type, created_at)
+                SELECT * FROM moved
+            """, bounds)
+            fields = cursor.rowcount
+            cursor.execute("""
+                WITH moved AS (
+                    DELETE FROM metadata_change_events_legacy
+                    WHERE event_time >= %s AND event_time < %s
+                    RETURNING *
+                )
+                INSERT INTO metadata_change_events
+                (event_id, event_type, event_time, entity_type, entity_id, entity_fqn, entity_name,
+                 change_description, updated_by, previous_version, current_version, full_payload,
+                 entity_hash, created_at)
+                SELECT event_id, event_type, event_time, entity_type, entity_id, entity_fqn, entity_name,
+                       change_description, updated_by, previous_version, current_version, full_payload,
+                       entity_hash, created_at
+                FROM moved
+                ON CONFLICT DO NOTHING
+            """, bounds)
+            events = cursor.rowcount
+            conn.commit()
+            logger.info("Перенесён %s: событий %s, изменений полей %s (%.1f сек)",
+                        f"{month:%Y-%m}", events, fields, time.monotonic() - started)
+            month = add_months(month, 1)
+
+    cursor.execute("SELECT count(*) FROM field_changes_legacy")
+    orphans = cursor.fetchone()[0]
+    if orphans:
+        logger.warning("В field_changes_legacy остались строки без события: %s", orphans)
+    if drop_legacy:
+        cursor.execute("DROP TABLE metadata_change_events_legacy, field_changes_legacy")
+        conn.commit()
+        logger.info("Таблицы *_legacy удалены")
+    cursor.close()
+
+
+def _parse_month(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='Показать партиции')
+    ensure = sub.add_parser('ensure', help='Создать партиции')
+    ensure.add_argument('--from', dest='start', type=_parse_month, default=None,
+                        help='С какого месяца (YYYY-MM), по умолчанию текущий')
+    ensure.add_argument('--ahead', type=int, default=PARTITION_PREMAKE_MONTHS,
+                        help='Сколько месяцев вперёд')
+    drop = sub.add_parser('drop', help='Удалить устаревшие партиции')
+    drop.add_argument('--retention-months', type=int, default=PARTITION_RETENTION_MONTHS,
+                      help='Сколько полных месяцев хранить помимо текущего')
+    migrate = sub.add_parser('migrate', help='Перевести несекционированные таблицы на партиции')
+    migrate.add_argument('--drop-legacy', action='store_true', help='Удалить *_legacy после переноса')
+    args = parser.parse_args()
+
+    configure_logging()
+    from db_pool import db_connection
+
+    with db_connection() as conn:
+        if args.command == 'list':
+            cursor = conn.cursor()
+            for table in PARTITIONED_TABLES:
+                if not is_partitioned(cursor, table):
+                    print(f"{table}: не секционирована")
+                    continue
+                for month, name in sorted(list_partitions(cursor, table).items()):
+                    cursor.execute("SELECT pg_total_relation_size(%s), "
+                                   "(SELECT reltuples::bigint FROM pg_class WHERE relname = %s)", (name, name))
+                    size, rows = cursor.fetchone()
+                    print(f"{name:<40} ~{max(rows, 0):>12} строк {size / 1024 / 1024:>10.1f} МБ")
+            cursor.close()
+        elif args.command == 'ensure':
+            created = ensure_partitions(conn, start=args.start, months_ahead=args.ahead)
+            print(f"Создано партиций: {len(created)}")
+        elif args.command == 'drop':
+            dropped = drop_expired_partitions(conn, args.retention_months)
+            print(f"Удалено партиций: {len(dropped)}")
+        elif args.command == 'migrate':
+            migrate_legacy(conn, drop_legacy=args.drop_legacy)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
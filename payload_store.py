@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Компактное хранение entity из payload'ов событий (таблица payload_blobs)
+Тело сущности - основная часть payload'а (десятки КБ у таблиц с сотнями колонок),
+а соседние версии отличаются парой полей. Режимы PAYLOAD_STORAGE:
+    inline - как раньше, full_payload целиком (по умолчанию);
+    blob   - entity хранится один раз по SHA-256 канонического JSON, сжатым zlib,
+             со счётчиком ссылок; в full_payload остаётся событие без entity;
+    patch  - как blob, но новая версия сущности хранится JSON-patch'ем (RFC 6902)
+             к предыдущей, полная копия - не реже раза в PAYLOAD_PATCH_MAX_CHAIN версий.
+Режим действует на новые события; читатели (/events, восстановление, пересчёт
+состояния) понимают все три.
+
+Примеры:
+    python payload_store.py stats
+    python payload_store.py gc
+"""
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import logging
+import argparse
+from collections import Counter
+from typing import Dict, Any, Iterable, List, Optional
+
+from psycopg2.extras import execute_values
+
+from event_parser import ChangeEvent
+from log_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_STORAGE = os.getenv('PAYLOAD_STORAGE', 'inline')
+# Уровень zlib: 1 - быстрее, 9 - компактнее
+PAYLOAD_COMPRESSION_LEVEL = int(os.getenv('PAYLOAD_COMPRESSION_LEVEL', 6))
+# Максимальная длина цепочки patch'ей до полной копии (ограничивает цену чтения)
+PAYLOAD_PATCH_MAX_CHAIN = int(os.getenv('PAYLOAD_PATCH_MAX_CHAIN', 20))
+
+STORAGE_MODES = ('inline', 'blob', 'patch')
+
+BLOBS_DDL = """
+    CREATE TABLE IF NOT EXISTS payload_blobs (
+        hash BYTEA PRIMARY KEY,
+        base_hash BYTEA,
+        depth INTEGER NOT NULL DEFAULT 0,
+        data BYTEA NOT NULL,
+        raw_size INTEGER NOT NULL,
+        stored_size INTEGER NOT NULL,
+        refcount BIGINT NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    -- data уже сжато zlib: TOAST не тратит время на повторное сжатие
+    ALTER TABLE payload_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+    CREATE INDEX IF NOT EXISTS idx_payload_blobs_gc ON payload_blobs(refcount) WHERE refcount <= 0;
+"""
+
+# Цепочка blob'ов до полных копий: сами запрошенные и все их базы
+_CHAIN_SQL = """
+    WITH RECURSIVE chain AS (
+        SELECT hash, base_hash, data FROM payload_blobs WHERE hash = ANY(%s)
+        UNION
+        SELECT b.hash, b.base_hash, b.data
+        FROM payload_blobs b JOIN chain c ON b.hash = c.base_hash
+    )
+    SELECT hash, base_hash, data FROM chain
+"""
+
+
+def canonical_json(value: Any) -> bytes:
+    """Канонический JSON: одинаковое содержимое - одинаковые байты и хэш"""
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                      default=str).encode()
+
+
+def _pointer(path: tuple) -> str:
+    return ''.join('/' + str(key).replace('~', '~0').replace('/', '~1') for key in path)
+
+
+def _split_pointer(pointer: str) -> List[str]:
+    return [key.replace('~1', '/').replace('~0', '~') for key in pointer.split('/')[1:]]
+
+
+def make_patch(old: Any, new: Any, path: tuple = ()) -> List[Dict[str, Any]]:
+    """JSON-patch (add/remove/replace), превращающий old в new; списки сравниваются по позициям"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{'op': 'remove', 'path': _pointer(path + (key,))} for key in old if key not in new]
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': _pointer(path + (key,)), 'value': value})
+            elif old[key] != value:
+                ops.extend(make_patch(old[key], value, path + (key,)))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        common = min(len(old), len(new))
+        ops = []
+        for index in range(common):
+            if old[index] != new[index]:
+                ops.extend(make_patch(old[index], new[index], path + (index,)))
+        ops.extend({'op': 'remove', 'path': _pointer(path + (index,))}
+                   for index in range(len(old) - 1, common - 1, -1))
+        ops.extend({'op': 'add', 'path': _pointer(path + (index,)), 'value': new[index]}
+                   for index in range(common, len(new)))
+        return ops
+    return [{'op': 'replace', 'path': _pointer(path), 'value': new}]
+
+
+def apply_patch(document: Any, ops: List[Dict[str, Any]]) -> Any:
+    """
+    Новый документ - document с применённым JSON-patch. Исходный не меняется: копируются
+    только узлы на путях операций, остальное у результата с document общее
+    """
+    copied = set()
+
+    def own(node):
+        node = dict(node) if isinstance(node, dict) else list(node)
+        copied.add(id(node))
+        return node
+
+    if ops and isinstance(document, (dict, list)):
+        document = own(document)
+    for op in ops:
+        keys = _split_pointer(op['path'])
+        if not keys:
+            value = op.get('value')
+            document = own(value) if isinstance(value, (dict, list)) else value
+            continue
+        node = document
+        for key in keys[:-1]:
+            key = int(key) if isinstance(node, list) else key
+            child = node[key]
+            if id(child) not in copied:
+                child = node[key] = own(child)
+            node = child
+        last = keys[-1]
+        if isinstance(node, list):
+            index = len(node) if last == '-' else int(last)
+            if op['op'] == 'remove':
+                del node[index]
+            elif op['op'] == 'add':
+                node.insert(index, op['value'])
+            else:
+                node[index] = op['value']
+        elif op['op'] == 'remove':
+            del node[last]
+        else:
+            node[last] = op['value']
+    return document
+
+
+def _compress(raw: bytes) -> bytes:
+    return zlib.compress(raw, PAYLOAD_COMPRESSION_LEVEL)
+
+
+def prepare_blobs(events: List[ChangeEvent], mode: Optional[str] = None) -> Dict[bytes, bytes]:
+    """
+    Считает event.entity_hash для событий с настоящим entity (кроме режима inline).
+    Возвращает {hash: канонический JSON entity} для store_blobs
+    """
+    mode = mode or PAYLOAD_STORAGE
+    if mode == 'inline':
+        return {}
+    blobs = {}
+    for event in events:
+        if event.entity_from_event or not event.entity:
+            continue
+        raw = canonical_json(event.entity)
+        event.entity_hash = hashlib.sha256(raw).digest()
+        blobs[event.entity_hash] = raw
+    return blobs
+
+
+def stored_payload(event: ChangeEvent) -> Dict[str, Any]:
+    """Payload для full_payload: без entity, если он хранится в payload_blobs"""
+    if event.entity_hash is None:
+        return event.payload
+    return {key: value for key, value in event.payload.items() if key != 'entity'}
+
+
+def _patch_bases(cursor, entity_ids: List[str]) -> Dict[str, tuple]:
+    """Последняя сохранённая версия сущностей из entity_current_state: {entity_id: (hash, entity)}"""
+    cursor.execute("""
+        SELECT entity_id, payload_hash, snapshot FROM entity_current_state
+        WHERE entity_id = ANY(%s) AND payload_hash IS NOT NULL AND snapshot IS NOT NULL
+    """, (entity_ids,))
+    return {entity_id: (payload_hash.tobytes(), snapshot) for entity_id, payload_hash, snapshot in cursor}
+
+
+def store_blobs(cursor, events: List[ChangeEvent], blobs: Dict[bytes, bytes], mode: Optional[str] = None):
+    """
+    Сохраняет entity новых (вставленных) событий в payload_blobs в текущей транзакции.
+    Ссылки считаются по событиям, поэтому повтор события не увеличивает refcount
+    """
+    mode = mode or PAYLOAD_STORAGE
+    refs = Counter(event.entity_hash for event in events if event.entity_hash is not None)
+    if not refs:
+        return
+
+    bases = {}
+    if mode == 'patch':
+        bases = _patch_bases(cursor, list({event.entity_id for event in events
+                                           if event.entity_hash is not None and event.entity_id}))
+    # Уже сохранённые blob'ы (и базы patch'ей) блокируются от удаления сборщиком до конца
+    # транзакции - сразу для обновления refcount и по порядку хэша: параллельные пачки
+    # с общими blob'ами ждут друг друга, а не взаимоблокируются при повышении блокировки
+    lookup = list(refs) + [base_hash for base_hash, _ in bases.values()]
+    cursor.execute("SELECT hash, depth FROM payload_blobs WHERE hash = ANY(%s) "
+                   "ORDER BY hash FOR NO KEY UPDATE", ([bytes(h) for h in lookup],))
+    depths = {row_hash.tobytes(): depth for row_hash, depth in cursor}
+
+    rows = {}
+    for event in sorted(events, key=ChangeEvent.version_key):
+        entity_hash = event.entity_hash
+        if entity_hash is None:
+            continue
+        base = bases.get(event.entity_id)
+        if mode == 'patch' and event.entity_id:
+            bases[event.entity_id] = (entity_hash, event.entity)
+        if entity_hash in depths:
+            continue
+
+        raw = blobs[entity_hash]
+        row = None
+        if base is not None and base[0] != entity_hash and depths.get(base[0], PAYLOAD_PATCH_MAX_CHAIN) < PAYLOAD_PATCH_MAX_CHAIN:
+            ops = make_patch(base[1], event.entity)
+            patch_raw = canonical_json(ops)
+            # Patch должен давать ровно то содержимое, на которое указывает хэш
+            if (len(patch_raw) < len(raw)
+                    and canonical_json(apply_patch(base[1], ops)) == raw):
+                data = _compress(patch_raw)
+                row = (entity_hash, base[0], depths[base[0]] + 1, data, len(raw), len(data))
+        if row is None:
+            data = _compress(raw)
+            row = (entity_hash, None, 0, data, len(raw), len(data))
+        rows[entity_hash] = row
+        depths[entity_hash] = row[2]
+
+    base_refs = Counter()
+    if rows:
+        inserted = execute_values(cursor, """
+            INSERT INTO payload_blobs AS b (hash, base_hash, depth, data, raw_size, stored_size, refcount)
+            VALUES %s
+            ON CONFLICT (hash) DO UPDATE SET refcount = b.refcount + EXCLUDED.refcount
+            RETURNING base_hash, xmax = 0
+        """, [rows[entity_hash] + (refs.pop(entity_hash),) for entity_hash in sorted(rows)],
+            page_size=len(rows), fetch=True)
+        # База patch'а живёт, пока на неё ссылается хотя бы один blob
+        base_refs.update(base_hash.tobytes() for base_hash, is_new in inserted if is_new and base_hash)
+
+    increments = refs + base_refs
+    if increments:
+        execute_values(cursor, """
+            UPDATE payload_blobs b SET refcount = b.refcount + v.n
+            FROM (VALUES %s) AS v(hash, n)
+            WHERE b.hash = v.hash
+        """, list(increments.items()), page_size=len(increments))
+
+
+def load_entities(cursor, hashes: Iterable[bytes]) -> Dict[bytes, Any]:
+    """
+    entity по хэшам: {hash: entity}; отсутствующие хэши в результат не попадают.
+    Версии одной цепочки разделяют неизменённые вложенные объекты - не меняйте их на месте
+    """
+    hashes = list({bytes(h) for h in hashes if h is not None})
+    if not hashes:
+        return {}
+    cursor.execute(_CHAIN_SQL, (hashes,))
+    chain = {row_hash.tobytes(): (base_hash.tobytes() if base_hash else None, data)
+             for row_hash, base_hash, data in cursor}
+
+    decoded = {}
+
+    def resolve(entity_hash: bytes):
+        if entity_hash in decoded:
+            return decoded[entity_hash]
+        base_hash, data = chain[entity_hash]
+        value = json.loads(zlib.decompress(data))
+        if base_hash is not None:
+            value = apply_patch(resolve(base_hash), value)
+        decoded[entity_hash] = value
+        return value
+
+    return {entity_hash: resolve(entity_hash) for entity_hash in hashes if entity_hash in chain}
+
+
+def restore_payloads(cursor, rows: List[Dict[str, Any]]):
+    """
+    Возвращает entity в full_payload строк /events (на месте).
+    Строки содержат full_payload и entity_hash; entity_hash из строк убирается
+    """
+    entities = load_entities(cursor, [row['entity_hash'] for row in rows if row.get('entity_hash')])
+    for row in rows:
+        entity_hash = row.pop('entity_hash', None)
+        payload = row.get('full_payload')
+        if entity_hash is not None and isinstance(payload, dict):
+            entity = entities.get(bytes(entity_hash))
+            if entity is not None:
+                row['full_payload'] = {**payload, 'entity': entity}
+
+
+def release_references(cursor, source_sql: str, params: tuple = ()) -> int:
+    """
+    Уменьшает refcount на число ссылок из строк source_sql (SELECT или DELETE ... RETURNING
+    с колонкой entity_hash), например перед удалением партиции событий
+    """
+    cursor.execute(f"""
+        WITH src AS ({source_sql})
+        UPDATE payload_blobs b SET refcount = b.refcount - r.n
+        FROM (SELECT entity_hash, count(*) AS n FROM src
+              WHERE entity_hash IS NOT NULL GROUP BY entity_hash) r
+        WHERE b.hash = r.entity_hash
+    """, params)
+    return cursor.rowcount
+
+
+def collect_garbage(cursor) -> int:
+    """Удаляет blob'ы без ссылок; освободившиеся базы patch'ей - следующими проходами"""
+    removed = 0
+    while True:
+        cursor.execute("DELETE FROM payload_blobs WHERE refcount <= 0 RETURNING base_hash")
+        deleted = cursor.fetchall()
+        if not deleted:
+            return removed
+        removed += len(deleted)
+        bases = Counter(base_hash.tobytes() for base_hash, in deleted if base_hash)
+        if bases:
+            execute_values(cursor, """
+                UPDATE payload_blobs b SET refcount = b.refcount - v.n
+                FROM (VALUES %s) AS v(hash, n)
+                WHERE b.hash = v.hash
+            """, list(bases.items()), page_size=len(bases))
+
+
+def stats(cursor) -> Dict[str, Any]:
+    cursor.execute("""
+        SELECT count(*), count(base_hash), COALESCE(sum(raw_size), 0), COALESCE(sum(stored_size), 0),
+               COALESCE(sum(refcount), 0), COALESCE(max(depth), 0),
+               pg_total_relation_size('payload_blobs')
+        FROM payload_blobs
+    """)
+    blobs, patches, raw_size, stored_size, references, max_depth, table_size = cursor.fetchone()
+    return {
+        'blobs': blobs, 'patches': patches, 'references': int(references), 'max_chain': max_depth,
+        'raw_bytes': raw_size, 'stored_bytes': stored_size, 'table_bytes': table_size,
+        'compression_ratio': round(raw_size / stored_size, 2) if stored_size else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['stats', 'gc'])
+    args = parser.parse_args()
+
+    configure_logging()
+    from webhook_listener import init_database
+    from db_pool import db_connection
+
+    init_database()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if args.command == 'gc':
+            print(f"Удалено blob'ов без ссылок: {collect_garbage(cursor)}")
+        else:
+            for key, value in stats(cursor).items():
+                print(f"{key}: {value}")
+        conn.commit()
+        cursor.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
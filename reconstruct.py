@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Восстановление сущности на момент времени или версию
+Каждые ENTITY_SNAPSHOT_INTERVAL версий сущности при записи сохраняется полный снимок
+(entity_snapshots); состояние на момент D - ближайший снимок до D плюс changeDescription
+событий после него. Недавно восстановленные версии держатся в LRU-кэше.
+
+Снимки для уже накопленной истории:
+    python reconstruct.py backfill
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Optional, Tuple
+
+from psycopg2.extras import Json, execute_values
+
+from event_parser import ChangeEvent
+from log_config import configure_logging
+from payload_store import load_entities
+
+logger = logging.getLogger(__name__)
+
+# Полный снимок сущности сохраняется раз в N версий (изменений)
+ENTITY_SNAPSHOT_INTERVAL = int(os.getenv('ENTITY_SNAPSHOT_INTERVAL', 50))
+# Сколько восстановленных версий держать в памяти воркера
+RECONSTRUCT_CACHE_SIZE = int(os.getenv('RECONSTRUCT_CACHE_SIZE', 256))
+
+# Элемент пути: имя без точек или имя в кавычках ("a.b" - колонка с точкой в имени)
+_PATH_TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^.]+)')
+
+# Ключи, по которым сравниваются элементы списков (tags, columns, owners, ...)
+_ITEM_KEYS = ('tagFQN', 'fullyQualifiedName', 'name', 'id')
+
+
+class EntityNotFound(LookupError):
+    """Нет событий сущности до запрошенного момента"""
+
+
+def parse_field_path(name: str) -> List[str]:
+    return [quoted if quoted else plain for quoted, plain in _PATH_TOKEN_RE.findall(name or '')]
+
+
+def _decode(value: Any) -> Any:
+    """OpenMetadata передаёт списки и объекты в changeDescription JSON-строками"""
+    if isinstance(value, str) and value[:1] in ('[', '{'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _item_key(item: Any):
+    if isinstance(item, dict):
+        for key in _ITEM_KEYS:
+            if item.get(key) is not None:
+                return key, item[key]
+    return None, json.dumps(item, sort_keys=True, default=str)
+
+
+def _child(node: Any, key: str, create: bool):
+    """Дочерний узел: ключ словаря или элемент списка с таким именем"""
+    if isinstance(node, dict):
+        if key not in node and create:
+            node[key] = {}
+        return node.get(key)
+    if isinstance(node, list):
+        for item in node:
+            if isinstance(item, dict) and key in (item.get('name'), item.get('fullyQualifiedName')):
+                return item
+    return None
+
+
+def _set_path(entity: Dict[str, Any], path: List[str], value: Any, mode: str):
+    """mode: set - заменить, add - дополнить список, delete - убрать из списка / удалить ключ"""
+    node = entity
+    for key in path[:-1]:
+        node = _child(node, key, create=(mode != 'delete'))
+        if node is None:
+            return
+    if not isinstance(node, dict):
+        return
+    field = path[-1]
+    current = node.get(field)
+
+    if mode == 'set':
+        node[field] = value
+    elif mode == 'add':
+        if isinstance(current, list):
+            items = value if isinstance(value, list) else [value]
+            existing = {_item_key(item) for item in current}
+            current.extend(item for item in items if _item_key(item) not in existing)
+        else:
+            node[field] = value
+    elif mode == 'delete':
+        if isinstance(current, list) and isinstance(value, (list, dict)):
+            removed = {_item_key(item) for item in (value if isinstance(value, list) else [value])}
+            node[field] = [item for item in current if _item_key(item) not in removed]
+        else:
+            node.pop(field, None)
+
+
+def apply_change_description(entity: Dict[str, Any], change_desc: Dict[str, Any]) -> Dict[str, Any]:
+    """Применяет changeDescription события к entity (на месте) и возвращает его"""
+    for item in change_desc.get('fieldsDeleted') or []:
+        if isinstance(item, dict):
+            _set_path(entity, parse_field_path(item.get('name')), _decode(item.get('oldValue')), 'delete')
+    for item in change_desc.get('fieldsUpdated') or []:
+        if isinstance(item, dict):
+            _set_path(entity, parse_field_path(item.get('name')), _decode(item.get('newValue')), 'set')
+    for item in change_desc.get('fieldsAdded') or []:
+        if isinstance(item, dict):
+            _set_path(entity, parse_field_path(item.get('name')), _decode(item.get('newValue')), 'add')
+    return entity
+
+
+def snapshot_rows(events: List[ChangeEvent], counts: Dict[str, Tuple[int, int]],
+                  interval: Optional[int] = None) -> List[tuple]:
+    """
+    Снимки для пачки: первая версия сущности и каждая interval-я (по умолчанию
+    ENTITY_SNAPSHOT_INTERVAL). counts - {entity_id: (изменений до пачки, после)} из upsert_entity_state
+    """
+    interval = ENTITY_SNAPSHOT_INTERVAL if interval is None else interval
+    if interval <= 0:
+        return []
+    rows = {}
+    for event in events:
+        if event.entity_from_event or event.entity_id not in counts:
+            continue
+        before, after = counts[event.entity_id]
+        if before and before // interval == after // interval:
+            continue
+        current = rows.get(event.entity_id)
+        if current is None or event.event_time >= current[1]:
+            rows[event.entity_id] = (event.entity_id, event.event_time, event.event_id,
+                                     event.current_version, Json(event.entity))
+    return [rows[entity_id] for entity_id in sorted(rows)]
+
+
+def write_snapshots(cursor, events: List[ChangeEvent], counts: Dict[str, Tuple[int, int]]):
+    rows = snapshot_rows(events, counts)
+    if rows:
+        execute_values(cursor, """
+            INSERT INTO entity_snapshots (entity_id, event_time, event_id, version, snapshot)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        """, rows, page_size=len(rows))
+
+
+def _archived_change(event: Dict[str, Any]) -> Any:
+    """changeDescription события из архива (в payload'е он бывает строкой JSON)"""
+    change_desc = (event['full_payload'] or {}).get('changeDescription')
+    if isinstance(change_desc, str):
+        try:
+            return json.loads(change_desc)
+        except ValueError:
+            return None
+    return change_desc
+
+
+class Reconstructor:
+    """Восстановление сущности по снимкам и дельтам с LRU-кэшем версий"""
+
+    def __init__(self, get_connection, cache_size: int = 256, archive=None):
+        self.get_connection = get_connection
+        self.cache_size = cache_size
+        # archive.ArchiveReader: события месяцев, перенесённых из БД в архив
+        self.archive = archive
+        self._cache = OrderedDict()  # (entity_id, event_time, event_id) -> entity
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._deltas_applied = 0
+
+    def _cached(self, key):
+        with self._lock:
+            entity = self._cache.get(key)
+            if entity is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+            return entity
+
+    def _best_cached_base(self, entity_id: str, after: tuple, upto: tuple):
+        """Закэшированная версия той же сущности между снимком и целью - с неё меньше дельт"""
+        best = None
+        with self._lock:
+            for key in self._cache:
+                if key[0] == entity_id and after < key[1:] <= upto and (best is None or key[1:] > best[1:]):
+                    best = key
+            return (best, self._cache[best]) if best else (None, None)
+
+    def _remember(self, key, entity):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = entity
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def reconstruct(self, entity_id: str, at: Optional[datetime] = None,
+                    version: Optional[Decimal] = None) -> Dict[str, Any]:
+        """
+        Сущность на момент at (последнее событие не позже at) или на версию version.
+        Возвращает {'entity', 'event_id', 'event_time', 'version', 'deltas_applied', 'cached'}
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            target = self._find_target(cursor, entity_id, at, version)
+            if target is None:
+                cursor.close()
+                raise EntityNotFound(f"Нет событий сущности {entity_id} на запрошенный момент")
+            target_event_id, target_time, target_version = target
+            key = (entity_id, target_time, target_event_id)
+
+            entity = self._cached(key)
+            if entity is not None:
+                cursor.close()
+                return {'entity': entity, 'event_id': target_event_id, 'event_time': target_time,
+                        'version': target_version, 'deltas_applied': 0, 'cached': True}
+
+            base, base_position = self._load_base(cursor, entity_id, key[1:])
+            deltas = self._load_deltas(cursor, entity_id, base_position, key[1:])
+            cursor.close()
+            conn.rollback()
+
+        entity = copy.deepcopy(base)
+        for change_desc, event_version, created_entity in deltas:
+            if isinstance(created_entity, dict):
+                entity = copy.deepcopy(created_entity)
+            elif isinstance(change_desc, dict):
+                apply_change_description(entity, change_desc)
+            if event_version is not None:
+                entity['version'] = float(event_version)
+
+        with self._lock:
+            self._misses += 1
+            self._deltas_applied += len(deltas)
+        self._remember(key, entity)
+        return {'entity': entity, 'event_id': target_event_id, 'event_time': target_time,
+                'version': target_version, 'deltas_applied': len(deltas), 'cached': False}
+
+    def _find_target(self, cursor, entity_id, at, version):
+        query = "SELECT event_id, event_time, current_version FROM metadata_change_events WHERE entity_id = %s"
+        params = [entity_id]
+        if version is not None:
+            query += " AND current_version = %s"
+            params.append(version)
+        if at is not None:
+            query += " AND event_time <= %s"
+            params.append(at)
+        cursor.execute(query + " ORDER BY event_time DESC, event_id DESC LIMIT 1", params)
+        target = cursor.fetchone()
+
+        newest_archived = self.archive.newest_time() if self.archive is not None else None
+        if newest_archived is not None and (target is None or target[1] <= newest_archived):
+            archived = self.archive.find_target(entity_id, at, version)
+            if archived is not None and (target is None or (archived[1], archived[0]) > (target[1], target[0])):
+                target = archived
+        return target
+
+    def _load_base(self, cursor, entity_id: str, target: tuple):
+        """Ближайший снимок не позже цели (или более близкая закэшированная версия)"""
+        cursor.execute("""
+            SELECT event_time, event_id, snapshot FROM entity_snapshots
+            WHERE entity_id = %s AND (event_time, event_id) <= (%s, %s)
+            ORDER BY event_time DESC, event_id DESC LIMIT 1
+        """, (entity_id, *target))
+        row = cursor.fetchone()
+        if row is not None:
+            base, position = row[2], (row[0], row[1])
+        else:
+            # Снимков ещё нет: от пустой сущности, с первого события
+            base, position = {}, (datetime.min, '')
+
+        cached_key, cached = self._best_cached_base(entity_id, position, target)
+        if cached_key is not None:
+            return cached, cached_key[1:]
+        return base, position
+
+    def _load_deltas(self, cursor, entity_id: str, after: tuple, upto: tuple) -> List[tuple]:
+        cursor.execute("""
+            SELECT event_time, event_id,
+                   CASE WHEN jsonb_typeof(full_payload->'changeDescription') = 'string'
+                        THEN (full_payload->>'changeDescription')::jsonb
+                        ELSE full_payload->'changeDescription' END,
+                   current_version,
+                   CASE WHEN e.event_type = 'entityCreated' THEN full_payload->'entity' END,
+                   CASE WHEN e.event_type = 'entityCreated' THEN entity_hash END
+            FROM metadata_change_events e
+            WHERE entity_id = %s
+              AND (event_time, event_id) > (%s, %s) AND (event_time, event_id) <= (%s, %s)
+            ORDER BY event_time, event_id
+        """, (entity_id, *after, *upto))
+        rows = cursor.fetchall()
+        # entity событий создания, вынесенные в payload_blobs
+        stored = load_entities(cursor, [row[5] for row in rows if row[4] is None and row[5] is not None])
+
+        newest_archived = self.archive.newest_time() if self.archive is not None else None
+        if newest_archived is not None and after[0] <= newest_archived:
+            # Начало истории в архиве: его full_payload уже содержит entity
+            archived = [(event['event_time'], event['event_id'], _archived_change(event), event['current_version'],
+                         (event['full_payload'] or {}).get('entity') if event['event_type'] == 'entityCreated' else None,
+                         None)
+                        for event in self.archive.entity_events(entity_id, after[0], upto[0])
+                        if after < (event['event_time'], event['event_id']) <= upto]
+            rows = sorted(archived + rows, key=lambda row: row[:2])
+
+        deltas = []
+        for _, _, change_desc, event_version, created_entity, entity_hash in rows:
+            if created_entity is None and entity_hash is not None:
+                created_entity = stored.get(bytes(entity_hash))
+            if isinstance(created_entity, dict):
+                # Создание сущности несёт её целиком: предыдущие дельты не нужны
+                deltas = []
+            deltas.append((change_desc, event_version, created_entity))
+        return deltas
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'cache_size': len(self._cache), 'cache_max_size': self.cache_size,
+                    'hits': self._hits, 'misses': self._misses, 'deltas_applied': self._deltas_applied}
+
+
+_BACKFILL_POSITIONS = """
+    SELECT entity_id, event_time, event_id, current_version, full_payload, entity_hash,
+           row_number() OVER (PARTITION BY entity_id ORDER BY event_time, event_id) AS n
+    FROM metadata_change_events
+    WHERE entity_id IS NOT NULL
+"""
+
+BACKFILL_SQL = f"""
+    INSERT INTO entity_snapshots (entity_id, event_time, event_id, version, snapshot)
+    SELECT entity_id, event_time, event_id, current_version, full_payload->'entity'
+    FROM ({_BACKFILL_POSITIONS}) e
+    WHERE (n = 1 OR n %% %s = 0) AND jsonb_typeof(full_payload->'entity') = 'object'
+    ON CONFLICT DO NOTHING
+"""
+
+# Те же позиции для событий, чей entity хранится в payload_blobs
+BACKFILL_BLOBS_SQL = f"""
+    SELECT entity_id, event_time, event_id, current_version, entity_hash
+    FROM ({_BACKFILL_POSITIONS}) e
+    WHERE (n = 1 OR n %% %s = 0) AND entity_hash IS NOT NULL
+"""
+
+
+def backfill(conn, interval: int, page_size: int = 500) -> int:
+    """Снимки по уже накопленной истории; возвращает число созданных снимков"""
+    cursor = conn.cursor()
+    cursor.execute(BACKFILL_SQL, (interval,))
+    created = cursor.rowcount
+
+    positions = conn.cursor(name='snapshot_backfill')
+    positions.execute(BACKFILL_BLOBS_SQL, (interval,))
+    while True:
+        page = positions.fetchmany(page_size)
+        if not page:
+            break
+        entities = load_entities(cursor, [row[4] for row in page])
+        rows = [(*row[:4], Json(entities[bytes(row[4])])) for row in page if bytes(row[4]) in entities]
+        if rows:
+            execute_values(cursor, """
+                INSERT INTO entity_snapshots (entity_id, event_time, event_id, version, snapshot)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, rows, page_size=len(rows))
+            created += cursor.rowcount
+    positions.close()
+    conn.commit()
+    cursor.close()
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--interval', type=int, default=ENTITY_SNAPSHOT_INTERVAL,
+                        help='Снимок раз в N версий')
+    args = parser.parse_args()
+
+    configure_logging()
+    from webhook_listener import init_database
+    from db_pool import db_connection
+
+    init_database()
+    with db_connection() as conn:
+        print(f"Создано снимков: {backfill(conn, args.interval)}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Почасовые и посуточные агрегаты событий (таблица event_rollups)
+Обновляются в той же транзакции, что и запись события: число событий всего и в разрезе
+event_type, entity_type, updated_by, по поддеревьям FQN (fqn_1 ... fqn_N, см. fqn.py),
+а также число изменений полей по field_name.
+/stats и панели дашбордов читают несколько строк агрегатов вместо GROUP BY по всей истории.
+Агрегаты не удаляются вместе с партициями событий: статистика за прошлые периоды остаётся.
+
+Пересчёт по накопленным событиям (после обновления, после bulk_import старых версий):
+    python rollups.py rebuild
+    python rollups.py rebuild --since 2024-01-01
+"""
+
+import os
+import sys
+import logging
+import argparse
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional
+
+from psycopg2.extras import execute_values
+
+from event_parser import ChangeEvent
+from fqn import FQN_DIMENSIONS, FQN_ROLLUP_DEPTH, fqn_prefixes
+from log_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Число «полос» счётчиков: воркеры пишут в свою полосу (по pid) и не ждут блокировок
+# одной и той же строки текущего часа; при чтении полосы суммируются
+ROLLUP_SHARDS = max(int(os.getenv('ROLLUP_SHARDS', 8)), 1)
+
+GRANULARITIES = ('hour', 'day')
+# Разрезы событий; field_name считает изменения полей, остальные - события.
+# fqn_K - события поддерева FQN K-го уровня (значение - канонический FQN префикса)
+EVENT_DIMENSIONS = ('event_type', 'entity_type', 'updated_by')
+DIMENSIONS = ('total',) + EVENT_DIMENSIONS + ('field_name',) + FQN_DIMENSIONS
+
+ROLLUPS_DDL = """
+    CREATE TABLE IF NOT EXISTS event_rollups (
+        granularity VARCHAR(10) NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        dimension VARCHAR(30) NOT NULL,
+        value TEXT NOT NULL,
+        shard SMALLINT NOT NULL DEFAULT 0,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularity, dimension, bucket, value, shard)
+    ) WITH (fillfactor = 70);
+"""
+
+# Счётчики пачки: строки уже сложены в Python и упорядочены
+_UPSERT_SQL = """
+    INSERT INTO event_rollups AS r (granularity, bucket, dimension, value, shard, event_count)
+    VALUES %s
+    ON CONFLICT (granularity, dimension, bucket, value, shard) DO UPDATE
+        SET event_count = r.event_count + EXCLUDED.event_count
+"""
+
+# Слияние строк-источников (event_time, dimension, value, n) в агрегаты обеих гранулярностей
+# (пересчёт и bulk_import). Строки упорядочены: параллельные транзакции блокируют их
+# в одном порядке, без взаимоблокировок
+_MERGE_SQL = """
+    INSERT INTO event_rollups AS r (granularity, bucket, dimension, value, shard, event_count)
+    SELECT g.granularity, date_trunc(g.granularity, src.event_time::timestamp),
+           src.dimension, src.value, {shard}, sum(src.n)
+    FROM ({source}) AS src (event_time, dimension, value, n)
+    CROSS JOIN (VALUES ('hour'), ('day')) AS g (granularity)
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (granularity, dimension, bucket, value, shard) DO UPDATE
+        SET event_count = r.event_count + EXCLUDED.event_count
+"""
+
+
+def source_sql(events: str, fields: str) -> str:
+    """
+    Строки-источники из SQL: events - выражение FROM с колонками event_time, event_type,
+    entity_type, updated_by, entity_fqn; fields - с колонками event_time, field_name
+    """
+    dimensions = ', '.join(f"('{d}', e.{d})" for d in EVENT_DIMENSIONS)
+    return f"""
+        SELECT e.event_time, d.dimension, d.value, 1
+        FROM {events}
+        CROSS JOIN LATERAL (
+            VALUES ('total', ''), {dimensions}
+            UNION ALL
+            SELECT 'fqn_' || p.fqn_depth, p.prefix
+            FROM history_fqn_prefixes(e.entity_fqn, {FQN_ROLLUP_DEPTH}) AS p
+        ) AS d (dimension, value)
+        WHERE d.value IS NOT NULL
+        UNION ALL
+        SELECT f.event_time, 'field_name', f.field_name, 1
+        FROM {fields}
+        WHERE f.field_name IS NOT NULL
+    """
+
+
+def merge_sql(source: str, shard: int = 0) -> str:
+    return _MERGE_SQL.format(source=source, shard=int(shard))
+
+
+def _hours(cursor, events: List[ChangeEvent]) -> Dict[str, datetime]:
+    """Начало часа для времени каждого события"""
+    hours, unparsed = {}, set()
+    for event in events:
+        if event.event_time in hours:
+            continue
+        try:
+            parsed = datetime.fromisoformat(event.event_time)
+        except ValueError:
+            unparsed.add(event.event_time)
+            continue
+        # Как у колонки TIMESTAMP: смещение часового пояса отбрасывается без пересчёта
+        hours[event.event_time] = parsed.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    for event_time in unparsed:
+        # Форматы, которые понимает PostgreSQL, но не datetime.fromisoformat
+        cursor.execute("SELECT date_trunc('hour', %s::timestamp)", (event_time,))
+        hours[event_time] = cursor.fetchone()[0]
+    return hours
+
+
+def rollup_rows(cursor, events: List[ChangeEvent], shard: int = 0) -> List[tuple]:
+    """Строки event_rollups для пачки, сложенные по корзинам и упорядоченные по ключу"""
+    hours = _hours(cursor, events)
+    counts = Counter()
+    for event in events:
+        hour = hours[event.event_time]
+        keys = [('total', '')]
+        keys.extend((dimension, getattr(event, dimension)) for dimension in EVENT_DIMENSIONS
+                    if getattr(event, dimension) is not None)
+        keys.extend(fqn_prefixes(event.entity_fqn))
+        keys.extend(('field_name', change.field_name) for change in event.field_changes
+                    if change.field_name is not None)
+        for dimension, value in keys:
+            counts[('hour', dimension, hour, value)] += 1
+            counts[('day', dimension, hour.replace(hour=0), value)] += 1
+    return [(granularity, bucket, dimension, value, shard, n)
+            for (granularity, dimension, bucket, value), n in sorted(counts.items())]
+
+
+def update_rollups(cursor, events: List[ChangeEvent]):
+    """Добавляет записанные (новые) события в агрегаты в текущей транзакции"""
+    if not events:
+        return
+    rows = rollup_rows(cursor, events, os.getpid() % ROLLUP_SHARDS)
+    execute_values(cursor, _UPSERT_SQL, rows, page_size=len(rows))
+
+
+def _range_filter(granularity: str, since: Optional[datetime], until: Optional[datetime]):
+    conditions, params = ["granularity = %s"], [granularity]
+    if since is not None:
+        conditions.append("bucket >= date_trunc(%s, %s::timestamp)")
+        params.extend([granularity, since])
+    if until is not None:
+        conditions.append("bucket < %s")
+        params.append(until)
+    return " AND ".join(conditions), params
+
+
+def series(cursor, granularity: str, since: Optional[datetime], until: Optional[datetime],
+           dimension: str = 'total', value: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Ряд по корзинам: [{'bucket', 'value', 'count'}] (value - только для разрезов)"""
+    where, params = _range_filter(granularity, since, until)
+    where += " AND dimension = %s"
+    params.append(dimension)
+    if value is not None:
+        where += " AND value = %s"
+        params.append(value)
+    cursor.execute(f"""
+        SELECT bucket, value, sum(event_count)
+        FROM event_rollups WHERE {where}
+        GROUP BY bucket, value ORDER BY bucket, value
+    """, params)
+    if dimension == 'total':
+        return [{'bucket': bucket, 'count': int(count)} for bucket, _, count in cursor.fetchall()]
+    return [{'bucket': bucket, 'value': row_value, 'count': int(count)}
+            for bucket, row_value, count in cursor.fetchall()]
+
+
+def top(cursor, granularity: str, since: Optional[datetime], until: Optional[datetime],
+        dimension: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Значения разреза по убыванию числа за период"""
+    where, params = _range_filter(granularity, since, until)
+    query = f"""
+        SELECT value, sum(event_count) AS count
+        FROM event_rollups WHERE {where} AND dimension = %s
+        GROUP BY value ORDER BY count DESC, value
+    """
+    params.append(dimension)
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    cursor.execute(query, params)
+    return [{'value': row_value, 'count': int(count)} for row_value, count in cursor.fetchall()]
+
+
+def fqn_children(cursor, granularity: str, since: Optional[datetime], until: Optional[datetime],
+                 prefix: Optional[str], depth: int, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    События поддерева prefix (канонический FQN уровня depth - 1, None - все) и его ветвей
+    уровня depth из разреза fqn_<depth>: {'total', 'children': [{'fqn', 'count'}]}
+    """
+    where, params = _range_filter(granularity, since, until)
+    if prefix is None:
+        total_where, total_params = where + " AND dimension = 'total'", list(params)
+        children_where, children_params = where + " AND dimension = %s", params + [f'fqn_{depth}']
+    else:
+        total_where = where + " AND dimension = %s AND value = %s"
+        total_params = params + [f'fqn_{depth - 1}', prefix]
+        children_where = where + " AND dimension = %s AND starts_with(value, %s)"
+        children_params = params + [f'fqn_{depth}', prefix + '.']
+    cursor.execute(f"SELECT coalesce(sum(event_count), 0) FROM event_rollups WHERE {total_where}", total_params)
+    total = int(cursor.fetchone()[0])
+    query = f"""
+        SELECT value, sum(event_count) AS count
+        FROM event_rollups WHERE {children_where}
+        GROUP BY value ORDER BY count DESC, value
+    """
+    if limit is not None:
+        query += " LIMIT %s"
+        children_params.append(limit)
+    cursor.execute(query, children_params)
+    return {'total': total,
+            'children': [{'fqn': value, 'count': int(count)} for value, count in cursor.fetchall()]}
+
+
+def peak_hours(cursor, since: Optional[datetime], until: Optional[datetime]) -> Dict[int, int]:
+    """События по часу суток за период (из почасовых агрегатов)"""
+    where, params = _range_filter('hour', since, until)
+    cursor.execute(f"""
+        SELECT extract(hour FROM bucket)::int, sum(event_count)
+        FROM event_rollups WHERE {where} AND dimension = 'total'
+        GROUP BY 1 ORDER BY 1
+    """, params)
+    return {hour: int(count) for hour, count in cursor.fetchall()}
+
+
+def top_entities(cursor, limit: int) -> List[Dict[str, Any]]:
+    """Самые изменяемые сущности за всю историю - из счётчиков entity_current_state"""
+    columns = ('entity_id', 'entity_fqn', 'entity_type', 'change_count', 'last_event_time')
+    cursor.execute(f"""
+        SELECT {', '.join(columns)} FROM entity_current_state
+        ORDER BY change_count DESC LIMIT %s
+    """, (limit,))
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def rebuild(conn, since: Optional[date] = None) -> int:
+    """
+    Пересчитывает агрегаты по событиям начиная с since (с начала суток; по умолчанию - все).
+    Запись событий на время пересчёта ждёт блокировку event_rollups, поэтому счётчики
+    не задваиваются и не теряются. Возвращает число строк агрегатов
+    """
+    cursor = conn.cursor()
+    cursor.execute("LOCK TABLE event_rollups IN SHARE ROW EXCLUSIVE MODE")
+    if since is None:
+        cursor.execute("DELETE FROM event_rollups")
+        events, fields = "metadata_change_events e", "field_changes f"
+        params = ()
+    else:
+        since = datetime.combine(since, datetime.min.time())
+        cursor.execute("DELETE FROM event_rollups WHERE bucket >= %s", (since,))
+        events = "metadata_change_events e WHERE e.event_time >= %s"
+        fields = "field_changes f WHERE f.event_time >= %s"
+        params = (since, since)
+    # Фильтр по времени - внутри источников, до разворота на разрезы
+    source = source_sql(f"(SELECT * FROM {events}) e", f"(SELECT * FROM {fields}) f")
+    cursor.execute(merge_sql(source), params)
+    count = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--since', type=date.fromisoformat, default=None,
+                        help='С какой даты пересчитать (YYYY-MM-DD), по умолчанию - всё')
+    args = parser.parse_args()
+
+    configure_logging()
+    from webhook_listener import init_database
+    from db_pool import db_connection
+
+    init_database()
+    with db_connection() as conn:
+        count = rebuild(conn, args.since)
+    print(f"Строк агрегатов: {count}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
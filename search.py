@@ -0,0 +1,294 @@
+"""
+Поиск по истории изменений (/search): полнотекстовый по именам и значениям изменённых полей,
+описаниям и колонкам сущностей и структурный - вхождение JSON (теги, владельцы, колонки).
+
+Векторы tsvector - колонки search_vector у field_changes и entity_current_state, их считает
+PostgreSQL при записи строки, отдельного шага в write_events нет: на новой установке это
+генерируемые (STORED) колонки, на установке с данными - обычные, с триггером и фоновым
+заполнением старых строк (migrations.add_derived_column). Пока заполнение идёт, старые
+строки в /search не находятся.
+Значения полей OpenMetadata присылает текстом JSON; history_try_jsonb разбирает его
+для GIN-индекса по выражению (текст, не являющийся JSON, - NULL).
+
+Точки в именах полей, FQN и значениях заменяются пробелами до разбора на слова
+(и в индексе, и в запросе): columns.ssn.tags ищется по слову ssn, PII.Sensitive - по pii.
+"""
+
+import json
+import base64
+from datetime import datetime
+from typing import Dict, Any, Tuple
+
+from events_query import InvalidQuery, parse_fqn_prefix, parse_limit, _parse_time
+from fqn import subtree_condition
+
+# Конфигурация разбора текста: без стемминга и стоп-слов - в истории смешаны языки и идентификаторы
+SEARCH_CONFIG = 'simple'
+# Сколько символов значения попадает в tsvector (размер tsvector ограничен 1 МБ).
+# Входит в выражение колонок search_vector: изменение применяется только к новой колонке
+SEARCH_TEXT_MAX_CHARS = 100000
+
+SCOPES = ('changes', 'entities')
+
+
+def _words(expression: str) -> str:
+    return f"to_tsvector('{SEARCH_CONFIG}', translate(left({expression}, {SEARCH_TEXT_MAX_CHARS}), '.', ' '))"
+
+
+SEARCH_FUNCTIONS_DDL = """
+    CREATE OR REPLACE FUNCTION history_try_jsonb(value TEXT) RETURNS JSONB
+    LANGUAGE plpgsql IMMUTABLE PARALLEL UNSAFE AS $$
+    BEGIN
+        IF value IS NULL OR left(ltrim(value), 1) NOT IN ('{', '[') THEN
+            RETURN NULL;
+        END IF;
+        RETURN value::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$;
+"""
+
+# Колонки search_vector: (таблица, колонка, тип, исходные колонки, выражение).
+# {row} в выражении - '' для генерируемой колонки, 'NEW.' для триггера
+SEARCH_COLUMNS = (
+    ('field_changes', 'search_vector', 'tsvector', ('field_name', 'new_value', 'old_value'), f"""
+        setweight({_words("coalesce({row}field_name, '')")}, 'A') ||
+        setweight({_words("coalesce({row}new_value, '')")}, 'B') ||
+        setweight({_words("coalesce({row}old_value, '')")}, 'C')
+    """),
+    ('entity_current_state', 'search_vector', 'tsvector', ('entity_fqn', 'snapshot'), f"""
+        setweight({_words("coalesce({row}entity_fqn, '')")}, 'A') ||
+        setweight({_words("coalesce({row}snapshot->>'description', '')")}, 'B') ||
+        setweight({_words("coalesce(jsonb_path_query_array({row}snapshot, '$.columns[*].name')::text, '')")}, 'B') ||
+        setweight({_words("coalesce(jsonb_path_query_array({row}snapshot, '$.columns[*].description')::text, '')")}, 'C')
+    """),
+)
+
+# Индексы /search: (имя, таблица, определение), строятся online-миграцией
+SEARCH_INDEXES = (
+    ('idx_field_changes_search', 'field_changes', 'USING GIN (search_vector)'),
+    # Страница результатов от новых к старым без сортировки всех совпадений частого слова
+    ('idx_field_changes_time_id', 'field_changes', '(event_time, id)'),
+    ('idx_field_changes_new_json', 'field_changes', 'USING GIN (history_try_jsonb(new_value) jsonb_path_ops)'),
+    ('idx_field_changes_old_json', 'field_changes', 'USING GIN (history_try_jsonb(old_value) jsonb_path_ops)'),
+    ('idx_entity_state_search', 'entity_current_state', 'USING GIN (search_vector)'),
+    ('idx_entity_state_snapshot', 'entity_current_state', 'USING GIN (snapshot jsonb_path_ops)'),
+)
+
+CHANGE_COLUMNS = (
+    'id', 'event_time', 'event_id', 'field_name', 'change_type', 'old_value', 'new_value',
+    'event_type', 'entity_type', 'entity_id', 'entity_fqn', 'updated_by',
+)
+ENTITY_COLUMNS = (
+    'entity_id', 'entity_type', 'entity_fqn', 'entity_name', 'current_version', 'last_event_id',
+    'last_event_type', 'last_event_time', 'last_updated_by', 'is_deleted', 'change_count',
+)
+
+# Фильтры на равенство: параметр запроса -> колонка события (для scope=changes)
+EVENT_FILTERS = {
+    'event_type': 'e.event_type',
+    'entity_type': 'e.entity_type',
+    'entity_fqn': 'e.entity_fqn',
+    'entity_id': 'e.entity_id',
+    'updated_by': 'e.updated_by',
+}
+ENTITY_FILTERS = {
+    'entity_type': 'entity_type',
+    'updated_by': 'last_updated_by',
+}
+
+
+def encode_cursor(position: tuple) -> str:
+    """Курсор следующей страницы: (время, ключ) последней отданной строки"""
+    raw = json.dumps([position[0].isoformat(), position[1]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position_time, key = json.loads(raw)
+        return datetime.fromisoformat(position_time), key
+    except (ValueError, TypeError) as e:
+        raise InvalidQuery(f"Некорректный cursor: {e}")
+
+
+def _parse_json(name: str, value: str) -> str:
+    try:
+        document = json.loads(value)
+    except ValueError as e:
+        raise InvalidQuery(f"{name}: ожидается JSON ({e})")
+    if not isinstance(document, (dict, list)):
+        raise InvalidQuery(f"{name}: ожидается JSON-объект или массив")
+    return json.dumps(document)
+
+
+def _field_pattern(value: str) -> str:
+    """Шаблон имени поля: * - любая часть имени (columns.*.tags), остальное - буквально"""
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%')
+
+
+def _text_condition(column: str) -> str:
+    # Синтаксис поисковой строки: "фраза", or, -исключение
+    return f"{column} @@ websearch_to_tsquery('{SEARCH_CONFIG}', translate(%s, '.', ' '))"
+
+
+def build_search_query(args: Dict[str, Any], limit: int) -> Tuple[str, list, Tuple[str, ...]]:
+    """
+    SQL поиска по параметрам запроса, от новых к старым.
+    Возвращает (query, params, columns); нужен хотя бы один из q, contains, old_contains, field
+    """
+    scope = args.get('scope') or 'changes'
+    if scope not in SCOPES:
+        raise InvalidQuery(f"scope: ожидается {' или '.join(SCOPES)}")
+    if not any(args.get(name) for name in ('q', 'contains', 'old_contains', 'field')):
+        raise InvalidQuery("Укажите q, contains, old_contains или field")
+    if scope == 'changes':
+        return _changes_query(args, limit)
+    return _entities_query(args, limit)
+
+
+def _changes_query(args: Dict[str, Any], limit: int) -> Tuple[str, list, Tuple[str, ...]]:
+    conditions, params = [], []
+    if args.get('q'):
+        conditions.append(_text_condition('f.search_vector'))
+        params.append(args['q'])
+    if args.get('contains'):
+        conditions.append("history_try_jsonb(f.new_value) @> %s::jsonb")
+        params.append(_parse_json('contains', args['contains']))
+    if args.get('old_contains'):
+        conditions.append("history_try_jsonb(f.old_value) @> %s::jsonb")
+        params.append(_parse_json('old_contains', args['old_contains']))
+    if args.get('field'):
+        if '*' in args['field']:
+            conditions.append("f.field_name LIKE %s")
+            params.append(_field_pattern(args['field']))
+        else:
+            conditions.append("f.field_name = %s")
+            params.append(args['field'])
+    if args.get('change_type'):
+        conditions.append("f.change_type = %s")
+        params.append(args['change_type'])
+    if args.get('since'):
+        conditions.append("f.event_time >= %s")
+        params.append(_parse_time('since', args['since']))
+    if args.get('until'):
+        conditions.append("f.event_time < %s")
+        params.append(_parse_time('until', args['until']))
+    if args.get('cursor'):
+        event_time, row_id = decode_cursor(args['cursor'])
+        if not isinstance(row_id, int):
+            raise InvalidQuery("Некорректный cursor: курсор другого scope")
+        conditions.append("(f.event_time, f.id) < (%s, %s)")
+        params.extend([event_time, row_id])
+
+    event_conditions, event_params = [], []
+    for name, column in EVENT_FILTERS.items():
+        if args.get(name):
+            event_conditions.append(f"{column} = %s")
+            event_params.append(args[name])
+    fqn_path = parse_fqn_prefix(args.get('fqn_prefix'))
+    if fqn_path:
+        condition, condition_params = subtree_condition('e.fqn_path', fqn_path)
+        event_conditions.append(condition)
+        event_params.extend(condition_params)
+
+    columns = CHANGE_COLUMNS
+    select = ', '.join(f"f.{c}" if c in ('id', 'event_time', 'event_id') else c for c in columns)
+    join = "JOIN metadata_change_events e ON e.event_id = f.event_id AND e.event_time = f.event_time"
+    order = "ORDER BY f.event_time DESC, f.id DESC"
+    if event_conditions:
+        query = f"""
+            SELECT {select}
+            FROM field_changes f
+            {join}
+            WHERE {' AND '.join(conditions + event_conditions)}
+            {order}
+            LIMIT %s
+        """
+        params.extend(event_params)
+    else:
+        # Страница выбирается из одной field_changes, событие читается только для её строк:
+        # частое слово находится обратным проходом по (event_time, id) с остановкой на LIMIT,
+        # редкое - по GIN с сортировкой найденного
+        query = f"""
+            SELECT {select}
+            FROM (
+                SELECT * FROM field_changes f
+                WHERE {' AND '.join(conditions)}
+                {order}
+                LIMIT %s
+            ) f
+            {join}
+            {order}
+        """
+    params.append(limit)
+    return query, params, columns
+
+
+def _entities_query(args: Dict[str, Any], limit: int) -> Tuple[str, list, Tuple[str, ...]]:
+    if args.get('old_contains') or args.get('field'):
+        raise InvalidQuery("old_contains и field - только для scope=changes")
+    conditions, params = [], []
+    if args.get('q'):
+        conditions.append(_text_condition('search_vector'))
+        params.append(args['q'])
+    if args.get('contains'):
+        conditions.append("snapshot @> %s::jsonb")
+        params.append(_parse_json('contains', args['contains']))
+    for name, column in ENTITY_FILTERS.items():
+        if args.get(name):
+            conditions.append(f"{column} = %s")
+            params.append(args[name])
+    fqn_path = parse_fqn_prefix(args.get('fqn_prefix'))
+    if fqn_path:
+        condition, condition_params = subtree_condition('fqn_path', fqn_path)
+        conditions.append(condition)
+        params.extend(condition_params)
+    if args.get('include_deleted') not in ('1', 'true', 'yes'):
+        conditions.append("NOT is_deleted")
+    if args.get('cursor'):
+        event_time, entity_id = decode_cursor(args['cursor'])
+        if not isinstance(entity_id, str):
+            raise InvalidQuery("Некорректный cursor: курсор другого scope")
+        conditions.append("(last_event_time, entity_id) < (%s, %s)")
+        params.extend([event_time, entity_id])
+
+    columns = ENTITY_COLUMNS
+    query = f"""
+        SELECT {', '.join(columns)}
+        FROM entity_current_state
+        WHERE {' AND '.join(conditions)}
+        ORDER BY last_event_time DESC, entity_id DESC
+        LIMIT %s
+    """
+    params.append(limit)
+    return query, params, columns
+
+
+def search(cursor, args: Dict[str, Any]) -> Dict[str, Any]:
+    """Страница /search по параметрам запроса (некорректные параметры - InvalidQuery)"""
+    limit = parse_limit(args.get('limit'))
+    scope = args.get('scope') or 'changes'
+    # +1 строка, чтобы понять, есть ли следующая страница
+    query, params, columns = build_search_query(args, limit + 1)
+    cursor.execute(query, params)
+    results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        if scope == 'entities':
+            next_cursor = encode_cursor((last['last_event_time'], last['entity_id']))
+        else:
+            next_cursor = encode_cursor((last['event_time'], last['id']))
+
+    return {
+        'scope': scope,
+        'count': len(results),
+        'results': results,
+        'next_cursor': next_cursor
+    }
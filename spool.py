@@ -0,0 +1,405 @@
+"""
+Локальный spool событий на случай недоступности БД
+Пока PostgreSQL лежит или тормозит, события дописываются в сегментированные
+append-only файлы (fsync пачками), а replayer потом переносит их в БД.
+Повторная запись безопасна: события вставляются с ON CONFLICT DO NOTHING по (event_id, event_time).
+Событие, которое БД отвергает не из-за недоступности (ошибка данных), откладывается в
+карантин quarantine.jsonl, чтобы не останавливать перенос остальных.
+
+Использование из командной строки:
+    python spool.py stats  [--dir /var/spool/om_history]
+    python spool.py replay [--dir /var/spool/om_history] [--batch-size 1000]
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import argparse
+import threading
+from typing import Callable, Dict, Any, List, Optional
+
+from db_pool import TRANSIENT_ERRORS
+from log_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Каталог spool; пусто - spool выключен
+SPOOL_DIR = os.getenv('SPOOL_DIR', '')
+# Размер сегмента, после которого начинается новый файл
+SPOOL_SEGMENT_MAX_BYTES = int(os.getenv('SPOOL_SEGMENT_MAX_BYTES', 64 * 1024 * 1024))
+# Как часто сбрасывать сегмент на диск (fsync); записи за это время ждут один общий fsync
+SPOOL_FSYNC_INTERVAL_MS = float(os.getenv('SPOOL_FSYNC_INTERVAL_MS', 10))
+# Как часто проверять, не пора ли переносить spool в БД
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SPOOL_REPLAY_INTERVAL', 5))
+SPOOL_REPLAY_BATCH_SIZE = int(os.getenv('SPOOL_REPLAY_BATCH_SIZE', 1000))
+
+SEGMENT_SUFFIX = '.jsonl'
+OFFSET_SUFFIX = '.offset'
+# События, которые не удалось записать в БД, с текстом ошибки (в каталоге spool)
+QUARANTINE_FILE = 'quarantine.jsonl'
+
+
+class Spool:
+    """Append-only spool: сегменты spool-<время>-<pid>.jsonl, один активный на процесс"""
+
+    def __init__(self, directory: str, segment_max_bytes: int = 64 * 1024 * 1024,
+                 fsync_interval: float = 0.01):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval = fsync_interval
+
+        self._cond = threading.Condition(threading.Lock())
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._written_seq = 0  # номер последней записанной строки
+        self._synced_seq = 0   # номер последней строки, прошедшей fsync
+        self._closed = False
+        self._appended = 0
+        self._fsyncs = 0
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='spool-fsync', daemon=True)
+        self._flusher.start()
+
+    def _open_segment(self):
+        self._path = os.path.join(
+            self.directory, f"spool-{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        )
+        self._file = open(self._path, 'ab')
+        # Активный сегмент заблокирован - replayer возьмёт его только после ротации
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._size = 0
+
+    def _close_segment(self):
+        """Закрывает активный сегмент (под self._cond)"""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced_seq = self._written_seq
+        self._file.close()
+        self._file = None
+        self._path = None
+        self._cond.notify_all()
+
+    def append(self, event_data: Dict[str, Any], wait_sync: bool = True):
+        """
+        Дописывает событие в spool. С wait_sync=True возвращается после fsync,
+        общего для всех записей за последние fsync_interval
+        """
+        line = json.dumps(event_data, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Spool закрыт")
+            if self._file is None:
+                self._open_segment()
+            self._file.write(line)
+            self._size += len(line)
+            self._written_seq += 1
+            self._appended += 1
+            seq = self._written_seq
+
+            if self._size >= self.segment_max_bytes:
+                self._close_segment()
+            else:
+                self._cond.notify_all()
+
+            if wait_sync:
+                while self._synced_seq < seq:
+                    self._cond.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while self._synced_seq == self._written_seq and not self._closed:
+                    self._cond.wait()
+                if self._closed and self._synced_seq == self._written_seq:
+                    return
+
+            # Даём набраться записям, чтобы сделать один fsync на всех
+            time.sleep(self.fsync_interval)
+
+            with self._cond:
+                if self._file is not None:
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._fsyncs += 1
+                self._synced_seq = self._written_seq
+                self._cond.notify_all()
+
+    def rotate(self):
+        """Закрывает активный сегмент, чтобы replayer мог его забрать"""
+        with self._cond:
+            self._close_segment()
+
+    def close(self):
+        with self._cond:
+            self._close_segment()
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join(1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = {
+                'appended': self._appended,
+                'fsyncs': self._fsyncs,
+                'active_segment': self._path,
+            }
+        stats.update(pending_stats(self.directory))
+        return stats
+
+
+def list_segments(directory: str) -> List[str]:
+    """Сегменты spool в порядке создания"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith('spool-') and name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def pending_stats(directory: str) -> Dict[str, Any]:
+    """Сколько сегментов и байт ещё не перенесено в БД и сколько байт в карантине"""
+    segments = list_segments(directory)
+    pending_bytes = 0
+    for path in segments:
+        try:
+            pending_bytes += os.path.getsize(path) - _read_offset(path)
+        except FileNotFoundError:
+            pass
+    quarantine = os.path.join(directory, QUARANTINE_FILE)
+    return {'pending_segments': len(segments), 'pending_bytes': pending_bytes,
+            'quarantine_bytes': os.path.getsize(quarantine) if os.path.exists(quarantine) else 0}
+
+
+def _read_offset(segment_path: str) -> int:
+    try:
+        with open(segment_path + OFFSET_SUFFIX) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_offset(segment_path: str, offset: int):
+    tmp_path = segment_path + OFFSET_SUFFIX + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, segment_path + OFFSET_SUFFIX)
+
+
+class SpoolReplayer:
+    """Переносит закрытые сегменты spool в БД пачками, запоминая прогресс по каждому сегменту"""
+
+    def __init__(self, directory: str, write_batch: Callable[[List[Dict[str, Any]]], None],
+                 batch_size: int = 1000, spool: Optional[Spool] = None,
+                 probe: Optional[Callable[[], None]] = None):
+        self.directory = directory
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.spool = spool
+        # Проверка доступности БД перед переносом (бросает исключение, если БД лежит)
+        self.probe = probe
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._replayed = 0
+        self._skipped_lines = 0
+        self._quarantined = 0
+        self._last_replay_rate = 0.0
+        self._last_error = None
+
+    def replay_segment(self, path: str) -> int:
+        """Переносит один сегмент; возвращает число событий или -1, если сегмент занят"""
+        try:
+            segment = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+
+        with segment:
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Активный сегмент пишущего процесса или его уже переносит другой воркер
+                return -1
+
+            if not os.path.exists(path):
+                # Пока ждали блокировку, сегмент перенёс и удалил другой воркер
+                return 0
+
+            offset = _read_offset(path)
+            segment.seek(offset)
+            replayed = 0
+            batch = []
+
+            for line in segment:
+                offset += len(line)
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    # Недописанная строка при аварийном завершении
+                    logger.warning(f"Пропущена повреждённая строка в {path}")
+                    with self._lock:
+                        self._skipped_lines += 1
+                    continue
+
+                if len(batch) >= self.batch_size:
+                    replayed += self._write(path, batch)
+                    _write_offset(path, offset)
+                    batch = []
+
+            if batch:
+                replayed += self._write(path, batch)
+                # Прогресс - до удаления: сбой между ними не повторит весь хвост
+                _write_offset(path, offset)
+
+            os.remove(path)
+            if os.path.exists(path + OFFSET_SUFFIX):
+                os.remove(path + OFFSET_SUFFIX)
+            return replayed
+
+    def _write(self, path: str, batch: List[Dict[str, Any]]) -> int:
+        """
+        Пишет пачку; возвращает число записанных событий. Недоступность БД (TRANSIENT_ERRORS)
+        прерывает перенос, а при другой ошибке пачка пишется по одному и события,
+        которые БД не принимает, уходят в карантин - иначе сегмент повторялся бы бесконечно
+        """
+        try:
+            self.write_batch(batch)
+            written = len(batch)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка переноса пачки из {len(batch)} событий из {path}: {e}; пишем по одному")
+            written = 0
+            for event_data in batch:
+                try:
+                    self.write_batch([event_data])
+                    written += 1
+                except TRANSIENT_ERRORS:
+                    raise
+                except Exception as event_error:
+                    self._quarantine(path, event_data, event_error)
+        with self._lock:
+            self._replayed += written
+        return written
+
+    def _quarantine(self, path: str, event_data: Any, error: Exception):
+        record = {
+            'quarantined_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'segment': os.path.basename(path),
+            'error': str(error),
+            'event': event_data,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+        # Карантин общий для воркеров: запись целой строкой под блокировкой
+        with open(os.path.join(self.directory, QUARANTINE_FILE), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._skipped_lines += 1
+            self._quarantined += 1
+        event_id = event_data.get('id', event_data.get('eventId')) if isinstance(event_data, dict) else None
+        logger.error(f"Событие {event_id} из {path} отложено в карантин {QUARANTINE_FILE}: {error}")
+
+    def replay_all(self) -> int:
+        """Переносит все доступные сегменты; при ошибке БД бросает исключение"""
+        if self.probe is not None:
+            self.probe()
+        if self.spool is not None:
+            # Свой активный сегмент тоже отдаём на перенос
+            self.spool.rotate()
+
+        started = time.monotonic()
+        total = 0
+        for path in list_segments(self.directory):
+            if self._stop.is_set():
+                break
+            replayed = self.replay_segment(path)
+            if replayed > 0:
+                total += replayed
+
+        elapsed = time.monotonic() - started
+        if total:
+            rate = total / elapsed if elapsed > 0 else 0.0
+            with self._lock:
+                self._last_replay_rate = round(rate, 1)
+            logger.info(f"Из spool перенесено в БД событий: {total} ({rate:.0f} событий/сек)")
+        return total
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            if not list_segments(self.directory):
+                continue
+            try:
+                self.replay_all()
+                with self._lock:
+                    self._last_error = None
+            except Exception as e:
+                # БД ещё недоступна (другие ошибки событий уходят в карантин) - попробуем в следующий раз
+                with self._lock:
+                    self._last_error = str(e)
+                logger.warning(f"Перенос spool в БД не удался: {e}")
+
+    def start(self, interval: float = 5):
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name='spool-replayer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'replayed': self._replayed,
+                'skipped_lines': self._skipped_lines,
+                'quarantined': self._quarantined,
+                'last_replay_rate': self._last_replay_rate,
+                'last_error': self._last_error,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['stats', 'replay'])
+    parser.add_argument('--dir', default=SPOOL_DIR, help='Каталог spool (по умолчанию SPOOL_DIR)')
+    parser.add_argument('--batch-size', type=int, default=SPOOL_REPLAY_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if not args.dir:
+        parser.error("Не задан каталог spool: --dir или SPOOL_DIR")
+
+    if args.command == 'stats':
+        print(json.dumps(pending_stats(args.dir), indent=2))
+        return
+
+    configure_logging()
+    # Импорт здесь, чтобы `spool.py stats` работал без Flask и БД
+    from webhook_listener import save_change_events
+
+    replayer = SpoolReplayer(args.dir, save_change_events, batch_size=args.batch_size)
+    started = time.monotonic()
+    total = replayer.replay_all()
+    elapsed = time.monotonic() - started
+    print(f"Перенесено событий: {total} за {elapsed:.1f} сек")
+    quarantined = replayer.stats()['quarantined']
+    if quarantined:
+        print(f"Отложено в карантин ({os.path.join(args.dir, QUARANTINE_FILE)}): {quarantined}")
+    left = pending_stats(args.dir)
+    if left['pending_segments']:
+        print(f"Осталось сегментов (заняты другими процессами): {left['pending_segments']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@
 
 import requests
 import json
+import uuid
 from datetime import datetime
 import sys
 
@@ -180,20 +181,77 @@ def check_saved_events():
         return False
 
 
+def check_retry_without_timestamp():
+    """
+    Повторная доставка события без timestamp не должна дать второй записи:
+    время берётся из entity.updatedAt, а без него - из уже записанной копии event_id.
+    Событие с id совсем без времени по-прежнему принимается и записывается
+    """
+    entity_id = str(uuid.uuid4())
+    event_data = {
+        "id": f"test-event-no-timestamp-{entity_id}",
+        "eventType": "entityUpdated",
+        "entityType": "table",
+        "entityId": entity_id,
+        "userName": "test_user@example.com",
+        "entity": {
+            "id": entity_id,
+            "type": "table",
+            "name": "retry_table",
+            "fullyQualifiedName": "sample_database.sample_schema.retry_table",
+            "updatedAt": 1700000000000
+        },
+        "currentVersion": 0.2
+    }
+    try:
+        for attempt in (1, 2):
+            response = requests.post(WEBHOOK_URL, json=event_data, timeout=10)
+            if response.status_code not in (200, 202):
+                print(f" Доставка {attempt}: статус {response.status_code}, {response.text}")
+                return False
+
+        response = requests.get("http://localhost:5000/events",
+                                params={"entity_id": entity_id}, timeout=5)
+        count = response.json().get('count', 0)
+        print(f" Событие без timestamp доставлено дважды, записей: {count}")
+        if count != 1:
+            return False
+
+        other_id = str(uuid.uuid4())
+        event_data["id"] = f"test-event-no-time-{other_id}"
+        event_data["entityId"] = other_id
+        event_data["entity"]["id"] = other_id
+        del event_data["entity"]["updatedAt"]
+        for attempt in (1, 2):
+            response = requests.post(WEBHOOK_URL, json=event_data, timeout=10)
+            if response.status_code not in (200, 202):
+                print(f" Событие с id без времени, доставка {attempt}: статус {response.status_code}")
+                return False
+
+        response = requests.get("http://localhost:5000/events",
+                                params={"entity_id": other_id}, timeout=5)
+        count = response.json().get('count', 0)
+        print(f" Событие с id без времени доставлено дважды, записей: {count}")
+        return count == 1
+    except Exception as e:
+        print(f" Ошибка: {e}")
+        return False
+
+
 def main():
     print("=" * 60)
     print(" Тестирование OpenMetadata Webhook Listener")
     print("=" * 60)
     
     # Шаг 1: Проверка работоспособности
-    print("\n[1/4] Проверка работоспособности сервиса...")
+    print("\n[1/5] Проверка работоспособности сервиса...")
     if not check_health():
         print("\n  Сервис не запущен. Запустите его командой:")
         print("   python webhook_listener.py")
         sys.exit(1)
     
     # Шаг 2: Отправка тестовых событий
-    print("\n[2/4] Отправка тестовых событий...")
+    print("\n[2/5] Отправка тестовых событий...")
     
     success_count = 0
     events_to_test = ["entityCreated", "entityUpdated", "entityDeleted"]
@@ -205,11 +263,17 @@ def main():
     print(f"\n   Успешно отправлено: {success_count}/{len(events_to_test)}")
     
     # Шаг 3: Проверка сохранённых событий
-    print("\n[3/4] Проверка сохранённых событий...")
+    print("\n[3/5] Проверка сохранённых событий...")
     check_saved_events()
-    
-    # Шаг 4: Итоги
-    print("\n[4/4] Результаты тестирования")
+
+    # Шаг 4: Повторная доставка события без timestamp
+    print("\n[4/5] Повторная доставка события без timestamp...")
+    if check_retry_without_timestamp():
+        success_count += 1
+    events_to_test.append("retry_without_timestamp")
+
+    # Шаг 5: Итоги
+    print("\n[5/5] Результаты тестирования")
     print("=" * 60)
     
     if success_count == len(events_to_test):
@@ -143,6 +143,35 @@ ORDER BY e.event_time DESC
 LIMIT 20;
 
 
+\echo '\n=== ПОИСК ПО ИСТОРИИ (индексы /search) ==='
+
+-- Колонка ssn получила тег PII.Sensitive (GIN по JSON нового значения)
+SELECT
+    e.entity_fqn,
+    e.updated_by,
+    f.event_time,
+    f.new_value as new_tags
+FROM field_changes f
+JOIN metadata_change_events e ON e.event_id = f.event_id AND e.event_time = f.event_time
+WHERE f.field_name = 'columns.ssn.tags'
+  AND history_try_jsonb(f.new_value) @> '[{"tagFQN": "PII.Sensitive"}]'
+ORDER BY f.event_time DESC
+LIMIT 20;
+
+-- Изменения, где встречаются слова (точки заменяются пробелами, как в индексе)
+SELECT f.event_time, f.event_id, f.field_name, SUBSTRING(f.new_value, 1, 80) as new_value
+FROM field_changes f
+WHERE f.search_vector @@ websearch_to_tsquery('simple', translate('ssn "PII.Sensitive"', '.', ' '))
+ORDER BY f.event_time DESC
+LIMIT 20;
+
+-- Текущие сущности с колонкой ssn под тегом PII.Sensitive
+SELECT entity_fqn, last_updated_by, last_event_time
+FROM entity_current_state
+WHERE snapshot @> '{"columns": [{"name": "ssn", "tags": [{"tagFQN": "PII.Sensitive"}]}]}'
+  AND NOT is_deleted;
+
+
 \echo '\n=== УДАЛЁННЫЕ СУЩНОСТИ ==='
 
 -- Все удалённые сущности
@@ -168,7 +197,7 @@ ORDER BY deleted_count DESC;
 
 \echo '\n=== АКТИВНОСТЬ ПО ДНЯМ ==='
 
--- События по дням за последний месяц
+-- События по дням за последний месяц (быстрый вариант без уникальных - rollup_daily_activity)
 SELECT 
     DATE(event_time) as date,
     COUNT(*) as events_count,
@@ -182,7 +211,7 @@ ORDER BY date DESC;
 
 \echo '\n=== АКТИВНОСТЬ ПО ЧАСАМ ==='
 
--- Пиковые часы активности
+-- Пиковые часы активности (быстрый вариант - rollup_peak_hours)
 SELECT 
     EXTRACT(HOUR FROM event_time) as hour,
     COUNT(*) as events_count
@@ -316,56 +345,177 @@ WHERE entity_type IS NOT NULL
 GROUP BY entity_type;
 
 
+\echo '\n=== БЫСТРАЯ СТАТИСТИКА ПО АГРЕГАТАМ ==='
+
+-- Представления ниже читают event_rollups (обновляется при приёме, см. rollups.py)
+-- и entity_current_state вместо GROUP BY по всей истории. Уникальные сущности и
+-- пользователи по дням в агрегатах не хранятся - для них остаются запросы выше.
+-- Пересчёт агрегатов по накопленным событиям: python rollups.py rebuild
+
+-- View: События по дням
+CREATE OR REPLACE VIEW rollup_daily_activity AS
+SELECT
+    bucket::date as date,
+    SUM(event_count) as events_count
+FROM event_rollups
+WHERE granularity = 'day' AND dimension = 'total'
+GROUP BY bucket;
+
+-- View: События по часу суток за последние 7 дней
+CREATE OR REPLACE VIEW rollup_peak_hours AS
+SELECT
+    EXTRACT(HOUR FROM bucket) as hour,
+    SUM(event_count) as events_count
+FROM event_rollups
+WHERE granularity = 'hour' AND dimension = 'total'
+  AND bucket > NOW() - INTERVAL '7 days'
+GROUP BY EXTRACT(HOUR FROM bucket);
+
+-- View: Изменения по пользователям
+CREATE OR REPLACE VIEW rollup_user_stats AS
+SELECT
+    value as updated_by,
+    SUM(event_count) as total_changes,
+    COUNT(DISTINCT bucket) as active_days,
+    MIN(bucket) as first_activity_day,
+    MAX(bucket) as last_activity_day
+FROM event_rollups
+WHERE granularity = 'day' AND dimension = 'updated_by'
+GROUP BY value;
+
+-- View: Статистика по типам сущностей (из текущего состояния, по всей истории)
+CREATE OR REPLACE VIEW rollup_entity_type_stats AS
+SELECT
+    entity_type,
+    COUNT(*) as unique_entities,
+    SUM(change_count) as total_changes,
+    MAX(last_event_time) as last_change
+FROM entity_current_state
+WHERE entity_type IS NOT NULL
+GROUP BY entity_type;
+
+-- Пример: самые изменяемые поля за месяц
+-- SELECT value as field_name, SUM(event_count) as change_count FROM event_rollups
+-- WHERE granularity = 'day' AND dimension = 'field_name' AND bucket > NOW() - INTERVAL '30 days'
+-- GROUP BY value ORDER BY change_count DESC LIMIT 20;
+
+-- Пример: изменения по базам сервиса mysql_prod за месяц (разрез fqn_2, FQN_ROLLUP_DEPTH)
+-- SELECT value as database_fqn, SUM(event_count) as event_count FROM event_rollups
+-- WHERE granularity = 'day' AND dimension = 'fqn_2' AND starts_with(value, 'mysql_prod.')
+--   AND bucket > NOW() - INTERVAL '30 days'
+-- GROUP BY value ORDER BY event_count DESC;
+
+-- Пример: последние события поддерева mysql_prod.sales - диапазон по индексу fqn_path
+-- (E'\x01' - наименьший символ: граница сразу за всеми путями, начинающимися с {mysql_prod,sales})
+-- SELECT event_time, event_type, entity_fqn, updated_by FROM metadata_change_events
+-- WHERE fqn_path >= ARRAY['mysql_prod', 'sales'] AND fqn_path < ARRAY['mysql_prod', E'sales\x01']
+-- ORDER BY event_time DESC LIMIT 50;
+
+
 \echo '\n=== ОЧИСТКА СТАРЫХ ДАННЫХ ==='
 
--- Функция для очистки событий старше N дней
-CREATE OR REPLACE FUNCTION cleanup_old_events(days_to_keep INTEGER DEFAULT 90)
+-- Функция для очистки событий старше N месяцев: удаляет целые месячные партиции
+-- (DROP TABLE вместо построчного DELETE - без раздувания таблиц и долгих блокировок).
+-- То же самое делает сервис при PARTITION_RETENTION_MONTHS и `python partitions.py drop`.
+-- Удалённая история пропадает; чтобы сохранить её для аудита, перенесите месяцы
+-- в архив Parquet: `python archive.py run --after-months N` (ARCHIVE_DIR)
+DROP FUNCTION IF EXISTS cleanup_old_events(INTEGER);
+CREATE OR REPLACE FUNCTION cleanup_old_events(months_to_keep INTEGER DEFAULT 3)
 RETURNS TABLE (
-    deleted_events BIGINT,
-    deleted_field_changes BIGINT
+    dropped_partition TEXT,
+    approx_rows BIGINT
 ) AS $$
 DECLARE
-    v_deleted_events BIGINT;
-    v_deleted_changes BIGINT;
-    cutoff_date TIMESTAMP;
+    cutoff_month DATE;
+    part RECORD;
+    removed_blobs BIGINT;
 BEGIN
-    cutoff_date := NOW() - (days_to_keep || ' days')::INTERVAL;
-    
-    -- Удаляем field_changes для старых событий
-    DELETE FROM field_changes
-    WHERE event_id IN (
-        SELECT event_id FROM metadata_change_events
-        WHERE event_time < cutoff_date
-    );
-    GET DIAGNOSTICS v_deleted_changes = ROW_COUNT;
-    
-    -- Удаляем старые события
-    DELETE FROM metadata_change_events
-    WHERE event_time < cutoff_date;
-    GET DIAGNOSTICS v_deleted_events = ROW_COUNT;
-    
-    RETURN QUERY SELECT v_deleted_events, v_deleted_changes;
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table
+                   WHERE partrelid = 'metadata_change_events'::regclass) THEN
+        RAISE EXCEPTION 'metadata_change_events не секционирована, выполните: python partitions.py migrate';
+    END IF;
+
+    cutoff_month := date_trunc('month', NOW()) - (months_to_keep || ' months')::INTERVAL;
+
+    -- Сначала партиции field_changes, затем событий того же месяца
+    FOR part IN
+        SELECT c.relname, c.reltuples::BIGINT AS reltuples
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent IN ('field_changes'::regclass, 'metadata_change_events'::regclass)
+          AND c.relname ~ '_p\d{4}_\d{2}$'
+          AND to_date(right(c.relname, 7), 'YYYY_MM') < cutoff_month
+        ORDER BY right(c.relname, 7), i.inhparent = 'metadata_change_events'::regclass
+    LOOP
+        -- entity событий партиции в payload_blobs (PAYLOAD_STORAGE=blob|patch) теряют ссылки
+        IF part.relname LIKE 'metadata_change_events%' THEN
+            EXECUTE format('UPDATE payload_blobs b SET refcount = b.refcount - r.n
+                            FROM (SELECT entity_hash, count(*) AS n FROM %I
+                                  WHERE entity_hash IS NOT NULL GROUP BY entity_hash) r
+                            WHERE b.hash = r.entity_hash', part.relname);
+        END IF;
+        EXECUTE format('DROP TABLE %I', part.relname);
+        dropped_partition := part.relname;
+        approx_rows := GREATEST(part.reltuples, 0);
+        RETURN NEXT;
+    END LOOP;
+
+    -- Строки вне месячных партиций
+    DELETE FROM field_changes_default WHERE event_time < cutoff_month;
+    WITH deleted AS (
+        DELETE FROM metadata_change_events_default WHERE event_time < cutoff_month
+        RETURNING entity_hash
+    )
+    UPDATE payload_blobs b SET refcount = b.refcount - r.n
+    FROM (SELECT entity_hash, count(*) AS n FROM deleted
+          WHERE entity_hash IS NOT NULL GROUP BY entity_hash) r
+    WHERE b.hash = r.entity_hash;
+
+    -- blob'ы без ссылок; освободившиеся базы patch'ей - следующими проходами
+    LOOP
+        WITH removed AS (
+            DELETE FROM payload_blobs WHERE refcount <= 0 RETURNING base_hash
+        ), bases AS (
+            UPDATE payload_blobs b SET refcount = b.refcount - r.n
+            FROM (SELECT base_hash, count(*) AS n FROM removed
+                  WHERE base_hash IS NOT NULL GROUP BY base_hash) r
+            WHERE b.hash = r.base_hash
+            RETURNING 1
+        )
+        SELECT count(*) INTO removed_blobs FROM removed;
+        EXIT WHEN removed_blobs = 0;
+    END LOOP;
 END;
 $$ LANGUAGE plpgsql;
 
--- Пример: удалить события старше 180 дней
--- SELECT * FROM cleanup_old_events(180);
+-- Пример: оставить последние 6 полных месяцев и текущий
+-- SELECT * FROM cleanup_old_events(6);
 
 
-\echo '\n=== ИНДЕКСЫ ДЛЯ ОПТИМИЗАЦИИ ==='
+\echo '\n=== ПОВТОРЫ В FIELD_CHANGES ==='
 
--- Дополнительные индексы для ускорения запросов
-CREATE INDEX IF NOT EXISTS idx_event_time_desc 
-    ON metadata_change_events(event_time DESC);
+-- Раньше изменения полей записывались и при повторной доставке уже сохранённого события.
+-- Удаляет такие копии, оставляя первую строку каждого (событие, поле, значения).
+-- Читает всю field_changes - запускайте вручную, в спокойное время:
+-- DELETE FROM field_changes f
+-- USING (
+--     SELECT id, event_time FROM (
+--         SELECT id, event_time, row_number() OVER (
+--             PARTITION BY event_id, event_time, field_name, change_type, old_value, new_value
+--             ORDER BY id) AS n
+--         FROM field_changes
+--     ) numbered
+--     WHERE n > 1
+-- ) duplicate
+-- WHERE f.id = duplicate.id AND f.event_time = duplicate.event_time;
 
-CREATE INDEX IF NOT EXISTS idx_entity_type_fqn 
-    ON metadata_change_events(entity_type, entity_fqn);
 
-CREATE INDEX IF NOT EXISTS idx_updated_by_time 
-    ON metadata_change_events(updated_by, event_time);
+\echo '\n=== ИНДЕКСЫ ДЛЯ ОПТИМИЗАЦИИ ==='
 
-CREATE INDEX IF NOT EXISTS idx_field_changes_name 
-    ON field_changes(field_name, change_type);
+-- Индексы создаёт сервис (migrations.py, CREATE INDEX CONCURRENTLY без остановки приёма):
+-- idx_entity_type_fqn (entity_type, entity_fqn), idx_field_changes_name_type (field_name, change_type).
+-- Сортировку по event_time и выборки по updated_by покрывают индексы /events
+-- (idx_events_time_id, idx_events_updated_by_time). Состояние: python migrations.py status
 
 
 \echo '\n=== ГОТОВО ==='
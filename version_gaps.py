@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Пропуски в цепочке версий сущностей (потерянные webhook'и)
+Событие несёт previous_version и current_version: если события с current_version, равной
+previous_version, у сущности нет, между последней сохранённой версией и этим событием
+что-то потеряно. Такие пропуски записываются в version_gaps.
+
+Проверка инкрементальная: новые события читаются по позиции потока (txid, id), как
+/events/stream, - только завершённые транзакции, так что поздний commit не пропускается.
+На каждое событие - проверка по индексу (entity_id, current_version) без просмотра таблицы;
+версии внутри прочитанной порции сверяются в памяти. Событие, пришедшее позже (ретрай,
+spool), закрывает свой пропуск (status = filled). Первые события сущности, которых
+сервис не видел (webhook подключили к уже существующей сущности), по умолчанию пропуском
+не считаются (VERSION_GAP_INCLUDE_START). События до появления колонки txid не проверяются.
+
+Дозаполнение: версии из пропуска берутся из OpenMetadata
+(GET /api/v1/<коллекция>/<id>/versions) и записываются как обычные события
+(id backfill-<entity_id>-<версия>) через write_events; пропуск получает status = backfilled.
+
+В сервисе проверка идёт фоновым потоком раз в VERSION_GAP_SCAN_INTERVAL секунд
+(одновременно - в одном воркере, advisory lock), /gaps показывает пропуски. Вручную:
+    python version_gaps.py scan
+    python version_gaps.py scan --from-head          # начать с конца потока, без накопленной истории
+    python version_gaps.py backfill --limit 100
+    python version_gaps.py list --status open
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from psycopg2.extras import execute_values
+
+from change_stream import _AFTER_CONDITION, _HEAD_SQL
+from event_parser import parse_event
+from log_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять новые события, сек (0 - только вручную: python version_gaps.py scan)
+VERSION_GAP_SCAN_INTERVAL = float(os.getenv('VERSION_GAP_SCAN_INTERVAL', 60))
+# Событий за один шаг проверки (одна транзакция)
+VERSION_GAP_BATCH_SIZE = int(os.getenv('VERSION_GAP_BATCH_SIZE', 5000))
+# Считать пропуском версии до первого сохранённого события сущности
+VERSION_GAP_INCLUDE_START = os.getenv('VERSION_GAP_INCLUDE_START', '0') == '1'
+# Дозаполнять пропуски из OpenMetadata после проверки (нужен OPENMETADATA_URL)
+VERSION_GAP_BACKFILL = os.getenv('VERSION_GAP_BACKFILL', '0') == '1'
+# Попыток дозаполнения одного пропуска
+VERSION_GAP_MAX_ATTEMPTS = int(os.getenv('VERSION_GAP_MAX_ATTEMPTS', 5))
+# API OpenMetadata: адрес (например, http://openmetadata:8585), JWT бота, таймаут запроса, сек
+OPENMETADATA_URL = os.getenv('OPENMETADATA_URL', '')
+OPENMETADATA_TOKEN = os.getenv('OPENMETADATA_TOKEN', '')
+OPENMETADATA_TIMEOUT = float(os.getenv('OPENMETADATA_TIMEOUT', 10))
+
+GAP_STATUSES = ('open', 'filled', 'backfilled', 'failed')
+
+GAPS_DDL = """
+    CREATE TABLE IF NOT EXISTS version_gaps (
+        entity_id VARCHAR(255) NOT NULL,
+        missing_version DECIMAL NOT NULL,   -- previous_version события после пропуска
+        known_version DECIMAL,              -- последняя сохранённая версия до пропуска
+        next_version DECIMAL NOT NULL,
+        next_event_id VARCHAR(255),
+        next_event_time TIMESTAMP,
+        entity_type VARCHAR(100),
+        entity_fqn TEXT,
+        status VARCHAR(20) NOT NULL DEFAULT 'open',
+        detected_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        resolved_at TIMESTAMP,
+        attempts INT NOT NULL DEFAULT 0,
+        backfilled INT NOT NULL DEFAULT 0,
+        error TEXT,
+        PRIMARY KEY (entity_id, missing_version)
+    );
+    CREATE INDEX IF NOT EXISTS idx_version_gaps_status ON version_gaps(status, detected_at);
+
+    -- Позиция проверки в потоке событий (txid, id)
+    CREATE TABLE IF NOT EXISTS version_gap_scan (
+        name VARCHAR(50) PRIMARY KEY,
+        txid xid8 NOT NULL,
+        last_id BIGINT NOT NULL,
+        scanned BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Сохранённые версии сущности, строится online-миграцией
+GAPS_INDEX = ('idx_events_entity_version', 'metadata_change_events', '(entity_id, current_version)')
+
+# Ключ advisory lock: проверкой в каждый момент занимается один процесс
+_LOCK_KEY = 'om_history_version_gaps'
+
+# Сохранённые версии кандидатов: есть ли пропущенная и какая последняя до неё
+_PROBE_SQL = """
+    SELECT c.entity_id, c.missing_version,
+           EXISTS (SELECT 1 FROM metadata_change_events e
+                   WHERE e.entity_id = c.entity_id AND e.current_version = c.missing_version),
+           (SELECT max(e.current_version) FROM metadata_change_events e
+            WHERE e.entity_id = c.entity_id AND e.current_version < c.missing_version)
+    FROM (VALUES %s) AS c (entity_id, missing_version)
+"""
+
+GAP_COLUMNS = ('entity_id', 'entity_type', 'entity_fqn', 'known_version', 'missing_version', 'next_version',
+               'next_event_id', 'next_event_time', 'status', 'detected_at', 'resolved_at', 'attempts',
+               'backfilled', 'error')
+
+# Коллекции API OpenMetadata, которые не получаются добавлением 's' к типу
+_COLLECTIONS = {
+    'glossary': 'glossaries',
+    'policy': 'policies',
+    'query': 'queries',
+    'dashboardDataModel': 'dashboard/datamodels',
+    'testCase': 'dataQuality/testCases',
+    'testSuite': 'dataQuality/testSuites',
+}
+
+
+def _version(value: Any) -> Optional[Decimal]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        version = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return version if version.is_finite() else None
+
+
+def scan_step(conn, limit: int = VERSION_GAP_BATCH_SIZE, include_start: bool = VERSION_GAP_INCLUDE_START,
+              archive=None) -> Optional[Dict[str, int]]:
+    """
+    Проверяет следующую порцию событий после сохранённой позиции (одна транзакция).
+    Возвращает {'scanned', 'gaps', 'filled'} или None, если проверку уже ведёт другой процесс
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return None
+        cursor.execute("SELECT txid::text, last_id FROM version_gap_scan WHERE name = 'events'")
+        row = cursor.fetchone()
+        # xid8 из int не приводится - позиция передаётся строкой, как в change_stream
+        txid, last_id = row if row else ('0', 0)
+
+        cursor.execute(f"""
+            SELECT txid::text, id, entity_id, entity_type, entity_fqn, event_id, event_time,
+                   previous_version, current_version
+            FROM metadata_change_events
+            WHERE {_AFTER_CONDITION} AND txid < pg_snapshot_xmin(pg_current_snapshot())
+            ORDER BY txid, id
+            LIMIT %s
+        """, (txid, txid, last_id, limit))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            return {'scanned': 0, 'gaps': 0, 'filled': 0}
+
+        # Версии порции: пропуск, закрытый событием этой же порции, в БД не проверяется
+        seen = {(row[2], row[8]) for row in rows if row[2] is not None and row[8] is not None}
+        candidates = {}
+        for _, _, entity_id, entity_type, entity_fqn, event_id, event_time, previous, current in rows:
+            if entity_id is None or previous is None or current is None or previous >= current:
+                continue
+            if (entity_id, previous) in seen:
+                continue
+            key = (entity_id, previous)
+            # Одна и та же пропущенная версия - один пропуск (с самым ранним следующим событием)
+            if key not in candidates or current < candidates[key][3]:
+                candidates[key] = (entity_type, entity_fqn, previous, current, event_id, event_time)
+
+        gaps = []
+        if candidates:
+            probes = execute_values(cursor, _PROBE_SQL, list(candidates), template="(%s, %s::numeric)",
+                                    page_size=len(candidates), fetch=True)
+            for entity_id, missing, present, known in probes:
+                if present or (known is None and not include_start):
+                    continue
+                if archive is not None and archive.find_target(entity_id, version=missing) is not None:
+                    continue
+                entity_type, entity_fqn, _, current, event_id, event_time = candidates[(entity_id, missing)]
+                gaps.append((entity_id, missing, known, current, event_id, event_time, entity_type, entity_fqn))
+        if gaps:
+            execute_values(cursor, """
+                INSERT INTO version_gaps (entity_id, missing_version, known_version, next_version,
+                                          next_event_id, next_event_time, entity_type, entity_fqn)
+                VALUES %s
+                ON CONFLICT (entity_id, missing_version) DO NOTHING
+            """, sorted(gaps), page_size=len(gaps))
+
+        # Пропущенная версия пришла позже (ретрай, spool) - пропуск закрыт
+        filled = execute_values(cursor, """
+            UPDATE version_gaps g SET status = 'filled', resolved_at = CURRENT_TIMESTAMP, error = NULL
+            FROM (VALUES %s) AS n (entity_id, version)
+            WHERE g.entity_id = n.entity_id AND g.missing_version = n.version AND g.status IN ('open', 'failed')
+            RETURNING 1
+        """, sorted(seen), template="(%s, %s::numeric)", page_size=max(len(seen), 1), fetch=True) if seen else []
+
+        last = rows[-1]
+        cursor.execute("""
+            INSERT INTO version_gap_scan (name, txid, last_id, scanned) VALUES ('events', %s::xid8, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET txid = EXCLUDED.txid, last_id = EXCLUDED.last_id,
+                scanned = version_gap_scan.scanned + EXCLUDED.scanned, updated_at = CURRENT_TIMESTAMP
+        """, (last[0], last[1], len(rows)))
+        conn.commit()
+        return {'scanned': len(rows), 'gaps': len(gaps), 'filled': len(filled)}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def skip_to_head(conn) -> Optional[str]:
+    """Переносит позицию проверки в конец потока: накопленная история не проверяется"""
+    cursor = conn.cursor()
+    cursor.execute(_HEAD_SQL)
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.execute("""
+            INSERT INTO version_gap_scan (name, txid, last_id) VALUES ('events', %s::xid8, %s)
+            ON CONFLICT (name) DO UPDATE SET txid = EXCLUDED.txid, last_id = EXCLUDED.last_id,
+                updated_at = CURRENT_TIMESTAMP
+        """, row)
+    conn.commit()
+    cursor.close()
+    return f"{row[0]}-{row[1]}" if row else None
+
+
+def scan(conn, limit: int = VERSION_GAP_BATCH_SIZE, include_start: bool = VERSION_GAP_INCLUDE_START,
+         archive=None) -> Dict[str, int]:
+    """Проверяет все новые события порциями по limit; итог - суммы по шагам"""
+    totals = {'scanned': 0, 'gaps': 0, 'filled': 0}
+    while True:
+        result = scan_step(conn, limit, include_start, archive)
+        if result is None:
+            break
+        for name, value in result.items():
+            totals[name] += value
+        if result['scanned'] < limit:
+            break
+    return totals
+
+
+class OpenMetadataClient:
+    """Версии сущности из API OpenMetadata"""
+
+    def __init__(self, base_url: str = OPENMETADATA_URL, token: str = OPENMETADATA_TOKEN,
+                 timeout: float = OPENMETADATA_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    @staticmethod
+    def collection(entity_type: str) -> str:
+        if entity_type in _COLLECTIONS:
+            return _COLLECTIONS[entity_type]
+        if entity_type.endswith('Service'):
+            return f'services/{entity_type}s'
+        return f'{entity_type}s'
+
+    def versions(self, entity_type: str, entity_id: str) -> List[Dict[str, Any]]:
+        """Все версии сущности (entity каждой версии)"""
+        response = self.session.get(f"{self.base_url}/api/v1/{self.collection(entity_type)}/{entity_id}/versions",
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        # Версии приходят JSON-строками, от новой к старой
+        return [json.loads(version) if isinstance(version, str) else version
+                for version in response.json().get('versions') or []]
+
+
+def version_events(gap: Dict[str, Any], versions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """События OpenMetadata для версий пропуска: (known_version, missing_version]"""
+    known, missing = gap['known_version'], gap['missing_version']
+    chain = sorted((_version(entity.get('version')), entity) for entity in versions
+                   if _version(entity.get('version')) is not None)
+    events = []
+    previous = None
+    for version, entity in chain:
+        if (known is None or version > known) and version <= missing:
+            change = entity.get('changeDescription') or {}
+            previous_version = change.get('previousVersion', previous)
+            events.append({
+                'id': f"backfill-{gap['entity_id']}-{version}",
+                'eventType': 'entityUpdated' if previous_version is not None else 'entityCreated',
+                'entityType': gap['entity_type'],
+                'entityId': gap['entity_id'],
+                'entityFQN': entity.get('fullyQualifiedName') or gap['entity_fqn'],
+                'timestamp': entity.get('updatedAt'),
+                'userName': entity.get('updatedBy'),
+                'previousVersion': float(previous_version) if previous_version is not None else None,
+                'currentVersion': float(version),
+                'changeDescription': change,
+                'entity': entity,
+            })
+        previous = version
+    return events
+
+
+def backfill(conn, client: OpenMetadataClient, write_events: Callable,
+             limit: int = 100, max_attempts: int = VERSION_GAP_MAX_ATTEMPTS) -> Dict[str, int]:
+    """
+    Дозаполняет открытые пропуски (не больше limit), каждый - своей транзакцией вместе
+    с записью событий. write_events - webhook_listener.write_events
+    """
+    totals = {'backfilled': 0, 'events': 0, 'failed': 0}
+    cursor = conn.cursor()
+    for _ in range(limit):
+        # Пропуск, который дозаполняет другой процесс, пропускается (SKIP LOCKED)
+        cursor.execute(f"""
+            SELECT {', '.join(GAP_COLUMNS)} FROM version_gaps
+            WHERE status IN ('open', 'failed') AND attempts < %s
+            ORDER BY detected_at, entity_id, missing_version
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """, (max_attempts,))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            break
+        gap = dict(zip(GAP_COLUMNS, row))
+        try:
+            events = version_events(gap, client.versions(gap['entity_type'], gap['entity_id']))
+            if not events:
+                raise LookupError(f"OpenMetadata не вернул версий ({gap['known_version']}, {gap['missing_version']}]")
+            new_events = write_events(cursor, [parse_event(event_data) for event_data in events])
+        except (requests.RequestException, ValueError, LookupError) as e:
+            cursor.execute("""
+                UPDATE version_gaps SET status = 'failed', attempts = attempts + 1, error = %s
+                WHERE entity_id = %s AND missing_version = %s
+            """, (str(e)[:1000], gap['entity_id'], gap['missing_version']))
+            conn.commit()
+            totals['failed'] += 1
+            logger.warning("Пропуск %s (версия %s) не дозаполнен: %s", gap['entity_id'], gap['missing_version'], e)
+            continue
+        cursor.execute("""
+            UPDATE version_gaps SET status = 'backfilled', resolved_at = CURRENT_TIMESTAMP,
+                attempts = attempts + 1, backfilled = %s, error = NULL
+            WHERE entity_id = %s AND missing_version = %s
+        """, (len(new_events), gap['entity_id'], gap['missing_version']))
+        conn.commit()
+        totals['backfilled'] += 1
+        totals['events'] += len(new_events)
+    cursor.close()
+    return totals
+
+
+def list_gaps(cursor, status: Optional[str] = None, entity_id: Optional[str] = None,
+              entity_type: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    """Пропуски по фильтрам, новые первыми"""
+    conditions, params = [], []
+    for column, value in (('status', status), ('entity_id', entity_id), ('entity_type', entity_type)):
+        if value:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor.execute(f"""
+        SELECT {', '.join(GAP_COLUMNS)} FROM version_gaps {where}
+        ORDER BY detected_at DESC, entity_id, missing_version DESC
+        LIMIT %s
+    """, params + [limit])
+    return [dict(zip(GAP_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def gap_summary(cursor) -> Dict[str, Any]:
+    """Число пропусков по статусам и позиция проверки"""
+    cursor.execute("SELECT status, count(*) FROM version_gaps GROUP BY status")
+    counts = {status: 0 for status in GAP_STATUSES}
+    counts.update(dict(cursor.fetchall()))
+    cursor.execute("SELECT txid::text, last_id, scanned, updated_at FROM version_gap_scan WHERE name = 'events'")
+    row = cursor.fetchone()
+    return {
+        'counts': counts,
+        'scan': {'position': f"{row[0]}-{row[1]}", 'scanned': row[2], 'updated_at': row[3]} if row else None,
+    }
+
+
+class GapDetector:
+    """Фоновый поток: раз в interval секунд проверяет новые события и дозаполняет пропуски"""
+
+    def __init__(self, get_connection, write_events: Callable, interval: float = 60,
+                 client: Optional[OpenMetadataClient] = None, archive=None):
+        self.get_connection = get_connection
+        self.write_events = write_events
+        self.interval = interval
+        self.client = client
+        self.archive = archive
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+        self.last_error = None
+        self.last_result = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='version-gaps', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        try:
+            with self.get_connection() as conn:
+                result = scan(conn, archive=self.archive)
+                if self.client is not None:
+                    result.update(backfill(conn, self.client, self.write_events))
+            if result['gaps']:
+                logger.warning("Найдено пропусков версий: %s", result['gaps'])
+            self.last_result = result
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            logger.warning("Проверка пропусков версий не удалась: %s", e)
+        self.last_run = datetime.utcnow().isoformat()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'last_run': self.last_run, 'last_error': self.last_error, 'last_result': self.last_result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['scan', 'backfill', 'list'])
+    parser.add_argument('--limit', type=int, default=100, help='Пропусков для backfill / list')
+    parser.add_argument('--status', choices=GAP_STATUSES, default=None, help='Фильтр list')
+    parser.add_argument('--from-head', action='store_true',
+                        help='scan: перенести позицию в конец потока, накопленную историю не проверять')
+    parser.add_argument('--include-start', action='store_true', default=VERSION_GAP_INCLUDE_START,
+                        help='Считать пропуском версии до первого события сущности')
+    parser.add_argument('--openmetadata-url', default=OPENMETADATA_URL, help='Адрес API OpenMetadata')
+    args = parser.parse_args()
+
+    configure_logging()
+    from webhook_listener import init_database, write_events, get_archive
+    from db_pool import db_connection
+
+    init_database()
+    with db_connection() as conn:
+        if args.command == 'scan' and args.from_head:
+            print(f"Позиция проверки: {skip_to_head(conn)}")
+        elif args.command == 'scan':
+            result = scan(conn, include_start=args.include_start, archive=get_archive())
+            print(f"Проверено событий: {result['scanned']}, новых пропусков: {result['gaps']}, "
+                  f"закрыто: {result['filled']}")
+        elif args.command == 'backfill':
+            if not args.openmetadata_url:
+                parser.error('Нужен --openmetadata-url или OPENMETADATA_URL')
+            result = backfill(conn, OpenMetadataClient(args.openmetadata_url), write_events, args.limit)
+            print(f"Дозаполнено пропусков: {result['backfilled']} ({result['events']} событий), "
+                  f"не удалось: {result['failed']}")
+        else:
+            cursor = conn.cursor()
+            for gap in list_gaps(cursor, status=args.status, limit=args.limit):
+                print(f"{gap['status']:<10} {gap['entity_id']} {gap['entity_fqn'] or ''}: "
+                      f"{gap['known_version']} -> [{gap['missing_version']}] -> {gap['next_version']}")
+            conn.rollback()
+            cursor.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,313 +3,768 @@ OpenMetadata Webhook Listener Service
 Принимает события изменений из OpenMetadata и сохраняет их в PostgreSQL
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 import logging
-from datetime import datetime
 import os
-from typing import Dict, Any
+import sys
+import atexit
+import heapq
+import itertools
+import signal
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+import metrics
+from event_parser import (
+    ChangeEvent, json_text, parse_event, parse_batch_body, stored_event_time
 )
+from log_config import configure_logging, sample_payload
+from entity_state import upsert_entity_state, get_entity_state
+from payload_store import prepare_blobs, stored_payload, store_blobs, restore_payloads
+import rollups
+from rollups import update_rollups
+import search
+import fqn
+from change_stream import (
+    ChangeFeed, STREAM_CHANNEL, STREAM_NOTIFY, NOTIFY_SQL, STREAM_POLL_INTERVAL,
+    STREAM_MAX_SECONDS, STREAM_HEARTBEAT_SEC, STREAM_FETCH_SIZE, parse_stream_args, fetch_changes, sse_message, sse_position,
+    poll_timeout
+)
+from archive import ArchiveReader, ARCHIVE_DIR
+from entity_order import INGEST_ENTITY_ORDER, lock_entities, count_late
+import version_gaps
+from version_gaps import GapDetector, OpenMetadataClient, VERSION_GAP_SCAN_INTERVAL
+from migrations import SchemaMigrator, migrate
+from dedupe import DedupeCache, SharedKeySet, event_key, DEDUPE_CACHE_SIZE, DEDUPE_SHARED_FILE
+from reconstruct import Reconstructor, EntityNotFound, write_snapshots, RECONSTRUCT_CACHE_SIZE
+from partitions import (
+    PartitionMaintainer, ensure_partitions, is_partitioned, PARTITIONED_TABLES,
+    PARTITION_MAINTENANCE_INTERVAL
+)
+from events_query import (
+    InvalidQuery, build_events_query, encode_cursor, parse_fqn_prefix, parse_limit, _parse_time,
+    EQUALITY_FILTERS
+)
+from db_pool import db_connection, get_pool, DB_CONFIG, TRANSIENT_ERRORS, DB_WRITE_TIMEOUT_MS
+from ingest_queue import (
+    IngestQueue, QueueFull, QueueClosed, INGEST_QUEUE_MAX_SIZE, INGEST_BATCH_SIZE,
+    INGEST_FLUSH_INTERVAL_MS, INGEST_QUEUE_DIR, INGEST_QUEUE_FSYNC, INGEST_QUEUE_SEGMENT_MAX_BYTES,
+    INGEST_DRAIN_TIMEOUT
+)
+from spool import (
+    Spool, SpoolReplayer, SPOOL_DIR, SPOOL_SEGMENT_MAX_BYTES, SPOOL_FSYNC_INTERVAL_MS,
+    SPOOL_REPLAY_INTERVAL, SPOOL_REPLAY_BATCH_SIZE
+)
+
+# Настройка логирования (формат и уровни - из LOG_* переменных окружения)
+configure_logging()
 logger = logging.getLogger(__name__)
+# Строка на каждое принятое/сохранённое событие
+events_logger = logging.getLogger(__name__ + '.events')
+# Полные payload'ы событий - только выборочно (LOG_PAYLOAD_*) или при уровне DEBUG
+payload_logger = logging.getLogger(__name__ + '.payload')
 
 app = Flask(__name__)
 
-# Настройки подключения к БД (можно вынести в .env)
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', '172.24.64.1'),
-    'port': os.getenv('DB_PORT', '5432'),
-    'database': os.getenv('DB_NAME', 'openmetadata_history'),
-    'user': os.getenv('DB_USER', 'postgres'),
-    'password': os.getenv('DB_PASSWORD', 'postgres')
-}
-
 # Секретный ключ для проверки webhook (настраивается в OM)
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', 'your_secret_key')
 
+# Режим приёма: sync - запись в БД до ответа, async - очередь и ответ 202
+INGEST_MODE = os.getenv('INGEST_MODE', 'sync')
 
-def get_db_connection():
-    """Создаёт подключение к PostgreSQL"""
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        logger.error(f"Ошибка подключения к БД: {e}")
-        raise
+# Максимум событий в одном запросе /webhook/batch
+WEBHOOK_BATCH_MAX_EVENTS = int(os.getenv('WEBHOOK_BATCH_MAX_EVENTS', 5000))
+
+# Сколько строк за раз читать с сервера при выгрузке /events/export
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 2000))
 
 
 def init_database():
-    """Инициализация таблиц в БД при первом запуске"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """
+    Схема БД при запуске: обязательные миграции (migrations.py; если схема актуальна - один запрос
+    без DDL) и партиции. Online-миграции (индексы) выполняет фоновый поток get_schema_migrator
+    """
+    pool = get_pool()
+    conn = pool.getconn()
 
     try:
-        # Таблица для хранения событий изменений
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS metadata_change_events (
-                id SERIAL PRIMARY KEY,
-                event_id VARCHAR(255) UNIQUE,
-                event_type VARCHAR(100) NOT NULL,
-                event_time TIMESTAMP NOT NULL,
-                entity_type VARCHAR(100),
-                entity_id VARCHAR(255),
-                entity_fqn TEXT,
-                entity_name VARCHAR(500),
-                change_description TEXT,
-                updated_by VARCHAR(255),
-                previous_version DECIMAL,
-                current_version DECIMAL,
-                full_payload JSONB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        # Индексы для metadata_change_events
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_entity_fqn 
-            ON metadata_change_events(entity_fqn);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_event_type 
-            ON metadata_change_events(event_type);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_event_time 
-            ON metadata_change_events(event_time);
-        """)
-
-        # Таблица для хранения конкретных изменений полей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS field_changes (
-                id SERIAL PRIMARY KEY,
-                event_id VARCHAR(255) REFERENCES metadata_change_events(event_id),
-                field_name VARCHAR(255),
-                old_value TEXT,
-                new_value TEXT,
-                change_type VARCHAR(50),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        # Индексы для field_changes
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_field_changes_event_id 
-            ON field_changes(event_id);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_field_changes_name 
-            ON field_changes(field_name);
-        """)
-
-        # Таблица для софт-удалённых сущностей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS deleted_entities (
-                id SERIAL PRIMARY KEY,
-                entity_id VARCHAR(255) UNIQUE,
-                entity_type VARCHAR(100),
-                entity_fqn TEXT,
-                entity_name VARCHAR(500),
-                deleted_at TIMESTAMP,
-                deleted_by VARCHAR(255),
-                last_snapshot JSONB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-
-        # Индексы для deleted_entities
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_deleted_entity_type 
-            ON deleted_entities(entity_type);
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_deleted_at 
-            ON deleted_entities(deleted_at);
-        """)
+        applied = migrate(conn)
+        cursor = conn.cursor()
+        if all(is_partitioned(cursor, table) for table in PARTITIONED_TABLES):
+            ensure_partitions(conn)
+        else:
+            logger.warning("Таблицы событий не секционированы, удаление старых событий по партициям "
+                           "недоступно. Перевод на партиции: python partitions.py migrate")
 
-        conn.commit()
         cursor.close()
-        conn.close()
-        logger.info("База данных инициализирована успешно")
+        pool.putconn(conn)
+        if applied:
+            logger.info("База данных инициализирована успешно, применены миграции: %s", applied)
+        else:
+            logger.info("База данных инициализирована успешно")
 
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
         conn.rollback()
-        cursor.close()
-        conn.close()
+        pool.putconn(conn)
         raise
 
-def save_change_event(event_data: Dict[str, Any]) -> bool:
-    """Сохраняет событие изменения в БД"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        logger.info(f"event_data keys: {event_data.keys()}")
-        logger.info(f"Full event_data: {event_data}")
-        # Извлекаем основные данные из события
-        event_id = event_data.get('id', event_data.get('eventId'))
-        event_type = event_data.get('eventType')
-        #timestamp = event_data.get('timestamp', datetime.utcnow().isoformat())
-        raw_ts = event_data.get('timestamp')
-
-        if isinstance(raw_ts, (int, float)):
-            # Если это миллисекунды
-            if raw_ts > 10**12:  # значит это ms, не секунды
-                timestamp = datetime.fromtimestamp(raw_ts / 1000).isoformat()
-            else:
-                timestamp = datetime.fromtimestamp(raw_ts).isoformat()
-
-        elif isinstance(raw_ts, str):
-            timestamp = raw_ts  # надеемся, что строка уже ISO
+def insert_field_changes(cursor, rows: List[tuple]):
+    """Вставляет изменения полей (одного или нескольких событий) одним multi-row INSERT"""
+    if not rows:
+        return
+    execute_values(cursor, """
+        INSERT INTO field_changes (event_id, event_time, field_name, old_value, new_value, change_type)
+        VALUES %s
+    """, rows, page_size=len(rows))
 
-        else:
-            timestamp = datetime.utcnow().isoformat()
-
-        # Если entity пришёл как JSON-строка - распарсить
-        entity = event_data.get('entity', {})
-        logger.info(f"Extracted entity: {entity}") #1111111111111111111111111
-        logger.info(f"entity type: {type(entity)}, value: {entity}")
-
-        if not entity or (isinstance(entity, dict) and len(entity) == 0):
-            logger.warning("Entity пустой, используем данные из верхнего уровня event_data")
-            # Создаём псевдо-entity из данных event_data
-            entity = {
-                'type': event_data.get('entityType'),
-                'id': event_data.get('entityId'),
-                'fullyQualifiedName': event_data.get('entityFQN') or event_data.get('entityUrn'),
-                'name': event_data.get('entityName')
-            }
-            logger.info(f"Constructed entity from event_data: {entity}")
-
-        if isinstance(entity, str):
-            try:
-                import json
-                entity = json.loads(entity)
-                logger.info(f"Entity распарсен из строки: {type(entity)}")
-            except:
-                logger.warning(f"Не удалось распарсить entity как JSON, используем пустой dict")
-                entity = {}
-
-        # Если entity всё ещё не dict - используем пустой
-        if not isinstance(entity, dict):
-            logger.warning(f"Entity не является dict: {type(entity)}")
-            entity = {}
-        # =======================================
-
-        entity_type = entity.get('type') or event_data.get('entityType')
-        entity_id = entity.get('id') or event_data.get('entityId')
-        entity_fqn = entity.get('fullyQualifiedName') or event_data.get('entityFQN') or event_data.get('entityUrn')
-        entity_name = entity.get('name') or event_data.get('entityName')
-
-
-        # ===== ИСПРАВЛЕНИЕ: Парсинг changeDescription =====
-        change_desc = event_data.get('changeDescription', {})
-
-        # Если changeDescription пришёл как JSON-строка - распарсить
-        if isinstance(change_desc, str):
-            try:
-                import json
-                change_desc = json.loads(change_desc)
-                logger.info(f"ChangeDescription распарсен из строки")
-            except:
-                logger.warning(f"Не удалось распарсить changeDescription как JSON")
-                change_desc = {}
-
-        # Если не dict - используем пустой
-        if not isinstance(change_desc, dict):
-            change_desc = {}
-        # ==================================================
-
-        updated_by = event_data.get('updatedBy') or event_data.get('userName')
-        previous_version = event_data.get('previousVersion')
-        current_version = event_data.get('currentVersion')
-
-        # Логируем что получили для отладки
-        logger.info(f"Обработка события: type={event_type}, entity_type={entity_type}, fqn={entity_fqn}, name={entity_name}")
-
-        # Сохраняем основное событие
+
+def log_event_details(event: ChangeEvent):
+    """Payload события в лог: при DEBUG для webhook_listener.payload - каждый, иначе выборочно"""
+    if not payload_logger.isEnabledFor(logging.INFO):
+        return
+    if not (payload_logger.isEnabledFor(logging.DEBUG) or sample_payload(event.entity_fqn)):
+        return
+    payload_logger.info("Payload события %s", event.event_id, extra={
+        'event_id': event.event_id,
+        'event_type': event.event_type,
+        'entity_fqn': event.entity_fqn,
+        'entity_from_event': event.entity_from_event,
+        'payload': event.payload,
+    })
+
+
+# Первая половина ключа advisory lock на event_id событий без времени (ср. entity_order)
+CLOCK_TIME_LOCK_CLASS = 0x4F4D4532
+
+
+def resolve_clock_times(cursor, events: List[ChangeEvent],
+                        assigned: Optional[Dict[str, str]] = None) -> int:
+    """
+    Событиям с id, время которых назначили часы сервера (ни timestamp, ни entity.updatedAt),
+    даёт время уже записанной копии того же event_id: повторная доставка получает прежний ключ
+    (event_id, event_time) и отсекается ON CONFLICT. Копии без записанной - время первой из них
+    (assigned - уже назначенные в этой транзакции). Блокировки event_id держатся до конца
+    транзакции: параллельные доставки одного события записываются по очереди.
+    Возвращает число событий, время которых заменено
+    """
+    clocked = [event for event in events if event.event_time_from_clock and event.event_id is not None]
+    if not clocked:
+        return 0
+    assigned = {} if assigned is None else assigned
+    event_ids = sorted({str(event.event_id) for event in clocked} - assigned.keys())
+    if event_ids:
+        # Ключи - по возрастанию: транзакции с общими event_id не ждут друг друга по кругу
         cursor.execute("""
+            SELECT pg_advisory_xact_lock(%s, key)
+            FROM (SELECT DISTINCT hashtext(event_id) AS key FROM unnest(%s::text[]) AS event_id
+                  ORDER BY key) AS keys
+        """, (CLOCK_TIME_LOCK_CLASS, event_ids))
+        cursor.execute("SELECT event_id, min(event_time) FROM metadata_change_events "
+                       "WHERE event_id = ANY(%s) GROUP BY event_id", (event_ids,))
+        assigned.update((event_id, event_time.isoformat()) for event_id, event_time in cursor.fetchall())
+    replaced = 0
+    for event in clocked:
+        event_time = assigned.setdefault(str(event.event_id), event.event_time)
+        if event_time != event.event_time:
+            event.event_time = event_time
+            event.field_changes = [row._replace(event_time=event_time) for row in event.field_changes]
+            replaced += 1
+    return replaced
+
+
+def _lock_order(event: ChangeEvent) -> tuple:
+    # События сущности - по версиям: их id в истории и в /events/stream идут по порядку версий
+    return str(event.entity_id or ''), event.version_key(), event.event_id or ''
+
+
+def write_events(cursor, events: List[ChangeEvent]) -> List[ChangeEvent]:
+    """
+    Записывает разобранные события (одно или пачку) в рамках текущей транзакции.
+    Строки каждой таблицы пишутся в порядке ключа, а таблицы - всегда в одном порядке:
+    параллельные пачки с общими событиями и сущностями ждут друг друга без взаимоблокировок.
+    С INGEST_ENTITY_ORDER транзакции с общими сущностями выполняются целиком по очереди (entity_order).
+    Возвращает новые события (остальные уже были в БД)
+    """
+    if not events:
+        return []
+
+    if DB_WRITE_TIMEOUT_MS:
+        # Зависшая запись прерывается, и событие уходит в spool, а не держит запрос
+        cursor.execute("SET LOCAL statement_timeout = %s", (DB_WRITE_TIMEOUT_MS,))
+
+    if INGEST_ENTITY_ORDER:
+        # До первой записи: транзакция с той же сущностью в другом воркере завершится раньше
+        with metrics.stage('entity_locks'):
+            lock_entities(cursor, events)
+            metrics.count_late(count_late(cursor, events))
+    # Повтор события без времени получает время уже записанной копии
+    resolve_clock_times(cursor, events)
+
+    # Сохраняем основные события (entity - отдельно в payload_blobs, если так настроено)
+    with metrics.stage('payload_prepare'):
+        blobs = prepare_blobs(events)
+    event_rows = [(
+        event.event_id, event.event_type, stored_event_time(event.event_time), event.entity_type,
+        event.entity_id, event.entity_fqn, event.entity_name, json_text(event.change_description), event.updated_by,
+        event.previous_version, event.current_version, Json(stored_payload(event)), event.entity_hash
+    ) for event in sorted(events, key=_lock_order)]
+    with metrics.stage('insert_events'):
+        inserted = execute_values(cursor, """
             INSERT INTO metadata_change_events
             (event_id, event_type, event_time, entity_type, entity_id, entity_fqn,
              entity_name, change_description, updated_by, previous_version,
-             current_version, full_payload)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (event_id) DO NOTHING
-        """, (
-            event_id, event_type, timestamp, entity_type, entity_id, entity_fqn,
-            entity_name, str(change_desc), updated_by, previous_version,
-            current_version, Json(event_data)
-        ))
-
-        # Сохраняем детали изменений полей
-        fields_added = change_desc.get('fieldsAdded', []) if isinstance(change_desc, dict) else []
-        fields_updated = change_desc.get('fieldsUpdated', []) if isinstance(change_desc, dict) else []
-        fields_deleted = change_desc.get('fieldsDeleted', []) if isinstance(change_desc, dict) else []
-
-        for field in fields_added:
-            if isinstance(field, dict):
-                cursor.execute("""
-                    INSERT INTO field_changes (event_id, field_name, new_value, change_type)
-                    VALUES (%s, %s, %s, %s)
-                """, (event_id, field.get('name'), str(field.get('newValue')), 'added'))
-
-        for field in fields_updated:
-            if isinstance(field, dict):
-                cursor.execute("""
-                    INSERT INTO field_changes (event_id, field_name, old_value, new_value, change_type)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (event_id, field.get('name'), str(field.get('oldValue')),
-                      str(field.get('newValue')), 'updated'))
-
-        for field in fields_deleted:
-            if isinstance(field, dict):
-                cursor.execute("""
-                    INSERT INTO field_changes (event_id, field_name, old_value, change_type)
-                    VALUES (%s, %s, %s, %s)
-                """, (event_id, field.get('name'), str(field.get('oldValue')), 'deleted'))
-
-        # Если это событие удаления - сохраняем в таблицу удалённых
-        if event_type == 'entityDeleted':
-            cursor.execute("""
+             current_version, full_payload, entity_hash)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING event_id, event_time
+        """, event_rows, page_size=len(event_rows), fetch=True)
+
+    # Если есть события удаления - сохраняем в таблицу удалённых.
+    # В одном INSERT ... ON CONFLICT DO UPDATE сущность может встречаться только раз,
+    # поэтому оставляем последнее удаление каждой сущности
+    deleted = {}
+    for event in sorted(events, key=ChangeEvent.version_key):
+        if event.is_deletion:
+            deleted[event.entity_id] = (
+                event.entity_id, event.entity_type, event.entity_fqn, event.entity_name,
+                event.event_time, event.updated_by, Json(event.entity)
+            )
+    if deleted:
+        with metrics.stage('deleted_entities'):
+            execute_values(cursor, """
                 INSERT INTO deleted_entities
                 (entity_id, entity_type, entity_fqn, entity_name, deleted_at,
                  deleted_by, last_snapshot)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                VALUES %s
                 ON CONFLICT (entity_id) DO UPDATE SET
                     deleted_at = EXCLUDED.deleted_at,
                     deleted_by = EXCLUDED.deleted_by
-            """, (
-                entity_id, entity_type, entity_fqn, entity_name, timestamp,
-                updated_by, Json(entity if isinstance(entity, dict) else {})
-            ))
+                -- Удаление, пришедшее после более позднего, не откатывает deleted_at
+                WHERE EXCLUDED.deleted_at >= deleted_entities.deleted_at
+            """, [deleted[entity_id] for entity_id in sorted(deleted)], page_size=len(deleted))
+
+    # Изменения полей, blob'ы и текущее состояние сущностей - только по новым событиям,
+    # чтобы повтор не дублировал строки field_changes и не увеличил счётчики.
+    # Blob'ы - до состояния: оно служит базой для patch'ей
+    # Новая строка сверяется по ключу дедупликации (event_id, event_time): копии одного event_id
+    # с разным временем - разные события. Время - то же нормализованное, что ушло в INSERT
+    inserted_keys = Counter((row[0], row[1]) for row in inserted)
+    new_events = []
+    for event in events:
+        key = (event.event_id, stored_event_time(event.event_time))
+        if inserted_keys[key] > 0:
+            new_events.append(event)
+            if event.event_id is not None:
+                inserted_keys[key] -= 1
+    metrics.count_written(len(events), len(new_events))
+    with metrics.stage('insert_field_changes'):
+        insert_field_changes(cursor, [row for event in new_events for row in event.field_changes])
+    with metrics.stage('payload_blobs'):
+        store_blobs(cursor, new_events, blobs)
+    with metrics.stage('entity_state'):
+        counts = upsert_entity_state(cursor, new_events)
+    with metrics.stage('snapshots'):
+        write_snapshots(cursor, new_events, counts)
+    with metrics.stage('rollups'):
+        update_rollups(cursor, new_events)
+    if new_events and STREAM_NOTIFY:
+        # Доставляется подписчикам /events/stream после commit (и только при commit)
+        with metrics.stage('notify'):
+            cursor.execute(NOTIFY_SQL, (STREAM_CHANNEL,))
+    return new_events
+
 
+@contextmanager
+def _write_connection():
+    """Подключение для записи событий; ожидание подключения из пула - этап db_connect"""
+    started = time.perf_counter()
+    with db_connection() as conn:
+        metrics.observe_stage('db_connect', time.perf_counter() - started)
+        yield conn
+
+
+def _commit(conn, events: List[ChangeEvent]):
+    """Commit записи events; после него события попадают в кэш повторов"""
+    with metrics.stage('commit'):
         conn.commit()
-        cursor.close()
-        conn.close()
+    cache = get_dedupe_cache()
+    if cache.enabled:
+        cache.remember(event_key(event.payload) for event in events)
+
+
+def known_duplicate(event_data: Dict[str, Any]) -> bool:
+    """Событие уже записано (есть в кэше повторов) - в БД его можно не передавать"""
+    cache = get_dedupe_cache()
+    if not cache.enabled:
+        return False
+    with metrics.stage('dedupe'):
+        key = event_key(event_data)
+        if key is None:
+            return False
+        found = cache.seen(key)
+    metrics.count_dedupe(found)
+    return found is not None
+
+
+def _parse_events(events: List[Dict[str, Any]]) -> List[ChangeEvent]:
+    with metrics.stage('normalize'):
+        parsed = [parse_event(event_data) for event_data in events]
+    for event in parsed:
+        metrics.FIELD_CHANGES.observe(len(event.field_changes))
+    return parsed
+
+
+def save_change_events(events: List[Dict[str, Any]]):
+    """Сохраняет пачку событий в одной транзакции (при ошибке бросает исключение)"""
+    parsed = _parse_events(events)
+
+    try:
+        with _write_connection() as conn:
+            cursor = conn.cursor()
+            write_events(cursor, parsed)
+            _commit(conn, parsed)
+            cursor.close()
+    except TRANSIENT_ERRORS as e:
+        metrics.count_db_error(e, transient=True)
+        raise
+    except psycopg2.Error as e:
+        metrics.count_db_error(e, transient=False)
+        raise
+
+
+def save_change_event(event_data: Dict[str, Any]) -> bool:
+    """Сохраняет событие изменения в БД"""
+    try:
+        event, = _parse_events([event_data])
+        log_event_details(event)
+
+        with _write_connection() as conn:
+            cursor = conn.cursor()
+            write_events(cursor, [event])
+            _commit(conn, [event])
+            cursor.close()
 
-        logger.info(f"✓ Событие {event_id} ({event_type}) сохранено для {entity_fqn}")
+        events_logger.info("✓ Событие %s (%s) сохранено для %s", event.event_id, event.event_type,
+                           event.entity_fqn, extra={'event_id': event.event_id})
+        return True
+
+    except TRANSIENT_ERRORS as e:
+        metrics.count_db_error(e, transient=True)
+        if not SPOOL_DIR:
+            logger.error("✗ Ошибка сохранения события: %s", e)
+            return False
+        # БД недоступна или тормозит - откладываем событие в spool, replayer допишет его позже
+        try:
+            get_spool().append(event_data)
+        except Exception as spool_error:
+            logger.error("✗ Ошибка сохранения события: %s; spool: %s", e, spool_error)
+            return False
+        logger.warning("БД недоступна (%s), событие %s записано в spool", e,
+                       event_data.get('id', event_data.get('eventId')))
         return True
 
     except Exception as e:
-        logger.error(f"✗ Ошибка сохранения события: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+        if isinstance(e, psycopg2.Error):
+            metrics.count_db_error(e, transient=False)
+        logger.exception("✗ Ошибка сохранения события: %s", e)
         return False
 
 
+
+def _write_one(event: ChangeEvent) -> bool:
+    """Событие в отдельной транзакции; True - новое, False - уже было в БД"""
+    with _write_connection() as conn:
+        cursor = conn.cursor()
+        new_events = write_events(cursor, [event])
+        _commit(conn, [event])
+        cursor.close()
+    return bool(new_events)
+
+
+def ingest_batch(items: List[tuple]) -> Tuple[Dict[str, Any], int]:
+    """
+    Тело и HTTP-статус ответа /webhook/batch; items - (событие, ошибка) из parse_batch_body.
+    События проверяются и нормализуются вместе и пишутся одной транзакцией (multi-row INSERT'ы
+    write_events). Результат каждого: accepted - записано, duplicate - уже было в БД (в том числе
+    по кэшу повторов) или раньше в этой же пачке, rejected - с текстом ошибки. Если пачку
+    не удалось записать из-за конкретного события, остальные пишутся по одному
+    """
+    results = [{'index': index, 'event_id': None, 'status': 'rejected'} for index in range(len(items))]
+    valid = []
+    with metrics.stage('validate'):
+        for result, (event_data, error) in zip(results, items):
+            if error is None:
+                error = validate_event(event_data)
+            if error is not None:
+                result['error'] = error
+                continue
+            result['event_id'] = event_data.get('id', event_data.get('eventId'))
+            valid.append((result, event_data))
+
+    pending = []
+    seen = set()
+    for result, event_data in valid:
+        if known_duplicate(event_data):
+            # Записано раньше (по кэшу повторов) - в транзакцию пачки не попадает
+            result['status'] = 'duplicate'
+    with metrics.stage('normalize'):
+        for result, event_data in valid:
+            if result['status'] == 'duplicate':
+                continue
+            try:
+                event = parse_event(event_data)
+            except Exception as e:
+                result['error'] = f'Invalid event: {e}'
+                continue
+            # Повтор внутри пачки отсекается так же, как в БД - по (event_id, event_time)
+            key = (event.event_id, stored_event_time(event.event_time))
+            if event.event_id is not None and key in seen:
+                result['status'] = 'duplicate'
+                continue
+            seen.add(key)
+            pending.append((result, event))
+    for _, event in pending:
+        metrics.FIELD_CHANGES.observe(len(event.field_changes))
+        log_event_details(event)
+
+    spooled = False
+    try:
+        if pending:
+            try:
+                with _write_connection() as conn:
+                    cursor = conn.cursor()
+                    new_events = {id(event) for event in write_events(cursor, [e for _, e in pending])}
+                    _commit(conn, [e for _, e in pending])
+                    cursor.close()
+                for result, event in pending:
+                    result['status'] = 'accepted' if id(event) in new_events else 'duplicate'
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                if isinstance(e, psycopg2.Error):
+                    metrics.count_db_error(e, transient=False)
+                logger.error("Ошибка записи пачки из %s событий: %s; пишем по одному", len(pending), e)
+                for result, event in pending:
+                    try:
+                        result['status'] = 'accepted' if _write_one(event) else 'duplicate'
+                    except TRANSIENT_ERRORS:
+                        raise
+                    except Exception as event_error:
+                        if isinstance(event_error, psycopg2.Error):
+                            metrics.count_db_error(event_error, transient=False)
+                        result['error'] = str(event_error).splitlines()[0]
+    except TRANSIENT_ERRORS as e:
+        metrics.count_db_error(e, transient=True)
+        if not SPOOL_DIR:
+            logger.error("✗ Ошибка сохранения пачки из %s событий: %s", len(pending), e)
+            return {'status': 'error', 'message': 'Database unavailable, retry later'}, 503
+        # Отклонённые при записи по одному остаются отклонёнными; уже записанные
+        # при переносе spool окажутся повторами
+        spool_events = [(result, event) for result, event in pending if 'error' not in result]
+        _spill_to_spool([event.payload for _, event in spool_events])
+        logger.warning("БД недоступна (%s), пачка из %s событий записана в spool", e, len(spool_events))
+        spooled = True
+        for result, _ in spool_events:
+            result['status'] = 'accepted'
+
+    counts = {status: 0 for status in ('accepted', 'duplicate', 'rejected')}
+    for result in results:
+        counts[result['status']] += 1
+    metrics.count_batch_events(counts)
+    events_logger.info("✓ Пачка из %s событий: записано %s, повторов %s, отклонено %s",
+                       len(results), counts['accepted'], counts['duplicate'], counts['rejected'])
+
+    body = {
+        'status': 'success' if not counts['rejected'] else 'partial',
+        **counts,
+        'results': results,
+    }
+    if spooled:
+        body['spooled'] = True
+    if counts['rejected'] == len(results):
+        body['status'] = 'error'
+        return body, 400
+    return body, 200
+
+
+def receive_batch(data: bytes) -> Tuple[Dict[str, Any], int]:
+    """Тело и HTTP-статус ответа /webhook/batch по телу запроса (JSON-массив или NDJSON)"""
+    with metrics.stage('json_parse'):
+        try:
+            items = parse_batch_body(data)
+        except ValueError as e:
+            return {'error': f'Invalid JSON: {e}'}, 400
+    if not items:
+        return {'error': 'Empty payload'}, 400
+    if len(items) > WEBHOOK_BATCH_MAX_EVENTS:
+        return {'error': f'Too many events: {len(items)}, max {WEBHOOK_BATCH_MAX_EVENTS}'}, 413
+    metrics.BATCH_SIZE.observe(len(items))
+    return ingest_batch(items)
+
+_ingest_queue = None
+_ingest_queue_pid = None
+_ingest_queue_lock = threading.Lock()
+_spool = None
+_spool_replayer = None
+_spool_pid = None
+_spool_lock = threading.Lock()
+_partition_maintainer = None
+_partition_maintainer_pid = None
+_partition_maintainer_lock = threading.Lock()
+_reconstructor = None
+_reconstructor_pid = None
+_reconstructor_lock = threading.Lock()
+_change_feed = None
+_change_feed_pid = None
+_change_feed_lock = threading.Lock()
+_dedupe_cache = None
+_dedupe_cache_pid = None
+_dedupe_cache_lock = threading.Lock()
+_archive = None
+_archive_pid = None
+_archive_lock = threading.Lock()
+_gap_detector = None
+_gap_detector_pid = None
+_gap_detector_lock = threading.Lock()
+_schema_migrator = None
+_schema_migrator_pid = None
+_schema_migrator_lock = threading.Lock()
+
+
+def _probe_database():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+
+
+def get_spool() -> Spool:
+    """Spool текущего процесса; вместе с ним запускается фоновый перенос spool в БД"""
+    global _spool, _spool_replayer, _spool_pid
+    pid = os.getpid()
+    if _spool is None or _spool_pid != pid:
+        with _spool_lock:
+            if _spool is None or _spool_pid != pid:
+                _spool = Spool(
+                    SPOOL_DIR,
+                    segment_max_bytes=SPOOL_SEGMENT_MAX_BYTES,
+                    fsync_interval=SPOOL_FSYNC_INTERVAL_MS / 1000
+                )
+                _spool_replayer = SpoolReplayer(
+                    SPOOL_DIR, save_change_events,
+                    batch_size=SPOOL_REPLAY_BATCH_SIZE,
+                    spool=_spool,
+                    probe=_probe_database
+                )
+                _spool_replayer.start(SPOOL_REPLAY_INTERVAL)
+                _spool_pid = pid
+                atexit.register(_spool.close)
+                atexit.register(_spool_replayer.stop)
+    return _spool
+
+
+def _spill_to_spool(events: List[Dict[str, Any]]):
+    spool = get_spool()
+    for event_data in events:
+        spool.append(event_data, wait_sync=False)
+    # Один общий fsync на всю пачку
+    spool.rotate()
+
+
+def get_ingest_queue() -> IngestQueue:
+    """Очередь приёма текущего процесса (создаётся и запускается при первом обращении)"""
+    global _ingest_queue, _ingest_queue_pid
+    pid = os.getpid()
+    if _ingest_queue is None or _ingest_queue_pid != pid:
+        with _ingest_queue_lock:
+            if _ingest_queue is None or _ingest_queue_pid != pid:
+                _ingest_queue = IngestQueue(
+                    save_change_events,
+                    maxsize=INGEST_QUEUE_MAX_SIZE,
+                    batch_size=INGEST_BATCH_SIZE,
+                    flush_interval=INGEST_FLUSH_INTERVAL_MS / 1000,
+                    journal_dir=INGEST_QUEUE_DIR or None,
+                    journal_fsync=INGEST_QUEUE_FSYNC,
+                    journal_segment_max_bytes=INGEST_QUEUE_SEGMENT_MAX_BYTES,
+                    spill=_spill_to_spool if SPOOL_DIR else None
+                )
+                _ingest_queue.start()
+                _ingest_queue_pid = pid
+                # gunicorn завершает воркер через sys.exit - atexit успевает дописать очередь
+                atexit.register(_ingest_queue.stop, INGEST_DRAIN_TIMEOUT)
+    return _ingest_queue
+
+
+def get_partition_maintainer() -> PartitionMaintainer:
+    """Поток обслуживания партиций текущего процесса (создание будущих, удаление устаревших)"""
+    global _partition_maintainer, _partition_maintainer_pid
+    pid = os.getpid()
+    if _partition_maintainer is None or _partition_maintainer_pid != pid:
+        with _partition_maintainer_lock:
+            if _partition_maintainer is None or _partition_maintainer_pid != pid:
+                _partition_maintainer = PartitionMaintainer(db_connection, PARTITION_MAINTENANCE_INTERVAL)
+                _partition_maintainer.start()
+                _partition_maintainer_pid = pid
+                atexit.register(_partition_maintainer.stop)
+    return _partition_maintainer
+
+
+def get_gap_detector() -> GapDetector:
+    """Поток проверки пропусков версий текущего процесса (и дозаполнения, если задан OPENMETADATA_URL)"""
+    global _gap_detector, _gap_detector_pid
+    pid = os.getpid()
+    if _gap_detector is None or _gap_detector_pid != pid:
+        with _gap_detector_lock:
+            if _gap_detector is None or _gap_detector_pid != pid:
+                client = OpenMetadataClient() if version_gaps.VERSION_GAP_BACKFILL and version_gaps.OPENMETADATA_URL \
+                    else None
+                _gap_detector = GapDetector(db_connection, write_events, VERSION_GAP_SCAN_INTERVAL,
+                                            client=client, archive=get_archive())
+                _gap_detector.start()
+                _gap_detector_pid = pid
+                atexit.register(_gap_detector.stop)
+    return _gap_detector
+
+
+def get_schema_migrator() -> SchemaMigrator:
+    """Поток online-миграций текущего процесса (индексы CONCURRENTLY; выполняет один процесс)"""
+    global _schema_migrator, _schema_migrator_pid
+    pid = os.getpid()
+    if _schema_migrator is None or _schema_migrator_pid != pid:
+        with _schema_migrator_lock:
+            if _schema_migrator is None or _schema_migrator_pid != pid:
+                _schema_migrator = SchemaMigrator(lambda: psycopg2.connect(**DB_CONFIG))
+                _schema_migrator.start()
+                _schema_migrator_pid = pid
+                atexit.register(_schema_migrator.stop)
+    return _schema_migrator
+
+
+def get_reconstructor() -> Reconstructor:
+    """Восстановление сущностей на дату с кэшем версий текущего процесса"""
+    global _reconstructor, _reconstructor_pid
+    pid = os.getpid()
+    if _reconstructor is None or _reconstructor_pid != pid:
+        with _reconstructor_lock:
+            if _reconstructor is None or _reconstructor_pid != pid:
+                _reconstructor = Reconstructor(db_connection, cache_size=RECONSTRUCT_CACHE_SIZE,
+                                               archive=get_archive())
+                _reconstructor_pid = pid
+    return _reconstructor
+
+
+def get_archive() -> Optional[ArchiveReader]:
+    """Чтение архива старой истории (None, если ARCHIVE_DIR не задан)"""
+    global _archive, _archive_pid
+    if not ARCHIVE_DIR:
+        return None
+    pid = os.getpid()
+    if _archive is None or _archive_pid != pid:
+        with _archive_lock:
+            if _archive is None or _archive_pid != pid:
+                _archive = ArchiveReader(ARCHIVE_DIR)
+                _archive_pid = pid
+    return _archive
+
+
+def get_change_feed() -> ChangeFeed:
+    """Лента новых событий для подписчиков /events/stream и /events/poll текущего процесса"""
+    global _change_feed, _change_feed_pid
+    pid = os.getpid()
+    if _change_feed is None or _change_feed_pid != pid:
+        with _change_feed_lock:
+            if _change_feed is None or _change_feed_pid != pid:
+                # Отдельное подключение не из пула: LISTEN держит его всё время работы
+                _change_feed = ChangeFeed(lambda: psycopg2.connect(**DB_CONFIG))
+                _change_feed.start()
+                _change_feed_pid = pid
+                atexit.register(_change_feed.stop)
+    return _change_feed
+
+
+def get_dedupe_cache() -> DedupeCache:
+    """Кэш недавно записанных событий текущего процесса (с общей таблицей воркеров, если задана)"""
+    global _dedupe_cache, _dedupe_cache_pid
+    pid = os.getpid()
+    if _dedupe_cache is None or _dedupe_cache_pid != pid:
+        with _dedupe_cache_lock:
+            if _dedupe_cache is None or _dedupe_cache_pid != pid:
+                shared = SharedKeySet(DEDUPE_SHARED_FILE) if DEDUPE_SHARED_FILE else None
+                _dedupe_cache = DedupeCache(DEDUPE_CACHE_SIZE, shared)
+                _dedupe_cache_pid = pid
+    return _dedupe_cache
+
+
+@app.before_request
+def _start_background_tasks():
+    # Под gunicorn __main__ не выполняется - запускаем при первом запросе воркера
+    get_schema_migrator()
+    if PARTITION_MAINTENANCE_INTERVAL > 0:
+        get_partition_maintainer()
+    if VERSION_GAP_SCAN_INTERVAL > 0:
+        get_gap_detector()
+
+
+def validate_event(event_data: Any) -> Optional[str]:
+    """Проверяет, что событие можно сохранить; возвращает текст ошибки или None"""
+    if not isinstance(event_data, dict):
+        return 'Event must be a JSON object'
+    if not event_data.get('eventType'):
+        return 'Missing eventType'
+    return None
+
+
+def _runtime_stats() -> Dict[str, Any]:
+    stats = {'pool': get_pool().stats()}
+    if INGEST_MODE == 'async':
+        stats['queue'] = get_ingest_queue().stats()
+    if SPOOL_DIR:
+        stats['spool'] = {**get_spool().stats(), **_spool_replayer.stats()}
+    if PARTITION_MAINTENANCE_INTERVAL > 0:
+        stats['partitions'] = get_partition_maintainer().stats()
+    if VERSION_GAP_SCAN_INTERVAL > 0:
+        stats['version_gaps'] = get_gap_detector().stats()
+    stats['migrations'] = get_schema_migrator().stats()
+    stats['reconstruct'] = get_reconstructor().stats()
+    if get_dedupe_cache().enabled:
+        stats['dedupe'] = get_dedupe_cache().stats()
+    if get_archive() is not None:
+        stats['archive'] = get_archive().stats()
+    if _change_feed is not None and _change_feed_pid == os.getpid():
+        stats['stream'] = _change_feed.stats()
+    return stats
+
+
+def health_status():
+    """Тело и HTTP-статус ответа /health"""
+    try:
+        _probe_database()
+        return {
+            'status': 'healthy',
+            'database': 'connected',
+            **_runtime_stats()
+        }, 200
+    except Exception as e:
+        return {
+            'status': 'unhealthy',
+            'error': str(e),
+            **_runtime_stats()
+        }, 503
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверка работоспособности сервиса"""
-    try:
-        conn = get_db_connection()
-        conn.close()
-        return jsonify({'status': 'healthy', 'database': 'connected'}), 200
-    except Exception as e:
-        return jsonify({'status': 'unhealthy', 'error': str(e)}), 503
+    body, status = health_status()
+    return jsonify(body), status
 
 
 @app.route('/webhook', methods=['POST'])
@@ -317,20 +772,68 @@ def webhook_receiver():
     """
     Основной endpoint для приёма webhook'ов от OpenMetadata
     """
+    started = time.perf_counter()
+    g.event_type = None
+    response = app.make_response(_receive_webhook())
+    metrics.count_request(response.status_code, g.event_type)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
+    return response
+
+
+def _receive_webhook():
     try:
         # Проверка секретного ключа (если настроено в OM)
-        auth_header = request.headers.get('Authorization')
-        if WEBHOOK_SECRET and auth_header != f"Bearer {WEBHOOK_SECRET}":
+        with metrics.stage('auth'):
+            auth_header = request.headers.get('Authorization')
+            authorized = not WEBHOOK_SECRET or auth_header == f"Bearer {WEBHOOK_SECRET}"
+        if not authorized:
             logger.warning("Неверный секретный ключ webhook")
             return jsonify({'error': 'Unauthorized'}), 401
         
         # Получаем данные события
-        event_data = request.json
+        if request.content_length is not None:
+            metrics.PAYLOAD_BYTES.observe(request.content_length)
+        with metrics.stage('json_parse'):
+            event_data = request.json
         
         if not event_data:
             return jsonify({'error': 'Empty payload'}), 400
+
+        with metrics.stage('validate'):
+            error = validate_event(event_data)
+        if error:
+            return jsonify({'error': error}), 400
+        g.event_type = event_data.get('eventType')
         
-        logger.info(f"Получено событие: {event_data.get('eventType')} для {event_data.get('entityType')}")
+        events_logger.info("Получено событие: %s для %s", event_data.get('eventType'),
+                           event_data.get('entityType'))
+
+        if known_duplicate(event_data):
+            # Повторная доставка уже записанного события - без обращения к БД
+            return jsonify({
+                'status': 'success',
+                'message': 'Duplicate event, already saved'
+            }), 200
+
+        if INGEST_MODE == 'async':
+            # Ставим в очередь и сразу отвечаем - запись в БД сделает фоновый поток
+            try:
+                get_ingest_queue().put(event_data)
+            except QueueFull:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Ingest queue is full, retry later'
+                }), 429, {'Retry-After': '1'}
+            except QueueClosed:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Service is shutting down'
+                }), 503, {'Retry-After': '5'}
+
+            return jsonify({
+                'status': 'accepted',
+                'message': 'Event queued'
+            }), 202
         
         # Сохраняем событие в БД
         success = save_change_event(event_data)
@@ -351,49 +854,481 @@ def webhook_receiver():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/events', methods=['GET'])
-def get_events():
-    """API для получения сохранённых событий (для отладки)"""
+@app.route('/webhook/batch', methods=['POST'])
+def webhook_batch_receiver():
+    """
+    Пачка событий в одном запросе: JSON-массив или NDJSON (событие на строку).
+    Пачка пишется одной транзакцией до ответа (в том числе при INGEST_MODE=async);
+    в ответе - accepted/duplicate/rejected для каждого события по его индексу в пачке
+    """
+    started = time.perf_counter()
+    response = app.make_response(_receive_batch_request())
+    metrics.BATCH_REQUESTS.labels(str(response.status_code)).inc()
+    metrics.BATCH_REQUEST_SECONDS.observe(time.perf_counter() - started)
+    return response
+
+
+def _receive_batch_request():
     try:
-        entity_fqn = request.args.get('entity_fqn')
-        event_type = request.args.get('event_type')
-        limit = int(request.args.get('limit', 100))
-        
-        conn = get_db_connection()
+        with metrics.stage('auth'):
+            auth_header = request.headers.get('Authorization')
+            authorized = not WEBHOOK_SECRET or auth_header == f"Bearer {WEBHOOK_SECRET}"
+        if not authorized:
+            logger.warning("Неверный секретный ключ webhook")
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        body, status = receive_batch(request.get_data())
+        return jsonify(body), status
+    except Exception as e:
+        logger.error(f"Ошибка обработки пачки событий: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в формате Prometheus (под gunicorn - суммарно по всем воркерам)"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def fetch_events_page(args) -> Dict[str, Any]:
+    """Страница /events по параметрам запроса (некорректные параметры - InvalidQuery)"""
+    limit = parse_limit(args.get('limit'))
+    # +1 строка, чтобы понять, есть ли следующая страница
+    query, params, columns = build_events_query(args, limit + 1)
+
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
-        query = "SELECT * FROM metadata_change_events WHERE 1=1"
-        params = []
-        
-        if entity_fqn:
-            query += " AND entity_fqn = %s"
-            params.append(entity_fqn)
-        
-        if event_type:
-            query += " AND event_type = %s"
-            params.append(event_type)
-        
-        query += " ORDER BY event_time DESC LIMIT %s"
-        params.append(limit)
-        
         cursor.execute(query, params)
-        
-        columns = [desc[0] for desc in cursor.description]
         results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        
+        archive = get_archive()
+        if archive is not None:
+            # Страница может продолжаться в архиве: события из БД и архива сливаются по (event_time, id)
+            results = archive.merge_events(results, args, limit + 1)
+
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(results[-1]['event_time'], results[-1]['id'])
+
+        if 'entity_hash' in columns:
+            restore_payloads(cursor, results)
         cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'count': len(results),
-            'events': results
-        }), 200
-        
+
+    return {
+        'count': len(results),
+        'events': results,
+        'next_cursor': next_cursor
+    }
+
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """
+    API для получения сохранённых событий (от новых к старым, постранично).
+    Следующая страница - по next_cursor из ответа: /events?cursor=...
+    """
+    try:
+        return jsonify(fetch_events_page(request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения событий: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def export_lines(args) -> Iterator[str]:
+    """
+    Строки NDJSON выгрузки /events/export. Параметры проверяются сразу (InvalidQuery),
+    события читаются при переборе: серверный курсор и архив помесячно
+    """
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError as e:
+        raise InvalidQuery(f"limit: {e}")
+    query, params, columns = build_events_query(args, limit)
+    return _export_lines(args, limit, query, params, columns)
+
+
+def _export_lines(args, limit: Optional[int], query: str, params, columns) -> Iterator[str]:
+    exported = 0
+    try:
+        with db_connection() as conn:
+            # Именованный курсор - строки читаются с сервера порциями по EXPORT_FETCH_SIZE
+            cursor = conn.cursor(name='events_export')
+            blobs_cursor = conn.cursor()
+            cursor.execute(query, params)
+
+            def database_rows():
+                while True:
+                    rows = [dict(zip(columns, row)) for row in cursor.fetchmany(EXPORT_FETCH_SIZE)]
+                    if not rows:
+                        break
+                    if 'entity_hash' in columns:
+                        restore_payloads(blobs_cursor, rows)
+                    yield from rows
+
+            rows = database_rows()
+            archive = get_archive()
+            if archive is not None and archive.months():
+                # Архив читается помесячно и сливается с БД по (event_time, id)
+                descending = (args.get('order') or 'desc').lower() == 'desc'
+                rows = heapq.merge(rows, archive.iter_events(args, limit),
+                                   key=lambda row: (row['event_time'], row['id']), reverse=descending)
+                if limit is not None:
+                    rows = itertools.islice(rows, limit)
+            for row in rows:
+                yield app.json.dumps(row) + '\n'
+                exported += 1
+            blobs_cursor.close()
+            cursor.close()
+            conn.rollback()
+    except GeneratorExit:
+        logger.info("Выгрузка событий прервана клиентом после %s событий", exported)
+        raise
+    except Exception as e:
+        # Статус уже отправлен - только логируем, клиент увидит оборванный поток
+        logger.error("Ошибка выгрузки событий после %s событий: %s", exported, e)
+
+
+@app.route('/events/export', methods=['GET'])
+def export_events():
+    """
+    Потоковая выгрузка событий в NDJSON (по событию на строку) через серверный курсор:
+    память воркера не зависит от размера выгрузки. Фильтры - как у /events
+    """
+    try:
+        lines = export_lines(request.args)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+def fetch_stream_changes(subscription: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Следующие события подписки /events/stream, /events/poll и её новая позиция:
+    из буфера ленты процесса, а если он не покрывает позицию подписки - из БД
+    """
+    result = get_change_feed().read(subscription)
+    if result is not None:
+        return result
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        events, position = fetch_changes(cursor, subscription)
+        if 'entity_hash' in subscription['columns']:
+            restore_payloads(cursor, events)
+        cursor.close()
+    return events, position
+
+
+@app.route('/events/stream', methods=['GET'])
+def stream_events():
+    """
+    Новые события в формате Server-Sent Events (event: change, id - позиция в потоке).
+    Продолжение после обрыва - с заголовком Last-Event-ID (браузерный EventSource
+    передаёт его сам) или параметром cursor; cursor=0-0 - с начала потока.
+    Подключение закрывается через STREAM_MAX_SECONDS: клиент переподключается
+    """
+    try:
+        subscription = parse_stream_args(request.args, request.headers.get('Last-Event-ID'))
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    feed = get_change_feed()
+
+    def generate():
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        last_output = 0.0
+        delivered = 0
+        feed.attach()
+        try:
+            while True:
+                # Версия - до чтения: события, пришедшие во время чтения, не потеряются
+                version = feed.version
+                events, position = fetch_stream_changes(subscription)
+                for event in events:
+                    yield sse_message(event, app.json.dumps)
+                delivered += len(events)
+                now = time.monotonic()
+                if events:
+                    last_output = now
+                if len(events) == STREAM_FETCH_SIZE:
+                    continue
+                if now - last_output >= STREAM_HEARTBEAT_SEC:
+                    yield sse_position(position)
+                    last_output = now
+                if now >= deadline:
+                    break
+                feed.wait(version, min(STREAM_POLL_INTERVAL, STREAM_HEARTBEAT_SEC - (now - last_output)))
+        except GeneratorExit:
+            logger.info("Подписчик /events/stream отключился после %s событий", delivered)
+            raise
+        except Exception as e:
+            logger.error("Ошибка потока событий после %s событий: %s", delivered, e)
+        finally:
+            feed.detach()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/events/poll', methods=['GET'])
+def poll_events():
+    """
+    Long-poll: события после cursor, а если их нет - ожидание новых до timeout секунд.
+    Следующий запрос - с cursor из ответа (он сдвигается и когда событий нет)
+    """
+    try:
+        subscription = parse_stream_args(request.args)
+        timeout = poll_timeout(request.args.get('timeout'))
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    feed = get_change_feed()
+    feed.attach()
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            version = feed.version
+            events, position = fetch_stream_changes(subscription)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                break
+            feed.wait(version, min(remaining, STREAM_POLL_INTERVAL))
+        return jsonify({'count': len(events), 'events': events, 'cursor': position}), 200
+    except Exception as e:
+        logger.error("Ошибка ожидания событий: %s", e)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        feed.detach()
+
+
+def fetch_stats(args) -> Dict[str, Any]:
+    """Ответ /stats по параметрам запроса (некорректные параметры - InvalidQuery)"""
+    granularity = args.get('granularity', 'day')
+    dimension = args.get('dimension')
+    if granularity not in rollups.GRANULARITIES:
+        raise InvalidQuery(f"granularity: ожидается {' или '.join(rollups.GRANULARITIES)}")
+    if dimension is not None and dimension not in rollups.DIMENSIONS:
+        raise InvalidQuery(f"dimension: ожидается одно из {', '.join(rollups.DIMENSIONS)}")
+    try:
+        since = args.get('since')
+        until = args.get('until')
+        since = datetime.fromisoformat(since) if since else (
+            datetime.now() - (timedelta(days=30) if granularity == 'day' else timedelta(hours=24)))
+        until = datetime.fromisoformat(until) if until else None
+    except ValueError as e:
+        raise InvalidQuery(str(e))
+    limit = parse_limit(args.get('limit', '10'))
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        result = {'granularity': granularity, 'since': since, 'until': until}
+        if dimension is not None:
+            result['dimension'] = dimension
+            result['series'] = rollups.series(cursor, granularity, since, until, dimension, args.get('value'))
+        else:
+            result['series'] = rollups.series(cursor, granularity, since, until)
+            result['total'] = sum(point['count'] for point in result['series'])
+            for name in rollups.EVENT_DIMENSIONS + ('field_name',):
+                result[name] = rollups.top(cursor, granularity, since, until, name, limit)
+            result['peak_hours'] = rollups.peak_hours(cursor, since, until)
+            result['top_entities'] = rollups.top_entities(cursor, limit)
+        cursor.close()
+        conn.rollback()
+    return result
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    Статистика из агрегатов event_rollups (без просмотра событий).
+    granularity=day|hour, since/until (ISO, по умолчанию последние 30 дней / 24 часа), limit - размер топов.
+    С dimension=event_type|entity_type|updated_by|field_name (и value=...) - только ряд по этому разрезу
+    """
+    try:
+        return jsonify(fetch_stats(request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения статистики: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+# Фильтры /stats/fqn: параметр запроса -> колонка события (с ними счёт идёт по событиям)
+FQN_STATS_FILTERS = {name: EQUALITY_FILTERS[name] for name in ('event_type', 'entity_type', 'updated_by')}
+
+
+def fetch_fqn_stats(args) -> Dict[str, Any]:
+    """
+    События поддерева fqn_prefix и его ветвей следующего уровня за период.
+    Из агрегатов, если уровень ветвей не глубже FQN_ROLLUP_DEPTH и нет фильтров, иначе -
+    по индексу fqn_path событий (и архиву)
+    """
+    path = parse_fqn_prefix(args.get('fqn_prefix')) or []
+    depth = len(path) + 1
+    granularity = args.get('granularity', 'day')
+    if granularity not in rollups.GRANULARITIES:
+        raise InvalidQuery(f"granularity: ожидается {' или '.join(rollups.GRANULARITIES)}")
+    since = _parse_time('since', args['since']) if args.get('since') else (
+        datetime.now() - (timedelta(days=30) if granularity == 'day' else timedelta(hours=24)))
+    until = _parse_time('until', args['until']) if args.get('until') else None
+    limit = parse_limit(args.get('limit', '10'))
+    filters = {column: args[name] for name, column in FQN_STATS_FILTERS.items() if args.get(name)}
+
+    result = {'fqn_prefix': fqn.join_fqn(path) if path else None, 'depth': depth, 'since': since, 'until': until}
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if depth <= fqn.FQN_ROLLUP_DEPTH and not filters:
+            result.update(source='rollups', granularity=granularity)
+            result.update(rollups.fqn_children(cursor, granularity, since, until, result['fqn_prefix'],
+                                               depth, limit))
+        else:
+            counts = fqn.subtree_counts(cursor, path, since, until, filters)
+            archive = get_archive()
+            if archive is not None:
+                for entity_fqn, count in archive.fqn_counts(path, since, until, filters).items():
+                    if entity_fqn is not None:
+                        counts[tuple(fqn.split_fqn(entity_fqn)[:depth])] += count
+            children = sorted(((fqn.join_fqn(list(branch)), count) for branch, count in counts.items()
+                               if len(branch) == depth), key=lambda item: (-item[1], item[0]))
+            result.update(source='events', total=sum(counts.values()),
+                          children=[{'fqn': name, 'count': count} for name, count in children[:limit]])
+        cursor.close()
+        conn.rollback()
+    return result
+
+
+@app.route('/stats/fqn', methods=['GET'])
+def get_fqn_stats():
+    """
+    Число событий по поддеревьям FQN: fqn_prefix=svc.db - сама ветка (total) и её ветви
+    следующего уровня (children, по убыванию); без fqn_prefix - сервисы.
+    since/until, granularity, limit - как у /stats; event_type, entity_type, updated_by - фильтры
+    """
+    try:
+        return jsonify(fetch_fqn_stats(request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения статистики по FQN: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def fetch_search_page(args) -> Dict[str, Any]:
+    """Страница /search по параметрам запроса (некорректные параметры - InvalidQuery)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        result = search.search(cursor, args)
+        cursor.close()
+        conn.rollback()
+    return result
+
+
+@app.route('/search', methods=['GET'])
+def search_history():
+    """
+    Поиск по истории изменений (от новых к старым, постранично, как /events).
+    q - текст (имена и значения полей, описания), contains / old_contains - JSON, который должен
+    входить в новое / старое значение поля, field - имя поля (columns.*.tags).
+    scope=entities - поиск по текущему состоянию сущностей (contains - по снимку entity)
+    """
+    try:
+        return jsonify(fetch_search_page(request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Ошибка получения событий: {e}")
+        logger.error("Ошибка поиска: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
+def fetch_gaps(args) -> Dict[str, Any]:
+    """Ответ /gaps по параметрам запроса (некорректные параметры - InvalidQuery)"""
+    status = args.get('status')
+    if status is not None and status not in version_gaps.GAP_STATUSES:
+        raise InvalidQuery(f"status: ожидается одно из {', '.join(version_gaps.GAP_STATUSES)}")
+    limit = parse_limit(args.get('limit', '100'))
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        result = version_gaps.gap_summary(cursor)
+        result['gaps'] = version_gaps.list_gaps(cursor, status=status, entity_id=args.get('entity_id'),
+                                                entity_type=args.get('entity_type'), limit=limit)
+        cursor.close()
+        conn.rollback()
+    return result
+
+
+@app.route('/gaps', methods=['GET'])
+def get_gaps():
+    """
+    Пропуски в цепочках версий сущностей (version_gaps): status=open|filled|backfilled|failed,
+    entity_id, entity_type, limit. Вместе со списком - число пропусков по статусам и позиция проверки
+    """
+    try:
+        return jsonify(fetch_gaps(request.args)), 200
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Ошибка получения пропусков версий: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def fetch_entity(entity_id: Optional[str], args) -> Optional[Dict[str, Any]]:
+    """
+    Состояние сущности для /entities (None - сущности нет). Некорректные параметры - InvalidQuery,
+    версии или момента, на который сущность не восстанавливается, - EntityNotFound
+    """
+    entity_fqn = args.get('fqn')
+    entity_id = entity_id or args.get('entity_id')
+    if not entity_id and not entity_fqn:
+        raise InvalidQuery('Укажите entity_id или fqn')
+    include_snapshot = args.get('include_snapshot', '1') not in ('0', 'false', 'no')
+
+    as_of = args.get('as_of')
+    version = args.get('version')
+    try:
+        as_of = datetime.fromisoformat(as_of) if as_of else None
+        version = Decimal(version) if version else None
+    except (ValueError, InvalidOperation):
+        raise InvalidQuery('as_of: ожидается дата ISO 8601, version: число')
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        state = get_entity_state(cursor, entity_id=entity_id, entity_fqn=entity_fqn,
+                                 include_snapshot=include_snapshot and as_of is None and version is None)
+        cursor.close()
+
+    if state is not None and (as_of is not None or version is not None):
+        state = {
+            'entity_id': state['entity_id'],
+            'entity_fqn': state['entity_fqn'],
+            **get_reconstructor().reconstruct(state['entity_id'], at=as_of, version=version)
+        }
+    return state
+
+
+@app.route('/entities/<path:entity_id>', methods=['GET'])
+@app.route('/entities', methods=['GET'])
+def get_entity(entity_id: Optional[str] = None):
+    """
+    Текущее состояние сущности: /entities/<entity_id> или /entities?fqn=<FQN>.
+    Снимок entity не возвращается с include_snapshot=0.
+    С as_of=<ISO дата> или version=<версия> - сущность, восстановленная на этот момент
+    """
+    try:
+        state = fetch_entity(entity_id, request.args)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except EntityNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        logger.error("Ошибка получения состояния сущности: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+    if state is None:
+        return jsonify({'error': 'Entity not found'}), 404
+    return jsonify(state), 200
+
+
 if __name__ == '__main__':
     # Инициализируем БД при запуске
     try:
@@ -402,6 +1337,15 @@ if __name__ == '__main__':
         logger.error(f"Не удалось инициализировать БД: {e}")
         exit(1)
     
+    if SPOOL_DIR:
+        # Запускаем перенос spool, оставшегося с прошлого запуска
+        get_spool()
+
+    if INGEST_MODE == 'async':
+        get_ingest_queue()
+        # SIGTERM -> sys.exit, чтобы atexit дописал очередь в БД
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # Запускаем Flask-сервер
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)